@@ -0,0 +1,134 @@
+"""
+doc_numbers.py
+Place this in the anchors/ folder.
+Document number allocator for POB (POB / STM / CRN), OFS orders and OPS
+documents, backed by pob_number_sequences.
+
+POB and OFS used to read last_number and write last_number + 1 in a
+second request — two reps submitting together could read the same value
+and get the same number — and fell back to int(time.time()) on any error.
+OPS numbers were OPS-<yyyymmdd>-<hhmmss>, which collide within a second.
+
+    next_number(doc_type)      -> int, never reused
+    ops_doc_no(prefix="OPS")   -> "OPS-20260427-000123"
+
+Each allocation is one call to the next_doc_number() function below: a
+single upsert that increments and returns the counter in one statement,
+so concurrent callers are serialized by Postgres' row lock. It can also
+reserve a block (p_count > 1); doc types listed in _BLOCK lease that many
+numbers per call and hand them out from memory, so a busy process makes
+one round-trip per block instead of one per document. Leased numbers not
+used before a restart are skipped — fine for OPS (gaps were always there
+with timestamp numbers); POB / OFS keep a block of 1 so their visible
+sequences stay gap-free.
+DOC_NUMBER_BLOCK overrides the default block size.
+
+Until the function is created, a compare-and-swap update
+(... where last_number = <value read>) is used instead, retried on
+conflict — slower, but still never hands out a number twice.
+
+    create unique index if not exists pob_number_sequences_doc_type_key
+        on pob_number_sequences (doc_type);
+
+    create or replace function next_doc_number(p_doc_type text, p_count int default 1)
+    returns bigint language sql as $$
+        insert into pob_number_sequences (doc_type, last_number)
+        values (p_doc_type, p_count)
+        on conflict (doc_type) do update
+            set last_number = pob_number_sequences.last_number + excluded.last_number
+        returning last_number;
+    $$;
+
+    -- seed OPS above any existing row count if you like, e.g.
+    -- insert into pob_number_sequences (doc_type, last_number) values ('OPS', 0);
+"""
+
+import os
+import threading
+from datetime import datetime
+
+from anchors.supabase_client import admin_supabase
+
+
+_BLOCK = {"OPS": 20}
+_DEFAULT_BLOCK = max(1, int(os.environ.get("DOC_NUMBER_BLOCK") or 1))
+_CAS_RETRIES = 8
+
+_lock = threading.Lock()
+_leases = {}           # doc_type -> [next unused, last leased]
+_rpc_ok = True         # False once the RPC is found missing; CAS from then on
+
+
+def _block_size(doc_type):
+    return _BLOCK.get(doc_type, _DEFAULT_BLOCK)
+
+
+def _reserve_rpc(doc_type, count):
+    last = admin_supabase.rpc("next_doc_number",
+                              {"p_doc_type": doc_type, "p_count": count}).execute().data
+    if isinstance(last, list):
+        last = last[0] if last else None
+    if isinstance(last, dict):
+        last = next(iter(last.values()), None)
+    if last is None:
+        raise RuntimeError(f"next_doc_number returned nothing for {doc_type}")
+    return int(last)
+
+
+def _reserve_cas(doc_type, count):
+    """Conditional update: only succeeds if nobody moved the counter since
+    we read it. The first use of a doc type creates its row."""
+    table = admin_supabase.table("pob_number_sequences")
+    for _ in range(_CAS_RETRIES):
+        rows = table.select("last_number").eq("doc_type", doc_type).limit(1).execute().data
+        if not rows:
+            try:
+                table.insert({"doc_type": doc_type, "last_number": count}).execute()
+                return count
+            except Exception:
+                continue            # someone else created it — read again
+        current = int(rows[0]["last_number"] or 0)
+        done = table.update({"last_number": current + count}) \
+            .eq("doc_type", doc_type) \
+            .eq("last_number", current) \
+            .execute().data
+        if done:
+            return current + count
+    raise RuntimeError(f"Could not allocate a {doc_type} number (sequence busy)")
+
+
+def _reserve(doc_type, count):
+    """Last number of a freshly reserved block of `count` numbers."""
+    global _rpc_ok
+    if _rpc_ok:
+        try:
+            return _reserve_rpc(doc_type, count)
+        except Exception as e:
+            # PostgREST: PGRST202 "Could not find the function
+            # public.next_doc_number(...)" until the SQL above is run
+            if "PGRST202" not in str(e) and "Could not find the function" not in str(e):
+                raise
+            _rpc_ok = False
+    return _reserve_cas(doc_type, count)
+
+
+def next_number(doc_type: str) -> int:
+    """Next number for `doc_type`. Raises on database errors — callers
+    must not invent a number instead."""
+    with _lock:
+        lease = _leases.get(doc_type)
+        if lease and lease[0] <= lease[1]:
+            n = lease[0]
+            lease[0] += 1
+            return n
+        size = _block_size(doc_type)
+        last = _reserve(doc_type, size)
+        if size > 1:
+            _leases[doc_type] = [last - size + 2, last]
+        return last - size + 1
+
+
+def ops_doc_no(prefix: str = "OPS") -> str:
+    """OPS document number: <prefix>-<yyyymmdd>-<seq>. All prefixes share
+    the OPS counter, so the number is unique whatever the prefix."""
+    return f"{prefix}-{datetime.utcnow().strftime('%Y%m%d')}-{str(next_number('OPS')).zfill(6)}"
@@ -0,0 +1,94 @@
+"""
+Entity Directory — anchors/entity_directory.py
+
+O(1) entity_type + id → display name, built once from the shared master
+cache (anchors.master_cache) and rebuilt only when one of the underlying
+master tables reloads. Replaces the `next(x for x in <master> if x["id"] ==
+eid)` scans that ran per row (and up to three times per entity in the
+register search boxes).
+
+    entity_name("Stockist", sid)              -> name or default
+    resolve_many([(type, id), ...])           -> [name, ...] for a whole page
+    match_entity_ids("sharma")                -> {ids whose name contains it}
+
+Search is done once per query over the precomputed lowercase names, so a
+register filter becomes `eid in matched` per document.
+"""
+
+import threading
+
+from anchors.master_cache import master_rows
+
+
+# entity_type -> (master table, name column)
+_KINDS = {
+    "CNF":       ("cnfs",       "name"),
+    "User":      ("users",      "username"),
+    "Stockist":  ("stockists",  "name"),
+    "Purchaser": ("purchasers", "name"),
+}
+# entity types that are not master rows — the type is the name
+_FIXED = {"Company": "Company", "Destroyed": "Destroyed"}
+
+_SEARCH_TYPES = ("Stockist", "User", "CNF")
+
+_lock = threading.Lock()
+_built = (None, None)   # (source row lists, directory)
+
+
+def _directory():
+    """Return {"names": {(type, id): name}, "lower": {type: [(id, lower)]}},
+    rebuilding only when a master table has been reloaded."""
+    global _built
+    sources = tuple(master_rows(table) for table, _ in _KINDS.values())
+    with _lock:
+        cached_sources, directory = _built
+        if cached_sources is not None and all(
+            a is b for a, b in zip(cached_sources, sources)
+        ):
+            return directory
+        names, lower = {}, {}
+        for (etype, (_, col)), rows in zip(_KINDS.items(), sources):
+            bucket = lower.setdefault(etype, [])
+            for r in rows:
+                name = r.get(col) or ""
+                names[(etype, r["id"])] = name
+                bucket.append((r["id"], name.lower()))
+        directory = {"names": names, "lower": lower}
+        _built = (sources, directory)
+        return directory
+
+
+def entity_name(entity_type, entity_id, default=None):
+    """Display name for one entity; `default` when the id is unknown."""
+    if entity_type in _FIXED:
+        return _FIXED[entity_type]
+    return _directory()["names"].get((entity_type, entity_id), default)
+
+
+def resolve_many(pairs, default=None):
+    """
+    Names for an iterable of (entity_type, entity_id), in order — one call
+    per page instead of one lookup per row. Unknown ids resolve to
+    `default` ("Unknown <type>" when None); non-master types resolve to the
+    type itself, as resolve_entity_display_name() does.
+    """
+    names = _directory()["names"]
+    out = []
+    for etype, eid in pairs:
+        if etype in _FIXED or etype not in _KINDS:
+            out.append(_FIXED.get(etype, etype))
+        else:
+            out.append(names.get((etype, eid),
+                                 default if default is not None else f"Unknown {etype}"))
+    return out
+
+
+def match_entity_ids(text, types=_SEARCH_TYPES):
+    """Set of entity ids (across `types`) whose name contains `text`
+    (case-insensitive)."""
+    text = (text or "").strip().lower()
+    if not text:
+        return set()
+    lower = _directory()["lower"]
+    return {eid for t in types for eid, name in lower.get(t, ()) if text in name}
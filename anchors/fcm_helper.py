@@ -6,68 +6,291 @@ RAILWAY-READY: reads Firebase service account JSON from the
 FIREBASE_SERVICE_ACCOUNT environment variable first, falls back to
 Streamlit secrets [firebase] section (works on both Railway and
 Streamlit Cloud).
+
+Dispatch (inline — the OPS notify_* helpers go through the outbox in
+anchors/notification_outbox.py instead):
+    send_push_to_users(user_ids, title, body, data)  -> successful sends
+    send_push_to_all_users(title, body, data)        -> successful sends
+    send_push_notification(user_id, title, body, data) -> bool
+
+A broadcast used to run user by user: re-read the config, mint a new
+OAuth token, look up the device token, post, insert the notification row
+— 150 reps kept the admin's script blocked for over a minute. Now:
+  • the access token is cached until shortly before it expires,
+  • all device tokens load in one query,
+  • posts go out on a bounded thread pool over one pooled
+    requests.Session,
+  • user_notifications rows are inserted in one batch at the end.
+Worker threads never touch st.*; errors are collected and reported once
+by the calling script.
+
+Testing: FCM_ENDPOINT points the sender at another base URL (e.g. the
+local stub in anchors/fcm_stub.py). With FCM_ENDPOINT set and no
+Firebase credentials, a placeholder token / project id is used.
 """
 
 import os
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 import streamlit as st
 import google.auth
 import google.auth.transport.requests
 from google.oauth2 import service_account
-from anchors.supabase_client import admin_supabase
+from anchors.supabase_client import admin_supabase, IN_CHUNK
+from anchors.notification_outbox import enqueue
+
+
+_DEFAULT_ENDPOINT = "https://fcm.googleapis.com"
+FCM_ENDPOINT = os.environ.get("FCM_ENDPOINT", _DEFAULT_ENDPOINT).rstrip("/")
+_STUBBED = FCM_ENDPOINT != _DEFAULT_ENDPOINT
+
+FCM_WORKERS = 16
+_SEND_TIMEOUT = 10          # seconds per request
+_TOKEN_PAGE = 1000
+_INSERT_CHUNK = 500
+
+_lock = threading.Lock()
+_config = None              # service-account dict, loaded once
+_credentials = None         # google.oauth2 credentials, refreshed on expiry
+_session = None             # pooled requests.Session shared by all sends
+
 
+# ─────────────────────────────────────────────────────────────
+# CONFIG / AUTH
+# ─────────────────────────────────────────────────────────────
 
 def _get_firebase_config() -> dict:
-    """Load Firebase service-account config.
+    """Load Firebase service-account config (once per process).
     Priority: FIREBASE_SERVICE_ACCOUNT env var (JSON string) → st.secrets["firebase"].
     Returns {} if neither is available."""
+    global _config
+    if _config:
+        return _config
     raw = os.environ.get("FIREBASE_SERVICE_ACCOUNT")
     if raw:
         try:
-            return json.loads(raw)
+            _config = json.loads(raw)
         except Exception as e:
             st.error(f"FIREBASE_SERVICE_ACCOUNT is not valid JSON: {e}")
             return {}
+        return _config
     try:
-        return dict(st.secrets["firebase"])
+        _config = dict(st.secrets["firebase"])
     except Exception:
         return {}
+    return _config
 
 
-def _get_access_token() -> str:
-    """Get OAuth2 access token for FCM V1 API using service account."""
-    try:
-        firebase_config = _get_firebase_config()
-        if not firebase_config:
-            st.error("FCM: Firebase credentials not configured.")
-            return ""
-        credentials = service_account.Credentials.from_service_account_info(
-            firebase_config,
-            scopes=["https://www.googleapis.com/auth/firebase.messaging"],
-        )
-        request = google.auth.transport.requests.Request()
-        credentials.refresh(request)
-        return credentials.token
-    except Exception as e:
-        st.error(f"FCM token error: {e}")
-        return ""
+def _project_id() -> str:
+    project_id = _get_firebase_config().get("project_id", "")
+    return project_id or ("stub" if _STUBBED else "")
+
+
+def _get_access_token(force: bool = False) -> str:
+    """OAuth2 access token for the FCM V1 API, reused until it is about to
+    expire. force=True mints a new one (after a 401). Raises RuntimeError
+    when no credentials are configured."""
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            firebase_config = _get_firebase_config()
+            if not firebase_config:
+                if _STUBBED:
+                    return "stub-token"
+                raise RuntimeError("Firebase credentials not configured.")
+            _credentials = service_account.Credentials.from_service_account_info(
+                firebase_config,
+                scopes=["https://www.googleapis.com/auth/firebase.messaging"],
+            )
+        # .valid is False once the token is within google-auth's refresh
+        # threshold (a few minutes) of expiry
+        if force or not _credentials.valid:
+            _credentials.refresh(google.auth.transport.requests.Request())
+        return _credentials.token
+
+
+def _http() -> requests.Session:
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FCM_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+# ─────────────────────────────────────────────────────────────
+# DEVICE TOKENS
+# ─────────────────────────────────────────────────────────────
+
+def _load_device_tokens(user_ids=None) -> dict:
+    """user_id -> FCM device token, in as few requests as possible.
+    user_ids=None loads every registered device."""
+    def _query():
+        return admin_supabase.table("user_fcm_tokens").select("user_id, token")
+
+    rows = []
+    if user_ids is None:
+        start = 0
+        while True:
+            page = _query().order("user_id") \
+                .range(start, start + _TOKEN_PAGE - 1).execute().data or []
+            rows += page
+            if len(page) < _TOKEN_PAGE:
+                break
+            start += _TOKEN_PAGE
+    else:
+        ids = list(dict.fromkeys(str(u) for u in user_ids if u))
+        for i in range(0, len(ids), IN_CHUNK):
+            rows += _query().in_("user_id", ids[i:i + IN_CHUNK]).execute().data or []
+
+    tokens = {}
+    for r in rows:
+        if r.get("token"):
+            tokens.setdefault(r["user_id"], r["token"])
+    return tokens
 
 
 def _get_fcm_token_for_user(user_id: str) -> str:
     """Get the FCM device token for a user from Supabase."""
     try:
-        result = admin_supabase.table("user_fcm_tokens") \
-            .select("token") \
-            .eq("user_id", user_id) \
-            .limit(1) \
-            .execute()
-        if result.data:
-            return result.data[0].get("token", "")
+        return _load_device_tokens([user_id]).get(str(user_id), "")
     except Exception as e:
         st.error(f"FCM token fetch error: {e}")
     return ""
 
+
+# ─────────────────────────────────────────────────────────────
+# SEND
+# ─────────────────────────────────────────────────────────────
+
+def _payload(device_token: str, title: str, body: str, data: dict) -> dict:
+    return {
+        "message": {
+            "token": device_token,
+            "notification": {
+                "title": title,
+                "body": body,
+            },
+            "android": {
+                "notification": {
+                    "channel_id": "ivy_pharma_channel",
+                    "sound": "default",
+                },
+                "priority": "high",
+            },
+            "data": {k: str(v) for k, v in (data or {}).items()},
+        }
+    }
+
+
+def _post(url: str, payload: dict):
+    """One FCM send, retried once with a fresh token on 401.
+    Returns None on success, else an error string. Thread-safe, no st.*."""
+    try:
+        for attempt in range(2):
+            response = _http().post(
+                url,
+                headers={
+                    "Authorization": f"Bearer {_get_access_token(force=attempt > 0)}",
+                    "Content-Type": "application/json",
+                },
+                json=payload,
+                timeout=_SEND_TIMEOUT,
+            )
+            if response.status_code == 200:
+                return None
+            if response.status_code != 401:
+                break
+        return f"{response.status_code} {response.text[:200]}"
+    except Exception as e:
+        return str(e)
+
+
+def _record_sent(user_ids, title: str, body: str, data: dict):
+    """Save delivered pushes to user_notifications (My Activity screen)."""
+    rows = [{
+        "user_id": uid,
+        "title": title,
+        "body": body,
+        "type": (data or {}).get("type", ""),
+        "ops_no": (data or {}).get("ops_no", ""),
+    } for uid in user_ids]
+    for i in range(0, len(rows), _INSERT_CHUNK):
+        try:
+            admin_supabase.table("user_notifications") \
+                .insert(rows[i:i + _INSERT_CHUNK]).execute()
+        except Exception:
+            pass
+
+
+def dispatch(tokens: dict, title: str, body: str, data: dict = None):
+    """
+    Send one message to every user in `tokens` (user_id -> device token)
+    concurrently. Returns (sent_user_ids, {user_id: error}). Does not
+    touch st.* — safe to call from a background thread.
+    """
+    if not tokens:
+        return [], {}
+    project_id = _project_id()
+    if not project_id:
+        return [], {uid: "Firebase project_id not found in configuration."
+                    for uid in tokens}
+    try:
+        _get_access_token()
+    except Exception as e:
+        return [], {uid: f"token error: {e}" for uid in tokens}
+
+    url = f"{FCM_ENDPOINT}/v1/projects/{project_id}/messages:send"
+    uids = list(tokens)
+    with ThreadPoolExecutor(max_workers=min(FCM_WORKERS, len(uids))) as pool:
+        results = list(pool.map(
+            lambda uid: _post(url, _payload(tokens[uid], title, body, data)), uids))
+
+    sent = [uid for uid, err in zip(uids, results) if err is None]
+    errors = {uid: err for uid, err in zip(uids, results) if err is not None}
+    _record_sent(sent, title, body, data)
+    return sent, errors
+
+
+def dispatch_to_users(user_ids, title: str, body: str, data: dict = None):
+    """Device-token lookup + dispatch() for a list of users, without st.*
+    (used by the notification outbox worker). Users with no registered
+    device are skipped."""
+    return dispatch(_load_device_tokens(user_ids), title, body, data)
+
+
+def _report(errors: dict):
+    if errors:
+        sample = next(iter(errors.values()))
+        st.error(f"FCM error for {len(errors)} user(s): {sample}")
+
+
+def send_push_to_users(
+    user_ids,
+    title: str,
+    body: str,
+    data: dict = None,
+) -> int:
+    """
+    Send a push notification to each of `user_ids` that has a device
+    registered. Returns count of successful sends.
+    """
+    try:
+        tokens = _load_device_tokens(user_ids)
+    except Exception as e:
+        st.error(f"FCM token fetch error: {e}")
+        return 0
+    sent, errors = dispatch(tokens, title, body, data)
+    _report(errors)
+    return len(sent)
+
+
 def send_push_notification(
     user_id: str,
     title: str,
@@ -78,70 +301,13 @@ def send_push_notification(
     Send a push notification to a specific user.
     Returns True if successful, False otherwise.
     """
-    try:
-        device_token = _get_fcm_token_for_user(user_id)
-        if not device_token:
-            st.warning(f"No FCM token for user {user_id}")
-            return False
-
-        access_token = _get_access_token()
-        if not access_token:
-            return False
-
-        project_id = _get_firebase_config().get("project_id", "")
-        if not project_id:
-            st.error("FCM: Firebase project_id not found in configuration.")
-            return False
-        url = f"https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
-
-        payload = {
-            "message": {
-                "token": device_token,
-                "notification": {
-                    "title": title,
-                    "body": body,
-                },
-                "android": {
-                    "notification": {
-                        "channel_id": "ivy_pharma_channel",
-                        "sound": "default",
-                    },
-                    "priority": "high",
-                },
-                "data": {k: str(v) for k, v in (data or {}).items()},
-            }
-        }
-
-        response = requests.post(
-            url,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=10,
-        )
-
-        if response.status_code == 200:
-            # Save to user_notifications for My Activity screen
-            try:
-                admin_supabase.table("user_notifications").insert({
-                    "user_id": user_id,
-                    "title": title,
-                    "body": body,
-                    "type": (data or {}).get("type", ""),
-                    "ops_no": (data or {}).get("ops_no", ""),
-                }).execute()
-            except Exception:
-                pass
-            return True
-        else:
-            st.error(f"FCM error: {response.status_code} {response.text}")
-            return False
-
-    except Exception as e:
-        st.error(f"FCM send error: {e}")
+    device_token = _get_fcm_token_for_user(user_id)
+    if not device_token:
+        st.warning(f"No FCM token for user {user_id}")
         return False
+    sent, errors = dispatch({str(user_id): device_token}, title, body, data)
+    _report(errors)
+    return bool(sent)
 
 
 def send_push_to_all_users(
@@ -154,28 +320,24 @@ def send_push_to_all_users(
     Returns count of successful sends.
     """
     try:
-        users = admin_supabase.table("user_fcm_tokens") \
-            .select("user_id") \
-            .execute()
-
-        success = 0
-        for user in (users.data or []):
-            if send_push_notification(
-                user["user_id"], title, body, data
-            ):
-                success += 1
-        return success
+        tokens = _load_device_tokens()
     except Exception as e:
         print(f"FCM broadcast error: {e}")
         return 0
+    sent, errors = dispatch(tokens, title, body, data)
+    if errors:
+        print(f"FCM broadcast: {len(errors)} failed, e.g. {next(iter(errors.values()))}")
+    return len(sent)
 
 
 # ── Convenience functions for OPS events ─────────────────────
+# Queued through the notification outbox: the submit path returns at
+# once and the outbox worker does the FCM round-trip.
 
 def notify_invoice_created(user_id: str, ops_no: str,
                             party_name: str, amount: float):
-    send_push_notification(
-        user_id=user_id,
+    enqueue(
+        user_id,
         title="📄 New Invoice Created",
         body=f"{ops_no} | {party_name} | \u20b9{amount:,.0f}",
         data={"type": "invoice", "ops_no": ops_no},
@@ -184,8 +346,8 @@ def notify_invoice_created(user_id: str, ops_no: str,
 
 def notify_payment_created(user_id: str, ops_no: str,
                             party_name: str, amount: float):
-    send_push_notification(
-        user_id=user_id,
+    enqueue(
+        user_id,
         title="\U0001f4b0 Payment Recorded",
         body=f"{ops_no} | {party_name} | \u20b9{amount:,.0f}",
         data={"type": "payment", "ops_no": ops_no},
@@ -194,8 +356,8 @@ def notify_payment_created(user_id: str, ops_no: str,
 
 def notify_credit_note_created(user_id: str, ops_no: str,
                                 party_name: str, amount: float):
-    send_push_notification(
-        user_id=user_id,
+    enqueue(
+        user_id,
         title="\U0001f4dd Credit Note Created",
         body=f"{ops_no} | {party_name} | \u20b9{amount:,.0f}",
         data={"type": "credit_note", "ops_no": ops_no},
@@ -203,8 +365,8 @@ def notify_credit_note_created(user_id: str, ops_no: str,
 
 
 def notify_invoice_cancelled(user_id: str, ops_no: str, party_name: str):
-    send_push_notification(
-        user_id=user_id,
+    enqueue(
+        user_id,
         title="\u274c Invoice Cancelled",
         body=f"{ops_no} | {party_name}",
         data={"type": "invoice_cancelled", "ops_no": ops_no},
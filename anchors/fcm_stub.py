@@ -0,0 +1,90 @@
+"""
+fcm_stub.py
+Local stand-in for the FCM V1 send endpoint, for exercising the push
+pipeline (anchors/fcm_helper.py) without Firebase.
+
+    python -m anchors.fcm_stub 8765 --latency 0.3
+    FCM_ENDPOINT=http://127.0.0.1:8765 streamlit run app.py
+
+Every POST /v1/projects/<id>/messages:send answers 200 with a message name
+after `latency` seconds. Device tokens starting with "invalid" get the 404
+UNREGISTERED reply real FCM gives for stale tokens. GET /stats returns
+{"sent": n, "failed": n} so a test can check what arrived.
+
+start_stub(port, latency) runs it on a daemon thread and returns the server
+(call .shutdown() when done).
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _handler(latency, stats, lock):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            raw = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                msg = json.loads(self.rfile.read(length) or b"{}").get("message", {})
+            except ValueError:
+                msg = {}
+            if not self.path.endswith("/messages:send"):
+                return self._reply(404, {"error": {"status": "NOT_FOUND"}})
+            if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+                return self._reply(401, {"error": {"status": "UNAUTHENTICATED"}})
+            if latency:
+                time.sleep(latency)
+            token = str(msg.get("token") or "")
+            if not token or token.startswith("invalid"):
+                with lock:
+                    stats["failed"] += 1
+                return self._reply(404, {"error": {"status": "NOT_FOUND",
+                                                   "details": [{"errorCode": "UNREGISTERED"}]}})
+            with lock:
+                stats["sent"] += 1
+                n = stats["sent"]
+            project = self.path.split("/")[3] if self.path.count("/") >= 4 else "stub"
+            self._reply(200, {"name": f"projects/{project}/messages/{n}"})
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._reply(404, {})
+            with lock:
+                self._reply(200, dict(stats))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_stub(port=8765, latency=0.0, host="127.0.0.1"):
+    stats, lock = {"sent": 0, "failed": 0}, threading.Lock()
+    server = ThreadingHTTPServer((host, port), _handler(latency, stats, lock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local FCM send endpoint stub")
+    ap.add_argument("port", nargs="?", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0,
+                    help="seconds to wait before answering each send")
+    args = ap.parse_args()
+    srv = start_stub(args.port, args.latency)
+    print(f"FCM stub on http://127.0.0.1:{args.port}  (FCM_ENDPOINT=http://127.0.0.1:{args.port})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
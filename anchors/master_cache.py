@@ -0,0 +1,287 @@
+"""
+Master Data Cache — anchors/master_cache.py
+
+One process-wide copy of the small master tables (users, cnfs, stockists,
+purchasers, products, territories and the three mapping tables), shared by every browser
+session and every module. Before this, each admin session kept its own
+copy in st.session_state (so a stockist added in one tab stayed invisible
+in another until logout) and statement_main cleared ALL st.cache_data on
+every product / stockist edit.
+
+    master_rows("stockists")    -> list of rows, in the table's display order
+    master_index("stockists")   -> {id: row}
+    invalidate("stockists")     -> call after any insert / update / delete
+
+Rows are shared between sessions — treat them as read-only.
+
+Freshness is a cheap version check. master_data_versions holds one counter
+per table; invalidate() bumps it, and every process polls the whole table
+(a handful of rows) at most once per _VERSION_POLL seconds, reloading only
+the tables whose counter moved. So an edit made in one tab — or on another
+app instance — shows up everywhere within a few seconds.
+
+    create table master_data_versions (
+        table_name  text primary key,
+        version     bigint not null default 0,
+        updated_at  timestamptz not null default now()
+    );
+
+Bumps are atomic — one call to this function (a plain read-then-write
+could lose a bump when two writers race). Until it exists invalidate()
+falls back to a compare-and-swap update, retried on conflict:
+
+    create or replace function bump_master_version(p_table text)
+    returns bigint language sql as $$
+        insert into master_data_versions (table_name, version)
+        values (p_table, 1)
+        on conflict (table_name) do update
+            set version = master_data_versions.version + 1, updated_at = now()
+        returning version;
+    $$;
+
+Optional trigger so edits made outside the app (SQL editor, other
+services) bump the counter too:
+
+    create or replace function bump_master_version() returns trigger as $$
+    begin
+        perform bump_master_version(tg_table_name);
+        return null;
+    end $$ language plpgsql;
+    -- create trigger bump_master_version after insert or update or delete
+    --     on stockists for each statement execute function bump_master_version();
+    -- (repeat for users, cnfs, purchasers, products, cnf_users, user_stockists)
+
+If master_data_versions does not exist yet, the cache degrades to a plain
+_FALLBACK_TTL expiry, and invalidate() still drops the local copy at once.
+Only a missing-table error switches that mode on; a timeout or network
+error just skips that poll and the next one tries again.
+
+No lock is held across a network call. _lock only guards the dicts; each
+table has its own load lock so one slow load never blocks another table,
+and sessions that already have a (stale) copy keep using it while one of
+them reloads.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_all, PAGE_SIZE
+
+
+# table -> (select, order columns, keyed by id)
+_TABLES = {
+    "users":          ("id, username, role, is_active, designation, report_to", ("username",), True),
+    "cnfs":           ("id, name, is_active",            ("name",),     True),
+    "stockists":      ("id, name",                       ("name",),     True),
+    "purchasers":     ("id, name, email",                ("name",),     True),
+    "products":       ("*",                              ("name",),     True),
+    "territories":    ("id, name, is_active",            ("name",),     True),
+    "cnf_users":      ("cnf_id, user_id",                ("cnf_id", "user_id"),      False),
+    "user_stockists": ("user_id, stockist_id",           ("user_id", "stockist_id"), False),
+    "user_territories": ("user_id, territory_id",        ("user_id", "territory_id"), False),
+}
+
+_VERSION_POLL = 15     # seconds between version checks (per process)
+_FALLBACK_TTL = 300    # seconds, used only when master_data_versions is missing
+
+_CAS_RETRIES = 8
+
+_lock = threading.Lock()   # guards the dicts below — never held across I/O
+_load_locks = {t: threading.Lock() for t in _TABLES}
+_entries = {}          # table -> {"rows", "index", "version", "loaded_at"}
+_versions = {}         # table -> last version seen in master_data_versions
+_generation = {}       # table -> local invalidate() count (drops in-flight loads)
+_versions_ok = None    # None = not probed yet, False = table missing
+_rpc_ok = True         # False once bump_master_version() is found missing
+_polled_at = 0.0
+
+
+def _missing_relation(e):
+    msg = str(e)
+    return any(s in msg for s in ("PGRST205", "42P01", "Could not find the table",
+                                  "does not exist"))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# LOADING
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _load(table, version):
+    select, order, keyed = _TABLES[table]
+    if keyed:
+        rows = fetch_all(
+            lambda: admin_supabase.table(table).select(select),
+            f"Error loading {table}",
+        )
+        rows.sort(key=lambda r: tuple((r.get(c) or "").lower() for c in order))
+    else:
+        # Mapping tables have no guaranteed id column — plain range paging
+        # on the full composite order is stable for these small tables.
+        rows, start = [], 0
+        while True:
+            q = admin_supabase.table(table).select(select)
+            for c in order:
+                q = q.order(c)
+            page = safe_exec(q.range(start, start + PAGE_SIZE - 1),
+                             f"Error loading {table}") or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+    return {
+        "rows": rows,
+        "index": {r["id"]: r for r in rows} if keyed else {},
+        "version": version,
+        "loaded_at": time.time(),
+    }
+
+
+def _poll_versions():
+    """Refresh _versions from master_data_versions (rate-limited)."""
+    global _versions_ok, _polled_at
+    now = time.time()
+    with _lock:
+        if _versions_ok is False or now - _polled_at < _VERSION_POLL:
+            return
+        _polled_at = now          # this thread polls; the others skip
+    try:
+        # Not safe_exec: a missing table must degrade, not stop the page.
+        resp = admin_supabase.table("master_data_versions") \
+            .select("table_name, version") \
+            .execute()
+    except Exception as e:
+        if _missing_relation(e):
+            with _lock:
+                _versions_ok = False
+        # anything else (timeout, network): keep the last known versions
+        # and try again on the next poll
+        return
+    with _lock:
+        _versions_ok = True
+        for r in resp.data or []:
+            _versions[r["table_name"]] = r.get("version") or 0
+
+
+def _stale(e, table):
+    return (
+        e is None
+        or (_versions_ok and e["version"] != _versions.get(table, 0))
+        or (not _versions_ok and time.time() - e["loaded_at"] > _FALLBACK_TTL)
+    )
+
+
+def _entry(table):
+    if table not in _TABLES:
+        raise KeyError(f"Unknown master table: {table}")
+    _poll_versions()
+    with _lock:
+        e = _entries.get(table)
+        if not _stale(e, table):
+            return e
+    load_lock = _load_locks[table]
+    if e is not None and not load_lock.acquire(blocking=False):
+        return e                  # someone else is reloading — serve the old copy
+    if e is None:
+        load_lock.acquire()
+    try:
+        with _lock:
+            e = _entries.get(table)
+            if not _stale(e, table):
+                return e
+            version, generation = _versions.get(table, 0), _generation.get(table, 0)
+        e = _load(table, version)
+        with _lock:
+            # an invalidate() during the load means these rows may predate
+            # the write — hand them out once, don't keep them
+            if _generation.get(table, 0) == generation:
+                _entries[table] = e
+        return e
+    finally:
+        load_lock.release()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# VERSION BUMPS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _bump_rpc(table):
+    v = admin_supabase.rpc("bump_master_version", {"p_table": table}).execute().data
+    if isinstance(v, list):
+        v = v[0] if v else None
+    if isinstance(v, dict):
+        v = next(iter(v.values()), None)
+    if v is None:
+        raise RuntimeError(f"bump_master_version returned nothing for {table}")
+    return int(v)
+
+
+def _bump_cas(table):
+    """Conditional update: only succeeds if nobody bumped since we read."""
+    t = admin_supabase.table("master_data_versions")
+    for _ in range(_CAS_RETRIES):
+        cur = t.select("version").eq("table_name", table).limit(1).execute().data
+        stamp = datetime.utcnow().isoformat()
+        if not cur:
+            try:
+                t.insert({"table_name": table, "version": 1, "updated_at": stamp}).execute()
+                return 1
+            except Exception:
+                continue            # created concurrently — read again
+        v = int(cur[0].get("version") or 0)
+        done = t.update({"version": v + 1, "updated_at": stamp}) \
+            .eq("table_name", table) \
+            .eq("version", v) \
+            .execute().data
+        if done:
+            return v + 1
+    raise RuntimeError(f"Could not bump master version for {table}")
+
+
+def _bump(table):
+    global _rpc_ok
+    if _rpc_ok:
+        try:
+            return _bump_rpc(table)
+        except Exception as e:
+            if "PGRST202" not in str(e) and "Could not find the function" not in str(e):
+                raise
+            _rpc_ok = False
+    return _bump_cas(table)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# PUBLIC API
+# ─────────────────────────────────────────────────────────────────────────────
+
+def master_rows(table):
+    """All rows of a master table, in display order (shared — don't mutate)."""
+    return _entry(table)["rows"]
+
+
+def master_index(table):
+    """{id: row} for a master table (not available for mapping tables)."""
+    return _entry(table)["index"]
+
+
+def invalidate(*tables):
+    """
+    Drop the local copy of each table and bump its shared version so every
+    other session / process reloads on its next poll. Call after writes.
+    """
+    with _lock:
+        for table in tables:
+            _entries.pop(table, None)
+            _generation[table] = _generation.get(table, 0) + 1
+        skip = _versions_ok is False
+    if skip:
+        return
+    for table in tables:
+        try:
+            v = _bump(table)
+        except Exception:
+            # Local copy is already gone; other processes fall back to
+            # their own poll / TTL.
+            continue
+        with _lock:
+            _versions[table] = max(v, _versions.get(table, 0))
@@ -0,0 +1,282 @@
+"""
+notification_outbox.py
+Place this in the anchors/ folder.
+Persistent outbox for push notifications. Submit paths call enqueue(),
+which writes one notification_outbox row and returns; a background
+thread in the same process sends it through fcm_helper. So an
+invoice save no longer waits for an OAuth refresh plus an FCM round-trip
+before the admin sees success.
+
+    enqueue(user_ids, title, body, data)   -> True once queued
+    start_worker()                         -> start the delivery thread
+    outbox_metrics()                       -> queue depth, sent / failed,
+                                              queue wait and send latency
+
+Worker loop (one daemon thread per process, started from app.py on every
+run — a no-op once it is alive — so rows left pending by a restart are
+sent without waiting for the next enqueue):
+  • claim up to _BATCH due rows (status pending, next_attempt_at <= now,
+    or 'sending' rows whose claim is older than _STALE — a crashed worker),
+  • send each row with fcm_helper.dispatch_to_users (token lookup + FCM),
+  • sent → status 'sent'; transport errors → the failed recipients stay
+    on the row and it is retried with exponential backoff
+    (_BACKOFF_BASE · 2^attempt, capped at _BACKOFF_MAX) until
+    _MAX_ATTEMPTS, then 'failed'. Recipients with no registered device,
+    or whose token FCM reports UNREGISTERED, are dropped, not retried.
+The sent / failed / retried counters all count recipients: a row for
+three users that reaches two and backs off for the third adds 2 to sent
+and 1 to retried.
+
+The claim is a conditional update (… where status = <seen status>), so
+two app instances never send the same row twice.
+
+If the outbox table cannot be written, the message goes on an in-memory
+queue drained by the same worker — the submit still never blocks on FCM,
+it just isn't persistent.
+
+    create table notification_outbox (
+        id               uuid primary key default gen_random_uuid(),
+        user_ids         jsonb not null,
+        title            text not null,
+        body             text not null,
+        data             jsonb not null default '{}',
+        status           text not null default 'pending',
+        attempts         int  not null default 0,
+        next_attempt_at  timestamptz not null default now(),
+        locked_at        timestamptz,
+        last_error       text,
+        created_at       timestamptz not null default now(),
+        sent_at          timestamptz
+    );
+    create index notification_outbox_due_idx
+        on notification_outbox (status, next_attempt_at);
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from anchors.supabase_client import admin_supabase
+
+
+_BATCH = 50
+_POLL = 15              # seconds between outbox polls when idle
+_STALE = 300            # seconds before a 'sending' claim is taken over
+_MAX_ATTEMPTS = 6
+_BACKOFF_BASE = 10      # seconds
+_BACKOFF_MAX = 900
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_local = queue.Queue()          # fallback when the table can't be written
+_worker = None
+
+_DEPTH_TTL = 30         # seconds the outbox_metrics() depth count is reused
+
+_stats = {"sent": 0, "failed": 0, "retried": 0}     # recipients, not rows
+_wait_s = deque(maxlen=200)     # enqueue → delivered, seconds
+_send_s = deque(maxlen=200)     # one dispatch() call, seconds
+_depth = {"value": None, "at": 0.0}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _iso(dt):
+    return dt.isoformat()
+
+
+# ─────────────────────────────────────────────────────────────
+# ENQUEUE
+# ─────────────────────────────────────────────────────────────
+
+def enqueue(user_ids, title: str, body: str, data: dict = None) -> bool:
+    """Queue one push for `user_ids` (one id or a list). Never sends inline."""
+    if isinstance(user_ids, str):
+        user_ids = [user_ids]
+    user_ids = [str(u) for u in dict.fromkeys(user_ids or []) if u]
+    if not user_ids:
+        return False
+    row = {
+        "user_ids": user_ids,
+        "title": title,
+        "body": body,
+        "data": {k: str(v) for k, v in (data or {}).items()},
+    }
+    try:
+        admin_supabase.table("notification_outbox").insert(row).execute()
+    except Exception as e:
+        print(f"Outbox insert failed, queueing in memory: {e}")
+        _local.put({**row, "id": None, "attempts": 0,
+                    "created_at": _iso(_now()), "next_attempt_at": _iso(_now())})
+    start_worker()
+    _wake.set()
+    return True
+
+
+# ─────────────────────────────────────────────────────────────
+# WORKER
+# ─────────────────────────────────────────────────────────────
+
+def start_worker():
+    """Start this process's delivery thread unless it is already running."""
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="notification-outbox", daemon=True)
+            _worker.start()
+
+
+def _claim():
+    """Due rows this worker now owns."""
+    now = _now()
+    stale = _iso(now - timedelta(seconds=_STALE))
+    rows = admin_supabase.table("notification_outbox") \
+        .select("id, status, locked_at") \
+        .or_(f'and(status.eq.pending,next_attempt_at.lte."{_iso(now)}"),'
+             f'and(status.eq.sending,locked_at.lt."{stale}")') \
+        .order("next_attempt_at") \
+        .limit(_BATCH) \
+        .execute().data or []
+    if not rows:
+        return []
+
+    cols = "id, user_ids, title, body, data, attempts, created_at"
+    claim = {"status": "sending", "locked_at": _iso(now)}
+    pending = [r["id"] for r in rows if r["status"] == "pending"]
+    claimed = []
+    if pending:
+        claimed += admin_supabase.table("notification_outbox") \
+            .update(claim).in_("id", pending).eq("status", "pending") \
+            .execute().data or []
+    for r in rows:
+        if r["status"] == "sending":
+            claimed += admin_supabase.table("notification_outbox") \
+                .update(claim).eq("id", r["id"]).eq("status", "sending") \
+                .eq("locked_at", r["locked_at"]).execute().data or []
+    return [{k: c.get(k) for k in cols.split(", ")} for c in claimed]
+
+
+def _backoff(attempts):
+    return min(_BACKOFF_BASE * 2 ** (attempts - 1), _BACKOFF_MAX)
+
+
+def _deliver(row):
+    """Send one outbox row. Returns the update to store on it."""
+    from anchors.fcm_helper import dispatch_to_users
+
+    started = time.monotonic()
+    try:
+        sent, errors = dispatch_to_users(row["user_ids"], row["title"], row["body"],
+                                         row.get("data") or {})
+    except Exception as e:                 # token lookup / auth failure
+        sent, errors = [], {uid: str(e) for uid in row["user_ids"]}
+    _send_s.append(time.monotonic() - started)
+
+    # stale device tokens will never succeed — drop them instead of retrying
+    retry = [uid for uid, err in errors.items() if "UNREGISTERED" not in err]
+    attempts = int(row.get("attempts") or 0) + 1
+    with _lock:
+        _stats["sent"] += len(sent)
+    if not retry:
+        try:
+            created = datetime.fromisoformat(str(row["created_at"]).replace("Z", "+00:00"))
+            if created.tzinfo is None:
+                created = created.replace(tzinfo=timezone.utc)
+            _wait_s.append((_now() - created).total_seconds())
+        except Exception:
+            pass
+        return {"status": "sent", "attempts": attempts, "sent_at": _iso(_now()),
+                "last_error": None, "locked_at": None}
+    last_error = errors[retry[0]][:500]
+    if attempts >= _MAX_ATTEMPTS:
+        with _lock:
+            _stats["failed"] += len(retry)
+        return {"status": "failed", "attempts": attempts, "user_ids": retry,
+                "last_error": last_error, "locked_at": None}
+    with _lock:
+        _stats["retried"] += len(retry)
+    return {"status": "pending", "attempts": attempts, "user_ids": retry,
+            "last_error": last_error, "locked_at": None,
+            "next_attempt_at": _iso(_now() + timedelta(seconds=_backoff(attempts)))}
+
+
+def _drain_local():
+    """Messages that never reached the table. Retries stay in memory."""
+    pending = []
+    while True:
+        try:
+            pending.append(_local.get_nowait())
+        except queue.Empty:
+            break
+    now = _iso(_now())
+    for row in pending:
+        if row["next_attempt_at"] > now:
+            _local.put(row)
+            continue
+        update = _deliver(row)
+        if update["status"] == "pending":
+            _local.put({**row, **update})
+
+
+def _run():
+    while True:
+        _wake.clear()
+        busy = False
+        try:
+            _drain_local()
+            rows = _claim()
+            busy = len(rows) == _BATCH
+            for row in rows:
+                admin_supabase.table("notification_outbox") \
+                    .update(_deliver(row)).eq("id", row["id"]).execute()
+        except Exception as e:
+            print(f"Outbox worker error: {e}")
+        if not busy:
+            _wake.wait(_POLL)
+
+
+# ─────────────────────────────────────────────────────────────
+# METRICS
+# ─────────────────────────────────────────────────────────────
+
+def _pct(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 2)
+
+
+def outbox_metrics() -> dict:
+    """Queue depth and delivery latency for this process's worker. The
+    depth is a count query, reused for _DEPTH_TTL seconds; the rest is
+    in memory."""
+    with _lock:
+        depth, fresh = _depth["value"], time.monotonic() - _depth["at"] < _DEPTH_TTL
+    if not fresh:
+        try:
+            depth = admin_supabase.table("notification_outbox") \
+                .select("id", count="exact") \
+                .in_("status", ["pending", "sending"]) \
+                .limit(1) \
+                .execute().count
+        except Exception:
+            depth = None
+        with _lock:
+            _depth.update(value=depth, at=time.monotonic())
+    with _lock:
+        stats = dict(_stats)
+        waits, sends = list(_wait_s), list(_send_s)
+    return {
+        "queue_depth": depth,
+        "local_queue": _local.qsize(),
+        "worker_alive": bool(_worker and _worker.is_alive()),
+        **stats,
+        "wait_p50_s": _pct(waits, 0.5),
+        "wait_p95_s": _pct(waits, 0.95),
+        "send_p50_s": _pct(sends, 0.5),
+        "send_p95_s": _pct(sends, 0.95),
+    }
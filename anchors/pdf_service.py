@@ -0,0 +1,236 @@
+"""
+PDF Service — anchors/pdf_service.py
+
+Shared plumbing for every PDF download in the app (OPS report PDFs, the
+financial ledger, POB documents, Doctor I/O). Each of those used to turn
+its rows into strings with iterrows(), lay them out as one giant reportlab
+Table, and do all of it on every rerun that drew the download button — so
+a 2,000-row ledger was rebuilt on every widget click even when nobody
+downloaded it.
+
+    frame_rows(df)                     -> [header, row, row, …] as strings
+    chunked_tables(data, style, …)     -> [Table, Table, …] for story.extend()
+    pdf_download_button(label, build, content, file_name, …)
+
+frame_rows converts column by column instead of row by row.
+
+chunked_tables splits a long table into sub-tables of CHUNK_ROWS rows,
+each repeating the header. reportlab sizes a Table by walking every row
+each time it splits it across a page, so one big table gets slower per
+page as it grows; fixed-size chunks keep layout linear. Style commands are
+written for the whole table (row 0 = header, -1 = last row) and mapped
+onto each chunk.
+
+pdf_download_button hands Streamlit a callable, so build() only runs when
+the user actually clicks Download. The bytes are kept in a small process
+cache keyed by a hash of `content` (whatever the PDF is made from), so a
+second click — from any session — reuses them. Streamlit ignores st.*
+calls made inside that callable, so a build error (e.g. from reportlab)
+is printed and remembered per digest instead; the next run of the page
+shows it with st.error above the button, which stays usable for a retry.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import date
+from importlib.util import find_spec
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+
+REPORTLAB_OK = find_spec("reportlab") is not None
+
+CHUNK_ROWS = 250
+_MAX_BYTES = 64 * 1024 * 1024
+
+_lock = threading.Lock()
+_cache = OrderedDict()    # digest -> pdf bytes, least recently used first
+_cache_bytes = 0
+_failures = {}            # digest -> last build error, shown on the next run
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ROWS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _cell(v):
+    if v is None or (not isinstance(v, (list, tuple, dict)) and pd.isna(v)):
+        return ""
+    if isinstance(v, float) and np.isfinite(v) and v == int(v):
+        return str(int(v))
+    return str(v)
+
+
+def _column_strings(s):
+    """One column as strings: blank for NaN, whole floats without '.0'."""
+    if pd.api.types.is_float_dtype(s.dtype):
+        out = s.astype(str)
+        whole = np.isfinite(s) & (s == np.round(s))
+        out[whole] = s[whole].astype("int64").astype(str)
+        out[s.isna()] = ""
+        return out.tolist()
+    if pd.api.types.is_integer_dtype(s.dtype) or pd.api.types.is_bool_dtype(s.dtype):
+        return s.astype(str).tolist()
+    return [_cell(v) for v in s.tolist()]
+
+
+def frame_rows(df):
+    """
+    Header + data rows of a DataFrame as lists of strings, index included.
+    MultiIndex columns (pivot_table output) are flattened to "a b".
+    """
+    df_out = df.reset_index()
+    headers = [
+        " ".join(str(c) for c in col).strip() if isinstance(col, tuple) else str(col)
+        for col in df_out.columns
+    ]
+    columns = [_column_strings(df_out.iloc[:, i]) for i in range(df_out.shape[1])]
+    return [headers] + [list(r) for r in zip(*columns)]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# TABLES
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _chunk_style(style, n_rows, start, end):
+    """
+    Map whole-table style commands onto the chunk holding data rows
+    start..end-1 (plus its own header at row 0). ROWBACKGROUNDS cycles are
+    rotated so stripes continue across chunk boundaries.
+    """
+    out = []
+    for cmd in style:
+        name, (c0, r0), (c1, r1), *args = cmd
+        r0 = r0 + n_rows if r0 < 0 else r0
+        r1 = r1 + n_rows if r1 < 0 else r1
+        lo, hi = max(r0, start), min(r1, end - 1)
+        if r0 <= 0 and hi < lo:
+            a, b = 0, 0                            # header only
+        elif hi < lo:
+            continue                               # nothing in this chunk
+        else:
+            a = 0 if r0 <= 0 else lo - start + 1
+            b = hi - start + 1
+        if name == "ROWBACKGROUNDS" and args:
+            cycle = list(args[0])
+            first = lo if a else r0                # absolute row drawn at local a
+            shift = (first - r0) % len(cycle) if cycle else 0
+            args = [cycle[shift:] + cycle[:shift]] + list(args[1:])
+        out.append((name, (c0, a), (c1, b), *args))
+    return out
+
+
+def chunked_tables(data, style, col_widths=None, chunk_rows=CHUNK_ROWS):
+    """
+    data[0] is the header row. Returns a list of Tables of at most
+    chunk_rows data rows each, header repeated, styled as if they were one
+    table — add them to the story with story.extend().
+    """
+    from reportlab.platypus import Table, TableStyle
+
+    header, body = data[0], data[1:]
+    n_rows = len(data)
+    tables = []
+    for start in range(1, max(n_rows, 2), chunk_rows):
+        end = min(start + chunk_rows, n_rows)
+        tbl = Table([header] + body[start - 1:end - 1], colWidths=col_widths, repeatRows=1)
+        tbl.setStyle(TableStyle(_chunk_style(style, n_rows, start, end)))
+        tables.append(tbl)
+    return tables
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# LAZY, CACHED DOWNLOAD
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _feed(h, part):
+    if isinstance(part, pd.DataFrame):
+        h.update(repr(list(part.columns)).encode())
+        h.update(repr(list(part.index.names)).encode())
+        h.update(pd.util.hash_pandas_object(part, index=True).values.tobytes())
+    else:
+        try:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        except TypeError:                          # e.g. tuple dict keys
+            h.update(repr(part).encode())
+
+
+def content_key(*parts):
+    """Stable hash of the data a PDF is built from (DataFrames, rows, dicts…)."""
+    h = hashlib.sha1()
+    for part in parts:
+        _feed(h, part)
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def cached_pdf(digest, build):
+    """PDF bytes for `digest`, calling build() only on a miss."""
+    global _cache_bytes
+    with _lock:
+        data = _cache.get(digest)
+        if data is not None:
+            _cache.move_to_end(digest)
+            return data
+
+    data = build()
+    if hasattr(data, "getvalue"):
+        data = data.getvalue()
+    if not data:
+        raise RuntimeError("PDF generation failed")
+
+    with _lock:
+        if digest not in _cache:
+            _cache[digest] = data
+            _cache_bytes += len(data)
+        while _cache_bytes > _MAX_BYTES and len(_cache) > 1:
+            _, old = _cache.popitem(last=False)
+            _cache_bytes -= len(old)
+    return data
+
+
+def _build_or_record(digest, build, error_label):
+    try:
+        data = cached_pdf(digest, build)
+    except Exception as e:
+        print(f"{error_label}: {e!r}")
+        with _lock:
+            _failures[digest] = str(e) or type(e).__name__
+        raise RuntimeError(error_label) from None
+    with _lock:
+        _failures.pop(digest, None)
+    return data
+
+
+def pdf_download_button(label, build, content, file_name,
+                        error_label="PDF generation failed", **kwargs):
+    """
+    st.download_button whose PDF is built on click, not on render.
+
+    build()     -> bytes / BytesIO, with everything it needs captured
+    content     -> the inputs build() reads; their hash is the cache key, so
+                   it must cover everything that changes the PDF
+    error_label -> st.error text shown (with the cause) after a failed build
+    Returns False (and draws nothing) when reportlab is not installed.
+    """
+    if not REPORTLAB_OK:
+        return False
+    # the day is part of the key — most PDFs print a "Generated on" date
+    digest = content_key(getattr(build, "__qualname__", ""), date.today(), content)
+    with _lock:
+        failure = _failures.get(digest)
+    if failure:
+        st.error(f"❌ {error_label}: {failure}")
+    st.download_button(
+        label,
+        data=lambda: _build_or_record(digest, build, error_label),
+        file_name=file_name,
+        mime="application/pdf",
+        on_click="ignore",
+        **kwargs,
+    )
+    return True
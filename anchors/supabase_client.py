@@ -1,8 +1,16 @@
 import os
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 from supabase import create_client
 
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # very old / very new streamlit — run without ctx
+    add_script_run_ctx = get_script_run_ctx = None
+
 # Get credentials from environment variables
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
@@ -61,26 +69,30 @@ _MAX_RETRIES  = 3
 _RETRY_DELAYS = [1.0, 2.5, 5.0]   # seconds between retries
 
 
+def _fail(msg, exc=None):
+    """Show the error and stop the run. st.stop() only interrupts the script
+    thread — in a worker thread (or a cached loader run from one) it just
+    returns, so raise as well: the caller must never get [] for a query
+    that failed, or a partial result ends up cached."""
+    st.error(msg)
+    if exc is not None:
+        st.exception(exc)
+    st.stop()
+    raise RuntimeError(f"{msg}: {exc}" if exc is not None else msg) from exc
+
+
 def safe_exec(q, msg="Database error"):
     """
     Safely execute a Supabase query with automatic retry for transient
     network errors (e.g. 'Resource temporarily unavailable', errno 11).
 
-    Returns data list or empty list on error.
-    Stops the app with an error message only after all retries are exhausted.
+    Returns the data list. After all retries are exhausted it shows the
+    error and stops the app — or raises RuntimeError where st.stop() can't
+    (worker threads), so a failed query never looks like an empty one.
     """
-    last_exc = None
-
     for attempt in range(_MAX_RETRIES):
         try:
             res = q.execute()
-
-            if hasattr(res, "error") and res.error:
-                st.error(msg)
-                st.stop()
-
-            return res.data or []
-
         except Exception as e:
             err_lower = str(e).lower()
             is_transient = any(sig in err_lower for sig in _RETRY_SIGNALS)
@@ -88,18 +100,159 @@ def safe_exec(q, msg="Database error"):
             if is_transient and attempt < _MAX_RETRIES - 1:
                 # Wait then retry
                 time.sleep(_RETRY_DELAYS[attempt])
-                last_exc = e
                 continue
 
             # Not transient, or final attempt — surface the error
-            st.error(msg)
-            st.exception(e)
-            st.stop()
+            _fail(msg, e)
+
+        if hasattr(res, "error") and res.error:
+            _fail(msg)
+
+        return res.data or []
+
+
+# ══════════════════════════════════════════════════════════════════
+# BULK FETCH ENGINE
+# PostgREST caps every response at 1000 rows, so any query that can
+# return more must be paged. Offset paging (.range) gets slower the
+# deeper it goes and runs one page after another. Instead we:
+#   • split the uuid `id` space into N shards (ids are random uuid4,
+#     so shards are evenly sized),
+#   • keyset-page each shard on `id` (id > last_seen, ORDER BY id),
+#   • run the shards concurrently on a small thread pool,
+#   • stream rows back to the caller as pages arrive.
+# Every page goes through safe_exec, so transient-error retries and
+# the st.error/st.stop behaviour are exactly the same as elsewhere.
+# ══════════════════════════════════════════════════════════════════
+
+PAGE_SIZE      = 1000
+FETCH_WORKERS  = 4
+FETCH_SHARDS   = 8
+IN_CHUNK       = 200
+
+_DONE = object()
+
+
+def _uuid_bounds(shards):
+    """Return [(lo, hi), ...] splitting the uuid space into `shards` ranges.
+    First lo and last hi are None (open-ended) so nothing can fall outside."""
+    shards = max(1, int(shards))
+    cuts = [format(i * 0x100000000 // shards, "08x") + "-0000-0000-0000-000000000000"
+            for i in range(1, shards)]
+    los = [None] + cuts
+    his = cuts + [None]
+    return list(zip(los, his))
+
+
+def _iter_shard(build_q, msg, key, page_size, lo, hi, stop=None):
+    """Keyset-page one id range, yielding one page (list of rows) at a time."""
+    last = None
+    while stop is None or not stop.is_set():
+        q = build_q()
+        if last is not None:
+            q = q.gt(key, last)
+        elif lo is not None:
+            q = q.gte(key, lo)
+        if hi is not None:
+            q = q.lt(key, hi)
+        page = safe_exec(q.order(key).limit(page_size), msg)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][key]
+
+
+def _pool(workers):
+    """Bounded thread pool whose threads carry the current script-run
+    context, so safe_exec can still call st.error / st.stop inside them."""
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def _init():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    return ThreadPoolExecutor(max_workers=workers, initializer=_init)
+
+
+def fetch_rows(build_q, msg="Database error", key="id",
+               page_size=PAGE_SIZE, shards=FETCH_SHARDS, workers=FETCH_WORKERS):
+    """
+    Stream EVERY row matched by a query, past the 1000-row cap.
+
+    build_q  : zero-arg callable returning a fresh query builder with its
+               select + filters applied. Do NOT add .order() / .range() /
+               .limit() — the engine owns those. The selected columns must
+               include `key`.
+    key      : uuid column used for keyset paging (default "id").
+    shards   : how many id ranges to page in parallel (1 = plain serial
+               keyset paging, usable for non-uuid keys).
+
+    Yields row dicts. Row order is NOT guaranteed across shards — sort
+    the result yourself if the caller needs an order.
+    """
+    bounds = _uuid_bounds(shards)
+    if len(bounds) == 1 or workers <= 1:
+        for lo, hi in bounds:
+            for page in _iter_shard(build_q, msg, key, page_size, lo, hi):
+                yield from page
+        return
+
+    out  = queue.SimpleQueue()
+    stop = threading.Event()
+
+    def _run(lo, hi):
+        try:
+            for page in _iter_shard(build_q, msg, key, page_size, lo, hi, stop):
+                out.put(page)
+        except BaseException as e:  # incl. StopException from st.stop()
+            out.put(e)
+        finally:
+            out.put(_DONE)
+
+    pool = _pool(min(workers, len(bounds)))
+    try:
+        for lo, hi in bounds:
+            pool.submit(_run, lo, hi)
+        pending = len(bounds)
+        while pending:
+            item = out.get()
+            if item is _DONE:
+                pending -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield from item
+    finally:
+        # Consumer stopped early or a shard failed — let the others wind down.
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_all(build_q, msg="Database error", **kw):
+    """List form of fetch_rows()."""
+    return list(fetch_rows(build_q, msg, **kw))
+
+
+def fetch_in(build_q, column, values, msg="Database error", chunk=IN_CHUNK,
+             workers=FETCH_WORKERS, key="id"):
+    """
+    Run build_q().in_(column, chunk_of_values) for every chunk of `values`
+    concurrently and return the concatenated rows. Keeps each request URL
+    short and replaces the hand-written `for i in range(0, len(ids), 100)`
+    loops. Each chunk is keyset-paged on `key`, so a chunk matching more
+    than 1000 rows still comes back in full — select `key` too.
+    """
+    values = [v for v in dict.fromkeys(values) if v is not None]
+    if not values:
+        return []
+    chunks = [values[i:i + chunk] for i in range(0, len(values), chunk)]
+
+    def _one(part):
+        return fetch_all(lambda: build_q().in_(column, part), msg, key=key, shards=1)
 
-    # Should not reach here, but just in case
-    if last_exc:
-        st.error(msg)
-        st.exception(last_exc)
-        st.stop()
+    if len(chunks) == 1 or workers <= 1:
+        return [r for part in chunks for r in _one(part)]
 
-    return []
+    with _pool(min(workers, len(chunks))) as pool:
+        return [r for rows in pool.map(_one, chunks) for r in rows]
@@ -0,0 +1,103 @@
+"""
+Territory Scope — anchors/territory_scope.py
+
+Which territories a user works in, shared by DCR, Doctor Fetch, Doctor
+I/O, Tours and the doctor / chemist masters. Each of dcr_database,
+masters_database and doctor_io_database had its own get_user_territories;
+the DCR one ran a designation query, a direct-reports query and one
+user_territories query per report — on nearly every rerun — and only
+looked one level down report_to, so a senior manager never saw the
+territories of the reps under their managers.
+
+    user_scope(user_id)                         -> (user_id, report ids…)
+    scope_territories(user_id, include_reports) -> [{id, name}] by name
+
+Everything is built from the master cache (users with designation /
+report_to, user_territories, territories), so there are no per-user
+queries at all. Managers and senior managers get their reports'
+territories through the whole report_to tree (active users only, cycle
+safe); everyone else gets their own. Results are memoised per user and
+dropped whenever one of those master tables reloads — i.e. after
+invalidate("users" / "user_territories" / "territories") or a version
+bump from another process.
+"""
+
+import threading
+
+from anchors.master_cache import master_rows, master_index
+
+
+MANAGER_DESIGNATIONS = ("manager", "senior_manager")
+
+_lock = threading.Lock()
+_state = {"sources": None, "children": {}, "owned": {}, "scopes": {}}
+
+
+def _index():
+    """Hierarchy + assignment maps, rebuilt when a source table reloads."""
+    users = master_rows("users")
+    links = master_rows("user_territories")
+    territories = master_index("territories")
+    sources = (users, links, territories)
+    with _lock:
+        cached = _state["sources"]
+        if cached is None or any(a is not b for a, b in zip(cached, sources)):
+            children, owned = {}, {}
+            for u in users:
+                if u.get("report_to") and u.get("is_active"):
+                    children.setdefault(u["report_to"], []).append(u["id"])
+            for link in links:
+                if link.get("territory_id"):
+                    owned.setdefault(link["user_id"], []).append(link["territory_id"])
+            _state.update(sources=sources, children=children, owned=owned, scopes={})
+        return dict(_state)             # consistent snapshot for the caller
+
+
+def user_scope(user_id):
+    """The user plus, for managers, every active user below them."""
+    state = _index()
+    scopes = state["scopes"]          # this build's memo — a rebuild swaps it
+    key = ("users", user_id)
+    scope = scopes.get(key)
+    if scope is not None:
+        return scope
+    ids = [user_id]
+    me = master_index("users").get(user_id) or {}
+    if me.get("designation") in MANAGER_DESIGNATIONS:
+        seen = {user_id}
+        stack = [user_id]
+        while stack:
+            for child in state["children"].get(stack.pop(), []):
+                if child not in seen:
+                    seen.add(child)
+                    ids.append(child)
+                    stack.append(child)
+    scope = tuple(ids)
+    with _lock:
+        scopes[key] = scope
+    return scope
+
+
+def scope_territories(user_id, include_reports=True):
+    """
+    [{id, name}] for the user's territories, deduplicated, by name.
+    include_reports=False: only territories assigned to the user.
+    """
+    state = _index()
+    scopes = state["scopes"]
+    key = ("territories", user_id, include_reports)
+    result = scopes.get(key)
+    if result is None:
+        uids = user_scope(user_id) if include_reports else (user_id,)
+        territories = master_index("territories")
+        seen = {}
+        for uid in uids:
+            for tid in state["owned"].get(uid, []):
+                t = territories.get(tid)
+                if t and tid not in seen:
+                    seen[tid] = {"id": t["id"], "name": t["name"]}
+        result = sorted(seen.values(), key=lambda t: (t.get("name") or "").lower())
+        with _lock:
+            scopes[key] = result
+    # callers may mutate the dicts they get back
+    return [dict(t) for t in result]
@@ -10,6 +10,7 @@ if PROJECT_ROOT not in sys.path:
 from anchors.core_session import handle_login
 from anchors.core_router import route_module
 from anchors.ivy_styles import apply_styles
+from anchors.notification_outbox import start_worker
 
 st.set_page_config(
     page_title="Ivy Pharmaceuticals",
@@ -19,5 +20,9 @@ st.set_page_config(
 
 apply_styles()
 
+# Push delivery thread — started here, not on first enqueue, so rows left
+# pending by a restart go out without waiting for the next save.
+start_worker()
+
 handle_login()
 route_module()
@@ -4,22 +4,36 @@ Powered by Claude API
 Place at: modules/ai/ai_assistant.py
 RAILWAY-READY: reads ANTHROPIC_API_KEY from environment variables first,
 falls back to Streamlit secrets (works on both Railway and Streamlit Cloud).
+
+Each question is sent with summary tables from modules/ai/ai_context.py
+(period totals, not row samples). Answers are cached per process; a
+repeated question on unchanged data is served from the cache and does not
+count against LIMIT_ADMIN / LIMIT_USER.
 """
 
 import os
+import re
 import streamlit as st
 import json
 import time
+import hashlib
+import threading
 import requests
+from collections import OrderedDict
 from datetime import datetime, date
-from calendar import monthrange
 from anchors.supabase_client import admin_supabase, safe_exec
+from modules.ai.ai_context import build_context
+from modules.statement.report_cache import data_watermark
 
 
 MODEL      = "claude-sonnet-4-20250514"
 MAX_TOKENS = 1000
 LIMIT_ADMIN = 300
 LIMIT_USER  = 200
+ANSWER_CACHE_SIZE = 500
+
+_answers = OrderedDict()     # answer key -> answer text, least recent first
+_answers_lock = threading.Lock()
 
 SYSTEM_PROMPT = """You are the Ivy Pharmaceuticals business intelligence assistant.
 Answer questions about sales, payments, stock, invoices, credit notes, and doctors.
@@ -70,140 +84,55 @@ def _increment_usage(user_id):
         pass
 
 
-# ── Fetch DB context ──────────────────────────────────────────────
-def _fetch_context(question, role, user_id):
-    q = question.lower()
-    parts = []
-    today = date.today()
-
-    # Date range
-    month_map = {
-        "january":1,"february":2,"march":3,"april":4,"may":5,"june":6,
-        "july":7,"august":8,"september":9,"october":10,"november":11,"december":12,
-        "jan":1,"feb":2,"mar":3,"apr":4,"jun":6,"jul":7,
-        "aug":8,"sep":9,"oct":10,"nov":11,"dec":12
-    }
-    detected_month = next((v for k, v in month_map.items() if k in q), None)
-    yr = today.year
-    if detected_month:
-        from_d = date(yr, detected_month, 1)
-        _, ld = monthrange(yr, detected_month)
-        to_d = date(yr, detected_month, ld)
-    elif "this month" in q or "current month" in q:
-        from_d = date(yr, today.month, 1)
-        _, ld = monthrange(yr, today.month)
-        to_d = date(yr, today.month, ld)
-    elif "last month" in q:
-        m = today.month - 1 or 12
-        y = yr if today.month > 1 else yr - 1
-        from_d = date(y, m, 1)
-        _, ld = monthrange(y, m)
-        to_d = date(y, m, ld)
-    else:
-        from_d = date(yr, 1, 1)
-        to_d = date(yr, 12, 31)
+# ── Answer cache ──────────────────────────────────────────────────
+# Same question (case / spacing / punctuation ignored), same role and
+# user, same data watermark and day -> same answer, without another API
+# call or another question counted against the monthly limit. Any new or
+# edited ops_document moves the watermark and retires old answers.
+def _answer_key(question, role, user_id):
+    norm = " ".join(re.findall(r"[\w₹]+", question.lower()))
+    raw = json.dumps([norm, role, str(user_id), date.today().isoformat(), data_watermark()])
+    return hashlib.sha1(raw.encode()).hexdigest()
 
-    parts.append(f"Date range: {from_d} to {to_d}. Today: {today}")
 
-    # Payments
-    if any(w in q for w in ["payment","paid","receipt","received","collection"]):
-        try:
-            rows = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("ops_no,ops_date,ops_type,from_entity_type,from_entity_id,"
-                        "to_entity_type,to_entity_id,invoice_total,narration,payment_mode")
-                .in_("ops_type", ["PAYMENT","RECEIPT"])
-                .eq("is_deleted", False)
-                .gte("ops_date", from_d.isoformat())
-                .lte("ops_date", to_d.isoformat())
-                .order("ops_date", desc=True)
-                .limit(30)
-            ) or []
-            if rows:
-                total = sum(float(r.get("invoice_total") or 0) for r in rows)
-                parts.append(f"PAYMENTS ({len(rows)} records, total ₹{total:,.2f}):\n" +
-                              json.dumps(rows, default=str))
-        except Exception as e:
-            parts.append(f"Payment fetch error: {e}")
-
-    # Invoices
-    if any(w in q for w in ["invoice","sale","outstanding","due","unpaid","billing"]):
-        try:
-            rows = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("ops_no,ops_date,stock_as,from_entity_type,from_entity_id,"
-                        "to_entity_type,to_entity_id,invoice_total,outstanding_balance,"
-                        "payment_status,reference_no")
-                .eq("stock_as", "normal")
-                .eq("is_deleted", False)
-                .gte("ops_date", from_d.isoformat())
-                .lte("ops_date", to_d.isoformat())
-                .order("ops_date", desc=True)
-                .limit(30)
-            ) or []
-            if rows:
-                total = sum(float(r.get("invoice_total") or 0) for r in rows)
-                parts.append(f"INVOICES ({len(rows)} records, total ₹{total:,.2f}):\n" +
-                              json.dumps(rows, default=str))
-        except Exception as e:
-            parts.append(f"Invoice fetch error: {e}")
-
-    # Stock
-    if any(w in q for w in ["stock","inventory","closing","qty","quantity"]):
-        try:
-            rows = safe_exec(
-                admin_supabase.table("stock_ledger")
-                .select("product_id,entity_type,entity_id,txn_date,qty_in,qty_out,closing_qty,narration")
-                .gte("txn_date", from_d.isoformat())
-                .lte("txn_date", to_d.isoformat())
-                .order("txn_date", desc=True)
-                .limit(40)
-            ) or []
-            if rows:
-                parts.append(f"STOCK LEDGER ({len(rows)} records):\n" +
-                              json.dumps(rows, default=str))
-        except Exception as e:
-            parts.append(f"Stock fetch error: {e}")
-
-    # Credit notes
-    if any(w in q for w in ["credit note","cn","credit","return"]):
-        try:
-            rows = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("ops_no,ops_date,stock_as,from_entity_type,from_entity_id,"
-                        "to_entity_type,to_entity_id,invoice_total,reference_no")
-                .eq("stock_as", "credit_note")
-                .eq("is_deleted", False)
-                .gte("ops_date", from_d.isoformat())
-                .lte("ops_date", to_d.isoformat())
-                .limit(20)
-            ) or []
-            if rows:
-                total = sum(float(r.get("invoice_total") or 0) for r in rows)
-                parts.append(f"CREDIT NOTES ({len(rows)} records, total ₹{total:,.2f}):\n" +
-                              json.dumps(rows, default=str))
-        except Exception as e:
-            parts.append(f"CN fetch error: {e}")
-
-    # General fallback
-    if len(parts) <= 1:
-        try:
-            rows = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("ops_no,ops_date,ops_type,stock_as,invoice_total,payment_status")
-                .eq("is_deleted", False)
-                .gte("ops_date", from_d.isoformat())
-                .lte("ops_date", to_d.isoformat())
-                .order("ops_date", desc=True)
-                .limit(20)
-            ) or []
-            if rows:
-                parts.append(f"RECENT ACTIVITY ({len(rows)} records):\n" +
-                              json.dumps(rows, default=str))
-        except Exception as e:
-            parts.append(f"General fetch error: {e}")
-
-    return "\n\n".join(parts)
+def _cached_answer(key):
+    with _answers_lock:
+        ans = _answers.get(key)
+        if ans is not None:
+            _answers.move_to_end(key)
+        return ans
+
+
+def _store_answer(key, ans):
+    with _answers_lock:
+        _answers[key] = ans
+        _answers.move_to_end(key)
+        while len(_answers) > ANSWER_CACHE_SIZE:
+            _answers.popitem(last=False)
+
+
+def _answer(question, role, user_id):
+    """(answer, from_cache). Errors start with "⚠️" and are never cached."""
+    key = _answer_key(question, role, user_id)
+    ans = _cached_answer(key)
+    if ans is not None:
+        return ans, True
+    try:
+        ans = _call_claude(question, build_context(question))
+    except Exception as e:
+        return f"⚠️ {e}", False
+    if not ans.startswith("⚠️"):
+        _store_answer(key, ans)
+    return ans, False
+
+
+def _ask(question, role, user_id):
+    with st.spinner("Thinking..."):
+        ans, cached = _answer(question, role, user_id)
+    st.session_state.ai_chat.append({"q": question, "a": ans, "cached": cached})
+    if user_id and not cached and not ans.startswith("⚠️"):
+        _increment_usage(user_id)
+    st.rerun()
 
 
 # ── Call Claude API ───────────────────────────────────────────────
@@ -216,7 +145,7 @@ def _call_claude(question, context):
         except Exception:
             return "⚠️ ANTHROPIC_API_KEY not found in environment variables or Streamlit secrets."
 
-    user_msg = f"Data from database:\n{context}\n\nQuestion: {question}"
+    user_msg = f"Data from database (summary tables):\n{context}\n\nQuestion: {question}"
 
     resp = requests.post(
         "https://api.anthropic.com/v1/messages",
@@ -268,34 +197,17 @@ def run_ai_assistant():
             st.write(turn["q"])
         with st.chat_message("assistant"):
             st.write(turn["a"])
+            if turn.get("cached"):
+                st.caption("↺ Same question as earlier on unchanged data — not counted.")
 
     # Process pending suggestion click
     if "_ai_pending" in st.session_state:
-        pending = st.session_state.pop("_ai_pending")
-        with st.spinner("Thinking..."):
-            try:
-                ctx = _fetch_context(pending, role, user_id)
-                ans = _call_claude(pending, ctx)
-            except Exception as e:
-                ans = f"⚠️ {e}"
-        st.session_state.ai_chat.append({"q": pending, "a": ans})
-        if user_id and not ans.startswith("⚠️"):
-            _increment_usage(user_id)
-        st.rerun()
+        _ask(st.session_state.pop("_ai_pending"), role, user_id)
 
     # Chat input
     question = st.chat_input("Ask about your sales, payments, stock...")
     if question and question.strip():
-        with st.spinner("Thinking..."):
-            try:
-                ctx = _fetch_context(question.strip(), role, user_id)
-                ans = _call_claude(question.strip(), ctx)
-            except Exception as e:
-                ans = f"⚠️ {e}"
-        st.session_state.ai_chat.append({"q": question.strip(), "a": ans})
-        if user_id and not ans.startswith("⚠️"):
-            _increment_usage(user_id)
-        st.rerun()
+        _ask(question.strip(), role, user_id)
 
     # Clear button
     if st.session_state.ai_chat:
@@ -0,0 +1,288 @@
+"""
+AI Assistant Context — modules/ai/ai_context.py
+
+Builds the "Data from database" block sent with every assistant question.
+It used to run up to five keyword-triggered queries and paste 20–40 raw
+rows as JSON, so a question like "payments this month" was answered from
+a truncated sample (and the payment query looked for ops_types that OPS
+never writes). Now every figure is a total over the whole period:
+
+    build_context(question)  -> text block of compact summary tables
+
+The money side reads the same per-period facts and money rules as the OPS
+reports (modules/statement/ops_facts.py), so the assistant and Reports
+1-6 agree to the rupee. Stock comes from the month-end snapshots plus
+the ledger rows after them (modules/ops/stock_snapshots.py).
+
+Tables:
+  • MONTHLY TOTALS — always: invoice count / ₹, credit notes ₹, payments ₹
+  • INVOICES BY PARTY (+ outstanding), PAYMENTS BY PARTY, CREDIT NOTES BY
+    PARTY, PRODUCTS, STOCK — only when the question mentions them
+Long tables keep the top rows plus one "Others (n)" row and a TOTAL row,
+so the totals stay exact however much is cut.
+"""
+
+import re
+from calendar import monthrange
+from datetime import date, timedelta
+
+import pandas as pd
+import streamlit as st
+
+from anchors.supabase_client import admin_supabase, fetch_all
+from anchors.master_cache import master_index
+from anchors.entity_directory import resolve_many
+from modules.ops.stock_snapshots import opening_rows, cancelled_doc_ids, is_reversal_narration
+from modules.statement.ops_facts import (
+    load_period_facts, invoice_amounts, credit_note_amounts, payment_amounts,
+    credit_note_qty,
+)
+from modules.statement.report_cache import data_watermark
+
+
+TOP_PARTIES  = 15
+TOP_PRODUCTS = 25
+TOP_STOCK    = 40
+
+_MONTHS = {
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
+    "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12,
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "jun": 6, "jul": 7,
+    "aug": 8, "sep": 9, "sept": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+# "may" is also the modal verb ("which stockist may run out") — only a
+# preposition before it or a year after it makes it the month
+_MAY = r"\b(in|for|of|during|since|from|till|until|upto|to|by)\s+may\b|\bmay\s*'?(\d{4}|\d{2})\b"
+
+# section -> words that switch it on (prefix match: "sale" also hits "sales")
+_TRIGGERS = {
+    "invoices": r"\b(invoice|sale|sold|billing|outstanding|due|unpaid|part(y|ies)|stockist|customer|top)",
+    "payments": r"\b(payment|paid|receipt|received|collection|collected)",
+    "credit_notes": r"\b(credit|cn\b|cns\b|return)",
+    "products": r"\b(product|item|qty|quantit|unit|free)",
+    "stock": r"\b(stock|inventory|closing)",
+}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# HELPERS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def question_period(question, today=None):
+    """(from_d, to_d) named by the question: a month name (this year),
+    "this month", "last month", else the whole current year."""
+    q = question.lower()
+    today = today or date.today()
+    yr = today.year
+    month = next((m for w, m in _MONTHS.items()
+                  if re.search(_MAY if w == "may" else rf"\b{w}\b", q)), None)
+    if month:
+        y, m = yr, month
+    elif "this month" in q or "current month" in q:
+        y, m = yr, today.month
+    elif "last month" in q:
+        y, m = (yr, today.month - 1) if today.month > 1 else (yr - 1, 12)
+    else:
+        return date(yr, 1, 1), date(yr, 12, 31)
+    return date(y, m, 1), date(y, m, monthrange(y, m)[1])
+
+
+def _sections(question):
+    q = question.lower()
+    return {name for name, pat in _TRIGGERS.items() if re.search(pat, q)}
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        return f"{v:,.0f}" if v == round(v) else f"{v:,.2f}"
+    return str(v)
+
+
+def _table(title, df):
+    """Pipe-separated table: title line, header, rows."""
+    if df.empty:
+        return f"{title}: none"
+    lines = [title, " | ".join(df.columns)]
+    lines += [" | ".join(_fmt(v) for v in row) for row in df.itertuples(index=False)]
+    return "\n".join(lines)
+
+
+def _top(df, label_col, sort_col, n):
+    """Top n rows by sort_col, the rest folded into "Others (k)", plus TOTAL."""
+    df = df.sort_values(sort_col, ascending=False)
+    num = [c for c in df.columns if c != label_col]
+    out = df.head(n)
+    rest = df.iloc[n:]
+    extra = []
+    if not rest.empty:
+        extra.append({label_col: f"Others ({len(rest)})", **rest[num].sum().to_dict()})
+    extra.append({label_col: "TOTAL", **df[num].sum().to_dict()})
+    return pd.concat([out, pd.DataFrame(extra)], ignore_index=True)
+
+
+def _by_party(df, type_col, id_col, values):
+    """Sum `values` columns per party, named via the entity directory."""
+    g = df.groupby([type_col, id_col], dropna=False)[list(values)].sum().reset_index()
+    g.insert(0, "Party", resolve_many(zip(g[type_col], g[id_col])))
+    g = g.drop(columns=[type_col, id_col]).rename(columns=values)
+    # two ids can share a display name — keep one row per name
+    return g.groupby("Party", as_index=False).sum()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# MONEY SECTIONS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _monthly(f, periods):
+    inv = invoice_amounts(f)
+    cn = credit_note_amounts(f)
+    pay = payment_amounts(f)
+    out = pd.DataFrame({"year": [y for y, _ in periods], "month": [m for _, m in periods]})
+    keys = ["year", "month"]
+    for name, df, col, how in (("Invoices", inv, "id", "count"),
+                               ("Invoice ₹ net", inv, "net", "sum"),
+                               ("Credit notes ₹", cn, "amount", "sum"),
+                               ("Payments ₹ net", pay, "net", "sum")):
+        agg = df.groupby(keys)[col].agg(how).rename(name).reset_index()
+        out = out.merge(agg, on=keys, how="left")
+    out = out.fillna(0)
+    out["Invoices"] = out["Invoices"].astype(int)
+    out.insert(0, "Month", [date(y, m, 1).strftime("%b-%y") for y, m in periods])
+    out = out.drop(columns=keys)
+    total = {"Month": "TOTAL", **out.drop(columns="Month").sum().to_dict()}
+    return pd.concat([out, pd.DataFrame([total])], ignore_index=True)
+
+
+def _invoice_parties(f):
+    inv = invoice_amounts(f).assign(n=1)
+    df = _by_party(inv, "to_entity_type", "to_entity_id",
+                   {"n": "Invoices", "net": "Invoice ₹ net",
+                    "outstanding_balance": "Outstanding ₹"})
+    return _top(df, "Party", "Invoice ₹ net", TOP_PARTIES)
+
+
+def _payment_parties(f):
+    pay = payment_amounts(f).assign(n=1)
+    df = _by_party(pay, "from_entity_type", "from_entity_id",
+                   {"n": "Payments", "gross": "Gross ₹", "discount": "Discount ₹",
+                    "net": "Net ₹"})
+    return _top(df, "Party", "Net ₹", TOP_PARTIES)
+
+
+def _credit_note_parties(f):
+    cn = credit_note_amounts(f).assign(n=1)
+    df = _by_party(cn, "from_entity_type", "from_entity_id",
+                   {"n": "Credit notes", "amount": "Amount ₹"})
+    return _top(df, "Party", "Amount ₹", TOP_PARTIES)
+
+
+def _products(f):
+    """Quantities only: line amounts are document-level totals stamped on
+    every line, so they cannot be split by product."""
+    lines = f["lines"]
+    inv_ids = invoice_amounts(f)["id"]
+    cn_ids = credit_note_amounts(f)["id"]
+    sold = lines[lines["ops_document_id"].isin(inv_ids)] \
+        .groupby("product")[["sale_qty", "free_qty"]].sum()
+    cn_lines = lines[lines["ops_document_id"].isin(cn_ids)]
+    returned = credit_note_qty(cn_lines).groupby(cn_lines["product"]).sum().rename("cn_qty")
+    df = sold.join(returned, how="outer").fillna(0.0).reset_index()
+    df.columns = ["Product", "Sale qty", "Free qty", "CN qty"]
+    return _top(df, "Product", "Sale qty", TOP_PRODUCTS)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# STOCK SECTION
+# ─────────────────────────────────────────────────────────────────────────────
+
+@st.cache_data(ttl=600, max_entries=8, show_spinner=False)
+def _stock_position(from_iso, to_iso, watermark):
+    """In / out during the period and closing on to_iso, per
+    (entity type, product), all entities combined."""
+    after = (date.fromisoformat(to_iso) + timedelta(days=1)).isoformat()
+    bf_rows, rows_from = opening_rows(after, None)
+    start = min(rows_from, from_iso) if rows_from else None
+
+    def _q():
+        q = admin_supabase.table("stock_ledger") \
+            .select("id, ops_document_id, product_id, entity_type, txn_date, "
+                    "qty_in, qty_out, narration") \
+            .lte("txn_date", to_iso)
+        return q.gte("txn_date", start) if start else q
+    rows = fetch_all(_q, "Error loading stock ledger")
+
+    cancelled = cancelled_doc_ids(r.get("ops_document_id") for r in rows)
+    rows = [r for r in rows
+            if r.get("product_id")
+            and not is_reversal_narration(r.get("narration"))
+            and r.get("ops_document_id") not in cancelled]
+    cols = ["product_id", "entity_type", "txn_date", "qty_in", "qty_out"]
+    led = pd.DataFrame(rows, columns=cols)
+    bf = pd.DataFrame(bf_rows, columns=cols)
+    for df in (led, bf):
+        for c in ("qty_in", "qty_out"):
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
+        df["entity_type"] = df["entity_type"].fillna("")
+        df["txn_date"] = df["txn_date"].astype(str).str[:10]
+
+    keys = ["entity_type", "product_id"]
+    in_period = led[led["txn_date"] >= from_iso]
+    moved = in_period.groupby(keys)[["qty_in", "qty_out"]].sum()
+    held = led[led["txn_date"] >= rows_from] if rows_from else led
+    closing = pd.concat([bf, held]).assign(closing=lambda d: d["qty_in"] - d["qty_out"]) \
+        .groupby(keys)["closing"].sum()
+    df = moved.join(closing, how="outer").fillna(0.0).reset_index()
+    df = df[(df["qty_in"] != 0) | (df["qty_out"] != 0) | (df["closing"].round(6) != 0)]
+
+    products = master_index("products")
+    df.insert(1, "Product", [(products.get(p) or {}).get("name") or "Unknown"
+                             for p in df["product_id"]])
+    df = df.drop(columns="product_id")
+    df.columns = ["Holder", "Product", "In", "Out", "Closing"]
+    return df.sort_values(["Holder", "Closing"], ascending=[True, False], ignore_index=True)
+
+
+def _stock_block(from_d, to_d):
+    df = _stock_position(from_d.isoformat(), to_d.isoformat(), data_watermark())
+    blocks = []
+    for holder, part in df.groupby("Holder", sort=True):
+        part = part.drop(columns="Holder")
+        blocks.append(_table(f"STOCK — {holder or 'Unassigned'} (qty, closing on {to_d})",
+                             _top(part, "Product", "Closing", TOP_STOCK)))
+    return "\n\n".join(blocks) if blocks else "STOCK: no movements"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ENTRY POINT
+# ─────────────────────────────────────────────────────────────────────────────
+
+def build_context(question, today=None):
+    """Summary tables for the period and topics the question names."""
+    today = today or date.today()
+    from_d, to_d = question_period(question, today)
+    wanted = _sections(question) or {"invoices", "payments"}
+
+    f = load_period_facts(from_d.year, from_d.month, to_d.year, to_d.month)
+    periods = [(y, m) for y in range(from_d.year, to_d.year + 1)
+               for m in range(1, 13)
+               if (from_d.year, from_d.month) <= (y, m) <= (to_d.year, to_d.month)]
+
+    parts = [
+        f"Period: {from_d} to {to_d}. Today: {today}. "
+        "All figures are totals over the whole period; cancelled documents are excluded.",
+        _table("MONTHLY TOTALS", _monthly(f, periods)),
+    ]
+    if "invoices" in wanted:
+        parts.append(_table("INVOICES BY PARTY (billed to)", _invoice_parties(f)))
+    if "payments" in wanted:
+        parts.append(_table("PAYMENTS BY PARTY (received from)", _payment_parties(f)))
+    if "credit_notes" in wanted:
+        parts.append(_table("CREDIT NOTES BY PARTY", _credit_note_parties(f)))
+    if "products" in wanted:
+        parts.append(_table("PRODUCTS (invoiced / credit-noted qty)", _products(f)))
+    if "stock" in wanted:
+        try:
+            parts.append(_stock_block(from_d, to_d))
+        except Exception as e:
+            parts.append(f"Stock fetch error: {e}")
+    return "\n\n".join(parts)
@@ -7,6 +7,8 @@ import streamlit as st
 from datetime import datetime
 import json
 from anchors.supabase_client import admin_supabase
+from anchors.master_cache import master_rows, master_index
+from anchors.territory_scope import scope_territories
 
 
 def init_dcr_session_state():
@@ -365,10 +367,10 @@ def get_dcr_by_id(dcr_id):
     if not dcr_id or dcr_id == "None" or str(dcr_id) == "None":
         return {}
         
-    # Get main record
+    # Main record with its visits and gifts embedded (one round trip)
     dcr = safe_exec(
         admin_supabase.table("dcr_reports")
-        .select("*")
+        .select("*, dcr_doctor_visits(*, doctors(name)), dcr_gifts(*, doctors(name))")
         .eq("id", dcr_id)
         .limit(1),
         "Error loading DCR"
@@ -378,6 +380,10 @@ def get_dcr_by_id(dcr_id):
         return {}
     
     dcr_data = dcr[0]
+    visits = sorted(dcr_data.pop("dcr_doctor_visits", None) or [],
+                    key=lambda v: v.get("sequence_no") or 0)
+    gifts = sorted(dcr_data.pop("dcr_gifts", None) or [],
+                   key=lambda g: g.get("sequence_no") or 0)
     
     # Parse JSONB fields safely
     try:
@@ -418,15 +424,9 @@ def get_dcr_by_id(dcr_id):
         )
         chemist_names = [c["name"] for c in chemists]
     
-    # Get doctor visits
-    visits = safe_exec(
-        admin_supabase.table("dcr_doctor_visits")
-        .select("*, doctors(name)")
-        .eq("dcr_report_id", dcr_id)
-        .order("sequence_no"),
-        "Error loading doctor visits"
-    )
-    
+    # Product names come from the shared product master
+    products = master_index("products")
+
     doctor_visits = []
     for visit in visits:
         _pids_raw = visit.get("product_ids") or []
@@ -435,16 +435,7 @@ def get_dcr_by_id(dcr_id):
         else:
             product_ids = _pids_raw
         
-        # Get product names
-        product_names = []
-        if product_ids:
-            products = safe_exec(
-                admin_supabase.table("products")
-                .select("name")
-                .in_("id", product_ids),
-                "Error loading products"
-            )
-            product_names = [p["name"] for p in products]
+        product_names = [products[pid]["name"] for pid in product_ids if pid in products]
         
         doctor_visits.append({
             "id": visit["id"],
@@ -456,15 +447,6 @@ def get_dcr_by_id(dcr_id):
             "sequence_no": visit["sequence_no"]
         })
     
-    # Get gifts
-    gifts = safe_exec(
-        admin_supabase.table("dcr_gifts")
-        .select("*, doctors(name)")
-        .eq("dcr_report_id", dcr_id)
-        .order("sequence_no"),
-        "Error loading gifts"
-    )
-    
     gift_list = []
     for gift in gifts:
         gift_list.append({
@@ -489,68 +471,31 @@ def get_user_territories(user_id):
     """
     Get territories assigned to user.
     If the user is a manager or senior_manager, also includes
-    territories of all direct reports (users where report_to = user_id).
-    Returns list of {id, name} — deduplicated.
+    territories of everyone below them in the report_to tree.
+    Returns list of {id, name} — deduplicated, by name.
+    Served from the shared hierarchy index (anchors.territory_scope).
     """
     try:
-        # ── Helper: fetch territories for one user_id ────────
-        def _fetch_territories(uid):
-            rows = safe_exec(
-                admin_supabase.table("user_territories")
-                .select("territory_id, territories(id, name)")
-                .eq("user_id", uid),
-                "Error loading user territories"
-            )
-            result = []
-            for r in rows:
-                if r.get("territories"):
-                    result.append({
-                        "id":   r["territories"]["id"],
-                        "name": r["territories"]["name"]
-                    })
-            return result
-
-        # ── Fetch this user's own territories first ──────────
-        territories_map = {}  # id -> territory dict (dedup)
-        for t in _fetch_territories(user_id):
-            territories_map[t["id"]] = t
-
-        # ── Check if user is a manager ────────────────────────
-        user_row = safe_exec(
-            admin_supabase.table("users")
-            .select("designation")
-            .eq("id", user_id)
-            .limit(1),
-            "Error loading user designation"
-        )
-        designation = user_row[0]["designation"] if user_row else ""
-
-        if designation in ("manager", "senior_manager"):
-            # ── Fetch all direct reports ──────────────────────
-            reps = safe_exec(
-                admin_supabase.table("users")
-                .select("id")
-                .eq("report_to", user_id)
-                .eq("is_active", True),
-                "Error loading direct reports"
-            )
-            for rep in reps:
-                for t in _fetch_territories(rep["id"]):
-                    territories_map[t["id"]] = t
-
-        return list(territories_map.values())
-
+        return scope_territories(user_id)
     except Exception as e:
         st.error(f"Error in get_user_territories: {str(e)}")
         return []
 
-def get_doctors_by_territories(territory_ids):
+def get_doctors_by_territories(territory_ids, user_id=None):
     """
     Get doctors practicing in given territories
     Returns list of {id, name, specialization}
+    With user_id, served from that user's cached doctor index when every
+    territory is one of theirs.
     """
     if not territory_ids:
         return []
+
+    if user_id:
+        from modules.dcr.masters_database import doctors_from_index
+        doctors = doctors_from_index(user_id, territory_ids)
+        if doctors is not None:
+            return doctors
     
     result = safe_exec(
         admin_supabase.table("doctor_territories")
@@ -594,14 +539,7 @@ def get_products_all():
     Get all active products
     Returns list of {id, name}
     """
-    result = safe_exec(
-        admin_supabase.table("products")
-        .select("id, name")
-        .order("name"),
-        "Error loading products"
-    )
-    
-    return result
+    return [{"id": p["id"], "name": p["name"]} for p in master_rows("products")]
 
 
 def get_managers_list():
@@ -636,9 +574,10 @@ def load_dcr_monthly_reports(user_id, year, month):
     Load all DCRs for user in given month/year
     Returns list of DCR summaries
     """
+    # Visit / gift counts are aggregated server-side in the same request
     result = safe_exec(
         admin_supabase.table("dcr_reports")
-        .select("*")
+        .select("*, dcr_doctor_visits(count), dcr_gifts(count)")
         .eq("user_id", user_id)
         .eq("year", year)
         .eq("month", month)
@@ -646,29 +585,19 @@ def load_dcr_monthly_reports(user_id, year, month):
         .order("report_date"),
         "Error loading monthly reports"
     )
-    
-    # Add counts for each report
+
+    def _count(embedded):
+        return (embedded or [{}])[0].get("count", 0)
+
     for report in result:
-        # Count doctor visits
-        doc_count = safe_exec(
-            admin_supabase.table("dcr_doctor_visits")
-            .select("id", count="exact")
-            .eq("dcr_report_id", report["id"]),
-            "Error counting doctors"
-        )
-        report["doctor_count"] = len(doc_count)
-        
+        report["doctor_count"] = _count(report.pop("dcr_doctor_visits", None))
+        report["gift_count"] = _count(report.pop("dcr_gifts", None))
+
         # Count chemists
-        chemist_ids = json.loads(report.get("chemist_ids") or "[]")
-        report["chemist_count"] = len(chemist_ids)
-        
-        # Count gifts
-        gift_count = safe_exec(
-            admin_supabase.table("dcr_gifts")
-            .select("id", count="exact")
-            .eq("dcr_report_id", report["id"]),
-            "Error counting gifts"
-        )
-        report["gift_count"] = len(gift_count)
+        try:
+            chemist_ids = json.loads(report.get("chemist_ids") or "[]")
+        except (TypeError, ValueError):
+            chemist_ids = report.get("chemist_ids") or []
+        report["chemist_count"] = len(chemist_ids) if isinstance(chemist_ids, list) else 0
     
     return result
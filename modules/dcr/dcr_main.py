@@ -674,7 +674,9 @@ def show_stage_2_visits():
     st.write("---")
     st.write("#### 👨‍⚕️ Doctor Visits")
     
-    doctors = get_doctors_by_territories(territory_ids)
+    doctors = get_doctors_by_territories(
+        territory_ids, user_id=st.session_state.get("dcr_user_id") or get_current_user_id()
+    )
     products = get_products_all()
     managers = get_managers_list()
     
@@ -1084,10 +1086,9 @@ def show_post_submit_screen():
 # ======================================================
 
 def show_expense_report():
-    """Admin-only expense calculation report."""
-    import urllib.parse
-    import io
+    """Admin-only expense calculation report (one user or all users)."""
     from anchors.supabase_client import admin_supabase, safe_exec
+    from modules.dcr.expense_engine import compute_expenses, user_slice
 
     role = st.session_state.get("role", "user")
     if role != "admin":
@@ -1107,25 +1108,24 @@ def show_expense_report():
 
     users = safe_exec(
         admin_supabase.table("users")
-        .select("id, username, daily_expense, km_allowance")
+        .select("id, username")
         .eq("is_active", True)
         .order("username"),
         "Error loading users"
     )
-    user_expense_map = {u["id"]: float(u.get("daily_expense") or 0) for u in users}
-    user_km_map = {u["id"]: float(u.get("km_allowance") or 0) for u in users}
     if not users:
         st.error("No users found.")
         return
 
     user_map = {u["id"]: u["username"] for u in users}
+    ALL = "__all__"
 
     col1, col2, col3 = st.columns(3)
     with col1:
         selected_user_id = st.selectbox(
             "Select User *",
-            options=list(user_map.keys()),
-            format_func=lambda x: user_map.get(x, x),
+            options=[ALL] + list(user_map.keys()),
+            format_func=lambda x: "\U0001f465 All users (payroll)" if x == ALL else user_map.get(x, x),
             key="exp_user"
         )
     with col2:
@@ -1154,148 +1154,74 @@ def show_expense_report():
     uid   = st.session_state.exp_user_id
     f_dt  = st.session_state.exp_from
     t_dt  = st.session_state.exp_to
-    uname = user_map.get(uid, "Unknown")
 
-    reports = safe_exec(
-        admin_supabase.table("dcr_reports")
-        .select(
-            "id, report_date, area_type, territory_ids, "
-            "km_travelled, misc_expense, misc_expense_details, status"
-        )
-        .eq("user_id", uid)
-        .eq("status", "submitted")
-        .eq("is_deleted", False)
-        .gte("report_date", f_dt)
-        .lte("report_date", t_dt)
-        .order("report_date"),
-        "Error loading reports"
-    )
-
-    if not reports:
-        st.warning(f"No submitted DCRs found for {uname} between {f_dt} and {t_dt}.")
+    if uid != ALL:
+        try:
+            expenses = compute_expenses((uid,), f_dt, t_dt)
+        except RuntimeError as e:
+            st.error(f"❌ Could not compute expenses: {e}")
+            return
+        _render_expense_detail(user_slice(expenses, uid), user_map.get(uid, "Unknown"), f_dt, t_dt)
         return
 
-    territories_all = safe_exec(
-        admin_supabase.table("territories").select("id, name"),
-        "Error loading territories"
-    )
-    terr_map = {str(t["id"]): t["name"] for t in territories_all}
+    # ── All users: one engine run, per-user summary, drill into any user ──
+    try:
+        with st.spinner(f"Computing expenses for {len(user_map)} users..."):
+            expenses = compute_expenses(tuple(user_map), f_dt, t_dt)
+    except RuntimeError as e:
+        st.error(f"❌ Could not compute expenses: {e}")
+        return
+    per_user = expenses["users"]
+    if per_user.empty:
+        st.warning(f"No submitted DCRs found between {f_dt} and {t_dt}.")
+        return
 
-    rows = []
-    for r in reports:
-        t_ids = r.get("territory_ids") or []
-        # territory_ids may come as a JSON string from Supabase — parse it
-        if isinstance(t_ids, str):
-            try:
-                import json as _json2
-                t_ids = _json2.loads(t_ids)
-            except Exception:
-                t_ids = []
-        if isinstance(t_ids, list) and t_ids:
-            resolved = []
-            for tid in t_ids:
-                name = terr_map.get(str(tid))
-                if not name:
-                    # try int form
-                    try:
-                        name = terr_map.get(str(int(tid)))
-                    except Exception:
-                        pass
-                resolved.append(name if name else str(tid)[:8])
-            terr_names = ", ".join(resolved) or "\u2014"
-        elif r.get("area_type") == "MEETING":
-            terr_names = "Meeting"
-        else:
-            terr_names = "\u2014"
+    import pandas as pd
+    summary = pd.concat([per_user.drop(columns="user_id"), expenses["total"]],
+                        ignore_index=True)
+    st.write(f"#### \U0001f465 Expense Summary \u2014 all users | {f_dt} to {t_dt}")
+    st.dataframe(summary, use_container_width=True, hide_index=True)
 
-        visits = safe_exec(
-            admin_supabase.table("dcr_doctor_visits")
-            .select("visited_with")
-            .eq("dcr_report_id", r["id"]),
-            "Error loading visits"
+    col_a, col_b = st.columns(2)
+    with col_a:
+        st.download_button(
+            "\U0001f4e5 Download Summary CSV",
+            data=summary.to_csv(index=False).encode("utf-8"),
+            file_name=f"expense_summary_{f_dt}_{t_dt}.csv",
+            mime="text/csv",
+            use_container_width=True
         )
-        num_doctors = len(visits)
-
-        gifts = safe_exec(
-            admin_supabase.table("dcr_gifts")
-            .select("gift_amount")
-            .eq("dcr_report_id", r["id"]),
-            "Error loading gifts"
+    with col_b:
+        st.download_button(
+            "\U0001f4e5 Download All Days CSV",
+            data=expenses["days"].drop(columns="user_id").to_csv(index=False).encode("utf-8"),
+            file_name=f"expense_days_{f_dt}_{t_dt}.csv",
+            mime="text/csv",
+            use_container_width=True
         )
-        total_gift = sum(float(g.get("gift_amount") or 0) for g in gifts)
-
-        visited_with_set = set()
-        for v in visits:
-            vw = v.get("visited_with", "")
-            if vw and vw != "single":
-                for vid in vw.split(","):
-                    vid = vid.strip()
-                    if vid and vid != "single":
-                        visited_with_set.add(vid)
-
-        # Keep only values that look like real UUIDs — older DCRs may have
-        # stored role words like "manager" in visited_with, which would
-        # crash a uuid column query.
-        def _is_uuid(s):
-            import re
-            return bool(re.fullmatch(
-                r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
-                r"[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", str(s)))
-
-        uuid_ids = [vid for vid in visited_with_set if _is_uuid(vid)]
-        non_uuid = [vid for vid in visited_with_set if not _is_uuid(vid)]
-
-        if uuid_ids:
-            mgr_rows = safe_exec(
-                admin_supabase.table("users")
-                .select("id, username")
-                .in_("id", uuid_ids),
-                "Error loading managers"
-            )
-            name_map = {m["id"]: m["username"] for m in mgr_rows}
-        else:
-            name_map = {}
-
-        labels = [name_map.get(vid, vid) for vid in uuid_ids] + non_uuid
-        visited_with_str = ", ".join(labels) if labels else "Self"
-        # Pull KM from Let's Go tracking_sessions for this date
-        tracking = safe_exec(
-            admin_supabase.table("tracking_sessions")
-            .select("total_km")
-            .eq("user_id", uid)
-            .eq("session_date", r["report_date"])
-            .eq("status", "completed"),
-            "Error loading tracking"
-        ) or []
-        lets_go_km = sum(float(t.get("total_km") or 0) for t in tracking)
-
-        daily_exp = user_expense_map.get(uid, 0)
-        km_rate = user_km_map.get(uid, 0)
-        dcr_km = float(r.get("km_travelled") or 0)
-        misc_exp = float(r.get("misc_expense") or 0)
-
-        # User Exp: (km_rate x dcr_km) + daily_exp + misc_expense
-        user_exp = round((km_rate * dcr_km) + daily_exp + misc_exp, 0)
-        # Lets Go Exp: (km_rate x lets_go_km) + daily_exp + misc_expense
-        lgo_exp = round((km_rate * lets_go_km) + daily_exp + misc_exp, 0)
-
-        rows.append({
-            "Date":                  r["report_date"],
-            "Territories":           terr_names,
-            "Visited With":          visited_with_str,
-            "Doctors Visited":       num_doctors,
-            "KM (DCR)":              round(dcr_km, 1),
-            "KM (Lets Go)":          round(lets_go_km, 1),
-            "KM Rate (₹/km)":        km_rate,
-            "Daily Exp (₹)":         daily_exp,
-            "Misc Expense (₹)":      misc_exp,
-            "User Exp (₹)":          user_exp,
-            "Lets Go Exp (₹)":       lgo_exp,
-            "Gifts Given (₹)":       total_gift,
-        })
 
+    st.write("---")
+    detail_uid = st.selectbox(
+        "View one user's days",
+        options=per_user["user_id"].tolist(),
+        format_func=lambda x: user_map.get(x, x),
+        key="exp_detail_user"
+    )
+    if detail_uid:
+        _render_expense_detail(user_slice(expenses, detail_uid),
+                               user_map.get(detail_uid, "Unknown"), f_dt, t_dt)
+
+
+def _render_expense_detail(df, uname, f_dt, t_dt):
+    """Day table, totals, CSV / PDF / WhatsApp for one user."""
+    import urllib.parse
+    import io
     import pandas as pd
-    df = pd.DataFrame(rows)
+
+    if df.empty:
+        st.warning(f"No submitted DCRs found for {uname} between {f_dt} and {t_dt}.")
+        return
+    rows = df.to_dict("records")
 
     totals = {
         "Date":                  "TOTAL",
@@ -9,6 +9,7 @@ from datetime import datetime, date, timedelta
 from modules.dcr.dcr_database import safe_exec, get_user_territories
 from modules.dcr.dcr_helpers import get_current_user_id
 from anchors.supabase_client import admin_supabase
+from modules.dcr.masters_database import doctors_from_index
 
 
 def run_doctor_fetch():
@@ -53,6 +54,21 @@ def run_doctor_fetch():
 # HOME SCREEN
 # ══════════════════════════════════════════════════════════════
 
+def _territory_doctors(territory_id):
+    """[{id, name, specialization}] for one territory — from the user's
+    cached doctor index when it is one of their territories."""
+    doctors = doctors_from_index(get_current_user_id(), [territory_id])
+    if doctors is not None:
+        return doctors
+    rows = safe_exec(
+        admin_supabase.table("doctor_territories")
+        .select("doctors(id, name, specialization)")
+        .eq("territory_id", territory_id),
+        "Error loading doctors"
+    )
+    return [d["doctors"] for d in rows if d.get("doctors")]
+
+
 def show_doctor_fetch_home():
     """
     Home screen with Update / Fetch / Capture Location options
@@ -133,14 +149,7 @@ def show_update_doctor_flow():
     if "doctor_fetch_doctor_id" not in st.session_state:
         territory_id = st.session_state.doctor_fetch_territory
 
-        doctors = safe_exec(
-            admin_supabase.table("doctor_territories")
-            .select("doctors(id, name, specialization)")
-            .eq("territory_id", territory_id),
-            "Error loading doctors"
-        )
-
-        doctor_list = [d["doctors"] for d in doctors if d.get("doctors")]
+        doctor_list = _territory_doctors(territory_id)
 
         if not doctor_list:
             st.warning("No doctors found in this territory")
@@ -632,13 +641,7 @@ def show_capture_location_flow():
 
     territory_id = st.session_state.doctor_fetch_territory
 
-    doctors = safe_exec(
-        admin_supabase.table("doctor_territories")
-        .select("doctors(id, name, specialization)")
-        .eq("territory_id", territory_id),
-        "Error loading doctors"
-    )
-    doctor_list = [d["doctors"] for d in doctors if d.get("doctors")]
+    doctor_list = _territory_doctors(territory_id)
 
     if not doctor_list:
         st.warning("No doctors found in this territory.")
@@ -779,14 +782,7 @@ def show_fetch_doctor_flow():
     if "doctor_fetch_doctor_id" not in st.session_state:
         territory_id = st.session_state.doctor_fetch_territory
 
-        doctors = safe_exec(
-            admin_supabase.table("doctor_territories")
-            .select("doctors(id, name, specialization)")
-            .eq("territory_id", territory_id),
-            "Error loading doctors"
-        )
-
-        doctor_list = [d["doctors"] for d in doctors if d.get("doctors")]
+        doctor_list = _territory_doctors(territory_id)
 
         if not doctor_list:
             st.warning("No doctors found in this territory")
@@ -12,6 +12,8 @@ import json
 from datetime import datetime
 import streamlit as st
 from anchors.supabase_client import admin_supabase, safe_exec
+from anchors.territory_scope import scope_territories
+from modules.dcr.masters_database import get_user_doctor_index
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -19,45 +21,18 @@ from anchors.supabase_client import admin_supabase, safe_exec
 # ─────────────────────────────────────────────────────────────────────────────
 
 def get_user_territories(user_id):
-    """Return [{id, name}] for territories assigned to user."""
-    result = safe_exec(
-        admin_supabase.table("user_territories")
-        .select("territory_id, territories(id, name)")
-        .eq("user_id", user_id),
-        "Error loading user territories"
-    )
-    territories = []
-    for r in result:
-        if r.get("territories"):
-            territories.append({
-                "id": r["territories"]["id"],
-                "name": r["territories"]["name"]
-            })
-    return territories
+    """Return [{id, name}] for territories assigned to user
+    (shared hierarchy index, anchors.territory_scope)."""
+    return scope_territories(user_id, include_reports=False)
 
 
 def get_doctors_for_user(user_id):
     """
     Return [{id, name, specialization}] for doctors in the user's territories.
+    Served from the shared cached per-user doctor index.
     """
-    territories = get_user_territories(user_id)
-    territory_ids = [t["id"] for t in territories]
-    if not territory_ids:
-        return []
-
-    result = safe_exec(
-        admin_supabase.table("doctor_territories")
-        .select("doctors(id, name, specialization)")
-        .in_("territory_id", territory_ids),
-        "Error loading doctors"
-    )
-
-    seen = {}
-    for r in result:
-        doc = r.get("doctors")
-        if doc and doc["id"] not in seen:
-            seen[doc["id"]] = doc
-    return list(seen.values())
+    index = get_user_doctor_index(user_id)
+    return list(index["doctors"].values())
 
 
 def get_all_users_active():
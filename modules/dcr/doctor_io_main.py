@@ -31,13 +31,13 @@ from modules.dcr.doctor_io_database import (
     load_io_report,
 )
 from modules.dcr.dcr_helpers import get_current_user_id
+from anchors.pdf_service import chunked_tables, pdf_download_button
 
 try:
     from reportlab.lib.pagesizes import A4
     from reportlab.lib import colors
     from reportlab.lib.units import cm
-    from reportlab.platypus import (SimpleDocTemplate, Table, TableStyle,
-                                    Paragraph, Spacer)
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
     from reportlab.lib.styles import getSampleStyleSheet
     REPORTLAB_OK = True
 except ImportError:
@@ -919,8 +919,7 @@ def _make_pdf_input(records, month, year):
         total += r["gift_amount"]
     data.append(["", "TOTAL", "", f"₹{total:,.2f}", "", ""])
 
-    tbl = Table(data, repeatRows=1)
-    tbl.setStyle(TableStyle([
+    elems.extend(chunked_tables(data, [
         ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1a6b5a")),
         ("TEXTCOLOR",  (0, 0), (-1, 0), colors.white),
         ("FONTNAME",   (0, 0), (-1, 0), "Helvetica-Bold"),
@@ -930,7 +929,6 @@ def _make_pdf_input(records, month, year):
         ("FONTNAME",   (0, -1), (-1, -1), "Helvetica-Bold"),
         ("ROWBACKGROUNDS", (0, 1), (-1, -2), [colors.white, colors.HexColor("#f5f5f5")]),
     ]))
-    elems.append(tbl)
 
     doc.build(elems)
     buf.seek(0)
@@ -960,8 +958,7 @@ def _make_pdf_output(records, month, year):
         total += r["sales_amount"]
     data.append(["TOTAL", f"₹{total:,.2f}", ""])
 
-    tbl = Table(data, repeatRows=1, colWidths=[7*cm, 5*cm, 7*cm])
-    tbl.setStyle(TableStyle([
+    elems.extend(chunked_tables(data, [
         ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1a4fa6")),
         ("TEXTCOLOR",  (0, 0), (-1, 0), colors.white),
         ("FONTNAME",   (0, 0), (-1, 0), "Helvetica-Bold"),
@@ -970,8 +967,7 @@ def _make_pdf_output(records, month, year):
         ("BACKGROUND", (0, -1), (-1, -1), colors.HexColor("#e8eef8")),
         ("FONTNAME",   (0, -1), (-1, -1), "Helvetica-Bold"),
         ("ROWBACKGROUNDS", (0, 1), (-1, -2), [colors.white, colors.HexColor("#f5f5f5")]),
-    ]))
-    elems.append(tbl)
+    ], col_widths=[7*cm, 5*cm, 7*cm]))
 
     doc.build(elems)
     buf.seek(0)
@@ -1012,16 +1008,14 @@ def _make_pdf_report(report_data, months, year):
     col_count = len(header)
     col_w = [5*cm] + [2.5*cm] * (col_count - 1)
 
-    tbl = Table(data, repeatRows=1, colWidths=col_w)
-    tbl.setStyle(TableStyle([
+    elems.extend(chunked_tables(data, [
         ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2c3e50")),
         ("TEXTCOLOR",  (0, 0), (-1, 0), colors.white),
         ("FONTNAME",   (0, 0), (-1, 0), "Helvetica-Bold"),
         ("FONTSIZE",   (0, 0), (-1, -1), 7),
         ("GRID",       (0, 0), (-1, -1), 0.3, colors.grey),
         ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f5f5f5")]),
-    ]))
-    elems.append(tbl)
+    ], col_widths=col_w))
 
     doc.build(elems)
     buf.seek(0)
@@ -1029,33 +1023,30 @@ def _make_pdf_report(report_data, months, year):
 
 
 def _pdf_download_btn_input(records, month, year):
-    buf = _make_pdf_input(records, month, year)
-    if buf:
-        st.download_button("📄 Download PDF", data=buf,
-                           file_name=f"doctor_input_{MONTHS[month]}_{year}.pdf",
-                           mime="application/pdf")
-    else:
+    if not pdf_download_button(
+        "📄 Download PDF", lambda: _make_pdf_input(records, month, year),
+        (records, month, year),
+        file_name=f"doctor_input_{MONTHS[month]}_{year}.pdf",
+    ):
         st.info("Install reportlab for PDF export.")
 
 
 def _pdf_download_btn_output(records, month, year):
-    buf = _make_pdf_output(records, month, year)
-    if buf:
-        st.download_button("📄 Download PDF", data=buf,
-                           file_name=f"doctor_output_{MONTHS[month]}_{year}.pdf",
-                           mime="application/pdf")
-    else:
+    if not pdf_download_button(
+        "📄 Download PDF", lambda: _make_pdf_output(records, month, year),
+        (records, month, year),
+        file_name=f"doctor_output_{MONTHS[month]}_{year}.pdf",
+    ):
         st.info("Install reportlab for PDF export.")
 
 
 def _pdf_download_btn_report(report_data, months, year):
-    buf = _make_pdf_report(report_data, months, year)
-    if buf:
-        mstr = MONTHS[months[0]] if len(months) == 1 else f"{MONTHS[months[0]]}-{MONTHS[months[-1]]}"
-        st.download_button("📄 Download Report PDF", data=buf,
-                           file_name=f"io_report_{mstr}_{year}.pdf",
-                           mime="application/pdf")
-    else:
+    mstr = MONTHS[months[0]] if len(months) == 1 else f"{MONTHS[months[0]]}-{MONTHS[months[-1]]}"
+    if not pdf_download_button(
+        "📄 Download Report PDF", lambda: _make_pdf_report(report_data, months, year),
+        (report_data, months, year),
+        file_name=f"io_report_{mstr}_{year}.pdf",
+    ):
         st.info("Install reportlab for PDF export.")
 
 
@@ -0,0 +1,212 @@
+"""
+DCR Expense Engine — modules/dcr/expense_engine.py
+
+Expense figures for any set of users over a date range, computed in a
+handful of grouped queries. show_expense_report used to run one user at a
+time with three queries per DCR day (visits, gifts, visited-with names)
+plus one tracking_sessions query per date — ~100 requests per rep, so
+month-end payroll for every rep meant thousands of round-trips.
+
+    e = compute_expenses(user_ids, from_date, to_date)
+    e["days"]   one row per submitted DCR (user × day)
+    e["users"]  one row per user with any DCR in the range
+    e["total"]  one row, all users
+
+Loads (each an .in_() batch via fetch_in, not a per-row query):
+  users (rates), dcr_reports, territories, then concurrently
+  dcr_doctor_visits, dcr_gifts and completed tracking_sessions.
+Visited-with names come from the master user cache. A failed load raises
+— the expenses are never computed (and cached) from an empty list.
+
+Formulas (unchanged):
+  User Exp    = km_rate × KM (DCR)     + daily_exp + misc_expense
+  Lets Go Exp = km_rate × KM (Lets Go) + daily_exp + misc_expense
+each rounded to the rupee per day.
+"""
+
+import json
+import re
+
+import pandas as pd
+import streamlit as st
+
+from anchors.supabase_client import _pool, admin_supabase, fetch_all, fetch_in
+from anchors.master_cache import master_index
+
+
+DAY_COLS = [
+    "User", "Date", "Territories", "Visited With", "Doctors Visited",
+    "KM (DCR)", "KM (Lets Go)", "KM Rate (₹/km)", "Daily Exp (₹)",
+    "Misc Expense (₹)", "User Exp (₹)", "Lets Go Exp (₹)", "Gifts Given (₹)",
+]
+SUM_COLS = [
+    "Doctors Visited", "KM (DCR)", "KM (Lets Go)", "Daily Exp (₹)",
+    "Misc Expense (₹)", "User Exp (₹)", "Lets Go Exp (₹)", "Gifts Given (₹)",
+]
+
+_UUID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+                   r"[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ROW HELPERS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _territory_label(report, terr_map):
+    t_ids = report.get("territory_ids") or []
+    # territory_ids may come as a JSON string from Supabase — parse it
+    if isinstance(t_ids, str):
+        try:
+            t_ids = json.loads(t_ids)
+        except Exception:
+            t_ids = []
+    if isinstance(t_ids, list) and t_ids:
+        resolved = []
+        for tid in t_ids:
+            name = terr_map.get(str(tid))
+            if not name:
+                # try int form
+                try:
+                    name = terr_map.get(str(int(tid)))
+                except Exception:
+                    pass
+            resolved.append(name if name else str(tid)[:8])
+        return ", ".join(resolved) or "—"
+    if report.get("area_type") == "MEETING":
+        return "Meeting"
+    return "—"
+
+
+def _visited_with_label(values, user_names):
+    """Comma-joined visited_with values of one DCR -> display names.
+    Older DCRs may have stored role words like "manager" instead of a
+    user id; those are shown as-is."""
+    ids = set()
+    for vw in values:
+        if vw and vw != "single":
+            for vid in str(vw).split(","):
+                vid = vid.strip()
+                if vid and vid != "single":
+                    ids.add(vid)
+    uuid_ids = sorted(v for v in ids if _UUID.fullmatch(v))
+    non_uuid = sorted(v for v in ids if not _UUID.fullmatch(v))
+    labels = [(user_names.get(v) or {}).get("username", v) for v in uuid_ids] + non_uuid
+    return ", ".join(labels) if labels else "Self"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ENGINE
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _empty():
+    days = pd.DataFrame(columns=["user_id"] + DAY_COLS)
+    users = pd.DataFrame(columns=["user_id", "User", "Days"] + SUM_COLS)
+    return {"days": days, "users": users, "total": _total_row(users)}
+
+
+def _total_row(users):
+    total = {"User": "TOTAL", "Days": int(users["Days"].sum()) if len(users) else 0}
+    total.update({c: users[c].sum() if len(users) else 0 for c in SUM_COLS})
+    return pd.DataFrame([total])
+
+
+@st.cache_data(ttl=300, max_entries=16, show_spinner=False)
+def compute_expenses(user_ids, from_date, to_date):
+    """Expense frames for `user_ids` (tuple) between from_date and to_date
+    (ISO strings, inclusive). Only submitted, non-deleted DCRs count."""
+    user_ids = [str(u) for u in dict.fromkeys(user_ids or []) if u]
+    if not user_ids:
+        return _empty()
+
+    users = fetch_in(
+        lambda: admin_supabase.table("users").select("id, username, daily_expense, km_allowance"),
+        "id", user_ids, "Error loading users",
+    )
+    reports = fetch_in(
+        lambda: admin_supabase.table("dcr_reports")
+        .select("id, user_id, report_date, area_type, territory_ids, "
+                "km_travelled, misc_expense, misc_expense_details, status")
+        .eq("status", "submitted")
+        .eq("is_deleted", False)
+        .gte("report_date", from_date)
+        .lte("report_date", to_date),
+        "user_id", user_ids, "Error loading reports",
+    )
+    if not reports:
+        return _empty()
+
+    report_ids = [r["id"] for r in reports]
+    # _pool threads carry the script-run context; a failed fetch raises
+    # out of .result() instead of coming back as [] (and being cached)
+    with _pool(4) as pool:
+        terr_f = pool.submit(fetch_all, lambda: admin_supabase.table("territories")
+                             .select("id, name"), "Error loading territories")
+        visits_f = pool.submit(fetch_in, lambda: admin_supabase.table("dcr_doctor_visits")
+                               .select("id, dcr_report_id, visited_with"),
+                               "dcr_report_id", report_ids, "Error loading visits")
+        gifts_f = pool.submit(fetch_in, lambda: admin_supabase.table("dcr_gifts")
+                              .select("id, dcr_report_id, gift_amount"),
+                              "dcr_report_id", report_ids, "Error loading gifts")
+        track_f = pool.submit(fetch_in, lambda: admin_supabase.table("tracking_sessions")
+                              .select("id, user_id, session_date, total_km")
+                              .eq("status", "completed")
+                              .gte("session_date", from_date)
+                              .lte("session_date", to_date),
+                              "user_id", user_ids, "Error loading tracking")
+        terr_map = {str(t["id"]): t["name"] for t in terr_f.result()}
+        visits, gifts, tracking = visits_f.result(), gifts_f.result(), track_f.result()
+
+    rates = {u["id"]: u for u in users}
+    user_names = master_index("users")
+
+    visit_vals = {}
+    for v in visits:
+        visit_vals.setdefault(v["dcr_report_id"], []).append(v.get("visited_with", ""))
+    gift_sum = pd.DataFrame(gifts, columns=["dcr_report_id", "gift_amount"]) \
+        .assign(gift_amount=lambda d: pd.to_numeric(d["gift_amount"], errors="coerce").fillna(0.0)) \
+        .groupby("dcr_report_id")["gift_amount"].sum()
+    lets_go = pd.DataFrame(tracking, columns=["user_id", "session_date", "total_km"]) \
+        .assign(total_km=lambda d: pd.to_numeric(d["total_km"], errors="coerce").fillna(0.0),
+                session_date=lambda d: d["session_date"].astype(str).str[:10]) \
+        .groupby(["user_id", "session_date"])["total_km"].sum()
+
+    rows = []
+    for r in reports:
+        uid = r["user_id"]
+        u = rates.get(uid) or {}
+        day = str(r["report_date"])[:10]
+        daily_exp = float(u.get("daily_expense") or 0)
+        km_rate = float(u.get("km_allowance") or 0)
+        dcr_km = float(r.get("km_travelled") or 0)
+        misc_exp = float(r.get("misc_expense") or 0)
+        lets_go_km = float(lets_go.get((uid, day), 0.0))
+        rows.append({
+            "user_id":               uid,
+            "User":                  u.get("username") or "Unknown",
+            "Date":                  r["report_date"],
+            "Territories":           _territory_label(r, terr_map),
+            "Visited With":          _visited_with_label(visit_vals.get(r["id"], []), user_names),
+            "Doctors Visited":       len(visit_vals.get(r["id"], [])),
+            "KM (DCR)":              round(dcr_km, 1),
+            "KM (Lets Go)":          round(lets_go_km, 1),
+            "KM Rate (₹/km)":        km_rate,
+            "Daily Exp (₹)":         daily_exp,
+            "Misc Expense (₹)":      misc_exp,
+            "User Exp (₹)":          round((km_rate * dcr_km) + daily_exp + misc_exp, 0),
+            "Lets Go Exp (₹)":       round((km_rate * lets_go_km) + daily_exp + misc_exp, 0),
+            "Gifts Given (₹)":       float(gift_sum.get(r["id"], 0.0)),
+        })
+
+    days = pd.DataFrame(rows, columns=["user_id"] + DAY_COLS) \
+        .sort_values(["User", "Date"], ignore_index=True)
+    per_user = days.groupby(["user_id", "User"], as_index=False) \
+        .agg(Days=("Date", "size"), **{c: (c, "sum") for c in SUM_COLS}) \
+        .sort_values("User", ignore_index=True)
+    return {"days": days, "users": per_user, "total": _total_row(per_user)}
+
+
+def user_slice(expenses, user_id):
+    """One user's day rows, display columns only (the single-user report)."""
+    days = expenses["days"]
+    return days[days["user_id"] == str(user_id)].drop(columns=["user_id", "User"]) \
+        .reset_index(drop=True)
@@ -4,7 +4,8 @@ Handles all database queries for doctors and chemists masters
 """
 
 import streamlit as st
-from anchors.supabase_client import admin_supabase, safe_exec
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_all
+from anchors.territory_scope import scope_territories
 
 
 # ======================================================
@@ -14,27 +15,10 @@ from anchors.supabase_client import admin_supabase, safe_exec
 def get_user_territories(user_id):
     """
     Get territories assigned to a user
-    Returns list of {id, name}
+    Returns list of {id, name}, alphabetical by name
+    (shared hierarchy index, anchors.territory_scope)
     """
-    result = safe_exec(
-        admin_supabase.table("user_territories")
-        .select("territory_id, territories(id, name)")
-        .eq("user_id", user_id),
-        "Error loading user territories"
-    )
-    
-    territories = []
-    for r in result:
-        if r.get("territories"):
-            territories.append({
-                "id": r["territories"]["id"],
-                "name": r["territories"]["name"]
-            })
-
-    # Alphabetical by name (case-insensitive)
-    territories.sort(key=lambda t: (t.get("name") or "").lower())
-
-    return territories
+    return scope_territories(user_id, include_reports=False)
 
 
 def get_all_users():
@@ -142,6 +126,15 @@ def get_chemists_by_territories(territory_ids):
 # DOCTORS CRUD
 # ======================================================
 
+# Embedded link rows for the doctors list — one request per page of
+# doctors instead of two per doctor.
+_DOCTOR_LIST_SELECT = (
+    "id, name, specialization, phone, clinic_address, is_active, "
+    "doctor_territories(territory_id, territories(id, name)), "
+    "doctor_stockists(stockist_id, stockists(name))"
+)
+
+
 def get_doctors_list(user_id, search=None, territory_id=None, active_only=True, all_territories=False):
     """
     Get list of doctors.
@@ -149,10 +142,9 @@ def get_doctors_list(user_id, search=None, territory_id=None, active_only=True,
     - Admin (all_territories=True): NOT scoped to a user; can see every doctor,
       optionally filtered by a specific territory or a name search.
 
-    Efficient paths:
-    - If territory_id is given, fetch only that territory's doctors via
-      doctor_territories (fast, e.g. BERHAMPORE HQ -> its doctors).
-    - If a search is given, the name filter limits the set.
+    Territories and stockists come embedded in the doctors select, and the
+    user / territory scoping is an inner join on doctor_territories, so the
+    whole list is a single (paged) query however many doctors match.
     """
     # Determine user scoping
     if all_territories:
@@ -162,81 +154,92 @@ def get_doctors_list(user_id, search=None, territory_id=None, active_only=True,
         if not scope_territory_ids:
             return []
 
-    # Territory-first: if a territory filter is set, get its doctor ids directly
-    candidate_ids = None
+    # Inner-joined aliases only filter; the un-aliased embed above keeps
+    # every territory of a matching doctor for display.
+    select = _DOCTOR_LIST_SELECT
+    if scope_territory_ids is not None:
+        select += ", in_scope:doctor_territories!inner(territory_id)"
     if territory_id:
-        dt_rows = safe_exec(
-            admin_supabase.table("doctor_territories")
-            .select("doctor_id")
-            .eq("territory_id", territory_id),
-            "Error loading doctor territories"
-        ) or []
-        candidate_ids = list({r['doctor_id'] for r in dt_rows})
-        if not candidate_ids:
-            return []
-
-    # Build the doctors query
-    query = admin_supabase.table("doctors").select("""
-        id,
-        name,
-        specialization,
-        phone,
-        clinic_address,
-        is_active
-    """)
-
-    if active_only:
-        query = query.eq("is_active", True)
-
-    if search:
-        query = query.ilike("name", f"%{search}%")
-
-    if candidate_ids is not None:
-        query = query.in_("id", candidate_ids)
+        select += ", in_territory:doctor_territories!inner(territory_id)"
+
+    def _q():
+        query = admin_supabase.table("doctors").select(select)
+        if active_only:
+            query = query.eq("is_active", True)
+        if search:
+            query = query.ilike("name", f"%{search}%")
+        if scope_territory_ids is not None:
+            query = query.in_("in_scope.territory_id", scope_territory_ids)
+        if territory_id:
+            query = query.eq("in_territory.territory_id", territory_id)
+        return query
 
-    doctors = safe_exec(query.order("name"), "Error loading doctors") or []
+    doctors = fetch_all(_q, "Error loading doctors")
+    doctors.sort(key=lambda d: (d.get("name") or "").lower())
 
-    # Enrich + filter
+    # Flatten the embedded links
     result = []
     for doctor in doctors:
-        doc_territories = safe_exec(
-            admin_supabase.table("doctor_territories")
-            .select("territory_id, territories(id, name)")
-            .eq("doctor_id", doctor['id']),
-            "Error loading doctor territories"
-        ) or []
+        doc_territories = doctor.pop("doctor_territories", None) or []
+        doc_stockists = doctor.pop("doctor_stockists", None) or []
+        doctor.pop("in_scope", None)
+        doctor.pop("in_territory", None)
 
-        doctor_territory_ids = [dt['territory_id'] for dt in doc_territories]
-
-        # User scoping (admin bypasses this)
-        if scope_territory_ids is not None:
-            if not any(tid in scope_territory_ids for tid in doctor_territory_ids):
-                continue
+        doctor['territory_names'] = [dt['territories']['name'] for dt in doc_territories if dt.get('territories')]
+        doctor['territory_ids'] = [dt['territory_id'] for dt in doc_territories]
+        doctor['stockist_names'] = [ds['stockists']['name'] for ds in doc_stockists if ds.get('stockists')]
+        doctor['chemist_ids'] = []  # TODO: Implement when table exists
 
-        # Territory filter (already pre-filtered, but keep as safety)
-        if territory_id and territory_id not in doctor_territory_ids:
-            continue
+        result.append(doctor)
 
-        territory_names = [dt['territories']['name'] for dt in doc_territories if dt.get('territories')]
+    return result
 
-        doc_stockists = safe_exec(
-            admin_supabase.table("doctor_stockists")
-            .select("stockist_id, stockists(name)")
-            .eq("doctor_id", doctor['id']),
-            "Error loading doctor stockists"
-        ) or []
-        stockist_names = [ds['stockists']['name'] for ds in doc_stockists if ds.get('stockists')]
 
-        chemist_ids = []  # TODO: Implement when table exists
+@st.cache_data(ttl=300, show_spinner=False)
+def get_user_doctor_index(user_id):
+    """
+    Cached per-user doctor index shared by DCR stage 2, Doctor Fetch and
+    Doctor I/O:
+        {"territory_ids": [...],                  # the user's territories
+         "doctors": {id: {id, name, specialization}},
+         "by_territory": {territory_id: [doctor ids, by name]}}
+    One query (doctors inner-joined to the user's doctor_territories).
+    Cleared by create / update / delete doctor.
+    """
+    territory_ids = [t["id"] for t in get_user_territories(user_id)]
+    index = {"territory_ids": territory_ids, "doctors": {}, "by_territory": {}}
+    if not territory_ids:
+        return index
 
-        doctor['territory_names'] = territory_names
-        doctor['territory_ids'] = doctor_territory_ids
-        doctor['stockist_names'] = stockist_names
-        doctor['chemist_ids'] = chemist_ids
+    rows = fetch_all(
+        lambda: admin_supabase.table("doctors")
+        .select("id, name, specialization, doctor_territories!inner(territory_id)")
+        .in_("doctor_territories.territory_id", territory_ids),
+        "Error loading doctors",
+    )
+    rows.sort(key=lambda d: (d.get("name") or "").lower())
+    for r in rows:
+        links = r.pop("doctor_territories", None) or []
+        index["doctors"][r["id"]] = r
+        for link in links:
+            index["by_territory"].setdefault(link["territory_id"], []).append(r["id"])
+    return index
 
-        result.append(doctor)
 
-    return result
+def doctors_from_index(user_id, territory_ids):
+    """
+    [{id, name, specialization}] for territory_ids from the user's cached
+    index, or None if any territory is outside the user's own (caller then
+    queries directly).
+    """
+    index = get_user_doctor_index(user_id)
+    if not set(territory_ids) <= set(index["territory_ids"]):
+        return None
+    seen = {}
+    for tid in territory_ids:
+        for did in index["by_territory"].get(tid, []):
+            seen.setdefault(did, index["doctors"][did])
+    return list(seen.values())
 
 
 def get_doctor_by_id(doctor_id):
@@ -340,7 +343,8 @@ def create_doctor(name, specialization, phone, clinic_address, territory_ids, st
         pass
 
     # TODO: Link chemists when table exists
-    
+
+    get_user_doctor_index.clear()
     return doctor_id
 
 
@@ -410,6 +414,8 @@ def update_doctor(doctor_id, name, specialization, phone, clinic_address, territ
 
     # TODO: Update chemists when table exists
 
+    get_user_doctor_index.clear()
+
 
 def check_doctor_has_dcr_visits(doctor_id):
     """
@@ -437,6 +443,7 @@ def delete_doctor_soft(doctor_id, deleted_by):
         }).eq("id", doctor_id),
         "Error deleting doctor"
     )
+    get_user_doctor_index.clear()
 
 
 # ======================================================
@@ -1,62 +1,106 @@
 """
 Tour Programme Database Operations
 Handles all CRUD operations for tour programmes
+
+The list read path (list_tour_programmes) pages by tour_date inside a
+date window. Per page it makes one query for the tours and one batched
+read each of tour_programme_doctors / tour_programme_chemists for the
+counts. Territory, user and approver names come from the master cache.
+The old lists ran three queries per tour, over every tour ever created.
 """
 
-from anchors.supabase_client import admin_supabase, safe_exec
+import streamlit as st
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_in
+from anchors.master_cache import master_index
+from collections import Counter
 from datetime import datetime
 import json
 
 
-def get_tour_programmes_list(user_id, status_filter=None, search=None):
-    """Get list of tour programmes for a user"""
-    # Build query step by step
-    
-    query = admin_supabase.table("tour_programmes").select("id, tour_date, territory_ids, worked_with_type, notes, status, approved_by, approved_at, approval_comment, created_at, user_id").eq("user_id", user_id).is_("deleted_at", None)
-    
+TOUR_PAGE_SIZE = 25
+
+_TOUR_COLS = ("id, tour_date, territory_ids, worked_with_type, notes, status, approved_by, "
+              "approved_at, approval_comment, created_at, user_id")
+
+
+def _parse_ids(territory_ids):
+    if isinstance(territory_ids, str):
+        try:
+            return json.loads(territory_ids) if territory_ids.strip() else []
+        except Exception:
+            return []
+    return territory_ids or []
+
+
+def _child_counts(table, tour_ids):
+    """{tour_id: row count} for one child table, one batched read for the
+    whole page (PostgREST aggregates are off by default on Supabase)."""
+    rows = fetch_in(
+        lambda: admin_supabase.table(table).select("id, tour_programme_id"),
+        "tour_programme_id", tour_ids, f"Error counting {table}",
+    )
+    return Counter(r["tour_programme_id"] for r in rows)
+
+
+def _enrich_tours(tours):
+    """Territory names, doctor / chemist counts, user and approver names
+    for a page of tours — two batched reads plus the master caches."""
+    ids = [t["id"] for t in tours]
+    doctors = _child_counts("tour_programme_doctors", ids)
+    chemists = _child_counts("tour_programme_chemists", ids)
+    territories = {str(k): t["name"] for k, t in master_index("territories").items()}
+    users = master_index("users")
+    for tour in tours:
+        tour['territory_names'] = [
+            territories[str(tid)] for tid in _parse_ids(tour.get('territory_ids'))
+            if str(tid) in territories
+        ]
+        tour['doctor_count'] = doctors.get(tour['id'], 0)
+        tour['chemist_count'] = chemists.get(tour['id'], 0)
+        tour['user_name'] = (users.get(tour.get('user_id')) or {}).get('username', 'Unknown')
+        tour['approver_name'] = (users.get(tour.get('approved_by')) or {}).get('username') \
+            if tour.get('approved_by') else None
+    return tours
+
+
+def list_tour_programmes(user_id=None, status_filter=None, search=None,
+                         date_from=None, date_to=None, page=0, page_size=TOUR_PAGE_SIZE):
+    """
+    One page of tours (newest tour_date first), enriched.
+    user_id None = all users (admin). date_from / date_to bound tour_date
+    (inclusive, either may be None). Returns (tours, total matching).
+    """
+    query = admin_supabase.table("tour_programmes") \
+        .select(_TOUR_COLS, count="exact") \
+        .is_("deleted_at", None)
+    if user_id:
+        query = query.eq("user_id", user_id)
     if status_filter:
         query = query.eq("status", status_filter)
-    
     if search:
         query = query.ilike("notes", f"%{search}%")
-    
-    tours = safe_exec(query.order("tour_date", desc=True), "Error loading tours")
-    
-    if not tours:
-        return []
-    
-    # Enrich with territory names and counts
-    for tour in tours:
-        territory_ids = tour.get('territory_ids', [])
-        if isinstance(territory_ids, str):
-            try:
-                territory_ids = json.loads(territory_ids) if territory_ids.strip() else []
-            except Exception:
-                territory_ids = []
-        
-        if territory_ids:
-            territories = safe_exec(
-                admin_supabase.table("territories").select("name").in_("id", territory_ids),
-                "Error loading territory names"
-            )
-            tour['territory_names'] = [t['name'] for t in territories]
-        else:
-            tour['territory_names'] = []
-        
-        doctor_count = safe_exec(
-            admin_supabase.table("tour_programme_doctors").select("id").eq("tour_programme_id", tour['id']),
-            "Error counting doctors"
-        )
-        tour['doctor_count'] = len(doctor_count)
-        
-        chemist_count = safe_exec(
-            admin_supabase.table("tour_programme_chemists").select("id").eq("tour_programme_id", tour['id']),
-            "Error counting chemists"
-        )
-        tour['chemist_count'] = len(chemist_count)
-        tour['approver_name'] = None
-    
-    return tours
+    if date_from:
+        query = query.gte("tour_date", str(date_from))
+    if date_to:
+        query = query.lte("tour_date", str(date_to))
+
+    start = page * page_size
+    try:
+        resp = query.order("tour_date", desc=True).order("id", desc=True) \
+            .range(start, start + page_size - 1).execute()
+    except Exception as e:
+        st.error(f"Error loading tours: {e}")
+        return [], 0
+    tours = resp.data or []
+    total = resp.count if resp.count is not None else start + len(tours)
+    return (_enrich_tours(tours) if tours else []), total
+
+
+def get_tour_programmes_list(user_id, status_filter=None, search=None,
+                             date_from=None, date_to=None):
+    """Get list of tour programmes for a user (first page)"""
+    return list_tour_programmes(user_id, status_filter, search, date_from, date_to)[0]
+
 
 def get_tour_by_id(tour_id):
     """Get complete tour programme details"""
@@ -99,7 +143,8 @@ def get_tour_by_id(tour_id):
     )
     tour_data['chemist_ids'] = [tc['chemist_id'] for tc in tour_chemists]
     tour_data['chemists'] = []
-    tour_data['approver_name'] = None
+    tour_data['approver_name'] = (master_index("users").get(tour_data.get('approved_by')) or {}) \
+        .get('username') if tour_data.get('approved_by') else None
     
     return tour_data
 
@@ -306,50 +351,7 @@ def reject_tour_programme(tour_id, admin_user_id, comment):
         "Error creating audit log"
     )
 
-def get_all_tour_programmes_admin(status_filter=None, search=None):
-    """Get ALL tour programmes (admin only)"""
-    query = admin_supabase.table("tour_programmes").select("id, tour_date, territory_ids, worked_with_type, notes, status, approved_by, approved_at, approval_comment, created_at, user_id").is_("deleted_at", None)
-    
-    if status_filter:
-        query = query.eq("status", status_filter)
-    
-    if search:
-        query = query.ilike("notes", f"%{search}%")
-    
-    tours = safe_exec(query.order("tour_date", desc=True), "Error loading tours")
-    
-    if not tours:
-        return []
-    
-    # Enrich (same as get_tour_programmes_list)
-    for tour in tours:
-        territory_ids = tour.get('territory_ids', [])
-        if isinstance(territory_ids, str):
-            try:
-                territory_ids = json.loads(territory_ids) if territory_ids.strip() else []
-            except Exception:
-                territory_ids = []
-        
-        if territory_ids:
-            territories = safe_exec(
-                admin_supabase.table("territories").select("name").in_("id", territory_ids),
-                "Error loading territory names"
-            )
-            tour['territory_names'] = [t['name'] for t in territories]
-        else:
-            tour['territory_names'] = []
-        
-        doctor_count = safe_exec(
-            admin_supabase.table("tour_programme_doctors").select("id").eq("tour_programme_id", tour['id']),
-            "Error counting doctors"
-        )
-        tour['doctor_count'] = len(doctor_count)
-        
-        chemist_count = safe_exec(
-            admin_supabase.table("tour_programme_chemists").select("id").eq("tour_programme_id", tour['id']),
-            "Error counting chemists"
-        )
-        tour['chemist_count'] = len(chemist_count)
-        tour['approver_name'] = None
-    
-    return tours
+def get_all_tour_programmes_admin(status_filter=None, search=None,
+                                  date_from=None, date_to=None):
+    """Get ALL tour programmes (admin only, first page)"""
+    return list_tour_programmes(None, status_filter, search, date_from, date_to)[0]
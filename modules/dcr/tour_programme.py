@@ -6,7 +6,8 @@ Plan and manage daily tour programmes
 import streamlit as st
 from datetime import date, datetime, timedelta
 from modules.dcr.tour_database import (
-    get_tour_programmes_list,
+    list_tour_programmes,
+    TOUR_PAGE_SIZE,
     get_tour_by_id,
     create_tour_programme,
     update_tour_programme,
@@ -95,6 +96,12 @@ def show_tour_list():
         st.write("---")
     
     # Filters and search
+    col_from, col_to = st.columns(2)
+    with col_from:
+        date_from = st.date_input("From", value=date.today() - timedelta(days=60), key="tour_date_from")
+    with col_to:
+        date_to = st.date_input("To", value=date.today() + timedelta(days=60), key="tour_date_to")
+
     col1, col2, col3 = st.columns([2, 2, 1])
     
     with col1:
@@ -119,20 +126,38 @@ def show_tour_list():
     
     st.write("---")
     
-    # Get tours based on admin selection
-    if role == "admin" and view_mode == 'all':
-        # Get ALL tours for all users
-        from modules.dcr.tour_database import get_all_tour_programmes_admin
-        tours = get_all_tour_programmes_admin(status_filter, search)
-    else:
-        # Get tours for specific user
-        tours = get_tour_programmes_list(selected_user_id, status_filter, search)
+    # Get tours based on admin selection (all users = no user filter)
+    list_user_id = None if (role == "admin" and view_mode == 'all') else selected_user_id
+
+    # Back to the first page whenever the filters change
+    filter_sig = (list_user_id, status_filter, search, str(date_from), str(date_to))
+    if st.session_state.get("tour_list_sig") != filter_sig:
+        st.session_state.tour_list_sig = filter_sig
+        st.session_state.tour_list_page = 0
+    page = st.session_state.get("tour_list_page", 0)
+
+    tours, total = list_tour_programmes(list_user_id, status_filter, search,
+                                        date_from, date_to, page=page)
+    pages = max(1, -(-total // TOUR_PAGE_SIZE))
     
-    st.write(f"### 📋 Tour Programmes ({len(tours)} found)")
+    st.write(f"### 📋 Tour Programmes ({total} found)")
     
     if not tours:
         st.info("No tour programmes found. Click 'Create Tour' to start planning!")
         return
+
+    if pages > 1:
+        col_prev, col_info, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if st.button("◀ Newer", key="tour_page_prev", disabled=page == 0, use_container_width=True):
+                st.session_state.tour_list_page = page - 1
+                st.rerun()
+        with col_info:
+            st.caption(f"Page {page + 1} of {pages}")
+        with col_next:
+            if st.button("Older ▶", key="tour_page_next", disabled=page >= pages - 1, use_container_width=True):
+                st.session_state.tour_list_page = page + 1
+                st.rerun()
     
     # Display tours
     for tour in tours:
@@ -153,11 +178,7 @@ def show_tour_list():
                 
                 # Show user if admin
                 if role == "admin":
-                    from modules.dcr.masters_database import get_all_users
-                    users = get_all_users()
-                    user_dict = {u['id']: u['username'] for u in users}
-                    tour_username = user_dict.get(tour.get('user_id'), 'Unknown')
-                    st.write(f"**👤 User:** {tour_username}")
+                    st.write(f"**👤 User:** {tour.get('user_name', 'Unknown')}")
                 
                 st.write(f"**🗺️ Territories:** {', '.join(tour['territory_names'])}")
                 st.write(f"**👥 Worked With:** {tour['worked_with_type'].replace('_', ' ').title()}")
@@ -169,7 +190,7 @@ def show_tour_list():
                 # Show approval details
                 if tour['status'] in ['approved', 'rejected']:
                     st.write("---")
-                    st.write(f"**{'✅ Approved' if tour['status'] == 'approved' else '❌ Rejected'} by:** {tour.get('approver_name', 'Unknown')}")
+                    st.write(f"**{'✅ Approved' if tour['status'] == 'approved' else '❌ Rejected'} by:** {tour.get('approver_name') or 'Unknown'}")
                     if tour.get('approved_at'):
                         st.write(f"**On:** {tour['approved_at'][:10]}")
                     if tour.get('approval_comment'):
@@ -759,7 +780,7 @@ def show_view_tour():
     # Approval details
     if tour['status'] in ['approved', 'rejected']:
         st.write(f"**{'✅ APPROVED' if tour['status'] == 'approved' else '❌ REJECTED'} BY:**")
-        st.write(f"• {tour.get('approver_name', 'Unknown')}")
+        st.write(f"• {tour.get('approver_name') or 'Unknown'}")
         st.write(f"• On: {tour['approved_at'][:10] if tour.get('approved_at') else 'N/A'}")
         if tour.get('approval_comment'):
             st.write(f"• Comment: {tour['approval_comment']}")
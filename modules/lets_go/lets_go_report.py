@@ -9,17 +9,30 @@ Reads server-side tables written by the Flutter app:
 Features:
   Tab 1 — Daily Overview: all reps for a date range (sessions, KM, stops)
   Tab 2 — Session Detail: route map, stops with matched doctors, events
+  Tab 3 — Archive: compact old sessions' pings into session_routes
 Timestamps are stored in UTC; displayed here in IST (+5:30).
 """
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 from datetime import datetime, date, timedelta
 from anchors.supabase_client import admin_supabase, safe_exec
+from modules.lets_go.route_service import (
+    ARCHIVE_AFTER_DAYS, route_points, route_polyline, session_stamp,
+)
+from modules.lets_go import route_archive
 
 IST_OFFSET = timedelta(hours=5, minutes=30)
-MAX_PINGS = 15000          # safety cap per session
-CHUNK = 1000               # supabase page size
+
+# Route detail levels for the map: label -> zoom the line is simplified
+# for (None = every GPS point, loaded only when picked).
+ROUTE_DETAIL = {
+    "Overview": 12,
+    "Neighbourhood": 14,
+    "Street": 16,
+    "Full resolution": None,
+}
 
 
 # ──────────────────────────────────────────────────────────────
@@ -63,55 +76,6 @@ def _get_sessions(from_d, to_d, user_id=None):
     return safe_exec(q, "Error loading sessions") or []
 
 
-def _get_pings(session_id):
-    """Fetch ALL pings for a session in pages of 1000 (avoids the row cap)."""
-    all_rows = []
-    start = 0
-    while start < MAX_PINGS:
-        rows = safe_exec(
-            admin_supabase.table("tracking_pings")
-            .select("latitude, longitude, snapped_latitude, snapped_longitude, "
-                    "ping_time, speed, battery_level, gps_status, internet_status, "
-                    "segment_km, is_moving")
-            .eq("session_id", session_id)
-            .order("ping_time")
-            .range(start, start + CHUNK - 1),
-            "Error loading GPS pings"
-        ) or []
-        all_rows.extend(rows)
-        if len(rows) < CHUNK:
-            break
-        start += CHUNK
-    return all_rows
-
-
-def _get_archived_route(session_id):
-    """Fallback for sessions archived by the monthly pg_cron job."""
-    rows = safe_exec(
-        admin_supabase.table("session_routes")
-        .select("route_points, total_km")
-        .eq("session_id", session_id)
-        .limit(1),
-        "Error loading archived route"
-    ) or []
-    if not rows:
-        return []
-    pts = rows[0].get("route_points") or []
-    if isinstance(pts, dict):
-        pts = pts.get("points", [])
-    out = []
-    for p in pts:
-        if not isinstance(p, dict):
-            continue
-        lat = p.get("latitude", p.get("lat"))
-        lng = p.get("longitude", p.get("lng", p.get("lon")))
-        if lat is not None and lng is not None:
-            out.append({"latitude": lat, "longitude": lng,
-                        "snapped_latitude": None, "snapped_longitude": None,
-                        "ping_time": p.get("ping_time", p.get("t", ""))})
-    return out
-
-
 def _get_stops(session_id):
     return safe_exec(
         admin_supabase.table("tracking_stops")
@@ -267,31 +231,39 @@ def _tab_detail(users):
     m5.metric("Battery", f"{sess.get('start_battery') or '—'}→{sess.get('end_battery') or '—'}%")
 
     # ── Route data (live tables, else archive) ───────────────
-    with st.spinner("Loading route..."):
-        pings = _get_pings(sel_sess)
-        from_archive = False
-        if not pings:
-            pings = _get_archived_route(sel_sess)
-            from_archive = bool(pings)
+    detail = st.radio("Route detail", list(ROUTE_DETAIL.keys()), horizontal=True,
+                      key="lg_dt_detail",
+                      help="Simplified for the chosen map zoom. Full resolution "
+                           "draws every GPS point and is slower on long days.")
+    zoom = ROUTE_DETAIL[detail]
+    try:
+        sess_day = date.fromisoformat(str(sess.get("session_date") or pick_d)[:10])
+    except ValueError:
+        sess_day = pick_d
+    archived_first = (date.today() - sess_day).days > ARCHIVE_AFTER_DAYS
+    load_failed = False
+    try:
+        with st.spinner("Loading route..."):
+            route = route_polyline(sel_sess, session_stamp(sess), zoom, archived_first)
+    except Exception as e:
+        st.error(f"Error loading GPS pings: {e}")
+        load_failed = True
+        route = {"path": np.empty((0, 2)), "n_raw": 0, "source": ""}
+    path = route["path"].tolist()
 
     stops = _get_stops(sel_sess)
 
-    if not pings and not stops:
-        st.warning("No GPS data found for this session (it may not have synced yet).")
+    if not path and not stops:
+        if not load_failed:
+            st.warning("No GPS data found for this session (it may not have synced yet).")
         return
-    if from_archive:
-        st.caption("📦 Route loaded from monthly archive (session older than 60 days).")
-    elif pings:
-        st.caption(f"🛰️ {len(pings):,} GPS points loaded.")
+    if route["source"] == "archive":
+        st.caption("📦 Route loaded from the session archive (raw pings compacted).")
+    if path:
+        st.caption(f"🛰️ {route['n_raw']:,} GPS points"
+                   + (f", {len(path):,} drawn." if len(path) < route["n_raw"] else "."))
 
     # ── Map ──────────────────────────────────────────────────
-    path = []
-    for p in pings:
-        lat = p.get("snapped_latitude") or p.get("latitude")
-        lng = p.get("snapped_longitude") or p.get("longitude")
-        if lat is not None and lng is not None:
-            path.append([float(lng), float(lat)])
-
     try:
         import pydeck as pdk
         layers = []
@@ -350,7 +322,7 @@ def _tab_detail(users):
         st.pydeck_chart(pdk.Deck(
             map_style=None,
             initial_view_state=pdk.ViewState(
-                longitude=center[0], latitude=center[1], zoom=12),
+                longitude=center[0], latitude=center[1], zoom=zoom or 15),
             layers=layers,
             tooltip={"text": "{label}"},
         ))
@@ -394,6 +366,64 @@ def _tab_detail(users):
             st.info("No events recorded.")
 
 
+def _tab_archive():
+    st.markdown("#### 🗜️ Compact old routes")
+    st.caption("Packs every GPS ping of completed sessions into one compact "
+               "session_routes row and deletes the raw pings once the stored "
+               "copy has been verified. Kept per ping: position (to ~0.1 m), "
+               "snapped position, time, speed, battery, GPS / internet status, "
+               "segment km and moving flag. Ping row ids and any other ping "
+               "columns are not kept. Sessions with a ping lacking position or "
+               "time fail and keep their pings. Skipped and failed sessions are "
+               "logged so later runs move on (failed ones are retried after "
+               f"{route_archive.RETRY_FAILED_DAYS} days). Session Detail reads the archive.")
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        days = st.number_input("Older than (days)", min_value=route_archive.MIN_DAYS,
+                               value=route_archive.DEFAULT_DAYS, step=15, key="lg_ar_days")
+    with c2:
+        limit = st.number_input("Sessions per run", min_value=1, max_value=1000,
+                                value=route_archive.DEFAULT_LIMIT, step=50, key="lg_ar_limit")
+    with c3:
+        dry_run = st.checkbox("Dry run (verify only)", value=True, key="lg_ar_dry")
+
+    if not st.button("🗜️ Compact now" if not dry_run else "🔍 Check sessions",
+                     key="lg_ar_run", type="primary"):
+        return
+
+    bar = st.progress(0.0, text="Finding sessions...")
+
+    def _progress(done, total, r):
+        bar.progress(done / total, text=f"{done}/{total} sessions")
+
+    results = route_archive.run_compaction(int(days), int(limit), dry_run, progress=_progress)
+    bar.empty()
+    if not results:
+        st.info("Nothing to compact — no un-archived completed sessions before the cutoff.")
+        return
+    if not dry_run:
+        route_points.clear()
+        route_polyline.clear()
+
+    summary = route_archive.summarise(results)
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Sessions", summary["sessions"])
+    m2.metric("Pings " + ("checked" if dry_run else "archived"), f"{summary['pings']:,}")
+    m3.metric("Archive size", f"{summary['archive_bytes'] / 1024:,.0f} KB")
+    failed = summary["by_status"].get("failed", 0)
+    if failed:
+        st.warning(f"{failed} session(s) failed — their pings were kept.")
+    st.dataframe(pd.DataFrame([{
+        "Date": r["session_date"],
+        "Session": r["session_id"][:8],
+        "Status": r["status"],
+        "Pings": r["pings"],
+        "Dropped": r["dropped"],
+        "Archive (KB)": round(r["bytes"] / 1024, 1),
+        "Reason": r["reason"],
+    } for r in results]), use_container_width=True, hide_index=True)
+
+
 # ──────────────────────────────────────────────────────────────
 # Entry point
 # ──────────────────────────────────────────────────────────────
@@ -412,9 +442,11 @@ def run_lets_go_report():
         st.error("Could not load users.")
         return
 
-    tab1, tab2 = st.tabs(["📅 Daily Overview", "🗺️ Session Detail"])
+    tab1, tab2, tab3 = st.tabs(["📅 Daily Overview", "🗺️ Session Detail", "🗜️ Archive"])
     with tab1:
         _tab_overview(users)
     with tab2:
         _tab_detail(users)
+    with tab3:
+        _tab_archive()
 
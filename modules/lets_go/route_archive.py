@@ -0,0 +1,309 @@
+"""
+Let's Go — Route Archive / Compaction
+Place at: modules/lets_go/route_archive.py
+
+tracking_pings is by far the largest table and every Let's Go query pays
+for it. This job moves completed sessions out of it: all pings of a
+session are packed into one session_routes row in the compact format of
+route_service.py (delta-encoded int32 lat / lng / time, snapped offsets,
+status codes, float64 telemetry; zlib, base64 — a 20k-ping day is a few
+hundred KB instead of 20k rows), and the raw rows are deleted only after
+the stored copy has been read back and decodes to exactly the values that
+were packed.
+
+What survives per ping: latitude / longitude (rounded to 1e-6°, ~0.1 m),
+snapped_latitude / snapped_longitude, ping_time (to the millisecond),
+speed, battery_level, gps_status, internet_status, segment_km, is_moving.
+What is lost with the raw rows: the ping row id and any other
+tracking_pings column not listed here. A session with a ping that has no
+position or time is not compacted at all.
+
+    compact_session(sess, dry_run=False)            -> result dict
+    run_compaction(older_than_days, limit, dry_run) -> [result dict]
+
+From the Let's Go report (Archive tab, admin) or a shell / scheduler:
+
+    python -m modules.lets_go.route_archive --days 90 --limit 200
+    python -m modules.lets_go.route_archive --session <uuid> --dry-run
+
+Per session (any failed check leaves the pings untouched):
+  1. load every ping (no cap) and check the count matches the table
+  2. quantise + encode — any ping that can't be encoded fails the session
+     — then decode in memory and compare
+  3. write session_routes (update if the session already has a row)
+  4. read it back, decode and compare again
+  5. re-count pings — a late sync since step 1 aborts
+  6. delete the session's pings
+
+Candidates are completed sessions older than the cutoff with no
+session_routes row yet and at least one ping, oldest first. Sessions
+already archived by the old pg_cron job are therefore left alone; pass
+--session to redo one.
+
+Sessions that end skipped or failed have no session_routes row, so they
+would head every run and, once `limit` of them piled up, stop anything
+newer from being archived. Each outcome is therefore recorded in
+route_archive_log: skipped sessions are never offered again, failed ones
+only after RETRY_FAILED_DAYS; an archived session's entry is removed.
+Without the table the job still runs — it just can't remember outcomes.
+
+    create table route_archive_log (
+        session_id    uuid primary key,
+        status        text not null,          -- skipped | failed
+        reason        text,
+        attempts      int  not null default 1,
+        attempted_at  timestamptz not null default now()
+    );
+
+Optional, keeps one archive row per session:
+    create unique index if not exists session_routes_session_id_key
+        on session_routes (session_id);
+"""
+
+import argparse
+import json
+from datetime import date, datetime, timedelta, timezone
+
+from anchors.supabase_client import FETCH_WORKERS, IN_CHUNK, _pool, admin_supabase
+from modules.lets_go.route_service import (
+    ARCHIVE_PING_FIELDS, decode_values, encode_route, load_pings, quantise, same_packed,
+)
+
+
+DEFAULT_DAYS = 90
+MIN_DAYS = 7               # never touch sessions this recent
+DEFAULT_LIMIT = 100        # sessions per run
+RETRY_FAILED_DAYS = 7      # a failed session is offered again after this
+
+_ARCHIVE_PING_COLS = ", ".join(["id"] + ARCHIVE_PING_FIELDS)
+
+
+# ──────────────────────────────────────────────────────────────
+# One session
+# ──────────────────────────────────────────────────────────────
+
+def _ping_count(session_id):
+    return admin_supabase.table("tracking_pings") \
+        .select("id", count="exact") \
+        .eq("session_id", session_id) \
+        .limit(1) \
+        .execute().count or 0
+
+
+def _stored_doc(session_id):
+    rows = admin_supabase.table("session_routes") \
+        .select("id, route_points") \
+        .eq("session_id", session_id) \
+        .limit(1) \
+        .execute().data or []
+    return rows[0] if rows else None
+
+
+def _store(sess, doc):
+    payload = {"session_id": sess["id"], "route_points": doc,
+               "total_km": sess.get("total_km")}
+    existing = _stored_doc(sess["id"])
+    if existing:
+        admin_supabase.table("session_routes").update(payload) \
+            .eq("id", existing["id"]).execute()
+    else:
+        admin_supabase.table("session_routes").insert(payload).execute()
+
+
+def _same(doc, packed):
+    return same_packed(decode_values(doc), packed)
+
+
+def _record(result):
+    """Remember a skipped / failed outcome (route_archive_log) so later runs
+    move past the session; clear it once the session is archived."""
+    log = admin_supabase.table("route_archive_log")
+    sid = result["session_id"]
+    try:
+        if result["status"] == "archived":
+            log.delete().eq("session_id", sid).execute()
+            return
+        prev = log.select("attempts").eq("session_id", sid).limit(1).execute().data or []
+        log.upsert({
+            "session_id": sid,
+            "status": result["status"],
+            "reason": (result["reason"] or "")[:500],
+            "attempts": int((prev[0] if prev else {}).get("attempts") or 0) + 1,
+            "attempted_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="session_id").execute()
+    except Exception as e:
+        print(f"route_archive_log write failed for {sid}: {e}")
+
+
+def compact_session(sess, dry_run=False):
+    """Archive one session's pings into session_routes and delete them.
+    `sess` needs id (and total_km to copy). Never raises: the result says
+    what happened — status archived | dry_run | skipped | failed."""
+    sid = sess["id"]
+    result = {"session_id": sid, "session_date": sess.get("session_date"),
+              "status": "failed", "pings": 0, "dropped": 0, "bytes": 0, "reason": ""}
+    try:
+        rows, total = load_pings(sid, cols=_ARCHIVE_PING_COLS, cap=None)
+        result["pings"] = total
+        if not total:
+            result.update(status="skipped", reason="no pings")
+            return result
+        if len(rows) != total or len({r.get("id") for r in rows}) != total:
+            result["reason"] = f"read {len(rows)} of {total} pings"
+            return result
+
+        packed, dropped = quantise(rows)
+        result["dropped"] = dropped
+        if dropped:
+            # the delete below is per session — these would be lost
+            result["reason"] = f"{dropped} pings without position/time — pings kept"
+            return result
+        doc = encode_route(packed)
+        result["bytes"] = len(doc["blob"]) + len(doc["floats"])
+        if not _same(doc, packed):
+            result["reason"] = "in-memory round-trip mismatch"
+            return result
+        if dry_run:
+            result["status"] = "dry_run"
+            return result
+
+        _store(sess, doc)
+        stored = (_stored_doc(sid) or {}).get("route_points")
+        if isinstance(stored, str):
+            stored = json.loads(stored)
+        if not isinstance(stored, dict) or not _same(stored, packed):
+            result["reason"] = "stored archive does not match — pings kept"
+            return result
+        if _ping_count(sid) != total:
+            result["reason"] = "new pings arrived while archiving — pings kept"
+            return result
+
+        admin_supabase.table("tracking_pings").delete().eq("session_id", sid).execute()
+        result["status"] = "archived"
+    except Exception as e:
+        result["reason"] = str(e)
+    finally:
+        if not dry_run:
+            _record(result)
+    return result
+
+
+# ──────────────────────────────────────────────────────────────
+# Batch
+# ──────────────────────────────────────────────────────────────
+
+def _logged(session_ids):
+    """Sessions route_archive_log says to leave alone for now: every skipped
+    one, and failed ones tried within RETRY_FAILED_DAYS."""
+    retry = (datetime.now(timezone.utc) - timedelta(days=RETRY_FAILED_DAYS)).isoformat()
+    try:
+        rows = admin_supabase.table("route_archive_log") \
+            .select("session_id, status, attempted_at") \
+            .in_("session_id", session_ids) \
+            .execute().data or []
+    except Exception as e:
+        print(f"route_archive_log unavailable: {e}")
+        return set()
+    return {r["session_id"] for r in rows
+            if r["status"] != "failed" or str(r.get("attempted_at") or "") >= retry}
+
+
+def _has_pings(session_ids):
+    """The subset of session_ids with at least one tracking_pings row
+    (one indexed limit-1 probe per session, run in parallel)."""
+    def _probe(sid):
+        return bool(admin_supabase.table("tracking_pings")
+                    .select("id").eq("session_id", sid).limit(1).execute().data)
+
+    if not session_ids:
+        return set()
+    with _pool(min(FETCH_WORKERS, len(session_ids))) as pool:
+        return {sid for sid, ok in zip(session_ids, pool.map(_probe, session_ids)) if ok}
+
+
+def candidate_sessions(older_than_days=DEFAULT_DAYS, limit=DEFAULT_LIMIT, record=True):
+    """Completed sessions before the cutoff with pings, no archive row and
+    no recent skip / fail in route_archive_log, oldest first. With record,
+    sessions found to have no pings are logged as skipped."""
+    cutoff = (date.today() - timedelta(days=max(int(older_than_days), MIN_DAYS))).isoformat()
+    found, start = [], 0
+    while len(found) < limit:
+        page = admin_supabase.table("tracking_sessions") \
+            .select("id, user_id, session_date, total_km") \
+            .eq("status", "completed") \
+            .lt("session_date", cutoff) \
+            .order("session_date") \
+            .order("id") \
+            .range(start, start + IN_CHUNK - 1) \
+            .execute().data or []
+        if not page:
+            break
+        ids = [s["id"] for s in page]
+        done = {r["session_id"] for r in admin_supabase.table("session_routes")
+                .select("session_id")
+                .in_("session_id", ids)
+                .execute().data or []}
+        done |= _logged(ids)
+        open_ids = [i for i in ids if i not in done]
+        with_pings = _has_pings(open_ids)
+        for s in page:
+            if s["id"] in with_pings:
+                found.append(s)
+            elif record and s["id"] not in done:
+                # completed with no pings — nothing to archive, ever
+                _record({"session_id": s["id"], "status": "skipped",
+                         "reason": "no pings"})
+        if len(page) < IN_CHUNK:
+            break
+        start += IN_CHUNK
+    return found[:limit]
+
+
+def run_compaction(older_than_days=DEFAULT_DAYS, limit=DEFAULT_LIMIT,
+                   dry_run=False, progress=None):
+    """Compact up to `limit` sessions. progress(done, total, result) is
+    called after each one."""
+    sessions = candidate_sessions(older_than_days, limit, record=not dry_run)
+    results = []
+    for i, sess in enumerate(sessions, 1):
+        results.append(compact_session(sess, dry_run=dry_run))
+        if progress:
+            progress(i, len(sessions), results[-1])
+    return results
+
+
+def summarise(results):
+    by_status = {}
+    for r in results:
+        by_status[r["status"]] = by_status.get(r["status"], 0) + 1
+    moved = sum(r["pings"] for r in results if r["status"] in ("archived", "dry_run"))
+    size = sum(r["bytes"] for r in results if r["status"] in ("archived", "dry_run"))
+    return {"sessions": len(results), "by_status": by_status,
+            "pings": moved, "archive_bytes": size}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Compact old Let's Go pings into session_routes")
+    ap.add_argument("--days", type=int, default=DEFAULT_DAYS,
+                    help=f"archive completed sessions older than this (min {MIN_DAYS})")
+    ap.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help="sessions per run")
+    ap.add_argument("--session", help="compact this one session id (even if already archived)")
+    ap.add_argument("--dry-run", action="store_true",
+                    help="encode and verify only; write and delete nothing")
+    args = ap.parse_args()
+
+    def _print(done, total, r):
+        print(f"[{done}/{total}] {r['session_id']} {r['session_date'] or ''} "
+              f"{r['status']} {r['pings']} pings {r['bytes']:,} B {r['reason']}")
+
+    if args.session:
+        sess = admin_supabase.table("tracking_sessions") \
+            .select("id, session_date, total_km") \
+            .eq("id", args.session).limit(1).execute().data
+        if not sess:
+            raise SystemExit(f"No tracking session {args.session}")
+        res = [compact_session(sess[0], dry_run=args.dry_run)]
+        _print(1, 1, res[0])
+    else:
+        res = run_compaction(args.days, args.limit, args.dry_run, progress=_print)
+    print(summarise(res))
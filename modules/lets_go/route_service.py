@@ -0,0 +1,386 @@
+"""
+Let's Go — Route Service
+Place at: modules/lets_go/route_service.py
+
+Route geometry for the Session Detail map. The tab used to page
+tracking_pings 1000 rows at a time, one page after another, build the
+full-resolution path as Python lists and hand all of it to pydeck — and
+redo everything on every widget change. A long field day (20k+ pings)
+took many seconds per redraw.
+
+    route_points(session_id, stamp, archived_first)  -> (N×2 [lng, lat], source)
+    route_polyline(session_id, stamp, zoom, …)       -> {"path", "n_raw", "source"}
+    session_stamp(sess)                              -> cache stamp for a session
+
+Loading: the first page also asks for the exact row count, the remaining
+pages are then fetched concurrently. Sessions old enough to have been
+archived read session_routes first (archived_route), live ones fall back
+to it. Archives are either the compact delta-i32 blob written by
+route_archive.py (decode_route, which also restores the ping telemetry)
+or the older pg_cron JSON point list.
+
+Simplification: Douglas–Peucker in NumPy on a local metric projection,
+tolerance = _PIXEL_TOLERANCE screen pixels at the chosen map zoom, so an
+overview keeps a few hundred points and a street view keeps the corners.
+zoom=None returns every point (only drawn when asked for).
+
+Both results are cached in st.cache_data keyed by session and stamp —
+successful loads only; a load error is raised to the caller. Completed
+sessions never change; an active session's stamp moves every minute so
+its route keeps growing.
+"""
+
+import base64
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from anchors.supabase_client import admin_supabase, safe_exec
+
+
+MAX_PINGS = 50000          # safety cap per session
+CHUNK = 1000               # supabase page size
+PAGE_WORKERS = 6
+ARCHIVE_AFTER_DAYS = 60    # older sessions are usually archived (pg_cron / route_archive)
+
+_PING_COLS = "latitude, longitude, snapped_latitude, snapped_longitude, ping_time"
+_EARTH_M = 6371000.0
+_PIXEL_TOLERANCE = 1.5
+
+
+# ──────────────────────────────────────────────────────────────
+# Loading
+# ──────────────────────────────────────────────────────────────
+
+def _ping_query(session_id, cols, count=None):
+    return (admin_supabase.table("tracking_pings")
+            .select(cols, count=count)
+            .eq("session_id", session_id)
+            .order("ping_time")
+            .order("id"))
+
+
+def load_pings(session_id, cols=_PING_COLS, cap=MAX_PINGS):
+    """Pings of a session in ping_time order: first page + exact count, then
+    the other pages in parallel. cap=None loads every row. Returns
+    (rows, total in table). Raises on error (caller reports it)."""
+    first = _ping_query(session_id, cols, count="exact").range(0, CHUNK - 1).execute()
+    rows = first.data or []
+    total = first.count if first.count is not None else len(rows)
+    wanted = total if cap is None else min(total, cap)
+    starts = list(range(CHUNK, wanted, CHUNK))
+    if not starts:
+        return rows, total
+
+    def _page(start):
+        return _ping_query(session_id, cols).range(start, start + CHUNK - 1).execute().data or []
+
+    with ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, len(starts))) as pool:
+        for page in pool.map(_page, starts):
+            rows.extend(page)
+    return rows, total
+
+
+def _live_rows(session_id):
+    return load_pings(session_id)[0]
+
+
+# ──────────────────────────────────────────────────────────────
+# Archive format
+# ──────────────────────────────────────────────────────────────
+# session_routes.route_points written by route_archive.py:
+#   {"format": "delta-i32-v2", "n": N, "t0": "<first ping, ISO UTC>",
+#    "cols": [...ARCHIVE_COLS],       "blob":   base64(zlib(int32[8, N], LE)),
+#    "float_cols": [...FLOAT_COLS],   "floats": base64(zlib(float64[3, N], LE)),
+#    "labels": {"gps_status": [...], "internet_status": [...]}}
+# lat / lng in micro-degrees and time in ms since t0, each delta-encoded
+# (first value absolute); snapped position as an offset from the raw one;
+# is_moving as 0/1; the status columns as indexes into "labels". NULL_I32
+# (NaN for floats) marks a NULL. speed, segment_km and battery_level are
+# kept as exact float64. Everything but lat / lng (rounded to 1e-6°, ~0.1 m)
+# comes back exactly. Not kept: the ping row id and any other column.
+# v1 documents (first five int columns only) still decode.
+
+ARCHIVE_FORMAT = "delta-i32-v2"
+_ARCHIVE_FORMATS = ("delta-i32-v1", ARCHIVE_FORMAT)
+ARCHIVE_COLS = ["lat", "lng", "t_ms", "snap_dlat", "snap_dlng",
+                "is_moving", "gps_status", "internet_status"]
+FLOAT_COLS = ["speed", "segment_km", "battery_level"]
+LABEL_COLS = ["gps_status", "internet_status"]
+ARCHIVE_PING_FIELDS = ["latitude", "longitude", "snapped_latitude", "snapped_longitude",
+                       "ping_time", "is_moving"] + LABEL_COLS + FLOAT_COLS
+NULL_I32 = np.iinfo(np.int32).min
+_MICRO = 1_000_000
+_DELTA_COLS = 3            # lat, lng, t_ms are delta-coded
+
+
+def _pack_array(arr, dtype):
+    return base64.b64encode(zlib.compress(arr.astype(dtype).tobytes(), 9)).decode("ascii")
+
+
+def _unpack_array(text, dtype, rows, n):
+    raw = zlib.decompress(base64.b64decode(text)) if n and rows else b""
+    return np.frombuffer(raw, dtype=dtype).reshape(rows, n)
+
+
+def quantise(rows):
+    """
+    Ping rows -> (packed, rows dropped). packed = {"ints": int64[8, N]
+    absolute values, "floats": float64[3, N], "labels": {col: [...]},
+    "t0": Timestamp | None}. Rows without a position or time can't be
+    archived and are dropped. Raises ValueError for a value the format
+    can't hold exactly (non-numeric telemetry, non-scalar status).
+    """
+    df = pd.DataFrame(rows, columns=ARCHIVE_PING_FIELDS)
+    for c in ["latitude", "longitude", "snapped_latitude", "snapped_longitude"]:
+        df[c] = pd.to_numeric(df[c], errors="coerce")
+    df["ping_time"] = pd.to_datetime(df["ping_time"], utc=True, errors="coerce", format="ISO8601")
+    ok = df[["latitude", "longitude", "ping_time"]].notna().all(axis=1)
+    df = df[ok].reset_index(drop=True)
+    dropped = int((~ok).sum())
+    n = len(df)
+    t0 = df["ping_time"].iloc[0] if n else None
+
+    lat = np.rint(df["latitude"].to_numpy() * _MICRO).astype(np.int64)
+    lng = np.rint(df["longitude"].to_numpy() * _MICRO).astype(np.int64)
+    t_ms = ((df["ping_time"] - t0) // pd.Timedelta(milliseconds=1)).to_numpy(dtype=np.int64) \
+        if n else np.zeros(0, dtype=np.int64)
+
+    def _offset(col, base):
+        v = df[col].to_numpy()
+        out = np.full(len(v), NULL_I32, dtype=np.int64)
+        has = np.isfinite(v)
+        out[has] = np.rint(v[has] * _MICRO).astype(np.int64) - base[has]
+        return out
+
+    moving = np.array([NULL_I32 if v is None or v != v else int(bool(v))
+                       for v in df["is_moving"].tolist()], dtype=np.int64)
+
+    labels, codes = {}, []
+    for c in LABEL_COLS:
+        values = [None if v is None or v != v else v for v in df[c].tolist()]
+        if any(not isinstance(v, (str, bool, int, float, type(None))) for v in values):
+            raise ValueError(f"{c} has values the archive can't store")
+        table = list(dict.fromkeys(v for v in values if v is not None))
+        index = {v: i for i, v in enumerate(table)}
+        labels[c] = table
+        codes.append(np.array([NULL_I32 if v is None else index[v] for v in values],
+                              dtype=np.int64))
+
+    floats = []
+    for c in FLOAT_COLS:
+        num = pd.to_numeric(df[c], errors="coerce")
+        if (df[c].notna() & num.isna()).any():
+            raise ValueError(f"{c} has non-numeric values")
+        floats.append(num.to_numpy(dtype=np.float64))
+
+    ints = np.vstack([lat, lng, t_ms,
+                      _offset("snapped_latitude", lat), _offset("snapped_longitude", lng),
+                      moving] + codes)
+    packed = {"ints": ints, "floats": np.vstack(floats).reshape(len(FLOAT_COLS), n),
+              "labels": labels, "t0": t0}
+    return packed, dropped
+
+
+def encode_route(packed):
+    """quantise() output -> route_points document.
+    Raises ValueError if a value or delta does not fit in int32."""
+    values = packed["ints"]
+    coded = values.copy()
+    coded[:_DELTA_COLS, 1:] = np.diff(values[:_DELTA_COLS], axis=1)
+    info = np.iinfo(np.int32)
+    if coded.size and (coded.min() < info.min or coded.max() > info.max):
+        raise ValueError("route does not fit the int32 archive format")
+    t0 = packed["t0"]
+    return {
+        "format": ARCHIVE_FORMAT,
+        "n": int(values.shape[1]),
+        "t0": t0.isoformat() if t0 is not None else None,
+        "cols": ARCHIVE_COLS,
+        "blob": _pack_array(coded, "<i4"),
+        "float_cols": FLOAT_COLS,
+        "floats": _pack_array(packed["floats"], "<f8"),
+        "labels": packed["labels"],
+    }
+
+
+def decode_values(doc):
+    """route_points document -> packed dict, as quantise() returns it."""
+    n = int(doc.get("n") or 0)
+    cols, float_cols = doc.get("cols") or [], doc.get("float_cols") or []
+    ints = _unpack_array(doc["blob"], "<i4", len(cols), n).astype(np.int64)
+    ints[:_DELTA_COLS] = np.cumsum(ints[:_DELTA_COLS], axis=1)
+    floats = _unpack_array(doc["floats"], "<f8", len(float_cols), n).copy() \
+        if float_cols else np.zeros((0, n))
+    return {"ints": ints, "floats": floats, "labels": doc.get("labels") or {},
+            "t0": pd.Timestamp(doc["t0"]) if doc.get("t0") else None}
+
+
+def same_packed(a, b):
+    """True when two packed routes hold exactly the same values."""
+    return (a["ints"].shape == b["ints"].shape and np.array_equal(a["ints"], b["ints"])
+            and a["floats"].shape == b["floats"].shape
+            and np.array_equal(a["floats"], b["floats"], equal_nan=True)
+            and a["labels"] == b["labels"] and a["t0"] == b["t0"])
+
+
+def decode_route(doc):
+    """route_points document -> ping rows (same keys as tracking_pings)."""
+    packed = decode_values(doc)
+    n = packed["ints"].shape[1]
+    if not n:
+        return []
+    ints = dict(zip(doc.get("cols") or [], packed["ints"].tolist()))
+    floats = dict(zip(doc.get("float_cols") or [], packed["floats"].tolist()))
+    lat, lng = ints["lat"], ints["lng"]
+    times = (packed["t0"] + pd.to_timedelta(ints["t_ms"], unit="ms")) \
+        .strftime("%Y-%m-%dT%H:%M:%S.%f+00:00").tolist()
+
+    def _snapped(offset, base):
+        return [None if o == NULL_I32 else (b + o) / _MICRO for o, b in zip(offset, base)]
+
+    columns = {
+        "latitude":          [v / _MICRO for v in lat],
+        "longitude":         [v / _MICRO for v in lng],
+        "snapped_latitude":  _snapped(ints["snap_dlat"], lat),
+        "snapped_longitude": _snapped(ints["snap_dlng"], lng),
+        "ping_time":         times,
+    }
+    if "is_moving" in ints:
+        columns["is_moving"] = [None if v == NULL_I32 else bool(v) for v in ints["is_moving"]]
+    for c in LABEL_COLS:
+        if c in ints:
+            table = packed["labels"].get(c) or []
+            columns[c] = [None if v == NULL_I32 else table[v] for v in ints[c]]
+    for c, vals in floats.items():
+        columns[c] = [None if v != v else v for v in vals]
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def archived_route(session_id):
+    """Archived session route: route_archive.py's compact format, or the
+    JSON point list of the older monthly pg_cron job."""
+    rows = safe_exec(
+        admin_supabase.table("session_routes")
+        .select("route_points, total_km")
+        .eq("session_id", session_id)
+        .limit(1),
+        "Error loading archived route"
+    ) or []
+    if not rows:
+        return []
+    pts = rows[0].get("route_points") or []
+    if isinstance(pts, str):
+        pts = json.loads(pts)
+    if isinstance(pts, dict):
+        if pts.get("format") in _ARCHIVE_FORMATS:
+            return decode_route(pts)
+        pts = pts.get("points", [])
+    out = []
+    for p in pts:
+        if not isinstance(p, dict):
+            continue
+        lat = p.get("latitude", p.get("lat"))
+        lng = p.get("longitude", p.get("lng", p.get("lon")))
+        if lat is not None and lng is not None:
+            out.append({"latitude": lat, "longitude": lng,
+                        "snapped_latitude": None, "snapped_longitude": None,
+                        "ping_time": p.get("ping_time", p.get("t", ""))})
+    return out
+
+
+def _to_points(rows):
+    """Ping rows -> N×2 float array of [lng, lat], snapped where available,
+    consecutive duplicates dropped."""
+    if not rows:
+        return np.empty((0, 2))
+    df = pd.DataFrame(rows, columns=["latitude", "longitude",
+                                     "snapped_latitude", "snapped_longitude"])
+    df = df.apply(pd.to_numeric, errors="coerce")
+    lat = df["snapped_latitude"].fillna(df["latitude"]).to_numpy()
+    lng = df["snapped_longitude"].fillna(df["longitude"]).to_numpy()
+    pts = np.column_stack([lng, lat])
+    pts = pts[np.isfinite(pts).all(axis=1)]
+    if len(pts) > 1:
+        pts = pts[np.r_[True, (np.diff(pts, axis=0) != 0).any(axis=1)]]
+    return pts
+
+
+def session_stamp(sess):
+    """Cache stamp: fixed once a session is completed, per-minute while active."""
+    if sess.get("status") == "completed" and sess.get("end_time"):
+        return f"done:{sess['end_time']}:{sess.get('total_km')}"
+    return "live:" + datetime.utcnow().strftime("%Y%m%d%H%M")
+
+
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)
+def route_points(session_id, stamp, archived_first=False):
+    """([lng, lat] array, "live" | "archive" | "") for one session.
+    A load error propagates — st.cache_data doesn't cache exceptions, so a
+    transient failure is retried on the next run instead of pinning an
+    empty route to the session's (fixed) stamp for the whole TTL."""
+    loaders = [("live", _live_rows), ("archive", archived_route)]
+    if archived_first:
+        loaders.reverse()
+    for source, load in loaders:
+        pts = _to_points(load(session_id))
+        if len(pts):
+            return pts, source
+    return np.empty((0, 2)), ""
+
+
+# ──────────────────────────────────────────────────────────────
+# Simplification
+# ──────────────────────────────────────────────────────────────
+
+def tolerance_for_zoom(zoom, lat, pixels=_PIXEL_TOLERANCE):
+    """Metres covered by `pixels` screen pixels at a web-map zoom level."""
+    return 156543.03392 * np.cos(np.radians(lat)) / (2 ** zoom) * pixels
+
+
+def simplify(points, tolerance_m):
+    """Douglas–Peucker on [lng, lat] points with a tolerance in metres."""
+    n = len(points)
+    if n < 3 or tolerance_m <= 0:
+        return points
+    lat0 = np.radians(points[:, 1].mean())
+    xy = np.radians(points) * _EARTH_M
+    xy[:, 0] *= np.cos(lat0)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        p, seg = xy[a], xy[a + 1:b] - xy[a]
+        d = xy[b] - p
+        length2 = d @ d
+        if length2 > 0:
+            t = np.clip(seg @ d / length2, 0.0, 1.0)
+            seg = seg - t[:, None] * d
+        dist = np.hypot(seg[:, 0], seg[:, 1])
+        i = int(dist.argmax())
+        if dist[i] > tolerance_m:
+            k = a + 1 + i
+            keep[k] = True
+            stack.append((a, k))
+            stack.append((k, b))
+    return points[keep]
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def route_polyline(session_id, stamp, zoom, archived_first=False):
+    """Simplified route for drawing at `zoom` (None = full resolution)."""
+    pts, source = route_points(session_id, stamp, archived_first)
+    path = pts
+    if zoom is not None and len(pts) > 2:
+        path = simplify(pts, tolerance_for_zoom(zoom, float(pts[:, 1].mean())))
+    return {"path": np.round(path, 6), "n_raw": len(pts), "source": source}
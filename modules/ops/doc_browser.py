@@ -0,0 +1,287 @@
+"""
+Document Browser — modules/ops/doc_browser.py
+
+Paged register for the OPS document browsers (Invoices, Credit Notes,
+Transfers, Samples & Lots, Purchases). Each register used to load every
+non-deleted document of its kind, pull ops_lines for all of them to get
+totals, and draw a row with three buttons per document — so page render
+time grew with the total document count.
+
+Now one page is one request:
+
+    ops_documents  <filter>  AND is_deleted = false
+                   [AND search]  AND (ops_date, id) < cursor
+    ORDER BY ops_date DESC, id DESC  LIMIT page_size + 1
+
+Keyset pagination on (ops_date, id): the cursor is the last row of the
+previous page, so page N costs the same as page 1. The extra row only
+tells us whether a Next page exists.
+
+Search runs server-side: OPS No / Reference No by ilike, party name by
+resolving matching entity ids once from the entity directory and filtering
+from_entity_id / to_entity_id with in.(…) — in chunks, one query each,
+merged, when many parties match.
+
+Totals come from ops_documents.invoice_total. Documents saved before that
+column was written for their type fall back to their first ops_line
+net_amount — fetched for the visible page only.
+"""
+
+import streamlit as st
+
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_in
+from anchors.entity_directory import resolve_many, match_entity_ids
+
+
+PAGE_SIZE = 25
+_MAX_PARTY_IDS = 100    # party-name matches sent in one in.(…) filter
+_MAX_PARTY_CHUNKS = 10  # at most this many in.(…) queries per page
+
+_SELECT = ("id, ops_no, ops_date, reference_no, narration, invoice_total, "
+           "from_entity_type, from_entity_id, to_entity_type, to_entity_id")
+
+# characters with meaning inside a PostgREST or=(…) expression
+_RESERVED = str.maketrans("", "", ',()"\\*%:')
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# QUERY
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _search_clauses(text, party_types):
+    """
+    PostgREST or=(…) bodies for a search term — one per chunk of
+    _MAX_PARTY_IDS matching party ids, each also carrying the OPS No /
+    Reference No parts — or [] if nothing usable. Also returns how many
+    party matches were left out beyond _MAX_PARTY_CHUNKS chunks.
+    """
+    term = (text or "").translate(_RESERVED).strip()
+    if not term:
+        return [], 0
+    base = [f"ops_no.ilike.*{term}*", f"reference_no.ilike.*{term}*"]
+    party_ids = sorted(match_entity_ids(term, party_types))
+    limit = _MAX_PARTY_IDS * _MAX_PARTY_CHUNKS
+    skipped = max(0, len(party_ids) - limit)
+    clauses = []
+    for i in range(0, min(len(party_ids), limit), _MAX_PARTY_IDS):
+        ids = ",".join(party_ids[i:i + _MAX_PARTY_IDS])
+        clauses.append(",".join(base + [f"from_entity_id.in.({ids})",
+                                        f"to_entity_id.in.({ids})"]))
+    return clauses or [",".join(base)], skipped
+
+
+def fetch_doc_page(apply_filter, cursor=None, search=None,
+                   party_types=("Stockist", "User", "CNF"), page_size=PAGE_SIZE):
+    """
+    One page of ops_documents, newest first.
+
+    apply_filter(q) adds the register's own filters (ops_type, stock_as…).
+    cursor is (ops_date, id) of the last row on the previous page.
+    A search matching more parties than fit one in.(…) runs one query per
+    id chunk with the same cursor; their pages are merged on (ops_date, id),
+    which keeps keyset paging exact.
+    Returns (rows, next_cursor, skipped) — next_cursor is None on the last
+    page; skipped counts party matches not searched (see _search_clauses).
+    """
+    def _query(clause):
+        q = apply_filter(admin_supabase.table("ops_documents").select(_SELECT)) \
+            .eq("is_deleted", False)
+        if clause:
+            q = q.or_(clause)
+        if cursor:
+            d, i = cursor
+            q = q.or_(f"ops_date.lt.{d},and(ops_date.eq.{d},id.lt.{i})")
+        return safe_exec(
+            q.order("ops_date", desc=True).order("id", desc=True).limit(page_size + 1),
+            "Error loading documents",
+        ) or []
+
+    clauses, skipped = _search_clauses(search, party_types)
+    if len(clauses) <= 1:
+        rows = _query(clauses[0] if clauses else None)
+    else:
+        merged = {}
+        for clause in clauses:
+            for r in _query(clause):
+                merged[r["id"]] = r
+        rows = sorted(merged.values(), key=lambda r: (str(r["ops_date"]), str(r["id"])),
+                      reverse=True)[:page_size + 1]
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, (rows[-1]["ops_date"], rows[-1]["id"]), skipped
+    return rows, None, skipped
+
+
+def page_totals(docs):
+    """doc_id -> total: stored invoice_total, else the first line's
+    net_amount (one request for just the docs on this page that need it)."""
+    totals = {d["id"]: float(d["invoice_total"])
+              for d in docs if d.get("invoice_total") is not None}
+    missing = [d["id"] for d in docs if d["id"] not in totals]
+    if missing:
+        for ln in fetch_in(
+            lambda: admin_supabase.table("ops_lines").select("id, ops_document_id, net_amount"),
+            "ops_document_id", missing, "Error loading document totals",
+        ):
+            totals.setdefault(ln["ops_document_id"], float(ln.get("net_amount") or 0))
+    return totals
+
+
+def _narration_parties(narration):
+    """Old documents: parse "Invoice - Company to Stockist"."""
+    try:
+        if " - " in narration and " to " in narration:
+            from_to = narration.split(" - ")[1].split(" to ")
+            return from_to[0].strip(), from_to[1].strip()
+    except Exception:
+        pass
+    return "Unknown", "Unknown"
+
+
+def page_parties(docs):
+    """doc_id -> (from_name, to_name) for a page, resolved in one pass."""
+    names = resolve_many(
+        pair for d in docs for pair in (
+            (d.get("from_entity_type"), d.get("from_entity_id")),
+            (d.get("to_entity_type"),   d.get("to_entity_id")),
+        )
+    )
+    out = {}
+    for k, d in enumerate(docs):
+        if d.get("from_entity_type") and d.get("to_entity_type"):
+            out[d["id"]] = (names[2 * k], names[2 * k + 1])
+        else:
+            out[d["id"]] = _narration_parties(d.get("narration") or "")
+    return out
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# PAGER STATE
+# Per-register cursor stack in session_state: cursors[n] is the cursor that
+# opens page n (None for page 0). Reset whenever the search changes.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _pager(key, signature):
+    state = st.session_state.get(f"{key}_pager")
+    if not state or state["sig"] != signature:
+        state = {"sig": signature, "cursors": [None], "page": 0}
+        st.session_state[f"{key}_pager"] = state
+    return state
+
+
+def _pager_controls(state, next_cursor, key):
+    p1, p2, p3 = st.columns([1, 2, 1])
+    with p1:
+        if st.button("◀ Prev", key=f"{key}_prev", disabled=state["page"] == 0):
+            state["page"] -= 1
+            st.rerun()
+    with p2:
+        st.caption(f"Page {state['page'] + 1}")
+    with p3:
+        if st.button("Next ▶", key=f"{key}_next", disabled=next_cursor is None):
+            del state["cursors"][state["page"] + 1:]
+            state["cursors"].append(next_cursor)
+            state["page"] += 1
+            st.rerun()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# REGISTER
+# ─────────────────────────────────────────────────────────────────────────────
+
+def render_doc_register(key, apply_filter, icon, sections, btn_prefix="",
+                        empty_msg="No documents found", search=False,
+                        search_placeholder="", party_types=("Stockist", "User", "CNF"),
+                        page_size=PAGE_SIZE):
+    """
+    Draw one page of a document register with View / Edit / Delete buttons.
+
+    sections = {"view": ..., "edit": ..., "delete": ...} — ops_section each
+    button opens. Button keys are f"view_{btn_prefix}{id}" etc., as before.
+    """
+    search_text = ""
+    if search:
+        search_text = st.text_input(
+            "🔍 Search by OPS No, Reference No, or Party Name",
+            placeholder=search_placeholder,
+            key=f"{key}_search",
+        ).strip().lower()
+
+    state = _pager(key, search_text)
+    docs, next_cursor, skipped = fetch_doc_page(
+        apply_filter, state["cursors"][state["page"]], search_text,
+        party_types, page_size,
+    )
+
+    if skipped:
+        st.warning(f"⚠️ \"{search_text}\" matches too many parties — {skipped} were "
+                   "not searched. Type more of the name to narrow the search.")
+
+    if not docs and state["page"] == 0:
+        if search_text:
+            st.warning("No documents match your search.")
+        else:
+            st.info(empty_msg)
+        return
+
+    if search_text:
+        st.caption(f"📋 Results for \"{search_text}\"")
+
+    totals  = page_totals(docs)
+    parties = page_parties(docs)
+
+    for doc in docs:
+        from_name, to_name = parties[doc["id"]]
+        with st.container():
+            c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
+
+            with c1:
+                st.write(f"{icon} **{doc['ops_no']}**")
+                st.caption(f"📤 {from_name} → 📥 {to_name}")
+
+            with c2:
+                st.write(doc["ops_date"])
+
+            with c3:
+                st.write(f"**Ref:** {doc.get('reference_no') or '-'}")
+                st.write(f"**💰 ₹{totals.get(doc['id'], 0):,.2f}**")
+
+            with c4:
+                b1, b2, b3 = st.columns(3)
+
+                with b1:
+                    if st.button("👁 View", key=f"view_{btn_prefix}{doc['id']}"):
+                        st.session_state.selected_ops_id = doc["id"]
+                        st.session_state.ops_section = sections["view"]
+                        st.rerun()
+
+                with b2:
+                    if st.button("✏️ Edit", key=f"edit_{btn_prefix}{doc['id']}"):
+                        st.session_state.edit_source_ops_id = doc["id"]
+                        st.session_state.edit_mode = True
+                        st.session_state.ops_section = sections["edit"]
+                        st.rerun()
+
+                with b3:
+                    if st.button("🗑 Delete", key=f"del_{btn_prefix}{doc['id']}"):
+                        st.session_state.selected_ops_id = doc["id"]
+                        st.session_state.ops_section = sections["delete"]
+                        st.rerun()
+
+            st.divider()
+
+    _pager_controls(state, next_cursor, key)
+
+
+def page_slice(rows, key, page_size=PAGE_SIZE):
+    """
+    Visible slice of an already-bounded list (e.g. a date-filtered register
+    that has to filter in memory). Draws a page picker only when there is
+    more than one page.
+    """
+    pages = max(1, -(-len(rows) // page_size))
+    if pages == 1:
+        return rows
+    page = st.selectbox("Page", range(1, pages + 1), key=f"{key}_page",
+                        format_func=lambda n: f"Page {n} of {pages}")
+    return rows[(page - 1) * page_size:page * page_size]
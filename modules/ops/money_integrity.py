@@ -0,0 +1,317 @@
+"""
+Money Integrity — modules/ops/money_integrity.py
+
+Set-based versions of the invoice balance maintenance that OPS used to do
+one invoice at a time. Every function here reads in a constant number of
+chunked .in_() sweeps (anchors.supabase_client.fetch_in), computes in
+memory, and writes back only the columns that actually change, as
+targeted updates batched by identical values.
+
+Bulk invoice recompute (Recalculate Balances screen):
+    plan_invoice_recalc()   -> list of change dicts (dry run, no writes)
+    apply_invoice_recalc()  -> re-checks and writes a plan, returns
+                               (rows written, errors, changed since preview)
+
+Settlement reversal / allocation (cancel, delete, Allocate Payments):
+    recompute_invoices(ids)            -> paid / outstanding / status from the
+                                          true total and remaining settlements
+    reverse_settlements_for_docs(ids)  -> delete every settlement touching the
+                                          docs, recompute affected invoices
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from anchors.supabase_client import admin_supabase, fetch_all, fetch_in, IN_CHUNK
+
+
+_WRITE_WORKERS = 4
+_EPS = 0.005     # money columns are compared to half a paisa
+
+
+def _money(v):
+    try:
+        return round(float(v or 0), 2)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _status(outstanding, paid):
+    if outstanding <= 0:
+        return "PAID"
+    if paid > 0:
+        return "PARTIAL"
+    return "UNPAID"
+
+
+def _first_line_totals(doc_ids):
+    """doc_id -> net_amount of its first ops_line. net_amount is a document-
+    level figure stored identically on every line, so ONE line is the total
+    (summing across lines inflates it by the product count)."""
+    totals = {}
+    for ln in fetch_in(
+        lambda: admin_supabase.table("ops_lines").select("id, ops_document_id, net_amount"),
+        "ops_document_id", doc_ids, "Error loading invoice lines",
+    ):
+        totals.setdefault(ln["ops_document_id"], _money(ln.get("net_amount")))
+    return totals
+
+
+def _settled_by_invoice(invoice_ids):
+    """invoice_id -> sum(payment_settlements.amount)."""
+    settled = {}
+    for s in fetch_in(
+        lambda: admin_supabase.table("payment_settlements").select("id, invoice_id, amount"),
+        "invoice_id", invoice_ids, "Error loading settlements",
+    ):
+        settled[s["invoice_id"]] = settled.get(s["invoice_id"], 0.0) + _money(s.get("amount"))
+    return settled
+
+
+def update_changed(table, changes):
+    """
+    Write {id: {col: value}} back to `table`, touching only those columns.
+
+    Targeted .update()s, never whole rows: a row read earlier and written
+    back in full would silently undo any payment / allocation edit made in
+    between. Ids whose new values are identical share one
+    .update(values).in_("id", chunk) request; the requests run on a small
+    pool. Returns (rows written, ids that failed) — a failed request does
+    not stop the others.
+    """
+    groups = {}
+    for row_id, values in changes.items():
+        groups.setdefault(tuple(sorted(values.items())), []).append(row_id)
+    jobs = [(dict(key), ids[i:i + IN_CHUNK])
+            for key, ids in groups.items()
+            for i in range(0, len(ids), IN_CHUNK)]
+
+    def _write(job):
+        values, ids = job
+        try:
+            admin_supabase.table(table).update(values).in_("id", ids).execute()
+            return ids, []
+        except Exception:
+            return [], ids
+
+    written, failed = 0, []
+    if not jobs:
+        return written, failed
+    with ThreadPoolExecutor(max_workers=min(_WRITE_WORKERS, len(jobs))) as pool:
+        for ok, bad in pool.map(_write, jobs):
+            written += len(ok)
+            failed.extend(bad)
+    return written, failed
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# BULK INVOICE RECOMPUTE  (Recalculate Balances)
+# ─────────────────────────────────────────────────────────────────────────────
+
+_INVOICE_COLS = ("id, ops_no, invoice_total, paid_amount, "
+                 "outstanding_balance, payment_status")
+
+
+def _recalc_changes(invoices):
+    """Change dicts (id, ops_no, old, new) for the invoices whose stored
+    total / paid / outstanding / status differ from the recomputed ones."""
+    ids = [inv["id"] for inv in invoices]
+    totals  = _first_line_totals(ids)
+    settled = _settled_by_invoice(ids)
+
+    plan = []
+    for inv in invoices:
+        inv_total   = totals.get(inv["id"], 0.0)
+        paid        = round(settled.get(inv["id"], 0.0), 2)
+        outstanding = round(max(0.0, inv_total - paid), 2)
+        new = {
+            "invoice_total": inv_total,
+            "paid_amount": paid,
+            "outstanding_balance": outstanding,
+            "payment_status": _status(outstanding, paid),
+        }
+        old = {k: inv.get(k) for k in new}
+        if not _same_values(old, new):
+            plan.append({"id": inv["id"], "ops_no": inv.get("ops_no"),
+                         "old": old, "new": new})
+    return plan
+
+
+def _same_values(a, b):
+    return (all(abs(_money(a[k]) - _money(b[k])) <= _EPS
+                for k in ("invoice_total", "paid_amount", "outstanding_balance"))
+            and a["payment_status"] == b["payment_status"])
+
+
+def plan_invoice_recalc():
+    """
+    Dry run: recompute invoice_total / paid_amount / outstanding_balance /
+    payment_status for every non-deleted STOCK_OUT document and return only
+    the invoices whose stored values differ.
+
+    Each change dict: id, ops_no, old (dict), new (dict).
+    """
+    invoices = fetch_all(lambda: (
+        admin_supabase.table("ops_documents")
+        .select(_INVOICE_COLS)
+        .eq("ops_type", "STOCK_OUT")
+        .eq("is_deleted", False)
+    ), "Error loading invoices")
+    return _recalc_changes(invoices)
+
+
+def apply_invoice_recalc(plan):
+    """
+    Write a plan from plan_invoice_recalc(). The planned invoices are read
+    and recomputed again first: one whose stored values or recomputed
+    result no longer match the preview (an edit, payment or allocation in
+    between) is left alone and reported, so nothing newer is overwritten.
+    Returns (rows written, rows that failed, ops_no changed since preview).
+    """
+    fresh = fetch_in(
+        lambda: admin_supabase.table("ops_documents")
+                .select(_INVOICE_COLS)
+                .eq("ops_type", "STOCK_OUT")
+                .eq("is_deleted", False),
+        "id", [c["id"] for c in plan], "Error loading invoices",
+    )
+    now = {c["id"]: c for c in _recalc_changes(fresh)}
+    changes, stale = {}, []
+    stamp = datetime.utcnow().isoformat()
+    for c in plan:
+        cur = now.get(c["id"])
+        if cur and _same_values(cur["old"], c["old"]) and _same_values(cur["new"], c["new"]):
+            changes[c["id"]] = {**cur["new"], "updated_at": stamp}
+        else:
+            stale.append(c.get("ops_no") or c["id"])
+    written, failed = update_changed("ops_documents", changes)
+    return written, len(failed), stale
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# SETTLEMENT REVERSAL + INVOICE RECOMPUTE
+# These guarantee that whenever a payment / credit note / freight / invoice
+# is cancelled or deleted, the payment_settlements that tie it to invoices
+# are reversed and every affected invoice is recomputed — in a constant
+# number of requests, however many invoices are involved.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def true_invoice_totals(invoice_ids):
+    """invoice_id -> correct total = FIRST financial_ledger debit row
+    (by created_at). Later debit rows are inflated duplicates."""
+    first = {}
+    for r in fetch_in(
+        lambda: (admin_supabase.table("financial_ledger")
+                 .select("id, ops_document_id, debit, created_at")
+                 .gt("debit", 0)),
+        "ops_document_id", invoice_ids, "Error loading invoice totals",
+    ):
+        cur = first.get(r["ops_document_id"])
+        if cur is None or (r.get("created_at") or "") < (cur.get("created_at") or ""):
+            first[r["ops_document_id"]] = r
+    return {k: float(v["debit"]) for k, v in first.items()}
+
+
+def recompute_invoices(invoice_ids):
+    """
+    Recompute paid_amount / outstanding_balance / payment_status for every
+    invoice in invoice_ids from its true total and its CURRENT settlements,
+    and write back only the invoices that changed. Returns rows written.
+    """
+    invoice_ids = [i for i in dict.fromkeys(invoice_ids) if i]
+    if not invoice_ids:
+        return 0
+    current = fetch_in(
+        lambda: admin_supabase.table("ops_documents")
+                .select("id, paid_amount, outstanding_balance, payment_status"),
+        "id", invoice_ids, "Error loading invoices",
+    )
+    totals  = true_invoice_totals(invoice_ids)
+    settled = _settled_by_invoice(invoice_ids)
+
+    changes = {}
+    stamp = datetime.utcnow().isoformat()   # moves the report-cache watermark
+    for inv in current:
+        true_total = totals.get(inv["id"], 0.0)
+        paid_sum   = settled.get(inv["id"], 0.0)
+        new_out    = max(0.0, true_total - paid_sum)
+        new_paid   = min(paid_sum, true_total)
+        new_st     = "PAID" if new_out <= 0.01 else ("PARTIAL" if new_paid > 0 else "UNPAID")
+        if (abs(_money(inv.get("paid_amount")) - new_paid) > _EPS
+                or abs(_money(inv.get("outstanding_balance")) - new_out) > _EPS
+                or inv.get("payment_status") != new_st):
+            changes[inv["id"]] = {
+                "paid_amount": new_paid,
+                "outstanding_balance": new_out,
+                "payment_status": new_st,
+                "updated_at": stamp,
+            }
+    written, failed = update_changed("ops_documents", changes)
+    if failed:
+        raise RuntimeError(f"Could not save balances for {len(failed)} invoice(s)")
+    return written
+
+
+def delete_settlements(settlement_ids):
+    """Delete payment_settlements rows by id list, one request per chunk."""
+    ids = [i for i in dict.fromkeys(settlement_ids) if i]
+    for i in range(0, len(ids), IN_CHUNK):
+        admin_supabase.table("payment_settlements") \
+            .delete().in_("id", ids[i:i + IN_CHUNK]).execute()
+
+
+def reverse_settlements_for_docs(doc_ids):
+    """
+    Reverse every payment_settlement that involves any of doc_ids, then
+    restore the invoices those settlements touched.
+
+    Handles BOTH roles a document can play:
+      • acted as the money source (payment / CN / freight) → payment_ops_id
+      • IS an invoice that received allocations            → invoice_id
+
+    Returns {doc_id: [{invoice_id, amount}, ...]} of what was reversed (for
+    audit) — source-role records first, then invoice-role, as before.
+    """
+    doc_ids = [d for d in dict.fromkeys(doc_ids) if d]
+    if not doc_ids:
+        return {}
+
+    as_source = fetch_in(
+        lambda: admin_supabase.table("payment_settlements")
+                .select("id, invoice_id, payment_ops_id, amount"),
+        "payment_ops_id", doc_ids, "Error loading settlements",
+    )
+    as_invoice = fetch_in(
+        lambda: admin_supabase.table("payment_settlements")
+                .select("id, invoice_id, payment_ops_id, amount"),
+        "invoice_id", doc_ids, "Error loading settlements",
+    )
+
+    records = {d: [] for d in doc_ids}
+    affected = set()
+    for s in as_source:
+        if s.get("invoice_id"):
+            affected.add(s["invoice_id"])
+        records[s["payment_ops_id"]].append({"invoice_id": s.get("invoice_id"),
+                                             "amount": float(s.get("amount") or 0)})
+    for s in as_invoice:
+        affected.add(s["invoice_id"])
+        records[s["invoice_id"]].append({"invoice_id": s["invoice_id"],
+                                         "amount": float(s.get("amount") or 0)})
+
+    delete_settlements([s["id"] for s in as_source + as_invoice])
+
+    # (If an invoice itself is being deleted, recompute is harmless — the
+    #  doc row is removed afterward by the caller.)
+    try:
+        recompute_invoices(affected)
+    except Exception:
+        # Never let a recompute failure abort the reversal itself.
+        pass
+    return records
+
+
+def reverse_settlements_for_doc(doc_id):
+    """Single-document form of reverse_settlements_for_docs(); returns the
+    list of {invoice_id, amount} reversed. Safe with no settlements ([])."""
+    return reverse_settlements_for_docs([doc_id]).get(doc_id, [])
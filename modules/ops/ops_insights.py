@@ -0,0 +1,327 @@
+"""
+OPS Insights engine — modules/ops/ops_insights.py
+
+Single-pass, vectorized version of the OPS Insights aggregation. The old
+per-entity `_aggregate()` walked every document and every stock_ledger row
+once per entity (O(entities × docs)); here docs, lines and stock rows are
+loaded into DataFrames once, matched to entities with one concat + merge,
+and grouped by (entity, product, month). Red flags, product flags and the
+health score are column operations on the grouped result.
+
+    compute_insights(docs, lines, stock_rows, entities, prod_map, today)
+        -> list of result dicts (name, entity_type, health, health_reason,
+           agg, flags, prod_insights), in the shape the OPS_INSIGHTS
+           renderer and PDF export already use.
+
+Entities are (entity_id, display_name, key) with key "company" | "user" |
+"stockist"; the company entity's id is the literal "company".
+"""
+
+import numpy as np
+import pandas as pd
+
+
+SAMPLE_RATIO_THRESHOLD = 2.0   # sample qty > 2x invoice qty = red flag
+CREDIT_NOTE_PCT        = 2.0   # credit note > 2% of invoice value = red flag
+PAYMENT_DELAY_DAYS     = 30    # outstanding invoice > 30 days = red flag
+STOCK_IDLE_THRESHOLD   = 0.2   # stock_out / stock_in < 20% = not moving
+
+_KEYS = ["ekey", "eid"]
+
+
+def _num(s):
+    return pd.to_numeric(s, errors="coerce").fillna(0.0).astype(float)
+
+
+def _qty(s):
+    """int(float(v or 0)) for a column — truncates toward zero."""
+    return np.trunc(_num(s)).astype(np.int64)
+
+
+def _frame(rows, cols):
+    df = pd.DataFrame(rows)
+    for c in cols:
+        if c not in df.columns:
+            df[c] = None
+    return df
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# AGGREGATION
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _doc_membership(docs, wanted):
+    """(doc_id, ekey, eid) for every doc ↔ analysed-entity match. A doc that
+    matches the same entity from both sides counts once."""
+    fet = docs["from_entity_type"].fillna("").str.lower()
+    tet = docs["to_entity_type"].fillna("").str.lower()
+    sides = [
+        pd.DataFrame({"doc_id": docs["id"], "ekey": fet, "eid": docs["from_entity_id"]}),
+        pd.DataFrame({"doc_id": docs["id"], "ekey": tet, "eid": docs["to_entity_id"]}),
+    ]
+    company = docs.loc[(fet == "company") | (tet == "company"), ["id"]]
+    sides.append(pd.DataFrame({"doc_id": company["id"], "ekey": "company", "eid": "company"}))
+    m = pd.concat(sides, ignore_index=True)
+    m = m[m["ekey"].isin(["user", "stockist", "company"])]
+    m = m.merge(wanted, on=_KEYS, how="inner")
+    m = m.drop_duplicates(["doc_id", "ekey", "eid"])
+    # back into document order, so products keep their first-seen order
+    pos = pd.Series(np.arange(len(docs)), index=docs["id"].to_numpy())
+    return m.iloc[np.argsort(pos.reindex(m["doc_id"]).to_numpy(), kind="stable")]
+
+
+def _aggregate_all(docs, lines, stock_rows, wanted, prod_map, today):
+    """Entity-level, product-level and monthly frames for every entity in
+    `wanted` in one pass."""
+    d = _frame(docs, [
+        "id", "ops_date", "stock_as", "invoice_total", "paid_amount",
+        "outstanding_balance", "payment_status",
+        "from_entity_type", "from_entity_id", "to_entity_type", "to_entity_id",
+    ])
+    d["sa"]           = d["stock_as"].fillna("").str.lower()
+    d["month"]        = d["ops_date"].fillna("").astype(str).str[:7]
+    d["invoice_total"] = _num(d["invoice_total"])
+    d["paid_amount"]   = _num(d["paid_amount"])
+    d["outstanding"]   = _num(d["outstanding_balance"])
+    doc_date          = pd.to_datetime(d["ops_date"], errors="coerce")
+    days_old          = (pd.Timestamp(today) - doc_date).dt.days.fillna(0)
+    d["overdue"]      = (d["payment_status"].isin(["UNPAID", "PARTIAL"])
+                         & (days_old > PAYMENT_DELAY_DAYS))
+
+    member = _doc_membership(d, wanted)
+    md = member.merge(
+        d[["id", "sa", "month", "invoice_total", "paid_amount", "outstanding", "overdue"]],
+        left_on="doc_id", right_on="id", how="inner",
+    )
+
+    # ── Document-level money (normal invoices) ───────────────────────────────
+    inv = md[md["sa"] == "normal"].copy()
+    inv["overdue_value"] = inv["outstanding"].where(inv["overdue"], 0.0)
+    ent = inv.groupby(_KEYS).agg(
+        invoice_value=("invoice_total", "sum"),
+        paid_amount=("paid_amount", "sum"),
+        outstanding=("outstanding", "sum"),
+        overdue_count=("overdue", "sum"),
+        overdue_value=("overdue_value", "sum"),
+    )
+    monthly = inv.groupby(_KEYS + ["month"], as_index=False)["invoice_total"].sum()
+
+    # ── Line-level quantities ─────────────────────────────────────────────────
+    ln = _frame(lines, ["ops_document_id", "product_id", "sale_qty", "free_qty",
+                        "total_qty", "gross_amount", "net_amount"])
+    ln["sale"]  = _qty(ln["sale_qty"])
+    ln["free"]  = _qty(ln["free_qty"])
+    total       = _qty(ln["total_qty"])
+    ln["qty"]   = total.where(total != 0, ln["sale"])
+    net         = _num(ln["net_amount"])
+    ln["cn_v"]  = net.where(net != 0, _num(ln["gross_amount"]))
+    ln["pname"] = ln["product_id"].map(prod_map).fillna("Unknown")
+
+    ml = md[["doc_id", "ekey", "eid", "sa"]].merge(
+        ln, left_on="doc_id", right_on="ops_document_id", how="inner",
+    )
+    is_inv, is_smp = ml["sa"] == "normal", ml["sa"] == "sample"
+    is_lot, is_cn  = ml["sa"] == "lot", ml["sa"] == "credit_note"
+    ml["invoice_qty"]       = ml["sale"].where(is_inv, 0)
+    ml["inv_qty"]           = (ml["sale"] + ml["free"]).where(is_inv, 0)
+    ml["sample_qty"]        = ml["qty"].where(is_smp, 0)
+    ml["lot_qty"]           = ml["qty"].where(is_lot, 0)
+    ml["credit_note_value"] = ml["cn_v"].where(is_cn, 0.0)
+
+    ent = ent.join(
+        ml.groupby(_KEYS)[["invoice_qty", "sample_qty", "lot_qty", "credit_note_value"]].sum(),
+        how="outer",
+    )
+
+    # Products appear in first-seen order (the renderer shows the top 8).
+    products = (
+        ml[is_inv | is_smp | is_cn]
+        .rename(columns={"credit_note_value": "cn_val"})
+        .groupby(_KEYS + ["pname"], sort=False, as_index=False)[["inv_qty", "sample_qty", "cn_val"]]
+        .sum()
+    )
+
+    # ── Stock movement ────────────────────────────────────────────────────────
+    sr = _frame(stock_rows, ["entity_type", "entity_id", "qty_in", "qty_out"])
+    sr["ekey"]    = sr["entity_type"].fillna("").str.lower()
+    sr["eid"]     = sr["entity_id"].where(sr["ekey"] != "company", "company")
+    sr["stock_in"], sr["stock_out"] = _num(sr["qty_in"]), _num(sr["qty_out"])
+    ent = ent.join(sr.groupby(_KEYS)[["stock_in", "stock_out"]].sum(), how="outer")
+
+    # Every analysed entity gets a row, even with no activity.
+    ent = wanted.set_index(_KEYS).join(ent, how="left").fillna(0)
+    for c in ("invoice_qty", "sample_qty", "lot_qty", "overdue_count"):
+        ent[c] = ent[c].astype(np.int64)
+    return ent, products, monthly
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# FLAGS + HEALTH (column operations)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _trend(monthly, index):
+    """Last three monthly sales values per entity (v1 = latest) and the
+    number of months with sales, aligned to `index`."""
+    out = pd.DataFrame(index=index)
+    if monthly.empty:
+        out["v1"] = out["v2"] = out["v3"] = np.nan
+        out["n_months"] = 0
+        return out
+    m = monthly.sort_values(_KEYS + ["month"])
+    m["k"] = m.groupby(_KEYS).cumcount(ascending=False)   # 0 = latest month
+    last3 = m[m["k"] < 3].pivot_table(index=_KEYS, columns="k",
+                                      values="invoice_total", aggfunc="sum")
+    for k in range(3):
+        out[f"v{k + 1}"] = last3[k] if k in last3.columns else np.nan
+    out["n_months"] = m.groupby(_KEYS).size()
+    out["n_months"] = out["n_months"].fillna(0)
+    return out
+
+
+def _red_flags(ent, trend):
+    """Boolean flag columns plus n_flags / n_red counts, one row per entity."""
+    inv_q, smp = ent["invoice_qty"], ent["sample_qty"]
+    inv_v      = ent["invoice_value"]
+    cn_pct     = (ent["credit_note_value"] / inv_v.where(inv_v > 0) * 100).fillna(0)
+    n, v1, v2, v3 = trend["n_months"], trend["v1"], trend["v2"], trend["v3"]
+
+    f = pd.DataFrame(index=ent.index)
+    f["zero_sales"] = (smp > 0) & (inv_q == 0)
+    f["excess_smp"] = ~f["zero_sales"] & (inv_q > 0) & (smp / inv_q.clip(lower=1) > SAMPLE_RATIO_THRESHOLD)
+    f["delay"]      = ent["overdue_count"] > 0
+    f["high_cn"]    = (inv_v > 0) & (cn_pct > CREDIT_NOTE_PCT)
+    f["idle"]       = (ent["stock_in"] > 0) & (ent["stock_out"] < ent["stock_in"] * STOCK_IDLE_THRESHOLD)
+    f["decline3"]   = (n >= 3) & (v1 < v2) & (v2 < v3)
+    f["decline2"]   = (n == 2) & (v1 < v2)
+    f["no_invoice"] = (inv_v == 0) & ((smp > 0) | (ent["lot_qty"] > 0))
+
+    # 🚨 / ⏰ / 📉 count as critical for the health score
+    f["n_flags"] = f.sum(axis=1)
+    f["n_red"]   = f[["zero_sales", "excess_smp", "delay", "decline3", "decline2"]].sum(axis=1)
+    f["cn_pct"]  = cn_pct
+    return f
+
+
+def _flag_messages(row, agg, t):
+    """Messages for one entity's raised flags (only called when any are)."""
+    out = []
+    if row["zero_sales"]:
+        out.append(f"🚨 Samples given ({agg['sample_qty']} units) but ZERO invoice sales")
+    elif row["excess_smp"]:
+        ratio = round(agg["sample_qty"] / agg["invoice_qty"], 1)
+        out.append(f"🚨 Excess Sampling: {agg['sample_qty']} samples vs {agg['invoice_qty']} invoiced units (ratio {ratio}x)")
+    if row["delay"]:
+        out.append(f"⏰ Payment Delay: {agg['overdue_count']} invoice(s) overdue > {PAYMENT_DELAY_DAYS} days (₹{agg['overdue_value']:,.0f} outstanding)")
+    if row["high_cn"]:
+        out.append(f"📋 High Credit Notes: ₹{agg['credit_note_value']:,.0f} = {row['cn_pct']:.1f}% of invoice value (threshold {CREDIT_NOTE_PCT}%)")
+    if row["idle"]:
+        out.append(f"📦 Stock Not Moving: {agg['stock_in']:.0f} units received, only {agg['stock_out']:.0f} units dispatched")
+    if row["decline3"]:
+        out.append(f"📉 Sales Declining 3 months: ₹{t['v3']:,.0f} → ₹{t['v2']:,.0f} → ₹{t['v1']:,.0f}")
+    elif row["decline2"]:
+        out.append(f"📉 Sales Declining: ₹{t['v2']:,.0f} → ₹{t['v1']:,.0f}")
+    if row["no_invoice"]:
+        out.append("⚠️ No Invoice Sales recorded in this period")
+    return out
+
+
+def _product_flags(products):
+    """{(ekey, eid): [insight, ...]} — top 8 per entity in first-seen order."""
+    p = products.copy()
+    no_sale = (p["sample_qty"] > 0) & (p["inv_qty"] == 0)
+    excess  = ~no_sale & (p["inv_qty"] > 0) & (p["sample_qty"] > p["inv_qty"] * SAMPLE_RATIO_THRESHOLD)
+    cn      = (p["cn_val"] > 0) & (p["inv_qty"] > 0)
+    p = p[no_sale | excess | cn | (p["inv_qty"] > 0)]
+    no_sale, excess, cn = no_sale[p.index], excess[p.index], cn[p.index]
+
+    text = []
+    for r, ns, ex, c in zip(p.itertuples(index=False), no_sale, excess, cn):
+        parts = []
+        if ns:
+            parts.append(f"{r.sample_qty} samples, 0 sales")
+        elif ex:
+            parts.append(f"sample {r.sample_qty} > {SAMPLE_RATIO_THRESHOLD}x invoice {r.inv_qty}")
+        if c:
+            parts.append(f"CN ₹{r.cn_val:,.0f}")
+        text.append(f"**{r.pname}**: {', '.join(parts)}" if parts
+                    else f"✅ **{r.pname}**: {r.inv_qty} units sold")
+    p = p.assign(text=text).groupby(_KEYS, sort=False).head(8)
+    return {k: g["text"].tolist() for k, g in p.groupby(_KEYS, sort=False)}
+
+
+def _health(f):
+    """health / health_reason columns from the flag counts."""
+    n, red = f["n_flags"].to_numpy(), f["n_red"].to_numpy()
+    health = np.select([n == 0, red == 0, red >= 2], ["GREEN", "YELLOW", "RED"], "YELLOW")
+    reason = [
+        "No issues detected" if nf == 0
+        else f"{nf} minor issue(s) noted" if nr == 0
+        else f"{nr} critical issue(s) require attention" if nr >= 2
+        else f"{nr} issue(s) require attention"
+        for nf, nr in zip(n, red)
+    ]
+    return pd.DataFrame({"health": health, "health_reason": reason}, index=f.index)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ENTRY POINT
+# ─────────────────────────────────────────────────────────────────────────────
+
+def compute_insights(docs, lines, stock_rows, entities, prod_map, today):
+    """Results for every entity (RED first, then YELLOW, then GREEN)."""
+    if not entities:
+        return []
+    wanted = pd.DataFrame(
+        [(ekey, eid) for eid, _, ekey in entities], columns=_KEYS,
+    ).drop_duplicates()
+
+    ent, products, monthly = _aggregate_all(docs, lines, stock_rows, wanted, prod_map, today)
+    trend  = _trend(monthly, ent.index)
+    flags  = _red_flags(ent, trend)
+    health = _health(flags)
+    prod_text = _product_flags(products)
+
+    prod_dicts = {
+        k: {r.pname: {"inv_qty": int(r.inv_qty), "sample_qty": int(r.sample_qty),
+                      "cn_val": float(r.cn_val)}
+            for r in g.itertuples(index=False)}
+        for k, g in products.groupby(_KEYS, sort=False)
+    }
+    month_dicts = {
+        k: dict(zip(g["month"], g["invoice_total"].astype(float)))
+        for k, g in monthly.groupby(_KEYS)
+    }
+
+    results = []
+    for eid, ename, ekey in entities:
+        key = (ekey, eid)
+        a = ent.loc[key]
+        agg = {
+            "invoice_value":     float(a["invoice_value"]),
+            "invoice_qty":       int(a["invoice_qty"]),
+            "sample_qty":        int(a["sample_qty"]),
+            "lot_qty":           int(a["lot_qty"]),
+            "credit_note_value": float(a["credit_note_value"]),
+            "paid_amount":       float(a["paid_amount"]),
+            "outstanding":       float(a["outstanding"]),
+            "overdue_count":     int(a["overdue_count"]),
+            "overdue_value":     float(a["overdue_value"]),
+            "monthly_sales":     month_dicts.get(key, {}),
+            "products":          prod_dicts.get(key, {}),
+            "stock_in":          float(a["stock_in"]),
+            "stock_out":         float(a["stock_out"]),
+        }
+        f = flags.loc[key]
+        results.append({
+            "name":          ename,
+            "entity_type":   ekey,
+            "health":        health.loc[key, "health"],
+            "health_reason": health.loc[key, "health_reason"],
+            "agg":           agg,
+            "flags":         _flag_messages(f, agg, trend.loc[key]) if f["n_flags"] else [],
+            "prod_insights": prod_text.get(key, []),
+        })
+
+    order = {"RED": 0, "YELLOW": 1, "GREEN": 2}
+    results.sort(key=lambda x: order.get(x["health"], 3))
+    return results
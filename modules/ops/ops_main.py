@@ -1,6 +1,20 @@
 import streamlit as st
 from datetime import datetime, date, timedelta, timezone
-from anchors.supabase_client import admin_supabase, safe_exec
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_all, fetch_rows, fetch_in
+from anchors.master_cache import master_rows, master_index, invalidate as invalidate_masters
+from anchors.entity_directory import entity_name, resolve_many, match_entity_ids
+from modules.ops.stock_snapshots import (
+    opening_rows, cancelled_doc_ids, is_reversal_narration,
+    invalidate_stock_snapshots, build_stock_snapshots, verify_stock_snapshots,
+)
+from modules.ops.ops_insights import compute_insights
+from modules.ops.doc_browser import render_doc_register, page_slice
+from anchors.pdf_service import chunked_tables, pdf_download_button
+from anchors.doc_numbers import ops_doc_no
+from modules.ops.money_integrity import (
+    plan_invoice_recalc, apply_invoice_recalc,
+    true_invoice_totals, recompute_invoices, reverse_settlements_for_doc,
+)
 
 
 # ══════════════════════════════════════════════════════════════════
@@ -14,29 +28,14 @@ from anchors.supabase_client import admin_supabase, safe_exec
 
 def _true_invoice_total_mod(inv_id):
     """Correct invoice total = first financial_ledger.debit row (non-inflated)."""
-    led = admin_supabase.table("financial_ledger") \
-        .select("debit").eq("ops_document_id", inv_id) \
-        .gt("debit", 0).order("created_at").limit(1) \
-        .execute().data or []
-    return float(led[0]["debit"]) if led else 0.0
+    return true_invoice_totals([inv_id]).get(inv_id, 0.0)
 
 
 def _recompute_invoice_mod(inv_id):
     """Recompute paid_amount / outstanding_balance / payment_status from the
     invoice's true total and its CURRENT remaining settlements. Identical
     formula to the Allocate-Payments _recompute_invoice_after_change."""
-    true_total = _true_invoice_total_mod(inv_id)
-    setts = admin_supabase.table("payment_settlements") \
-        .select("amount").eq("invoice_id", inv_id).execute().data or []
-    settled = sum(float(s["amount"]) for s in setts)
-    new_out  = max(0.0, true_total - settled)
-    new_paid = min(settled, true_total)
-    new_st   = "PAID" if new_out <= 0.01 else ("PARTIAL" if new_paid > 0 else "UNPAID")
-    admin_supabase.table("ops_documents").update({
-        "paid_amount": new_paid,
-        "outstanding_balance": new_out,
-        "payment_status": new_st
-    }).eq("id", inv_id).execute()
+    recompute_invoices([inv_id])
 
 
 def _reverse_settlements_for_doc(doc_id):
@@ -50,48 +49,10 @@ def _reverse_settlements_for_doc(doc_id):
 
     Returns a list of {invoice_id, amount} that were reversed (for audit).
     Safe to call even if there are no settlements (returns []).
+    Batched: settlements are deleted by id-list and all affected invoices
+    are recomputed together (see money_integrity).
     """
-    reversed_records = []
-
-    # 1. Settlements where this doc was the source (payment/CN/freight)
-    as_source = admin_supabase.table("payment_settlements") \
-        .select("id, invoice_id, amount").eq("payment_ops_id", doc_id) \
-        .execute().data or []
-
-    # 2. Settlements where this doc was the invoice being paid
-    as_invoice = admin_supabase.table("payment_settlements") \
-        .select("id, invoice_id, amount").eq("invoice_id", doc_id) \
-        .execute().data or []
-
-    # Collect every invoice that will need recomputation
-    affected_invoice_ids = set()
-    for s in as_source:
-        if s.get("invoice_id"):
-            affected_invoice_ids.add(s["invoice_id"])
-        reversed_records.append({"invoice_id": s.get("invoice_id"),
-                                 "amount": float(s.get("amount") or 0)})
-    for s in as_invoice:
-        affected_invoice_ids.add(doc_id)
-        reversed_records.append({"invoice_id": doc_id,
-                                 "amount": float(s.get("amount") or 0)})
-
-    # Delete the settlement rows (both roles)
-    for s in as_source:
-        admin_supabase.table("payment_settlements").delete().eq("id", s["id"]).execute()
-    for s in as_invoice:
-        admin_supabase.table("payment_settlements").delete().eq("id", s["id"]).execute()
-
-    # Recompute each affected invoice from its remaining settlements.
-    # (If the invoice itself is being deleted, recompute is harmless — the
-    #  doc row is removed afterward by the caller.)
-    for inv_id in affected_invoice_ids:
-        try:
-            _recompute_invoice_mod(inv_id)
-        except Exception:
-            # Never let a single recompute failure abort the whole reversal.
-            pass
-
-    return reversed_records
+    return reverse_settlements_for_doc(doc_id)
 
 
 def _mobile_table(df, compact_cols, detail_title_col, uid_prefix='tbl'):
@@ -175,36 +136,13 @@ def _mobile_table(df, compact_cols, detail_title_col, uid_prefix='tbl'):
 
 
 # ---------- Helper: resolve entity display name ----------
+# O(1) lookups through anchors.entity_directory (built from the masters).
 def resolve_entity_name(entity_type, entity_id):
-    if entity_type == "Company":
-        return "Company"
-
-    if entity_type == "CNF":
-        return next(
-            (c["name"] for c in st.session_state.cnfs_master if c["id"] == entity_id),
-            "Unknown CNF"
-        )
-
-    if entity_type == "User":
-        return next(
-            (u["username"] for u in st.session_state.users_master if u["id"] == entity_id),
-            "Unknown User"
-        )
+    if entity_type in ("Company", "Destroyed"):
+        return entity_type
 
-    if entity_type == "Stockist":
-        return next(
-            (s["name"] for s in st.session_state.stockists_master if s["id"] == entity_id),
-            "Unknown Stockist"
-        )
-
-    if entity_type == "Purchaser":
-        return next(
-            (p["name"] for p in st.session_state.purchasers_master if p["id"] == entity_id),
-            "Unknown Purchaser"
-        )
-
-    if entity_type == "Destroyed":
-        return "Destroyed"
+    if entity_type in ("CNF", "User", "Stockist", "Purchaser"):
+        return entity_name(entity_type, entity_id, f"Unknown {entity_type}")
 
     return "Unknown"
 def resolve_entity_display_name(entity_type, entity_id, doc_narration=None):
@@ -214,30 +152,8 @@ def resolve_entity_display_name(entity_type, entity_id, doc_narration=None):
     if entity_type:
         if entity_type == "Company":
             return ("Company", "Company")
-        elif entity_type == "CNF":
-            name = next(
-                (c["name"] for c in st.session_state.cnfs_master if c["id"] == entity_id),
-                "Unknown CNF"
-            )
-            return ("CNF", name)
-        elif entity_type == "User":
-            name = next(
-                (u["username"] for u in st.session_state.users_master if u["id"] == entity_id),
-                "Unknown User"
-            )
-            return ("User", name)
-        elif entity_type == "Stockist":
-            name = next(
-                (s["name"] for s in st.session_state.stockists_master if s["id"] == entity_id),
-                "Unknown Stockist"
-            )
-            return ("Stockist", name)
-        elif entity_type == "Purchaser":
-            name = next(
-                (p["name"] for p in st.session_state.purchasers_master if p["id"] == entity_id),
-                "Unknown Purchaser"
-            )
-            return ("Purchaser", name)
+        elif entity_type in ("CNF", "User", "Stockist", "Purchaser"):
+            return (entity_type, entity_name(entity_type, entity_id, f"Unknown {entity_type}"))
         else:
             return (entity_type, entity_type)
     
@@ -313,60 +229,16 @@ def run_ops():
     # =========================
     # MASTER DATA CACHE (FAST)
     # =========================
-
-    # USERS
-    if "users_master" not in st.session_state:
-        users_resp = admin_supabase.table("users") \
-            .select("id, username") \
-            .order("username") \
-            .execute()
-        st.session_state.users_master = users_resp.data or []
-
-    # CNFS
-    if "cnfs_master" not in st.session_state:
-        cnf_resp = admin_supabase.table("cnfs") \
-            .select("id, name") \
-            .order("name") \
-            .execute()
-        st.session_state.cnfs_master = cnf_resp.data or []
-
-    # STOCKISTS
-    if "stockists_master" not in st.session_state:
-        stockist_resp = admin_supabase.table("stockists") \
-            .select("id, name") \
-            .order("name") \
-            .execute()
-        st.session_state.stockists_master = stockist_resp.data or []
-
-    # PURCHASERS
-    if "purchasers_master" not in st.session_state:
-        purchaser_resp = admin_supabase.table("purchasers") \
-            .select("id, name, email") \
-            .order("name") \
-            .execute()
-        st.session_state.purchasers_master = purchaser_resp.data or []
-
-    # PRODUCTS
-    if "products_master" not in st.session_state:
-        product_resp = admin_supabase.table("products") \
-            .select("id, name") \
-            .order("name") \
-            .execute()
-        st.session_state.products_master = product_resp.data or []
-
-        # CNF → USER MAPPING CACHE
-        if "cnf_user_map" not in st.session_state:
-            resp = admin_supabase.table("cnf_users") \
-                .select("cnf_id, user_id") \
-                .execute()
-            st.session_state.cnf_user_map = resp.data or []
-
-        # USER → STOCKIST MAPPING CACHE
-        if "user_stockist_map" not in st.session_state:
-            resp = admin_supabase.table("user_stockists") \
-                .select("user_id, stockist_id") \
-                .execute()
-            st.session_state.user_stockist_map = resp.data or []
+    # Process-wide and version-checked (anchors.master_cache), so edits made
+    # in any tab show up here without a logout. Re-bound on every run — the
+    # session_state names stay for the sections that read them.
+    st.session_state.users_master      = master_rows("users")
+    st.session_state.cnfs_master       = master_rows("cnfs")
+    st.session_state.stockists_master  = master_rows("stockists")
+    st.session_state.purchasers_master = master_rows("purchasers")
+    st.session_state.products_master   = master_rows("products")
+    st.session_state.cnf_user_map      = master_rows("cnf_users")
+    st.session_state.user_stockist_map = master_rows("user_stockists")
 
 
     # =========================
@@ -501,6 +373,7 @@ def run_ops():
         "🔄 Return / Replace":              "RETURN_REPLACE",
         "🔄 Recalculate Balances":          "RECALC_BALANCES",
         "🔧 Repair Missing Stock Entries":  "REPAIR_STOCK_ENTRIES",
+        "🧮 Stock Snapshots":               "STOCK_SNAPSHOTS",
         "📊 OPS Insights":                  "OPS_INSIGHTS",
     }
 
@@ -651,7 +524,7 @@ def run_ops():
                             
                 # ---- Create synthetic OPS document for opening stock ----
                 ops_resp = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"OPEN-STOCK-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("OPEN-STOCK"),
                     "ops_date": opening_stock_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -690,7 +563,7 @@ def run_ops():
 
                 # Create synthetic OPS document for stock adjustment
                 ops_resp = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"STOCK-ADJ-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("STOCK-ADJ"),
                     "ops_date": opening_stock_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -966,7 +839,8 @@ This action will:
                     # party balance stops counting it. Stock ledger reversal rows
                     # already keep closing stock correct.
                     admin_supabase.table("ops_documents").update({
-                        "is_deleted": True
+                        "is_deleted": True,
+                        "updated_at": datetime.utcnow().isoformat()
                     }).eq("id", ops_id).execute()
 
                     st.success("✅ Invoice cancelled successfully with reverse entry")
@@ -1165,7 +1039,7 @@ This action will:
 
         # Create synthetic OPS for reversal
         reversal_ops = admin_supabase.table("ops_documents").insert({
-            "ops_no": f"REV-DEL-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+            "ops_no": ops_doc_no("REV-DEL"),
             "ops_date": datetime.utcnow().date().isoformat(),
             "ops_type": "ADJUSTMENT",
             "stock_as": "adjustment",
@@ -1277,7 +1151,7 @@ This action will:
 
                 # ---- Create synthetic OPS document for opening balance ----
                 ops_resp = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"OPEN-BAL-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("OPEN-BAL"),
                     "ops_date": opening_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -1497,6 +1371,7 @@ This action will:
                                         os_update_payload["qty_out"] = os_new_qty
                                     admin_supabase.table("stock_ledger") \
                                         .update(os_update_payload).eq("id", os_row["id"]).execute()
+                                    invalidate_stock_snapshots(min(os_new_date.isoformat(), os_row["txn_date"]))
                                     try:
                                         admin_supabase.table("audit_logs").insert({
                                             "action": "OS_UPDATED",
@@ -1518,6 +1393,7 @@ This action will:
                                     try:
                                         admin_supabase.table("stock_ledger") \
                                             .delete().eq("id", os_row["id"]).execute()
+                                        invalidate_stock_snapshots(os_row["txn_date"])
                                         if os_row.get("ops_document_id"):
                                             os_ops_check = admin_supabase.table("ops_documents") \
                                                 .select("narration") \
@@ -1627,7 +1503,12 @@ This action will:
 
                                     # Delete records
                                     admin_supabase.table("financial_ledger").delete().eq("ops_document_id", ops_id).execute()
+                                    _del_first = admin_supabase.table("stock_ledger") \
+                                        .select("txn_date").eq("ops_document_id", ops_id) \
+                                        .order("txn_date").limit(1).execute().data or []
                                     admin_supabase.table("stock_ledger").delete().eq("ops_document_id", ops_id).execute()
+                                    if _del_first:
+                                        invalidate_stock_snapshots(_del_first[0]["txn_date"])
                                     admin_supabase.table("ops_lines").delete().eq("ops_document_id", ops_id).execute()
                                     admin_supabase.table("ops_documents").delete().eq("id", ops_id).execute()
                                     
@@ -2357,7 +2238,7 @@ This action will:
                         # ─────────────────────────────────────────────────────
 
                         response = admin_supabase.table("ops_documents").insert({
-                            "ops_no": f"OPS-{__import__('datetime').datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                            "ops_no": ops_doc_no("OPS"),
                             "ops_date": ops_txn_date.isoformat(),
                             "ops_type": ops_type_val,
                             "stock_as": stock_as_val,
@@ -2461,19 +2342,27 @@ This action will:
                         }).execute()
 
 
-                        # ---------- UPDATE INVOICE TOTALS (FOR INVOICES ONLY) ----------
-                        if ops_type_val == "STOCK_OUT" and stock_as_val == "normal":
-                            # IMPORTANT: amounts are DOCUMENT-LEVEL (one total for the whole
-                            # invoice), but the same total is written into every ops_line.
-                            # So summing line net_amounts inflates by the number of products.
-                            # Use the single document-level net amount directly.
-                            invoice_total = float(st.session_state.ops_amounts.get("net", 0) or 0)
+                        # ---------- UPDATE DOCUMENT / INVOICE TOTALS ----------
+                        # IMPORTANT: amounts are DOCUMENT-LEVEL (one total for the whole
+                        # invoice), but the same total is written into every ops_line.
+                        # So summing line net_amounts inflates by the number of products.
+                        # Use the single document-level net amount directly.
+                        invoice_total = float(st.session_state.ops_amounts.get("net", 0) or 0)
 
+                        if ops_type_val == "STOCK_OUT" and stock_as_val == "normal":
                             # This is an invoice, set invoice totals
                             admin_supabase.table("ops_documents").update({
                                 "invoice_total": invoice_total,
                                 "outstanding_balance": invoice_total,
-                                "payment_status": "UNPAID"
+                                "payment_status": "UNPAID",
+                                "updated_at": datetime.utcnow().isoformat()
+                            }).eq("id", ops_document_id).execute()
+                        else:
+                            # Other documents store only the total, so the
+                            # registers can show it without reading ops_lines
+                            admin_supabase.table("ops_documents").update({
+                                "invoice_total": invoice_total,
+                                "updated_at": datetime.utcnow().isoformat()
                             }).eq("id", ops_document_id).execute()
 
                         
@@ -2534,9 +2423,9 @@ This action will:
 
                         st.success("✅ OPS document saved successfully")
                         st.session_state.ops_submit_done = True
-                        # Push notification — send to user assigned to this stockist
+                        # Push notification — queued for the users assigned to this stockist
                         try:
-                            from anchors.fcm_helper import send_push_notification
+                            from anchors.notification_outbox import enqueue as enqueue_push
                             _saved = response.data[0]
                             _doc_type = st.session_state.get("ops_stock_as", "Invoice")
                             _notif_title = "📝 Credit Note Created" if _doc_type == "Credit Note" \
@@ -2546,17 +2435,13 @@ This action will:
                                 if st.session_state.get("ops_to_entity_type") == "Stockist" \
                                 else st.session_state.get("ops_from_entity_id")
                             if _stockist_id:
-                                _user_map = admin_supabase.table("user_stockists") \
-                                    .select("user_id") \
-                                    .eq("stockist_id", _stockist_id) \
-                                    .execute()
-                                for _um in (_user_map.data or []):
-                                    send_push_notification(
-                                        user_id=_um["user_id"],
-                                        title=_notif_title,
-                                        body=f"{_saved.get('ops_no', '')} | {st.session_state.get('ops_to_entity_name', '')} | ₹{float(_saved.get('invoice_total', 0) or 0):,.0f}",
-                                        data={"type": _notif_type, "ops_no": _saved.get("ops_no", "")}
-                                    )
+                                enqueue_push(
+                                    [_um["user_id"] for _um in master_rows("user_stockists")
+                                     if _um["stockist_id"] == _stockist_id],
+                                    title=_notif_title,
+                                    body=f"{_saved.get('ops_no', '')} | {st.session_state.get('ops_to_entity_name', '')} | ₹{float(_saved.get('invoice_total', 0) or 0):,.0f}",
+                                    data={"type": _notif_type, "ops_no": _saved.get("ops_no", "")}
+                                )
                         except Exception:
                             pass
                         # ✅ IF EDITING, REVERSE THE OLD STOCK & FINANCIAL ENTRIES
@@ -2682,6 +2567,7 @@ This action will:
 
                 st.success("✅ CNF added successfully")
                 st.session_state.pop("cnf_master", None)
+                invalidate_masters("cnfs")
                 st.rerun()
 
             except Exception as e:
@@ -2803,6 +2689,7 @@ This action will:
                     # Insert new mappings
                     if rows:
                         admin_supabase.table("cnf_users").insert(rows).execute()
+                    invalidate_masters("cnf_users")
 
                     st.success("✅ CNF–User mapping saved successfully")
 
@@ -2889,6 +2776,7 @@ This action will:
                 st.session_state.purchaser_edit_mode = False
                 st.session_state.editing_purchaser_id = None
                 st.session_state.pop("purchaser_master", None)
+                invalidate_masters("purchasers")
                 st.rerun()
 
             except Exception as e:
@@ -3404,7 +3292,7 @@ This action will:
             from reportlab.lib.units import inch
             from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
             from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-            from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+            from reportlab.lib.enums import TA_CENTER
             from io import BytesIO
 
             export_rows = []
@@ -3690,7 +3578,7 @@ This action will:
                 # ─────────────────────────────────────────────────────
 
                 doc_resp = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"PAY-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("PAY"),
                     "ops_date": pay_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -3768,7 +3656,8 @@ This action will:
                             admin_supabase.table("ops_documents").update({
                                 "paid_amount": new_paid,
                                 "outstanding_balance": max(0, new_outstanding),
-                                "payment_status": status
+                                "payment_status": status,
+                                "updated_at": datetime.utcnow().isoformat()
                             }).eq("id", invoice_id).execute()
 
                 # Update payment allocation status
@@ -3784,7 +3673,8 @@ This action will:
                     alloc_status = "UNALLOCATED"
 
                 admin_supabase.table("ops_documents").update({
-                    "allocation_status": alloc_status
+                    "allocation_status": alloc_status,
+                    "updated_at": datetime.utcnow().isoformat()
                 }).eq("id", payment_ops_id).execute()
 
 
@@ -4133,7 +4023,7 @@ This action will:
                 st.markdown("**💰 Opening Balance (Unallocated)**")
                 if ob_rows_by_stockist:
                     for sid, ob_amt in ob_rows_by_stockist.items():
-                        sname = next((s["name"] for s in st.session_state.stockists_master if s["id"] == sid), "Unknown")
+                        sname = entity_name("Stockist", sid, "Unknown")
                         st.markdown(
                             f"<div style='background:#fff8e1;border-left:4px solid #e67e22;"
                             f"padding:0.55rem 0.9rem;border-radius:6px;margin-bottom:5px;font-size:0.88rem;'>"
@@ -4280,7 +4170,7 @@ This action will:
                         from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
                         from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
                         from reportlab.lib.units import inch
-                        from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+                        from reportlab.lib.enums import TA_CENTER
                         import io
                         
                         # Create PDF in memory
@@ -4553,71 +4443,46 @@ This action will:
             def _ename(eid):
                 if cs_entity_type == "Company":
                     return "Company"
-                if cs_entity_type == "CNF":
-                    return next(
-                        (c["name"] for c in st.session_state.get("cnfs_master", [])
-                         if c["id"] == eid), str(eid)[:8]
-                    )
-                return next(
-                    (u["username"] for u in st.session_state.get("users_master", [])
-                     if u["id"] == eid), str(eid)[:8]
-                )
+                return entity_name("CNF" if cs_entity_type == "CNF" else "User",
+                                   eid, str(eid)[:8])
 
-            # ── Paginated fetch: Supabase caps a single query at 1000 rows ────
-            def _sl_fetch_all(build_q):
-                _rows, _start = [], 0
-                while True:
-                    _batch = build_q().range(_start, _start + 999).execute().data or []
-                    _rows.extend(_batch)
-                    if len(_batch) < 1000:
-                        return _rows
-                    _start += 1000
-
-            # ── 1. Opening stock = all ledger rows BEFORE from_date ───────────
+            # ── 1. Opening stock = month-end snapshot + ledger rows after it ──
+            # (falls back to every row BEFORE from_date when no snapshot is
+            #  usable; fetch_all pages past Supabase's 1000-row cap)
             with st.spinner("Fetching opening stock..."):
-                open_rows_raw = _sl_fetch_all(lambda: (
-                    admin_supabase.table("stock_ledger")
-                    .select("id, product_id, entity_id, qty_in, qty_out, "
-                            "narration, ops_document_id")
-                    .eq("entity_type", cs_entity_type)
-                    .lt("txn_date", cs_from.isoformat())
-                    .order("id")
-                ))
+                _cs_bf, _cs_rows_from = opening_rows(cs_from, [cs_entity_type])
+
+                def _cs_open_q():
+                    q = (admin_supabase.table("stock_ledger")
+                         .select("id, product_id, entity_id, qty_in, qty_out, "
+                                 "narration, ops_document_id")
+                         .eq("entity_type", cs_entity_type)
+                         .lt("txn_date", cs_from.isoformat()))
+                    if _cs_rows_from:
+                        q = q.gte("txn_date", _cs_rows_from)
+                    return q
+
+                open_rows_raw = _cs_bf + fetch_all(_cs_open_q, "Error fetching opening stock")
             open_rows = _filter_entity(open_rows_raw)
 
             # ── 2. Period rows = ledger rows WITHIN from_date to to_date ──────
             with st.spinner("Fetching period movements..."):
-                period_rows_raw = _sl_fetch_all(lambda: (
+                period_rows_raw = fetch_all(lambda: (
                     admin_supabase.table("stock_ledger")
                     .select("id, product_id, entity_id, qty_in, qty_out, "
                             "narration, ops_document_id")
                     .eq("entity_type", cs_entity_type)
                     .gte("txn_date", cs_from.isoformat())
                     .lte("txn_date", cs_to.isoformat())
-                    .order("id")
-                ))
+                ), "Error fetching period movements")
             period_rows = _filter_entity(period_rows_raw)
 
             # ── Exclude cancelled documents AND their reversal rows ──────────
-            # so this report matches the Stock Ledger and Stock Statement.
-            def _cs_is_rev(nar):
-                n = nar or ""
-                return (n.startswith("Cancellation of ")
-                        or n.startswith("Reversal due to deletion of ")
-                        or n.startswith("Reversal of deleted"))
-
-            _cs_doc_ids = list({r.get("ops_document_id")
-                                for r in (open_rows + period_rows)
-                                if r.get("ops_document_id")})
-            _cs_deleted = set()
-            for _i in range(0, len(_cs_doc_ids), 200):
-                _drows = (admin_supabase.table("ops_documents")
-                          .select("id")
-                          .in_("id", _cs_doc_ids[_i:_i + 200])
-                          .eq("is_deleted", True)
-                          .execute().data or [])
-                for _d in _drows:
-                    _cs_deleted.add(_d["id"])
+            # so this report matches the Stock Ledger, Stock Statement and
+            # the snapshots (one shared rule in stock_snapshots).
+            _cs_is_rev = is_reversal_narration
+            _cs_deleted = cancelled_doc_ids(r.get("ops_document_id")
+                                            for r in (open_rows + period_rows))
 
             open_rows = [r for r in open_rows
                          if r.get("ops_document_id") not in _cs_deleted
@@ -4845,25 +4710,32 @@ This action will:
             if st.button("Generate Stock Statement", key="ss_gen", type="primary"):
                 _scope_type, _scope_id, _scope_lbl = ss_scope
 
-                def _ss_fetch_all(build_q):
-                    _rows, _start = [], 0
-                    while True:
-                        _batch = build_q().range(_start, _start + 999).execute().data or []
-                        _rows.extend(_batch)
-                        if len(_batch) < 1000:
-                            return _rows
-                        _start += 1000
-
                 _sel = ("id, ops_document_id, product_id, entity_type, entity_id, "
                         "txn_date, qty_in, qty_out, narration")
 
+                if _scope_type == "ALL":
+                    _ss_types = ["Company", "CNF", "User"]
+                elif _scope_type == "Company":
+                    _ss_types = ["Company"]
+                else:
+                    _ss_types = [_scope_type]
+
+                # Opening before From Date comes from the month-end snapshot as
+                # synthetic "Opening b/f" rows; only later rows are fetched.
+                with st.spinner("Loading stock snapshot..."):
+                    _ss_bf, _ss_rows_from = opening_rows(
+                        ss_from, _ss_types,
+                        _scope_id if _scope_type not in ("ALL", "Company") else None,
+                    )
+
                 def _ss_build():
                     q = (admin_supabase.table("stock_ledger")
                          .select(_sel)
-                         .lte("txn_date", ss_to.isoformat())
-                         .order("id"))
+                         .lte("txn_date", ss_to.isoformat()))
+                    if _ss_rows_from:
+                        q = q.gte("txn_date", _ss_rows_from)
                     if _scope_type == "ALL":
-                        q = q.in_("entity_type", ["Company", "CNF", "User"])
+                        q = q.in_("entity_type", _ss_types)
                     elif _scope_type == "Company":
                         q = q.eq("entity_type", "Company")
                     else:
@@ -4871,7 +4743,7 @@ This action will:
                     return q
 
                 with st.spinner("Fetching stock ledger..."):
-                    _raw = _ss_fetch_all(_ss_build)
+                    _raw = _ss_bf + fetch_all(_ss_build, "Error fetching stock ledger")
 
                 # Company rows must have no entity_id (safety, mirrors Closing Stock)
                 if _scope_type == "Company":
@@ -4949,64 +4821,12 @@ This action will:
 
             # ── Identify CANCELLED invoice documents (so their OUT is excluded) ─
             # A cancelled/deleted invoice is reversed by a synthetic ADJUSTMENT
-            # ops_document. Older reversals used inconsistent narrations, so we
-            # detect cancelled originals through THREE robust signals and union
-            # them. This also excludes historical bad rows without a DB migration.
-            #
-            #   1) Reversal stock rows whose narration is "Cancellation of <ops_no>"
-            #      (canonical, both cancel paths now write this).
-            #   2) The reversal ops_document's reference_no = original ops_no.
-            #   3) Any ops_document with is_deleted = True (authoritative flag set
-            #      by every cancel/delete path).
-            _cancelled_ops_nos = set()
-            for r in _rows_all:
-                _n = r.get("narration") or ""
-                if _n.startswith("Cancellation of "):
-                    _val = _n.replace("Cancellation of ", "").strip()
-                    # Guard: ignore legacy rows that stored a UUID (4 dashes)
-                    # instead of an ops_no (e.g. OPS-YYYYMMDD-NNNNNN, 2 dashes).
-                    if _val and _val.count("-") < 4:
-                        _cancelled_ops_nos.add(_val)
-
-            # Signal 2: reference_no on reversal ADJUSTMENT documents.
-            try:
-                _rev_docs = (admin_supabase.table("ops_documents")
-                             .select("reference_no")
-                             .eq("ops_type", "ADJUSTMENT")
-                             .not_.is_("reference_no", "null")
-                             .execute().data or [])
-                for _rd in _rev_docs:
-                    _rn = (_rd.get("reference_no") or "").strip()
-                    if _rn:
-                        _cancelled_ops_nos.add(_rn)
-            except Exception:
-                pass
-
-            _cancelled_doc_ids = set()
-            if _cancelled_ops_nos:
-                _con = list(_cancelled_ops_nos)
-                for _i in range(0, len(_con), 200):
-                    _crows = (admin_supabase.table("ops_documents")
-                              .select("id, ops_no")
-                              .in_("ops_no", _con[_i:_i + 200])
-                              .execute().data or [])
-                    for _c in _crows:
-                        _cancelled_doc_ids.add(_c["id"])
-
-            # Signal 3: authoritative is_deleted flag. Pull deleted document ids
-            # for the documents that actually appear in these stock rows, so the
-            # original OUT row of ANY deleted invoice is excluded even if its
-            # reversal narration was malformed.
-            _present_doc_ids = list({r.get("ops_document_id")
-                                     for r in _rows_all if r.get("ops_document_id")})
-            for _i in range(0, len(_present_doc_ids), 200):
-                _drows = (admin_supabase.table("ops_documents")
-                          .select("id")
-                          .in_("id", _present_doc_ids[_i:_i + 200])
-                          .eq("is_deleted", True)
-                          .execute().data or [])
-                for _d in _drows:
-                    _cancelled_doc_ids.add(_d["id"])
+            # ops_document. cancelled_doc_ids() unions the three signals
+            # ("Cancellation of <ops_no>" reversal rows, the reversal document's
+            # reference_no, and is_deleted) — the same rule the stock snapshots
+            # and Closing Stock use.
+            _cancelled_doc_ids = cancelled_doc_ids(r.get("ops_document_id")
+                                                   for r in _rows_all)
 
             st.session_state.ss_cancelled_doc_ids = _cancelled_doc_ids
 
@@ -5474,25 +5294,16 @@ This action will:
         # (not just rows with narration "Opening Balance" inside the range).
         # This makes the ledger correct for ANY From Date, e.g. 1st April
         # when the synthetic OB entry is dated 1st March.
-        # Paginated: Supabase caps a single query at 1000 rows.
+        # Paginated (fetch_rows): Supabase caps a single query at 1000 rows.
         # -------------------------
         opening_balance = 0.0
-        _ob_start = 0
-        while True:
-            _ob_batch = (
-                admin_supabase.table("financial_ledger")
-                .select("debit, credit")
-                .eq("party_id", party_id)
-                .lt("txn_date", from_date.isoformat())
-                .order("id")
-                .range(_ob_start, _ob_start + 999)
-                .execute()
-            ).data or []
-            for _r in _ob_batch:
-                opening_balance += float(_r.get("debit") or 0) - float(_r.get("credit") or 0)
-            if len(_ob_batch) < 1000:
-                break
-            _ob_start += 1000
+        for _r in fetch_rows(lambda: (
+            admin_supabase.table("financial_ledger")
+            .select("id, debit, credit")
+            .eq("party_id", party_id)
+            .lt("txn_date", from_date.isoformat())
+        ), "Error fetching opening balance"):
+            opening_balance += float(_r.get("debit") or 0) - float(_r.get("credit") or 0)
 
         if not ledger_rows and opening_balance == 0:
             st.info("No ledger entries found.")
@@ -5717,121 +5528,118 @@ This action will:
         # -------------------------
         st.divider()
         
-        if st.button("📥 Generate Ledger PDF"):
-            try:
-                from io import BytesIO
-                import re as _re
-                from reportlab.lib.pagesizes import A4, landscape
-                from reportlab.lib import colors
-                from reportlab.platypus import (SimpleDocTemplate, Table,
-                                                TableStyle, Paragraph, Spacer)
-                from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-                from reportlab.lib.enums import TA_RIGHT
-
-                _teal    = colors.HexColor("#00695C")
-                _teal50  = colors.HexColor("#E0F2F1")
-                _altRow  = colors.HexColor("#F0FAF7")
-                _openBg  = colors.HexColor("#E8F5E9")
-                _cbColor = (colors.HexColor("#C62828") if running_balance > 0
-                            else colors.HexColor("#2E7D32"))
-
-                _styles = getSampleStyleSheet()
-                _h1  = ParagraphStyle("h1", parent=_styles["Normal"], fontSize=15,
-                                      textColor=_teal, fontName="Helvetica-Bold")
-                _sub = ParagraphStyle("sub", parent=_styles["Normal"], fontSize=9,
-                                      textColor=colors.HexColor("#616161"))
-                _r9  = ParagraphStyle("r9", parent=_styles["Normal"], fontSize=9,
-                                      alignment=TA_RIGHT)
-                _r10b = ParagraphStyle("r10b", parent=_styles["Normal"], fontSize=10,
-                                       alignment=TA_RIGHT, fontName="Helvetica-Bold",
-                                       textColor=_cbColor)
-
-                _buf = BytesIO()
-                _doc = SimpleDocTemplate(_buf, pagesize=landscape(A4),
-                                         leftMargin=20, rightMargin=20,
-                                         topMargin=20, bottomMargin=28)
-
-                def _footer(canv, doc_):
-                    canv.saveState()
-                    canv.setFont("Helvetica", 7)
-                    canv.setFillColor(colors.HexColor("#9E9E9E"))
-                    canv.drawString(20, 14,
-                        f"Generated on {datetime.now().strftime('%d/%m/%Y')}")
-                    canv.drawRightString(landscape(A4)[0] - 20, 14,
-                        f"Page {doc_.page}")
-                    canv.restoreState()
-
-                _hdr = Table(
-                    [[Paragraph("Ivy Pharmaceuticals", _h1),
-                      Paragraph(f"<b>Party: {party_name}</b>", _r9)],
-                     [Paragraph("Ledger Statement", _sub),
-                      Paragraph(f"Period: {from_date.strftime('%d/%m/%Y')} "
-                                f"to {to_date.strftime('%d/%m/%Y')}", _r9)],
-                     ["", Paragraph(f"Closing Balance: {running_balance:,.2f}",
-                                    _r10b)]],
-                    colWidths=[_doc.width * 0.5, _doc.width * 0.5])
-                _hdr.setStyle(TableStyle([
-                    ("VALIGN", (0, 0), (-1, -1), "TOP"),
-                    ("LINEBELOW", (0, -1), (-1, -1), 1.2, _teal),
-                    ("BOTTOMPADDING", (0, -1), (-1, -1), 6),
-                    ("TOPPADDING", (0, 0), (-1, -1), 0),
-                ]))
-
-                _cols = ["Date", "Invoice No", "Type", "Invoice Amount\n(Debit)",
-                         "Gross Receipt/\nPayment (Credit)", "Discount",
-                         "Net Receipt/\nPayment (Credit)", "Balance Due"]
-                _data = [_cols]
-                for _row in display_rows:
-                    _data.append([
-                        _row["Date"], _row["Invoice No"], _row["Type"],
-                        _row["Invoice Amount (Debit)"],
-                        _row["Gross Receipt/Payment (Credit)"],
-                        _row["Discount"],
-                        _row["Net Receipt/Payment (Credit)"],
-                        _row["Balance Due"]])
-                _data.append(["", "", "TOTAL",
-                              f"{total_invoice:,.2f}", f"{total_gross:,.2f}",
-                              f"{total_discount:,.2f}", f"{total_net:,.2f}",
-                              f"{running_balance:,.2f}"])
-
-                _w = _doc.width
-                _tbl = Table(_data, repeatRows=1, colWidths=[
-                    _w*0.10, _w*0.15, _w*0.11, _w*0.13, _w*0.14,
-                    _w*0.10, _w*0.14, _w*0.13])
-                _tstyle = [
-                    ("BACKGROUND", (0, 0), (-1, 0), _teal),
-                    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-                    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                    ("FONTSIZE", (0, 0), (-1, -1), 7.5),
-                    ("ALIGN", (3, 0), (-1, -1), "RIGHT"),
-                    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                    ("TOPPADDING", (0, 0), (-1, -1), 4),
-                    ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
-                    ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CFD8DC")),
-                    ("BACKGROUND", (0, 1), (-1, 1), _openBg),
-                    ("FONTNAME", (0, 1), (-1, 1), "Helvetica-Bold"),
-                    ("BACKGROUND", (0, -1), (-1, -1), _teal50),
-                    ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
-                ]
-                for _i in range(2, len(_data) - 1):
-                    if _i % 2 == 0:
-                        _tstyle.append(("BACKGROUND", (0, _i), (-1, _i), _altRow))
-                _tbl.setStyle(TableStyle(_tstyle))
-
-                _doc.build([_hdr, Spacer(1, 8), _tbl],
-                           onFirstPage=_footer, onLaterPages=_footer)
+        # Built only when Download is clicked; cached by content.
+        def _build_ledger_pdf():
+            from io import BytesIO
+            from reportlab.lib.pagesizes import A4, landscape
+            from reportlab.lib import colors
+            from reportlab.platypus import (SimpleDocTemplate, Table,
+                                            TableStyle, Paragraph, Spacer)
+            from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+            from reportlab.lib.enums import TA_RIGHT
+
+            _teal    = colors.HexColor("#00695C")
+            _teal50  = colors.HexColor("#E0F2F1")
+            _altRow  = colors.HexColor("#F0FAF7")
+            _openBg  = colors.HexColor("#E8F5E9")
+            _cbColor = (colors.HexColor("#C62828") if running_balance > 0
+                        else colors.HexColor("#2E7D32"))
+
+            _styles = getSampleStyleSheet()
+            _h1  = ParagraphStyle("h1", parent=_styles["Normal"], fontSize=15,
+                                  textColor=_teal, fontName="Helvetica-Bold")
+            _sub = ParagraphStyle("sub", parent=_styles["Normal"], fontSize=9,
+                                  textColor=colors.HexColor("#616161"))
+            _r9  = ParagraphStyle("r9", parent=_styles["Normal"], fontSize=9,
+                                  alignment=TA_RIGHT)
+            _r10b = ParagraphStyle("r10b", parent=_styles["Normal"], fontSize=10,
+                                   alignment=TA_RIGHT, fontName="Helvetica-Bold",
+                                   textColor=_cbColor)
+
+            _buf = BytesIO()
+            _doc = SimpleDocTemplate(_buf, pagesize=landscape(A4),
+                                     leftMargin=20, rightMargin=20,
+                                     topMargin=20, bottomMargin=28)
+
+            def _footer(canv, doc_):
+                canv.saveState()
+                canv.setFont("Helvetica", 7)
+                canv.setFillColor(colors.HexColor("#9E9E9E"))
+                canv.drawString(20, 14,
+                    f"Generated on {datetime.now().strftime('%d/%m/%Y')}")
+                canv.drawRightString(landscape(A4)[0] - 20, 14,
+                    f"Page {doc_.page}")
+                canv.restoreState()
+
+            _hdr = Table(
+                [[Paragraph("Ivy Pharmaceuticals", _h1),
+                  Paragraph(f"<b>Party: {party_name}</b>", _r9)],
+                 [Paragraph("Ledger Statement", _sub),
+                  Paragraph(f"Period: {from_date.strftime('%d/%m/%Y')} "
+                            f"to {to_date.strftime('%d/%m/%Y')}", _r9)],
+                 ["", Paragraph(f"Closing Balance: {running_balance:,.2f}",
+                                _r10b)]],
+                colWidths=[_doc.width * 0.5, _doc.width * 0.5])
+            _hdr.setStyle(TableStyle([
+                ("VALIGN", (0, 0), (-1, -1), "TOP"),
+                ("LINEBELOW", (0, -1), (-1, -1), 1.2, _teal),
+                ("BOTTOMPADDING", (0, -1), (-1, -1), 6),
+                ("TOPPADDING", (0, 0), (-1, -1), 0),
+            ]))
 
-                _safe = _re.sub(r"[^A-Za-z0-9_-]", "_", party_name)
-                st.download_button(
-                    "⬇️ Download Ledger PDF",
-                    data=_buf.getvalue(),
-                    file_name=(f"ledger_{_safe}_{from_date.isoformat()}"
-                               f"_to_{to_date.isoformat()}.pdf"),
-                    mime="application/pdf",
-                    key="fin_ledger_pdf_dl"
-                )
-            except Exception as _e:
-                st.error(f"PDF generation failed: {_e}")
+            _cols = ["Date", "Invoice No", "Type", "Invoice Amount\n(Debit)",
+                     "Gross Receipt/\nPayment (Credit)", "Discount",
+                     "Net Receipt/\nPayment (Credit)", "Balance Due"]
+            _data = [_cols]
+            for _row in display_rows:
+                _data.append([
+                    _row["Date"], _row["Invoice No"], _row["Type"],
+                    _row["Invoice Amount (Debit)"],
+                    _row["Gross Receipt/Payment (Credit)"],
+                    _row["Discount"],
+                    _row["Net Receipt/Payment (Credit)"],
+                    _row["Balance Due"]])
+            _data.append(["", "", "TOTAL",
+                          f"{total_invoice:,.2f}", f"{total_gross:,.2f}",
+                          f"{total_discount:,.2f}", f"{total_net:,.2f}",
+                          f"{running_balance:,.2f}"])
+
+            _w = _doc.width
+            _tstyle = [
+                ("BACKGROUND", (0, 0), (-1, 0), _teal),
+                ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+                ("FONTSIZE", (0, 0), (-1, -1), 7.5),
+                ("ALIGN", (3, 0), (-1, -1), "RIGHT"),
+                ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+                ("TOPPADDING", (0, 0), (-1, -1), 4),
+                ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+                ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#CFD8DC")),
+                ("BACKGROUND", (0, 1), (-1, 1), _openBg),
+                ("FONTNAME", (0, 1), (-1, 1), "Helvetica-Bold"),
+                ("ROWBACKGROUNDS", (0, 2), (-1, -2), [_altRow, None]),
+                ("BACKGROUND", (0, -1), (-1, -1), _teal50),
+                ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+            ]
+            _tables = chunked_tables(_data, _tstyle, col_widths=[
+                _w*0.10, _w*0.15, _w*0.11, _w*0.13, _w*0.14,
+                _w*0.10, _w*0.14, _w*0.13])
+
+            _doc.build([_hdr, Spacer(1, 8), *_tables],
+                       onFirstPage=_footer, onLaterPages=_footer)
+
+            return _buf.getvalue()
+
+        import re as _re
+        _safe = _re.sub(r"[^A-Za-z0-9_-]", "_", party_name)
+        pdf_download_button(
+            "📥 Download Ledger PDF", _build_ledger_pdf,
+            (party_name, from_date, to_date, display_rows,
+             total_invoice, total_gross, total_discount, total_net, running_balance),
+            file_name=(f"ledger_{_safe}_{from_date.isoformat()}"
+                       f"_to_{to_date.isoformat()}.pdf"),
+            key="fin_ledger_pdf_dl",
+        )
 
    
 
@@ -5925,40 +5733,26 @@ This action will:
         # Paginated (1000-row cap) and rows of soft-deleted documents are
         # excluded, mirroring the in-period filter below.
         # -------------------------
-        def _stk_open_batch(_start):
+        def _stk_open_q():
             _q = (admin_supabase.table("stock_ledger")
-                  .select("qty_in, qty_out, ops_document_id, narration")
+                  .select("id, qty_in, qty_out, ops_document_id, narration")
                   .eq("product_id", product_id)
                   .eq("entity_type", entity_type))
             if entity_type == "Company":
                 _q = _q.is_("entity_id", None)
             else:
                 _q = _q.eq("entity_id", entity_id)
-            return (_q.lt("txn_date", from_date.isoformat())
-                      .order("id")
-                      .range(_start, _start + 999)
-                      .execute()).data or []
-
-        _open_rows = []
-        _op_start = 0
-        while True:
-            _b = _stk_open_batch(_op_start)
-            _open_rows.extend(_b)
-            if len(_b) < 1000:
-                break
-            _op_start += 1000
+            return _q.lt("txn_date", from_date.isoformat())
+
+        _open_rows = fetch_all(_stk_open_q, "Error fetching opening stock")
 
         _open_doc_ids = list({r.get("ops_document_id") for r in _open_rows
                               if r.get("ops_document_id")})
-        _open_deleted = set()
-        for _i in range(0, len(_open_doc_ids), 100):
-            _drows = (admin_supabase.table("ops_documents")
-                      .select("id")
-                      .in_("id", _open_doc_ids[_i:_i + 100])
-                      .eq("is_deleted", True)
-                      .execute().data or [])
-            for _d in _drows:
-                _open_deleted.add(_d["id"])
+        _open_deleted = {_d["id"] for _d in fetch_in(
+            lambda: (admin_supabase.table("ops_documents")
+                     .select("id").eq("is_deleted", True)),
+            "id", _open_doc_ids
+        )}
 
         # A cancellation writes its reversal rows under a NEW (non-deleted)
         # CANCEL-*/REV-* adjustment document, so filtering deleted docs alone
@@ -6114,131 +5908,20 @@ This action will:
     # DOCUMENT BROWSER — INVOICES
     # =========================
     elif section == "DOCUMENT_BROWSER_INVOICES":
-
         st.subheader("🧾 Invoice Register")
 
-        # ── Search bar ────────────────────────────────────────────────
-        inv_search = st.text_input(
-            "🔍 Search by OPS No, Reference No, or Party Name",
-            placeholder="e.g. OPS-2024, INV-001, Sharma Medicals...",
-            key="inv_search"
-        ).strip().lower()
-
-        invoices = admin_supabase.table("ops_documents") \
-            .select("id, ops_no, ops_date, reference_no, created_at, from_entity_type, from_entity_id, to_entity_type, to_entity_id, narration") \
-            .eq("ops_type", "STOCK_OUT") \
-            .eq("stock_as", "normal") \
-            .eq("is_deleted", False) \
-            .order("ops_date", desc=True) \
-            .execute().data
-
-        if not invoices:
-            st.info("No invoices found")
-            st.stop()
-
-        # Apply search filter
-        if inv_search:
-            def _inv_match(inv):
-                if inv_search in (inv.get("ops_no") or "").lower(): return True
-                if inv_search in (inv.get("reference_no") or "").lower(): return True
-                # Match party name from masters
-                for eid in [inv.get("from_entity_id"), inv.get("to_entity_id")]:
-                    if not eid: continue
-                    s = next((x for x in st.session_state.stockists_master if x["id"] == eid), None)
-                    if s and inv_search in s["name"].lower(): return True
-                    u = next((x for x in st.session_state.users_master if x["id"] == eid), None)
-                    if u and inv_search in u["username"].lower(): return True
-                    c = next((x for x in st.session_state.cnfs_master if x["id"] == eid), None)
-                    if c and inv_search in c["name"].lower(): return True
-                return False
-            invoices = [i for i in invoices if _inv_match(i)]
-            st.caption(f"📋 {len(invoices)} result(s) for \"{inv_search}\"")
-            if not invoices:
-                st.warning("No invoices match your search.")
-                st.stop()
-
-        # Fetch invoice totals
-        invoice_ids = [inv["id"] for inv in invoices]
-        
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", invoice_ids) \
-            .execute().data or []
-        
-        # Get first line's net_amount for each invoice
-        total_lookup = {}
-        for line in lines_data:
-            doc_id = line["ops_document_id"]
-            if doc_id not in total_lookup:
-                total_lookup[doc_id] = line["net_amount"]
-
-        for inv in invoices:
-            # Get invoice total
-            invoice_total = total_lookup.get(inv["id"], 0)
-
-            # Get From and To entities (handles old and new documents)
-            from_entity_type = inv.get('from_entity_type')
-            to_entity_type = inv.get('to_entity_type')
-            
-            if from_entity_type and to_entity_type:
-                # New document: use database columns
-                from_type, from_name = resolve_entity_display_name(from_entity_type, inv.get('from_entity_id'), None)
-                to_type, to_name = resolve_entity_display_name(to_entity_type, inv.get('to_entity_id'), None)
-            else:
-                # Old document: parse narration "Invoice - Company to Stockist"
-                narration = inv.get('narration', '')
-                try:
-                    if ' - ' in narration and ' to ' in narration:
-                        # Split by " - " to get "Company to Stockist"
-                        parts = narration.split(' - ')[1]
-                        # Split by " to " to get From and To
-                        from_to = parts.split(' to ')
-                        from_name = from_to[0].strip()
-                        to_name = from_to[1].strip()
-                    else:
-                        from_name = "Unknown"
-                        to_name = "Unknown"
-                except:
-                    from_name = "Unknown"
-                    to_name = "Unknown"
-
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
-
-                with c1:
-                    st.write(f"📄 **{inv['ops_no']}**")
-                    st.caption(f"📤 {from_name} → 📥 {to_name}")
-
-                with c2:
-                    st.write(inv["ops_date"])
-
-                with c3:
-                    st.write(f"**Ref:** {inv.get('reference_no') or '-'}")
-                    st.write(f"**💰 ₹{invoice_total:,.2f}**")
-
-                with c4:
-                    b1, b2, b3 = st.columns(3)
-
-                    with b1:
-                        if st.button("👁 View", key=f"view_{inv['id']}"):
-                            st.session_state.selected_ops_id = inv["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_VIEW"
-                            st.rerun()
-
-                    with b2:
-                        if st.button("✏️ Edit", key=f"edit_{inv['id']}"):
-                            st.session_state.edit_source_ops_id = inv["id"]
-                            st.session_state.edit_mode = True
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_EDIT"
-                            st.rerun()
-
-                    with b3:
-                        if st.button("🗑 Delete", key=f"del_{inv['id']}"):
-                            st.session_state.selected_ops_id = inv["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_DELETE"
-                            st.rerun()
-
-                st.divider()
+        render_doc_register(
+            "inv_register",
+            lambda q: q.eq("ops_type", "STOCK_OUT").eq("stock_as", "normal"),
+            "📄",
+            {"view": "DOCUMENT_BROWSER_INVOICE_VIEW",
+             "edit": "DOCUMENT_BROWSER_INVOICE_EDIT",
+             "delete": "DOCUMENT_BROWSER_INVOICE_DELETE"},
+            btn_prefix="",
+            empty_msg="No invoices found",
+            search=True,
+            search_placeholder="e.g. OPS-2024, INV-001, Sharma Medicals...",
+        )
 
     # =========================
     # DOCUMENT BROWSER — ARCHIVED INVOICES
@@ -6271,10 +5954,10 @@ This action will:
             .in_("ops_document_id", invoice_ids) \
             .execute().data or []
         
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", invoice_ids) \
-            .execute().data or []
+        lines_data = fetch_in(
+            lambda: admin_supabase.table("ops_lines").select("id, ops_document_id, net_amount"),
+            "ops_document_id", invoice_ids, "Error loading invoice totals"
+        )
         
         party_lookup = {row["ops_document_id"]: row["party_id"] for row in ledger_data}
         total_lookup = {}
@@ -6418,118 +6101,19 @@ This action will:
     elif section == "DOCUMENT_BROWSER_CREDIT_NOTES":
         st.subheader("📝 Credit Note Register")
 
-        # ── Search bar ────────────────────────────────────────────────
-        cn_search = st.text_input(
-            "🔍 Search by OPS No, Reference No, or Party Name",
-            placeholder="e.g. CRN-001, Sharma Medicals...",
-            key="cn_search"
-        ).strip().lower()
-
-        docs = admin_supabase.table("ops_documents") \
-            .select("id, ops_no, ops_date, reference_no, narration, from_entity_type, from_entity_id, to_entity_type, to_entity_id") \
-            .eq("stock_as", "credit_note") \
-            .eq("is_deleted", False) \
-            .order("ops_date", desc=True) \
-            .execute().data
-
-        if not docs:
-            st.info("No credit notes found")
-            st.stop()
-
-        if cn_search:
-            def _cn_match(d):
-                if cn_search in (d.get("ops_no") or "").lower(): return True
-                if cn_search in (d.get("reference_no") or "").lower(): return True
-                for eid in [d.get("from_entity_id"), d.get("to_entity_id")]:
-                    if not eid: continue
-                    s = next((x for x in st.session_state.stockists_master if x["id"] == eid), None)
-                    if s and cn_search in s["name"].lower(): return True
-                    u = next((x for x in st.session_state.users_master if x["id"] == eid), None)
-                    if u and cn_search in u["username"].lower(): return True
-                return False
-            docs = [d for d in docs if _cn_match(d)]
-            st.caption(f"📋 {len(docs)} result(s) for \"{cn_search}\"")
-            if not docs:
-                st.warning("No credit notes match your search.")
-                st.stop()
-
-        doc_ids = [d["id"] for d in docs]
-
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", doc_ids) \
-            .execute().data or []
-
-        total_lookup = {}
-        for line in lines_data:
-            doc_id = line["ops_document_id"]
-            if doc_id not in total_lookup:
-                total_lookup[doc_id] = line["net_amount"]
-
-        for doc in docs:
-            doc_total = total_lookup.get(doc["id"], 0)
-
-            # Get From and To entities (handles old and new documents)
-            from_entity_type = doc.get('from_entity_type')
-            to_entity_type = doc.get('to_entity_type')
-            
-            if from_entity_type and to_entity_type:
-                # New document: use database columns
-                from_type, from_name = resolve_entity_display_name(from_entity_type, doc.get('from_entity_id'), None)
-                to_type, to_name = resolve_entity_display_name(to_entity_type, doc.get('to_entity_id'), None)
-            else:
-                # Old document: parse narration
-                narration = doc.get('narration', '')
-                try:
-                    if ' - ' in narration and ' to ' in narration:
-                        parts = narration.split(' - ')[1]
-                        from_to = parts.split(' to ')
-                        from_name = from_to[0].strip()
-                        to_name = from_to[1].strip()
-                    else:
-                        from_name = "Unknown"
-                        to_name = "Unknown"
-                except:
-                    from_name = "Unknown"
-                    to_name = "Unknown"
-
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
-
-                with c1:
-                    st.write(f"📝 **{doc['ops_no']}**")
-                    st.caption(f"📤 {from_name} → 📥 {to_name}")
-
-                with c2:
-                    st.write(doc["ops_date"])
-
-                with c3:
-                    st.write(f"**Ref:** {doc.get('reference_no') or '-'}")
-                    st.write(f"**💰 ₹{doc_total:,.2f}**")
-
-                with c4:
-                    b1, b2, b3 = st.columns(3)
-
-                    with b1:
-                        if st.button("👁 View", key=f"view_cn_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_CN_VIEW"
-                            st.rerun()
-
-                    with b2:
-                        if st.button("✏️ Edit", key=f"edit_cn_{doc['id']}"):
-                            st.session_state.edit_source_ops_id = doc["id"]
-                            st.session_state.edit_mode = True
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_CN_EDIT"
-                            st.rerun()
-
-                    with b3:
-                        if st.button("🗑 Delete", key=f"del_cn_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_CN_DELETE"
-                            st.rerun()
-
-                st.divider()
+        render_doc_register(
+            "cn_register",
+            lambda q: q.eq("stock_as", "credit_note"),
+            "📝",
+            {"view": "DOCUMENT_BROWSER_CN_VIEW",
+             "edit": "DOCUMENT_BROWSER_CN_EDIT",
+             "delete": "DOCUMENT_BROWSER_CN_DELETE"},
+            btn_prefix="cn_",
+            empty_msg="No credit notes found",
+            search=True,
+            search_placeholder="e.g. CRN-001, Sharma Medicals...",
+            party_types=("Stockist", "User"),
+        )
     # =========================
     # DOCUMENT BROWSER — CN VIEW
     # =========================
@@ -6689,7 +6273,7 @@ This action:
             .execute().data or []
 
         reversal_ops = admin_supabase.table("ops_documents").insert({
-            "ops_no":     f"REV-CN-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+            "ops_no":     ops_doc_no("REV-CN"),
             "ops_date":   datetime.utcnow().date().isoformat(),
             "ops_type":   "ADJUSTMENT",
             "stock_as":   "adjustment",
@@ -6914,94 +6498,16 @@ This action:
     elif section == "DOCUMENT_BROWSER_TRANSFERS":
         st.subheader("🔄 Transfer Register")
 
-        docs = admin_supabase.table("ops_documents") \
-            .select("id, ops_no, ops_date, reference_no, narration, from_entity_type, from_entity_id, to_entity_type, to_entity_id") \
-            .eq("stock_as", "transfer") \
-            .eq("is_deleted", False) \
-            .order("ops_date", desc=True) \
-            .execute().data
-
-        if not docs:
-            st.info("No transfers found")
-            st.stop()
-
-        doc_ids = [d["id"] for d in docs]
-
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", doc_ids) \
-            .execute().data or []
-
-        total_lookup = {}
-        for line in lines_data:
-            doc_id = line["ops_document_id"]
-            if doc_id not in total_lookup:
-                total_lookup[doc_id] = line["net_amount"]
-
-        for doc in docs:
-            doc_total = total_lookup.get(doc["id"], 0)
-
-            # Get From and To entities (handles old and new documents)
-            from_entity_type = doc.get('from_entity_type')
-            to_entity_type = doc.get('to_entity_type')
-            
-            if from_entity_type and to_entity_type:
-                # New document: use database columns
-                from_type, from_name = resolve_entity_display_name(from_entity_type, doc.get('from_entity_id'), None)
-                to_type, to_name = resolve_entity_display_name(to_entity_type, doc.get('to_entity_id'), None)
-            else:
-                # Old document: parse narration
-                narration = doc.get('narration', '')
-                try:
-                    if ' - ' in narration and ' to ' in narration:
-                        parts = narration.split(' - ')[1]
-                        from_to = parts.split(' to ')
-                        from_name = from_to[0].strip()
-                        to_name = from_to[1].strip()
-                    else:
-                        from_name = "Unknown"
-                        to_name = "Unknown"
-                except:
-                    from_name = "Unknown"
-                    to_name = "Unknown"
-
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
-
-                with c1:
-                    st.write(f"🔄 **{doc['ops_no']}**")
-                    st.caption(f"📤 {from_name} → 📥 {to_name}")
-
-                with c2:
-                    st.write(doc["ops_date"])
-
-                with c3:
-                    st.write(f"**Ref:** {doc.get('reference_no') or '-'}")
-                    st.write(f"**💰 ₹{doc_total:,.2f}**")
-
-                with c4:
-                    b1, b2, b3 = st.columns(3)
-
-                    with b1:
-                        if st.button("👁 View", key=f"view_tr_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_TRANSFER_VIEW"
-                            st.rerun()
-
-                    with b2:
-                        if st.button("✏️ Edit", key=f"edit_tr_{doc['id']}"):
-                            st.session_state.edit_source_ops_id = doc["id"]
-                            st.session_state.edit_mode = True
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_TRANSFER_EDIT"
-                            st.rerun()
-
-                    with b3:
-                        if st.button("🗑 Delete", key=f"del_tr_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_TRANSFER_DELETE"
-                            st.rerun()
-
-                st.divider()
+        render_doc_register(
+            "tr_register",
+            lambda q: q.eq("stock_as", "transfer"),
+            "🔄",
+            {"view": "DOCUMENT_BROWSER_TRANSFER_VIEW",
+             "edit": "DOCUMENT_BROWSER_TRANSFER_EDIT",
+             "delete": "DOCUMENT_BROWSER_TRANSFER_DELETE"},
+            btn_prefix="tr_",
+            empty_msg="No transfers found",
+        )
     # =========================
     # DOCUMENT BROWSER — ARCHIVED TRANSFERS
     # =========================
@@ -7374,94 +6880,16 @@ This action will:
     elif section == "DOCUMENT_BROWSER_SAMPLES":
         st.subheader("🎁 Sample & Lot Register")
 
-        docs = admin_supabase.table("ops_documents") \
-            .select("id, ops_no, ops_date, reference_no, narration, from_entity_type, from_entity_id, to_entity_type, to_entity_id") \
-            .or_("stock_as.eq.sample,stock_as.eq.lot") \
-            .eq("is_deleted", False) \
-            .order("ops_date", desc=True) \
-            .execute().data
-
-        if not docs:
-            st.info("No samples/lots found")
-            st.stop()
-
-        doc_ids = [d["id"] for d in docs]
-
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", doc_ids) \
-            .execute().data or []
-
-        total_lookup = {}
-        for line in lines_data:
-            doc_id = line["ops_document_id"]
-            if doc_id not in total_lookup:
-                total_lookup[doc_id] = line["net_amount"]
-
-        for doc in docs:
-            doc_total = total_lookup.get(doc["id"], 0)
-
-            # Get From and To entities (handles old and new documents)
-            from_entity_type = doc.get('from_entity_type')
-            to_entity_type = doc.get('to_entity_type')
-            
-            if from_entity_type and to_entity_type:
-                # New document: use database columns
-                from_type, from_name = resolve_entity_display_name(from_entity_type, doc.get('from_entity_id'), None)
-                to_type, to_name = resolve_entity_display_name(to_entity_type, doc.get('to_entity_id'), None)
-            else:
-                # Old document: parse narration
-                narration = doc.get('narration', '')
-                try:
-                    if ' - ' in narration and ' to ' in narration:
-                        parts = narration.split(' - ')[1]
-                        from_to = parts.split(' to ')
-                        from_name = from_to[0].strip()
-                        to_name = from_to[1].strip()
-                    else:
-                        from_name = "Unknown"
-                        to_name = "Unknown"
-                except:
-                    from_name = "Unknown"
-                    to_name = "Unknown"
-
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
-
-                with c1:
-                    st.write(f"🎁 **{doc['ops_no']}**")
-                    st.caption(f"📤 {from_name} → 📥 {to_name}")
-
-                with c2:
-                    st.write(doc["ops_date"])
-
-                with c3:
-                    st.write(f"**Ref:** {doc.get('reference_no') or '-'}")
-                    st.write(f"**💰 ₹{doc_total:,.2f}**")
-
-                with c4:
-                    b1, b2, b3 = st.columns(3)
-
-                    with b1:
-                        if st.button("👁 View", key=f"view_sl_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_VIEW"
-                            st.rerun()
-
-                    with b2:
-                        if st.button("✏️ Edit", key=f"edit_sl_{doc['id']}"):
-                            st.session_state.edit_source_ops_id = doc["id"]
-                            st.session_state.edit_mode = True
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_EDIT"
-                            st.rerun()
-
-                    with b3:
-                        if st.button("🗑 Delete", key=f"del_sl_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_DELETE"
-                            st.rerun()
-
-                st.divider()
+        render_doc_register(
+            "sl_register",
+            lambda q: q.in_("stock_as", ["sample", "lot"]),
+            "🎁",
+            {"view": "DOCUMENT_BROWSER_INVOICE_VIEW",
+             "edit": "DOCUMENT_BROWSER_INVOICE_EDIT",
+             "delete": "DOCUMENT_BROWSER_INVOICE_DELETE"},
+            btn_prefix="sl_",
+            empty_msg="No samples/lots found",
+        )
     # =========================
     # DOCUMENT BROWSER — ARCHIVED SAMPLES & LOTS
     # =========================
@@ -7534,94 +6962,16 @@ This action will:
     elif section == "DOCUMENT_BROWSER_PURCHASES":
         st.subheader("🛒 Purchase Register")
 
-        docs = admin_supabase.table("ops_documents") \
-            .select("id, ops_no, ops_date, reference_no, narration, from_entity_type, from_entity_id, to_entity_type, to_entity_id") \
-            .eq("stock_as", "purchase") \
-            .eq("is_deleted", False) \
-            .order("ops_date", desc=True) \
-            .execute().data
-
-        if not docs:
-            st.info("No purchases found")
-            st.stop()
-
-        doc_ids = [d["id"] for d in docs]
-
-        lines_data = admin_supabase.table("ops_lines") \
-            .select("ops_document_id, net_amount") \
-            .in_("ops_document_id", doc_ids) \
-            .execute().data or []
-
-        total_lookup = {}
-        for line in lines_data:
-            doc_id = line["ops_document_id"]
-            if doc_id not in total_lookup:
-                total_lookup[doc_id] = line["net_amount"]
-
-        for doc in docs:
-            doc_total = total_lookup.get(doc["id"], 0)
-
-            # Get From and To entities (handles old and new documents)
-            from_entity_type = doc.get('from_entity_type')
-            to_entity_type = doc.get('to_entity_type')
-            
-            if from_entity_type and to_entity_type:
-                # New document: use database columns
-                from_type, from_name = resolve_entity_display_name(from_entity_type, doc.get('from_entity_id'), None)
-                to_type, to_name = resolve_entity_display_name(to_entity_type, doc.get('to_entity_id'), None)
-            else:
-                # Old document: parse narration
-                narration = doc.get('narration', '')
-                try:
-                    if ' - ' in narration and ' to ' in narration:
-                        parts = narration.split(' - ')[1]
-                        from_to = parts.split(' to ')
-                        from_name = from_to[0].strip()
-                        to_name = from_to[1].strip()
-                    else:
-                        from_name = "Unknown"
-                        to_name = "Unknown"
-                except:
-                    from_name = "Unknown"
-                    to_name = "Unknown"
-
-            with st.container():
-                c1, c2, c3, c4 = st.columns([3, 2, 3, 4])
-
-                with c1:
-                    st.write(f"🛒 **{doc['ops_no']}**")
-                    st.caption(f"📤 {from_name} → 📥 {to_name}")
-
-                with c2:
-                    st.write(doc["ops_date"])
-
-                with c3:
-                    st.write(f"**Ref:** {doc.get('reference_no') or '-'}")
-                    st.write(f"**💰 ₹{doc_total:,.2f}**")
-
-                with c4:
-                    b1, b2, b3 = st.columns(3)
-
-                    with b1:
-                        if st.button("👁 View", key=f"view_pur_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_VIEW"
-                            st.rerun()
-
-                    with b2:
-                        if st.button("✏️ Edit", key=f"edit_pur_{doc['id']}"):
-                            st.session_state.edit_source_ops_id = doc["id"]
-                            st.session_state.edit_mode = True
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_EDIT"
-                            st.rerun()
-
-                    with b3:
-                        if st.button("🗑 Delete", key=f"del_pur_{doc['id']}"):
-                            st.session_state.selected_ops_id = doc["id"]
-                            st.session_state.ops_section = "DOCUMENT_BROWSER_INVOICE_DELETE"
-                            st.rerun()
-
-                st.divider()
+        render_doc_register(
+            "pur_register",
+            lambda q: q.eq("stock_as", "purchase"),
+            "🛒",
+            {"view": "DOCUMENT_BROWSER_INVOICE_VIEW",
+             "edit": "DOCUMENT_BROWSER_INVOICE_EDIT",
+             "delete": "DOCUMENT_BROWSER_INVOICE_DELETE"},
+            btn_prefix="pur_",
+            empty_msg="No purchases found",
+        )
     # =========================
     # DOCUMENT BROWSER — ARCHIVED PURCHASES
     # =========================
@@ -8021,14 +7371,11 @@ This action will:
                 entity_id = out_move["entity_id"]
                 
                 if entity_type == "Stockist" and entity_id:
-                    stockist = next((s for s in st.session_state.stockists_master if s["id"] == entity_id), None)
-                    from_entity = f"Stockist: {stockist['name']}" if stockist else "Stockist: Unknown"
+                    from_entity = f"Stockist: {entity_name('Stockist', entity_id, 'Unknown')}"
                 elif entity_type == "User" and entity_id:
-                    user = next((u for u in st.session_state.users_master if u["id"] == entity_id), None)
-                    from_entity = f"User: {user['username']}" if user else "User: Unknown"
+                    from_entity = f"User: {entity_name('User', entity_id, 'Unknown')}"
                 elif entity_type == "CNF" and entity_id:
-                    cnf = next((c for c in st.session_state.cnfs_master if c["id"] == entity_id), None)
-                    from_entity = f"CNF: {cnf['name']}" if cnf else "CNF: Unknown"
+                    from_entity = f"CNF: {entity_name('CNF', entity_id, 'Unknown')}"
                 else:
                     from_entity = entity_type
             
@@ -8042,11 +7389,9 @@ This action will:
                 if entity_type == "Company":
                     to_entity = "Company"
                 elif entity_type == "CNF" and entity_id:
-                    cnf = next((c for c in st.session_state.cnfs_master if c["id"] == entity_id), None)
-                    to_entity = f"CNF: {cnf['name']}" if cnf else "CNF: Unknown"
+                    to_entity = f"CNF: {entity_name('CNF', entity_id, 'Unknown')}"
                 elif entity_type == "User" and entity_id:
-                    user = next((u for u in st.session_state.users_master if u["id"] == entity_id), None)
-                    to_entity = f"User: {user['username']}" if user else "User: Unknown"
+                    to_entity = f"User: {entity_name('User', entity_id, 'Unknown')}"
                 else:
                     to_entity = entity_type
             
@@ -8153,7 +7498,7 @@ This action will:
                         replace_items = []
                         
                         for sm in entry['stock_moves']:
-                            product = next((p for p in st.session_state.products_master if p["id"] == sm["product_id"]), None)
+                            product = master_index("products").get(sm["product_id"])
                             product_name = product["name"] if product else "Unknown"
                             
                             if "return" in sm["narration"].lower():
@@ -8603,7 +7948,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                     "Transfer to Destroyed": "destroyed"
                 }
                 return_ops = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"RET-{__import__('datetime').datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("RET"),
                     "ops_date": return_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -8925,7 +8270,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                     st.stop()
                 # ─────────────────────────────────────────────────────
                 freight_ops = admin_supabase.table("ops_documents").insert({
-                    "ops_no": f"FREIGHT-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}",
+                    "ops_no": ops_doc_no("FREIGHT"),
                     "ops_date": freight_date.isoformat(),
                     "ops_type": "ADJUSTMENT",
                     "stock_as": "adjustment",
@@ -9010,21 +8355,13 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
             return max(0.0, doc_total - sum(float(u["amount"]) for u in used))
 
         def _stockist_name(sid):
-            return next((s["name"] for s in st.session_state.stockists_master if s["id"] == sid), "Unknown")
+            return entity_name("Stockist", sid, "Unknown")
 
-        def _recompute_invoice_after_change(inv_id):
+        def _recompute_invoice_after_change(*inv_ids):
             """Recompute paid_amount / outstanding_balance / payment_status from
-            true total and current settlements. Used after any allocate/reverse."""
-            true_total = _true_invoice_total(inv_id)
-            settled    = _invoice_settled(inv_id)
-            new_out    = max(0.0, true_total - settled)
-            new_paid   = min(settled, true_total)
-            new_st     = "PAID" if new_out <= 0.01 else ("PARTIAL" if new_paid > 0 else "UNPAID")
-            admin_supabase.table("ops_documents").update({
-                "paid_amount": new_paid,
-                "outstanding_balance": new_out,
-                "payment_status": new_st
-            }).eq("id", inv_id).execute()
+            true total and current settlements. Used after any allocate/reverse.
+            Pass every touched invoice at once — one batched recompute."""
+            recompute_invoices(inv_ids)
 
         alloc_tab, cn_freight_tab, reverse_tab, search_tab = st.tabs([
             "💰 Allocate Payments",
@@ -9186,22 +8523,26 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                             elif total_alloc > 0 and st.button("✅ Confirm Allocation", type="primary", key="alloc_confirm"):
                                 try:
                                     uid = resolve_user_id()
+                                    _new_setts = []
                                     if ob_allocation > 0 and ob_doc_id:
-                                        admin_supabase.table("payment_settlements").insert({
+                                        _new_setts.append({
                                             "payment_ops_id": selected_payment_id,
                                             "invoice_id": ob_doc_id, "amount": ob_allocation
-                                        }).execute()
+                                        })
                                     for inv_id, amt in allocations.items():
-                                        admin_supabase.table("payment_settlements").insert({
+                                        _new_setts.append({
                                             "payment_ops_id": selected_payment_id,
                                             "invoice_id": inv_id, "amount": amt
-                                        }).execute()
-                                        _recompute_invoice_after_change(inv_id)
+                                        })
+                                    if _new_setts:
+                                        admin_supabase.table("payment_settlements").insert(_new_setts).execute()
+                                    _recompute_invoice_after_change(*allocations.keys())
 
                                     new_alloc = already_allocated + total_alloc
                                     new_status = "FULLY_ALLOCATED" if new_alloc >= total_payment - 0.01 else "PARTIALLY_ALLOCATED"
                                     admin_supabase.table("ops_documents").update({
-                                        "allocation_status": new_status
+                                        "allocation_status": new_status,
+                                        "updated_at": datetime.utcnow().isoformat()
                                     }).eq("id", selected_payment_id).execute()
 
                                     admin_supabase.table("audit_logs").insert({
@@ -9328,22 +8669,32 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                     if st.button("✅ Confirm — Apply to Invoices", type="primary", key="cnf_confirm"):
                         try:
                             uid = resolve_user_id()
-                            for doc_id, (inv_id, amt, kind) in cnf_allocations.items():
-                                # Tagging only — write settlement, recompute invoice.
-                                # Do NOT touch financial_ledger (credit already exists there).
-                                admin_supabase.table("payment_settlements").insert({
-                                    "payment_ops_id": doc_id, "invoice_id": inv_id, "amount": amt
-                                }).execute()
-                                _recompute_invoice_after_change(inv_id)
+                            # Tagging only — write settlements, recompute invoices.
+                            # Do NOT touch financial_ledger (credit already exists there).
+                            admin_supabase.table("payment_settlements").insert([
+                                {"payment_ops_id": doc_id, "invoice_id": inv_id, "amount": amt}
+                                for doc_id, (inv_id, amt, kind) in cnf_allocations.items()
+                            ]).execute()
+                            _recompute_invoice_after_change(
+                                *(v[0] for v in cnf_allocations.values()))
+
+                            _used_by_doc = {}
+                            for u in fetch_in(
+                                lambda: admin_supabase.table("payment_settlements")
+                                        .select("id, payment_ops_id, amount"),
+                                "payment_ops_id", list(cnf_allocations),
+                            ):
+                                _used_by_doc[u["payment_ops_id"]] = \
+                                    _used_by_doc.get(u["payment_ops_id"], 0.0) + float(u["amount"])
 
+                            for doc_id, (inv_id, amt, kind) in cnf_allocations.items():
                                 # Mark CN/freight allocation status
                                 doc_total = credit_sum.get(doc_id, 0.0)
-                                used = admin_supabase.table("payment_settlements")\
-                                    .select("amount").eq("payment_ops_id", doc_id).execute().data or []
-                                used_total = sum(float(u["amount"]) for u in used)
+                                used_total = _used_by_doc.get(doc_id, 0.0)
                                 alloc_st = "FULLY_ALLOCATED" if used_total >= doc_total - 0.01 else "PARTIALLY_ALLOCATED"
                                 admin_supabase.table("ops_documents").update({
-                                    "allocation_status": alloc_st
+                                    "allocation_status": alloc_st,
+                                    "updated_at": datetime.utcnow().isoformat()
                                 }).eq("id", doc_id).execute()
 
                                 admin_supabase.table("audit_logs").insert({
@@ -9451,7 +8802,8 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                                         else:
                                             new_src_st = "PARTIALLY_ALLOCATED"
                                         admin_supabase.table("ops_documents").update({
-                                            "allocation_status": new_src_st
+                                            "allocation_status": new_src_st,
+                                            "updated_at": datetime.utcnow().isoformat()
                                         }).eq("id", s["payment_ops_id"]).execute()
                                         admin_supabase.table("audit_logs").insert({
                                             "action": "REVERSE_ALLOCATION", "target_type": "payment_settlements",
@@ -9736,18 +9088,14 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
 
         # Apply search filter
         if pay_search:
+            _party_ids = match_entity_ids(pay_search)
             def _pay_match(p):
                 if pay_search in (p.get("ops_no") or "").lower(): return True
                 if pay_search in (p.get("reference_no") or "").lower(): return True
                 if pay_search in (p.get("narration") or "").lower(): return True
-                for eid in [p.get("from_entity_id"), p.get("to_entity_id")]:
-                    if not eid: continue
-                    s = next((x for x in st.session_state.stockists_master if x["id"] == eid), None)
-                    if s and pay_search in s["name"].lower(): return True
-                    u = next((x for x in st.session_state.users_master if x["id"] == eid), None)
-                    if u and pay_search in u["username"].lower(): return True
-                    c = next((x for x in st.session_state.cnfs_master if x["id"] == eid), None)
-                    if c and pay_search in c["name"].lower(): return True
+                # Match party name from masters (one name scan per query)
+                if p.get("from_entity_id") in _party_ids: return True
+                if p.get("to_entity_id") in _party_ids: return True
                 return False
             payments = [p for p in payments if _pay_match(p)]
             if not payments:
@@ -9782,34 +9130,18 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
         st.write(f"**Found {len(payments)} payments**")
         st.divider()
         
+        # Party names for the whole page in one pass
+        _names = resolve_many((
+            pair for payment in payments for pair in (
+                (payment["from_entity_type"], payment.get("from_entity_id")),
+                (payment["to_entity_type"],   payment.get("to_entity_id")),
+            )
+        ), default="Unknown")
+        _party_names = {payment["id"]: (_names[2 * k] or "Unknown", _names[2 * k + 1] or "Unknown")
+                        for k, payment in enumerate(payments)}
+
         for payment in payments:
-            if payment["from_entity_type"] == "Company":
-                from_name = "Company"
-            elif payment["from_entity_type"] == "Stockist" and payment.get("from_entity_id"):
-                stockist = next((s for s in st.session_state.stockists_master if s["id"] == payment["from_entity_id"]), None)
-                from_name = stockist["name"] if stockist else "Unknown"
-            elif payment["from_entity_type"] == "CNF" and payment.get("from_entity_id"):
-                cnf = next((c for c in st.session_state.cnfs_master if c["id"] == payment["from_entity_id"]), None)
-                from_name = cnf["name"] if cnf else "Unknown"
-            elif payment["from_entity_type"] == "User" and payment.get("from_entity_id"):
-                user = next((u for u in st.session_state.users_master if u["id"] == payment["from_entity_id"]), None)
-                from_name = user["username"] if user else "Unknown"
-            else:
-                from_name = "Unknown"
-            
-            if payment["to_entity_type"] == "Company":
-                to_name = "Company"
-            elif payment["to_entity_type"] == "Stockist" and payment.get("to_entity_id"):
-                stockist = next((s for s in st.session_state.stockists_master if s["id"] == payment["to_entity_id"]), None)
-                to_name = stockist["name"] if stockist else "Unknown"
-            elif payment["to_entity_type"] == "CNF" and payment.get("to_entity_id"):
-                cnf = next((c for c in st.session_state.cnfs_master if c["id"] == payment["to_entity_id"]), None)
-                to_name = cnf["name"] if cnf else "Unknown"
-            elif payment["to_entity_type"] == "User" and payment.get("to_entity_id"):
-                user = next((u for u in st.session_state.users_master if u["id"] == payment["to_entity_id"]), None)
-                to_name = user["username"] if user else "Unknown"
-            else:
-                to_name = "Unknown"
+            from_name, to_name = _party_names[payment["id"]]
             
             amounts = amount_lookup.get(payment["id"], {"gross": 0, "discount": 0, "net": 0})
 
@@ -9952,11 +9284,13 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                                             if not _new_narr.startswith("[CANCELLED]"):
                                                 _new_narr = "[CANCELLED] " + _new_narr
                                             admin_supabase.table("ops_documents").update({
-                                                "narration": _new_narr
+                                                "narration": _new_narr,
+                                                "updated_at": datetime.utcnow().isoformat()
                                             }).eq("id", _pid).execute()
                                             try:
                                                 admin_supabase.table("ops_documents").update({
-                                                    "allocation_status": "CANCELLED"
+                                                    "allocation_status": "CANCELLED",
+                                                    "updated_at": datetime.utcnow().isoformat()
                                                 }).eq("id", _pid).execute()
                                             except Exception:
                                                 pass
@@ -10074,7 +9408,8 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                                         new_alloc_st = "PARTIALLY_ALLOCATED"
 
                                     admin_supabase.table("ops_documents").update({
-                                        "allocation_status": new_alloc_st
+                                        "allocation_status": new_alloc_st,
+                                        "updated_at": datetime.utcnow().isoformat()
                                     }).eq("id", payment["id"]).execute()
 
                                     # Audit log
@@ -10219,20 +9554,27 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
 
         freight_docs = query.execute().data or []
 
-        # Enrich with financial_ledger amounts and filter by stockist
+        # Enrich with financial_ledger amounts (one chunked sweep for all
+        # docs in the range) and filter by stockist
+        ledger_by_doc = {}
+        for r in fetch_in(
+            lambda: admin_supabase.table("financial_ledger").select("id, ops_document_id, credit, party_id"),
+            "ops_document_id", [d["id"] for d in freight_docs], "Error loading freight amounts"
+        ):
+            ledger_by_doc.setdefault(r["ops_document_id"], []).append(r)
+
         results = []
         for doc in freight_docs:
-            ledger = admin_supabase.table("financial_ledger")                .select("credit, party_id")                .eq("ops_document_id", doc["id"])                .execute().data or []
+            ledger = ledger_by_doc.get(doc["id"])
             if not ledger:
                 continue
             party_id = ledger[0].get("party_id")
             if fb_stockist_id and party_id != fb_stockist_id:
                 continue
-            stockist = next((s for s in st.session_state.stockists_master if s["id"] == party_id), None)
             results.append({
                 "doc": doc,
                 "amount": sum(float(r.get("credit", 0)) for r in ledger),
-                "stockist_name": stockist["name"] if stockist else "Unknown",
+                "stockist_name": entity_name("Stockist", party_id, "Unknown"),
             })
 
         if not results:
@@ -10240,7 +9582,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
         else:
             st.write(f"**{len(results)} freight entries found**")
             st.divider()
-            for row in results:
+            for row in page_slice(results, "fb_register"):
                 doc = row["doc"]
                 col1, col2, col3 = st.columns([4, 2, 2])
                 with col1:
@@ -10267,7 +9609,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                             # Reverse any invoice allocations made from this freight
                             _reverse_settlements_for_doc(doc["id"])
                             admin_supabase.table("financial_ledger").delete().eq("ops_document_id", doc["id"]).execute()
-                            admin_supabase.table("ops_documents").update({"is_deleted": True}).eq("id", doc["id"]).execute()
+                            admin_supabase.table("ops_documents").update({"is_deleted": True, "updated_at": datetime.utcnow().isoformat()}).eq("id", doc["id"]).execute()
                             st.success("✅ Freight entry deleted")
                             st.rerun()
                         except Exception as e:
@@ -10444,77 +9786,71 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
         Use this if balances appear out of sync due to manual edits or data imports.
         """)
 
-        st.warning("⚠️ This will update ALL invoice records. Proceed only if balances look incorrect.")
+        st.warning("⚠️ Preview first — only invoices whose values actually change are written.")
 
         if "recalc_done" not in st.session_state:
             st.session_state.recalc_done = False
 
         if st.session_state.recalc_done:
-            st.success("✅ Balances recalculated successfully.")
+            if st.session_state.get("recalc_errors"):
+                st.warning(f"⚠️ Balances recalculated, but {st.session_state.recalc_errors} "
+                           "invoice(s) could not be saved. Run again to retry them.")
+            else:
+                st.success("✅ Balances recalculated successfully.")
+            recalc_stale = st.session_state.get("recalc_stale") or []
+            if recalc_stale:
+                st.warning(f"⚠️ {len(recalc_stale)} invoice(s) changed after the preview and "
+                           f"were left untouched: {', '.join(map(str, recalc_stale[:20]))}"
+                           f"{' …' if len(recalc_stale) > 20 else ''}. Run again to preview them.")
             if st.button("🔄 Run Again"):
                 st.session_state.recalc_done = False
+                st.session_state.pop("recalc_plan", None)
                 st.rerun()
             st.stop()
 
-        if st.button("▶️ Run Recalculation", type="primary"):
+        # Step 1 — dry run: a few chunked reads, all maths in memory
+        if st.button("🔍 Preview Changes (dry run)", type="primary"):
             try:
-                with st.spinner("Fetching all invoices..."):
-                    invoices = admin_supabase.table("ops_documents") \
-                        .select("id") \
-                        .eq("ops_type", "STOCK_OUT") \
-                        .eq("is_deleted", False) \
-                        .execute().data or []
-
-                updated = 0
-                errors = 0
-                progress = st.progress(0)
-                total = len(invoices)
-
-                for i, inv in enumerate(invoices):
-                    try:
-                        # Step 1 — Recalculate invoice_total from ops_lines (first line only).
-                        # net_amount is a document-level figure stored identically on every
-                        # ops_line row, so summing across all lines inflates it by product count.
-                        first_line = admin_supabase.table("ops_lines") \
-                            .select("net_amount") \
-                            .eq("ops_document_id", inv["id"]) \
-                            .limit(1) \
-                            .execute().data
-                        inv_total = float(first_line[0].get("net_amount", 0)) \
-                            if first_line else 0.0
-
-                        # Step 2 — Sum payments already allocated to this invoice
-                        settlements = admin_supabase.table("payment_settlements") \
-                            .select("amount") \
-                            .eq("invoice_id", inv["id"]) \
-                            .execute().data or []
-
-                        paid = sum(float(s.get("amount", 0)) for s in settlements)
-                        outstanding = max(0, inv_total - paid)
+                with st.spinner("Loading invoices, lines and settlements..."):
+                    st.session_state.recalc_plan = plan_invoice_recalc()
+            except Exception as e:
+                st.error("❌ Could not compute balances")
+                st.exception(e)
 
-                        if outstanding <= 0:
-                            status = "PAID"
-                        elif paid > 0:
-                            status = "PARTIAL"
-                        else:
-                            status = "UNPAID"
+        plan = st.session_state.get("recalc_plan")
+        if plan is None:
+            st.stop()
 
-                        # Step 3 — Write corrected invoice_total + outstanding + status
-                        admin_supabase.table("ops_documents").update({
-                            "invoice_total": inv_total,
-                            "paid_amount": paid,
-                            "outstanding_balance": outstanding,
-                            "payment_status": status
-                        }).eq("id", inv["id"]).execute()
+        if not plan:
+            st.success("✅ All invoice balances are already correct — nothing to update.")
+            st.stop()
 
-                        updated += 1
-                    except Exception:
-                        errors += 1
+        st.write(f"**{len(plan)} invoice(s) will change:**")
+        st.dataframe([
+            {
+                "Invoice":         c["ops_no"],
+                "Total (old)":     c["old"]["invoice_total"],
+                "Total (new)":     c["new"]["invoice_total"],
+                "Paid (old)":      c["old"]["paid_amount"],
+                "Paid (new)":      c["new"]["paid_amount"],
+                "Outstanding (old)": c["old"]["outstanding_balance"],
+                "Outstanding (new)": c["new"]["outstanding_balance"],
+                "Status (old)":    c["old"]["payment_status"],
+                "Status (new)":    c["new"]["payment_status"],
+            }
+            for c in plan
+        ], use_container_width=True, hide_index=True)
 
-                    progress.progress((i + 1) / total)
+        # Step 2 — commit only the changed columns, batched by identical values
+        if st.button(f"▶️ Apply {len(plan)} Change(s)", type="primary"):
+            try:
+                with st.spinner("Saving..."):
+                    updated, errors, stale = apply_invoice_recalc(plan)
 
                 st.session_state.recalc_done = True
-                st.success(f"✅ Done. {updated} invoices updated. {errors} errors.")
+                st.session_state.recalc_errors = errors
+                st.session_state.recalc_stale = stale
+                st.session_state.pop("recalc_plan", None)
 
                 user_id = resolve_user_id()
                 admin_supabase.table("audit_logs").insert({
@@ -10522,8 +9858,9 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                     "target_type": "ops_documents",
                     "target_id": None,
                     "performed_by": user_id,
-                    "message": f"Recalculated balances: {updated} updated, {errors} errors.",
-                    "metadata": {"updated": updated, "errors": errors}
+                    "message": f"Recalculated balances: {updated} updated, {errors} errors, "
+                               f"{len(stale)} changed since preview.",
+                    "metadata": {"updated": updated, "errors": errors, "changed_since_preview": stale}
                 }).execute()
                 st.rerun()
 
@@ -10531,6 +9868,63 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                 st.error("❌ Recalculation failed")
                 st.exception(e)
 
+    # =========================
+    # STOCK SNAPSHOTS (BUILD + VERIFY)
+    # =========================
+    elif section == "STOCK_SNAPSHOTS":
+        st.subheader("🧮 Stock Snapshots")
+
+        st.info("""
+        **Purpose:** Stores month-end stock per entity & product so Closing Stock and
+        Stock Statement read *last snapshot + newer rows* instead of all history.
+        Build is incremental — only new or changed months are recomputed.
+        """)
+
+        col1, col2 = st.columns(2)
+        with col1:
+            snap_full = st.checkbox("Full rebuild (from first ledger month)", key="snap_full")
+            if st.button("▶️ Build Snapshots", type="primary", key="snap_build"):
+                try:
+                    with st.spinner("Building stock snapshots..."):
+                        summary = build_stock_snapshots(full=snap_full)
+                    if summary["months"]:
+                        st.success(
+                            f"✅ Built {summary['months']} month(s) "
+                            f"({summary['start']} → {summary['through']}), "
+                            f"{summary['rows']} rows."
+                        )
+                    else:
+                        st.success(f"✅ Already up to date through {summary['through']}.")
+                    admin_supabase.table("audit_logs").insert({
+                        "action": "BUILD_STOCK_SNAPSHOTS",
+                        "target_type": "stock_balance_snapshots",
+                        "target_id": None,
+                        "performed_by": resolve_user_id(),
+                        "message": f"Stock snapshots built: {summary['months']} month(s).",
+                        "metadata": summary
+                    }).execute()
+                except Exception as e:
+                    st.error("❌ Snapshot build failed")
+                    st.exception(e)
+
+        with col2:
+            snap_date = st.date_input("Verify opening stock as of", key="snap_verify_date",
+                                      value=date.today().replace(day=1))
+            if st.button("🔍 Verify", key="snap_verify"):
+                try:
+                    with st.spinner("Comparing snapshot vs full scan..."):
+                        mismatches = verify_stock_snapshots(snap_date)
+                    if not mismatches:
+                        st.success("✅ Snapshot matches the full ledger scan.")
+                    else:
+                        st.error(f"❌ {len(mismatches)} mismatch(es) — run a full rebuild.")
+                        st.dataframe(mismatches, use_container_width=True, hide_index=True)
+                except ValueError as e:
+                    st.warning(str(e))
+                except Exception as e:
+                    st.error("❌ Verification failed")
+                    st.exception(e)
+
     # =========================
     # OPS INSIGHTS REPORT
     # =========================
@@ -10543,12 +9937,6 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
             "Flags red flags per User (MR), Stockist, and Company-wide."
         )
 
-        # ── Thresholds ────────────────────────────────────────────────────────
-        SAMPLE_RATIO_THRESHOLD   = 2.0   # sample qty > 2x invoice qty = red flag
-        CREDIT_NOTE_PCT          = 2.0   # credit note > 2% of invoice value = red flag
-        PAYMENT_DELAY_DAYS       = 30    # outstanding invoice > 30 days = red flag
-        STOCK_IDLE_THRESHOLD     = 0.2   # stock_out / stock_in < 20% = not moving
-
         # ── Filters ───────────────────────────────────────────────────────────
         today = date.today()
         three_months_ago = today - timedelta(days=90)
@@ -10571,8 +9959,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
 
         # User selector
         if role == "admin":
-            users_res = admin_supabase.table("users").select("id, username").order("username").execute()
-            all_users = users_res.data or []
+            all_users = [{"id": u["id"], "username": u["username"]} for u in master_rows("users")]
             sel_users = st.multiselect(
                 "Select User(s)", all_users,
                 default=all_users,
@@ -10583,8 +9970,7 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
             user_name_map  = {u["id"]: u["username"] for u in all_users}
         else:
             sel_user_ids  = [auth_user_id]
-            u_res = admin_supabase.table("users").select("id, username").eq("id", auth_user_id).execute()
-            user_name_map = {u["id"]: u["username"] for u in (u_res.data or [])}
+            user_name_map = {auth_user_id: entity_name("User", auth_user_id, str(auth_user_id))}
 
         if not sel_user_ids:
             st.info("Select at least one user.")
@@ -10600,17 +9986,18 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
             to_iso   = ins_to.isoformat()
 
             # ── Fetch all ops_documents in range ─────────────────────────────
-            docs = admin_supabase.table("ops_documents") \
+            docs = fetch_all(lambda: (
+                admin_supabase.table("ops_documents")
                 .select(
                     "id, ops_date, stock_as, ops_type, "
                     "invoice_total, paid_amount, outstanding_balance, payment_status, "
                     "from_entity_type, from_entity_id, "
                     "to_entity_type, to_entity_id"
-                ) \
-                .gte("ops_date", from_iso) \
-                .lte("ops_date", to_iso) \
-                .eq("is_deleted", False) \
-                .execute().data or []
+                )
+                .gte("ops_date", from_iso)
+                .lte("ops_date", to_iso)
+                .eq("is_deleted", False)
+            ), "Error loading documents")
 
             if not docs:
                 st.warning("No transactions found for the selected period.")
@@ -10619,239 +10006,33 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
             doc_ids = [d["id"] for d in docs]
 
             # ── Fetch ops_lines ───────────────────────────────────────────────
-            lines = admin_supabase.table("ops_lines") \
-                .select("ops_document_id, product_id, sale_qty, free_qty, total_qty, gross_amount, net_amount") \
-                .in_("ops_document_id", doc_ids) \
-                .execute().data or []
+            lines = fetch_in(
+                lambda: admin_supabase.table("ops_lines")
+                .select("id, ops_document_id, product_id, sale_qty, free_qty, total_qty, gross_amount, net_amount"),
+                "ops_document_id", doc_ids, "Error loading document lines"
+            )
 
             # ── Fetch stock_ledger ────────────────────────────────────────────
-            stock_rows = admin_supabase.table("stock_ledger") \
-                .select("entity_type, entity_id, product_id, qty_in, qty_out, txn_date") \
-                .gte("txn_date", from_iso) \
-                .lte("txn_date", to_iso) \
-                .execute().data or []
-
-            # ── Fetch stockists assigned to selected users ────────────────────
-            us_rows = admin_supabase.table("user_stockists") \
-                .select("user_id, stockist_id, stockists(id, name)") \
-                .in_("user_id", sel_user_ids) \
-                .execute().data or []
-
+            stock_rows = fetch_all(lambda: (
+                admin_supabase.table("stock_ledger")
+                .select("id, entity_type, entity_id, product_id, qty_in, qty_out, txn_date")
+                .gte("txn_date", from_iso)
+                .lte("txn_date", to_iso)
+            ), "Error loading stock ledger")
+
+            # ── Stockists assigned to selected users (master cache) ───────────
+            _stk_names = master_index("stockists")
+            _sel_users = set(sel_user_ids)
             stockist_map  = {}   # stockist_id → name
             user_stockist = {}   # user_id → [stockist_ids]
-            for r in us_rows:
-                s = r.get("stockists") or {}
-                sid = s.get("id") or r.get("stockist_id")
-                if sid:
-                    stockist_map[sid] = s.get("name", str(sid))
+            for r in master_rows("user_stockists"):
+                if r["user_id"] in _sel_users and r.get("stockist_id"):
+                    sid = r["stockist_id"]
+                    stockist_map[sid] = (_stk_names.get(sid) or {}).get("name", str(sid))
                     user_stockist.setdefault(r["user_id"], []).append(sid)
 
-            # ── Fetch product names ───────────────────────────────────────────
-            all_prod_ids = list({ln["product_id"] for ln in lines if ln.get("product_id")})
-            prod_map = {}
-            if all_prod_ids:
-                p_res = admin_supabase.table("products").select("id, name").in_("id", all_prod_ids).execute()
-                prod_map = {p["id"]: p["name"] for p in (p_res.data or [])}
-
-            # ── Build lookups ─────────────────────────────────────────────────
-            lines_by_doc = {}
-            for ln in lines:
-                lines_by_doc.setdefault(ln["ops_document_id"], []).append(ln)
-
-            def _f(v):
-                try: return float(v or 0)
-                except: return 0.0
-
-            def _int(v):
-                try: return int(float(v or 0))
-                except: return 0
-
-            # ── Core aggregation function ─────────────────────────────────────
-            def _aggregate(entity_id, entity_type_key):
-                """
-                Returns dict of aggregated signals for one entity.
-                entity_type_key: "user" | "stockist" | "company"
-                """
-                agg = {
-                    "invoice_value":    0.0,
-                    "invoice_qty":      0,
-                    "sample_qty":       0,
-                    "lot_qty":          0,
-                    "credit_note_value":0.0,
-                    "paid_amount":      0.0,
-                    "outstanding":      0.0,
-                    "overdue_count":    0,
-                    "overdue_value":    0.0,
-                    "monthly_sales":    {},   # YYYY-MM → invoice_value
-                    "products":         {},   # product_name → {inv_qty, sample_qty, cn_val}
-                }
-
-                for doc in docs:
-                    fet = (doc.get("from_entity_type") or "").lower()
-                    tet = (doc.get("to_entity_type")   or "").lower()
-                    fid = doc.get("from_entity_id")
-                    tid = doc.get("to_entity_id")
-                    sa  = (doc.get("stock_as") or "").lower()
-                    month = doc["ops_date"][:7]
-
-                    # Match entity
-                    if entity_type_key == "company":
-                        matched = (fet == "company" or tet == "company")
-                    elif entity_type_key == "user":
-                        matched = (
-                            (fet == "user" and fid == entity_id) or
-                            (tet == "user" and tid == entity_id)
-                        )
-                    elif entity_type_key == "stockist":
-                        matched = (
-                            (fet == "stockist" and fid == entity_id) or
-                            (tet == "stockist" and tid == entity_id)
-                        )
-                    else:
-                        matched = False
-
-                    if not matched:
-                        continue
-
-                    doc_lines = lines_by_doc.get(doc["id"], [])
-
-                    if sa == "normal":
-                        inv_val = _f(doc.get("invoice_total"))
-                        agg["invoice_value"]  += inv_val
-                        agg["paid_amount"]    += _f(doc.get("paid_amount"))
-                        agg["outstanding"]    += _f(doc.get("outstanding_balance"))
-                        agg["monthly_sales"][month] = agg["monthly_sales"].get(month, 0.0) + inv_val
-
-                        # Overdue: unpaid and older than PAYMENT_DELAY_DAYS
-                        try:
-                            doc_date = date.fromisoformat(doc["ops_date"])
-                            days_old = (today - doc_date).days
-                        except:
-                            days_old = 0
-
-                        if doc.get("payment_status") in ("UNPAID", "PARTIAL") and days_old > PAYMENT_DELAY_DAYS:
-                            agg["overdue_count"] += 1
-                            agg["overdue_value"] += _f(doc.get("outstanding_balance"))
-
-                        for ln in doc_lines:
-                            pname = prod_map.get(ln.get("product_id"), "Unknown")
-                            agg["products"].setdefault(pname, {"inv_qty": 0, "sample_qty": 0, "cn_val": 0.0})
-                            agg["products"][pname]["inv_qty"] += _int(ln.get("sale_qty", 0)) + _int(ln.get("free_qty", 0))
-                            agg["invoice_qty"] += _int(ln.get("sale_qty", 0))
-
-                    elif sa == "sample":
-                        for ln in doc_lines:
-                            pname = prod_map.get(ln.get("product_id"), "Unknown")
-                            qty = _int(ln.get("total_qty") or 0) or _int(ln.get("sale_qty") or 0)
-                            agg["products"].setdefault(pname, {"inv_qty": 0, "sample_qty": 0, "cn_val": 0.0})
-                            agg["products"][pname]["sample_qty"] += qty
-                            agg["sample_qty"] += qty
-
-                    elif sa == "lot":
-                        for ln in doc_lines:
-                            qty = _int(ln.get("total_qty") or 0) or _int(ln.get("sale_qty") or 0)
-                            agg["lot_qty"] += qty
-
-                    elif sa == "credit_note":
-                        for ln in doc_lines:
-                            pname = prod_map.get(ln.get("product_id"), "Unknown")
-                            cn_v = _f(ln.get("net_amount")) or _f(ln.get("gross_amount"))
-                            agg["products"].setdefault(pname, {"inv_qty": 0, "sample_qty": 0, "cn_val": 0.0})
-                            agg["products"][pname]["cn_val"] += cn_v
-                            agg["credit_note_value"] += cn_v
-
-                # ── Stock movement for this entity ────────────────────────────
-                stock_in  = 0.0
-                stock_out = 0.0
-                for s in stock_rows:
-                    et = (s.get("entity_type") or "").lower()
-                    eid = s.get("entity_id")
-                    if entity_type_key == "company" and et == "company":
-                        stock_in  += _f(s.get("qty_in"))
-                        stock_out += _f(s.get("qty_out"))
-                    elif entity_type_key == "user" and et == "user" and eid == entity_id:
-                        stock_in  += _f(s.get("qty_in"))
-                        stock_out += _f(s.get("qty_out"))
-                    elif entity_type_key == "stockist" and et == "stockist" and eid == entity_id:
-                        stock_in  += _f(s.get("qty_in"))
-                        stock_out += _f(s.get("qty_out"))
-                agg["stock_in"]  = stock_in
-                agg["stock_out"] = stock_out
-
-                return agg
-
-            # ── RED FLAG ENGINE ───────────────────────────────────────────────
-            def _red_flags(agg):
-                flags = []
-                inv_v = agg["invoice_value"]
-                inv_q = agg["invoice_qty"]
-
-                # 1. High samples, low sales
-                if agg["sample_qty"] > 0 and inv_q == 0:
-                    flags.append(f"🚨 Samples given ({agg['sample_qty']} units) but ZERO invoice sales")
-                elif inv_q > 0 and agg["sample_qty"] / max(inv_q, 1) > SAMPLE_RATIO_THRESHOLD:
-                    ratio = round(agg["sample_qty"] / inv_q, 1)
-                    flags.append(f"🚨 Excess Sampling: {agg['sample_qty']} samples vs {inv_q} invoiced units (ratio {ratio}x)")
-
-                # 2. Payment delayed
-                if agg["overdue_count"] > 0:
-                    flags.append(f"⏰ Payment Delay: {agg['overdue_count']} invoice(s) overdue > {PAYMENT_DELAY_DAYS} days (₹{agg['overdue_value']:,.0f} outstanding)")
-
-                # 3. Credit note ratio
-                if inv_v > 0:
-                    cn_pct = agg["credit_note_value"] / inv_v * 100
-                    if cn_pct > CREDIT_NOTE_PCT:
-                        flags.append(f"📋 High Credit Notes: ₹{agg['credit_note_value']:,.0f} = {cn_pct:.1f}% of invoice value (threshold {CREDIT_NOTE_PCT}%)")
-
-                # 4. Stock not moving
-                if agg["stock_in"] > 0 and agg["stock_out"] < agg["stock_in"] * STOCK_IDLE_THRESHOLD:
-                    flags.append(f"📦 Stock Not Moving: {agg['stock_in']:.0f} units received, only {agg['stock_out']:.0f} units dispatched")
-
-                # 5. Sales declining trend (month on month)
-                monthly = sorted(agg["monthly_sales"].items())
-                if len(monthly) >= 3:
-                    v = [v for _, v in monthly]
-                    if v[-1] < v[-2] < v[-3]:
-                        flags.append(f"📉 Sales Declining 3 months: ₹{v[-3]:,.0f} → ₹{v[-2]:,.0f} → ₹{v[-1]:,.0f}")
-                elif len(monthly) == 2:
-                    v = [v for _, v in monthly]
-                    if v[-1] < v[-2]:
-                        flags.append(f"📉 Sales Declining: ₹{v[-2]:,.0f} → ₹{v[-1]:,.0f}")
-
-                # 6. Low overall sales
-                if inv_v == 0 and (agg["sample_qty"] > 0 or agg["lot_qty"] > 0):
-                    flags.append("⚠️ No Invoice Sales recorded in this period")
-
-                return flags
-
-            # ── Product-level flags ───────────────────────────────────────────
-            def _product_flags(agg):
-                insights = []
-                for pname, p in agg["products"].items():
-                    parts = []
-                    if p["sample_qty"] > 0 and p["inv_qty"] == 0:
-                        parts.append(f"{p['sample_qty']} samples, 0 sales")
-                    elif p["inv_qty"] > 0 and p["sample_qty"] > p["inv_qty"] * SAMPLE_RATIO_THRESHOLD:
-                        parts.append(f"sample {p['sample_qty']} > {SAMPLE_RATIO_THRESHOLD}x invoice {p['inv_qty']}")
-                    if p["cn_val"] > 0 and p["inv_qty"] > 0:
-                        parts.append(f"CN ₹{p['cn_val']:,.0f}")
-                    if parts:
-                        insights.append(f"**{pname}**: {', '.join(parts)}")
-                    elif p["inv_qty"] > 0:
-                        insights.append(f"✅ **{pname}**: {p['inv_qty']} units sold")
-                return insights[:8]  # top 8 products
-
-            # ── Health score ──────────────────────────────────────────────────
-            def _health(flags):
-                red_count = sum(1 for f in flags if "🚨" in f or "📉" in f or "⏰" in f)
-                if red_count == 0 and len(flags) == 0:
-                    return "GREEN", "No issues detected"
-                elif red_count == 0:
-                    return "YELLOW", f"{len(flags)} minor issue(s) noted"
-                elif red_count >= 2:
-                    return "RED", f"{red_count} critical issue(s) require attention"
-                else:
-                    return "YELLOW", f"{red_count} issue(s) require attention"
+            # ── Product names (master cache) ──────────────────────────────────
+            prod_map = {pid: p["name"] for pid, p in master_index("products").items()}
 
             # ── Build entity list ─────────────────────────────────────────────
             entities = []
@@ -10872,26 +10053,8 @@ Amount: ₹{abs(entry['net_amount']):,.2f}""")
                 st.warning("No entities found to analyse.")
                 st.stop()
 
-            # ── Compute results ───────────────────────────────────────────────
-            results = []
-            for eid, ename, ekey in entities:
-                agg   = _aggregate(eid, ekey)
-                flags = _red_flags(agg)
-                prod_insights = _product_flags(agg)
-                health, health_reason = _health(flags)
-                results.append({
-                    "name":           ename,
-                    "entity_type":    ekey,
-                    "health":         health,
-                    "health_reason":  health_reason,
-                    "agg":            agg,
-                    "flags":          flags,
-                    "prod_insights":  prod_insights,
-                })
-
-            # ── Sort: RED first, then YELLOW, then GREEN ──────────────────────
-            order = {"RED": 0, "YELLOW": 1, "GREEN": 2}
-            results.sort(key=lambda x: order.get(x["health"], 3))
+            # ── Compute results (one vectorized pass, RED → YELLOW → GREEN) ──
+            results = compute_insights(docs, lines, stock_rows, entities, prod_map, today)
 
         # ── RENDER ────────────────────────────────────────────────────────────
         period_label = f"{ins_from.strftime('%d-%b-%Y')} to {ins_to.strftime('%d-%b-%Y')}"
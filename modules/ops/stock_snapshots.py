@@ -0,0 +1,521 @@
+"""
+Stock Balance Snapshots — modules/ops/stock_snapshots.py
+
+Closing Stock and Stock Statement need the stock on hand BEFORE a date,
+which used to mean re-reading every stock_ledger row since the business
+started. This module keeps a month-end closing balance per
+(entity_type, entity_id, product_id) so those reports read
+"last snapshot + the rows after it" instead of all history.
+
+Tables (run once in the Supabase SQL editor):
+
+    create table stock_balance_snapshots (
+        id           uuid primary key default gen_random_uuid(),
+        entity_type  text        not null,
+        entity_key   text        not null,   -- entity_id::text, '' for Company
+        entity_id    uuid,
+        product_id   uuid        not null,
+        month        date        not null,   -- first day of the month
+        closing_qty  numeric     not null default 0,
+        built_at     timestamptz not null default now(),
+        unique (entity_type, entity_key, product_id, month)
+    );
+
+    create table stock_snapshot_state (
+        id             int primary key default 1,
+        built_from     date,          -- first month with snapshot rows
+        built_through  date,          -- last month with snapshot rows
+        watermark      timestamptz,   -- newest stock_ledger.created_at seen
+        updated_at     timestamptz default now()
+    );
+
+A snapshot row is the CUMULATIVE balance at the END of `month`. Once a key
+has appeared it gets a row for every later month, so a reader only ever
+needs one month's rows.
+
+Exclusion rule (shared with Stock Ledger / Stock Statement / Closing Stock):
+reversal rows ("Cancellation of …", "Reversal due to deletion of …",
+"Reversal of deleted…") and every row of a cancelled or deleted document
+are left out. See cancelled_doc_ids() — it looks up only the documents
+of the rows in hand (by id, then their ops_no), never the whole ledger.
+Indexes for those lookups:
+
+    create index if not exists stock_ledger_narration_idx on stock_ledger (narration);
+    create index if not exists ops_documents_reference_no_idx
+        on ops_documents (reference_no) where ops_type = 'ADJUSTMENT';
+
+Staleness: the builder is incremental. Rows created after the watermark
+that are back-dated, or that cancel an older document, mark the affected
+months dirty; readers skip dirty months and fall back to an older snapshot
+(or full history). Paths that edit / hard-delete stock rows in place call
+invalidate_stock_snapshots().
+"""
+
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from anchors.supabase_client import admin_supabase, safe_exec, fetch_all, fetch_rows, fetch_in
+from modules.statement.report_cache import data_watermark
+
+
+SNAPSHOT_TABLE = "stock_balance_snapshots"
+STATE_TABLE    = "stock_snapshot_state"
+_WRITE_BATCH   = 500
+
+_LEDGER_COLS = ("id, ops_document_id, product_id, entity_type, entity_id, "
+                "txn_date, qty_in, qty_out, narration")
+
+_dirty_lock = threading.Lock()
+_dirty_cache = [None, None]     # [key, _dirty_from() result]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# HELPERS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def is_reversal_narration(nar):
+    """True for the synthetic reversal rows written by cancel / delete flows."""
+    n = nar or ""
+    return (n.startswith("Cancellation of ")
+            or n.startswith("Reversal due to deletion of ")
+            or n.startswith("Reversal of deleted"))
+
+
+def _month_start(d):
+    if isinstance(d, str):
+        d = date.fromisoformat(d[:10])
+    return d.replace(day=1)
+
+
+def _add_months(d, n):
+    y, m = divmod(d.year * 12 + (d.month - 1) + n, 12)
+    return date(y, m + 1, 1)
+
+
+def _month_end(d):
+    return _add_months(_month_start(d), 1) - timedelta(days=1)
+
+
+def _entity_key(eid):
+    return str(eid) if eid else ""
+
+
+def _cancelled_ops_nos(ops_nos):
+    """Subset of ops_nos whose document was cancelled, from the two canonical
+    signals: reversal stock rows 'Cancellation of <ops_no>' and the
+    reference_no of ADJUSTMENT (CANCEL-* / REV-*) documents. Only the given
+    numbers are looked up, so the cost follows the report, not the ledger."""
+    ops_nos = sorted({n.strip() for n in ops_nos if n and n.strip()})
+    if not ops_nos:
+        return set()
+    nos = set()
+    for r in fetch_in(
+        lambda: admin_supabase.table("stock_ledger").select("id, narration"),
+        "narration", [f"Cancellation of {n}" for n in ops_nos],
+        "Error loading cancellations",
+    ):
+        nos.add((r.get("narration") or "")[len("Cancellation of "):].strip())
+    for d in fetch_in(
+        lambda: admin_supabase.table("ops_documents")
+        .select("id, reference_no")
+        .eq("ops_type", "ADJUSTMENT"),
+        "reference_no", ops_nos, "Error loading reversal documents",
+    ):
+        nos.add((d.get("reference_no") or "").strip())
+    return nos & set(ops_nos)
+
+
+def cancelled_doc_ids(doc_ids):
+    """Subset of doc_ids that are cancelled or deleted (is_deleted flag, or
+    named by a cancellation / reversal document)."""
+    doc_ids = [d for d in set(doc_ids) if d]
+    if not doc_ids:
+        return set()
+    docs = fetch_in(
+        lambda: admin_supabase.table("ops_documents").select("id, ops_no, is_deleted"),
+        "id", doc_ids, "Error loading documents",
+    )
+    live = [d for d in docs if not d.get("is_deleted")]
+    nos = _cancelled_ops_nos(d.get("ops_no") for d in live)
+    return ({d["id"] for d in docs if d.get("is_deleted")}
+            | {d["id"] for d in live if (d.get("ops_no") or "").strip() in nos})
+
+
+def _net_rows(rows, cancelled):
+    """Drop reversal rows and rows of cancelled documents."""
+    return [r for r in rows
+            if not is_reversal_narration(r.get("narration"))
+            and r.get("ops_document_id") not in cancelled]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# STATE
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _get_state():
+    rows = safe_exec(
+        admin_supabase.table(STATE_TABLE).select("*").eq("id", 1).limit(1),
+        "Error loading snapshot state",
+    )
+    return rows[0] if rows else None
+
+
+def _save_state(**fields):
+    fields["id"] = 1
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    admin_supabase.table(STATE_TABLE).upsert(fields, on_conflict="id").execute()
+
+
+def invalidate_stock_snapshots(from_date):
+    """Mark every snapshot month on or after from_date's month as stale.
+    Call after editing or hard-deleting stock_ledger rows in place (those
+    leave no trace for the watermark check). Never raises."""
+    try:
+        state = _get_state()
+        if not state or not state.get("built_through"):
+            return
+        keep = _add_months(_month_start(from_date), -1)
+        if keep < _month_start(state["built_through"]):
+            _save_state(built_through=keep.isoformat())
+    except Exception:
+        pass
+
+
+def _latest_created_at():
+    rows = safe_exec(
+        admin_supabase.table("stock_ledger")
+        .select("created_at")
+        .order("created_at", desc=True)
+        .limit(1),
+        "Error reading stock ledger",
+    )
+    return rows[0]["created_at"] if rows else None
+
+
+def _dirty_from(state):
+    """
+    Earliest month whose snapshot is invalidated by stock rows created after
+    the watermark, or None when nothing older than the new rows changed.
+    Returns date.min when a change cannot be located (forces full rebuild).
+
+    Every Closing Stock / Stock Statement run asks this, so the answer is
+    kept per (snapshot watermark, newest stock row, OPS data watermark) —
+    two one-row reads instead of re-scanning the rows since the last build.
+    """
+    wm = (state or {}).get("watermark")
+    if not wm:
+        return date.min
+    key = (wm, _latest_created_at(), data_watermark())
+    with _dirty_lock:
+        if _dirty_cache[0] == key:
+            return _dirty_cache[1]
+    dirty = _scan_dirty(wm)
+    with _dirty_lock:
+        _dirty_cache[:] = [key, dirty]
+    return dirty
+
+
+def _scan_dirty(wm):
+
+    new_rows = fetch_all(lambda: (
+        admin_supabase.table("stock_ledger")
+        .select("id, txn_date, narration, ops_document_id")
+        .gt("created_at", wm)
+    ), "Error checking new stock rows")
+
+    months = set()
+    orig_nos, orig_ids = set(), set()
+    for r in new_rows:
+        nar = r.get("narration") or ""
+        if is_reversal_narration(nar):
+            # The reversal itself is excluded, but the ORIGINAL document's
+            # rows — possibly months old — now drop out of every snapshot.
+            if nar.startswith("Cancellation of "):
+                val = nar[len("Cancellation of "):].strip()
+                if val.count("-") >= 4:
+                    orig_ids.add(val)
+                elif val:
+                    orig_nos.add(val)
+            elif nar.startswith("Reversal due to deletion of CN "):
+                orig_ids.add(nar[len("Reversal due to deletion of CN "):].strip())
+            else:
+                return date.min
+        elif r.get("txn_date"):
+            months.add(_month_start(r["txn_date"]))
+
+    # Soft-deleted since the watermark (delete paths stamp updated_at)
+    for d in fetch_rows(lambda: (
+        admin_supabase.table("ops_documents")
+        .select("id")
+        .eq("is_deleted", True)
+        .gt("updated_at", wm)
+    ), "Error checking deleted documents"):
+        orig_ids.add(d["id"])
+
+    if orig_nos:
+        for d in fetch_in(
+            lambda: admin_supabase.table("ops_documents").select("id, ops_no"),
+            "ops_no", list(orig_nos), "Error resolving cancelled documents",
+        ):
+            orig_ids.add(d["id"])
+    if orig_ids:
+        for r in fetch_in(
+            lambda: admin_supabase.table("stock_ledger").select("id, txn_date"),
+            "ops_document_id", list(orig_ids), "Error resolving cancelled rows",
+        ):
+            if r.get("txn_date"):
+                months.add(_month_start(r["txn_date"]))
+
+    return min(months) if months else None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# READER
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _read_month(month, entity_types=None, entity_id=None):
+    """All snapshot rows for one month (optionally scoped)."""
+    def _q():
+        q = (admin_supabase.table(SNAPSHOT_TABLE)
+             .select("id, entity_type, entity_id, product_id, closing_qty")
+             .eq("month", month.isoformat()))
+        if entity_types:
+            q = q.in_("entity_type", list(entity_types))
+        if entity_id:
+            q = q.eq("entity_key", _entity_key(entity_id))
+        return q
+    return fetch_all(_q, "Error loading stock snapshots")
+
+
+def opening_rows(before, entity_types, entity_id=None):
+    """
+    Brought-forward balances for reports that need stock before `before`.
+
+    Returns (bf_rows, rows_from):
+      bf_rows   : synthetic stock_ledger-shaped rows (one per entity/product)
+                  carrying the snapshot balance, dated at the snapshot month
+                  end with narration "Opening b/f (snapshot …)".
+      rows_from : ISO date — the caller must still fetch real ledger rows with
+                  txn_date >= rows_from. None means no usable snapshot: fetch
+                  full history as before (bf_rows is then empty).
+
+    entity_types : list of stock_ledger.entity_type values in scope.
+    entity_id    : restrict to one entity (None = all entities of the types).
+    """
+    if isinstance(before, str):
+        before = date.fromisoformat(before[:10])
+    try:
+        state = _get_state()
+    except Exception:
+        return [], None
+    if not state or not state.get("built_through") or not state.get("built_from"):
+        return [], None
+
+    built_from = _month_start(state["built_from"])
+    usable = min(_month_start(state["built_through"]),
+                 _add_months(_month_start(before), -1))
+    dirty = _dirty_from(state)
+    if dirty is not None and dirty <= usable:
+        usable = _add_months(dirty, -1) if dirty > date.min else date.min
+    if usable < built_from:
+        return [], None
+
+    snap = _read_month(usable, entity_types, entity_id)
+
+    tag = f"Opening b/f (snapshot to {usable.strftime('%b-%y')})"
+    end = _month_end(usable).isoformat()
+    bf_rows = []
+    for s in snap:
+        qty = float(s.get("closing_qty") or 0)
+        if not qty:
+            continue
+        bf_rows.append({
+            "id": "",
+            "ops_document_id": None,
+            "product_id": s["product_id"],
+            "entity_type": s["entity_type"],
+            "entity_id": s.get("entity_id"),
+            "txn_date": end,
+            "qty_in": qty if qty > 0 else 0,
+            "qty_out": -qty if qty < 0 else 0,
+            "narration": tag,
+        })
+    return bf_rows, _add_months(usable, 1).isoformat()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# BUILDER
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _ledger_rows(start=None, end=None):
+    """Raw stock_ledger rows with start <= txn_date <= end (either open)."""
+    def _q():
+        q = admin_supabase.table("stock_ledger").select(_LEDGER_COLS)
+        if start:
+            q = q.gte("txn_date", start)
+        if end:
+            q = q.lte("txn_date", end)
+        return q
+    return fetch_all(_q, "Error fetching stock ledger")
+
+
+def _first_ledger_month():
+    rows = safe_exec(
+        admin_supabase.table("stock_ledger")
+        .select("txn_date")
+        .not_.is_("txn_date", "null")
+        .order("txn_date")
+        .limit(1),
+        "Error reading stock ledger",
+    )
+    return _month_start(rows[0]["txn_date"]) if rows else None
+
+
+def build_stock_snapshots(full=False, today=None):
+    """
+    Bring stock_balance_snapshots up to the last COMPLETE month.
+
+    Incremental by default: starts after the last built month, or earlier
+    if rows created since the last run touch older months. full=True
+    rebuilds from the first ledger month.
+
+    Returns a summary dict: start, through, months, rows (0s when up to date).
+    """
+    today = today or date.today()
+    target = _add_months(_month_start(today), -1)
+    state = _get_state()
+    # Read the watermark BEFORE loading rows so anything inserted while we
+    # build is picked up as "new" on the next run.
+    new_wm = _latest_created_at()
+
+    first = _first_ledger_month()
+    if first is None:
+        return {"start": None, "through": None, "months": 0, "rows": 0}
+
+    built_from = _month_start(state["built_from"]) if state and state.get("built_from") else None
+    built_through = _month_start(state["built_through"]) if state and state.get("built_through") else None
+
+    if full or not built_from or not built_through or built_from > first:
+        start = first
+    else:
+        start = _add_months(built_through, 1)
+        dirty = _dirty_from(state)
+        if dirty is not None and dirty < start:
+            start = dirty
+        if start <= built_from:
+            start = first
+
+    if start > target:
+        _save_state(built_from=(built_from or first).isoformat(),
+                    built_through=(built_through or target).isoformat(),
+                    watermark=new_wm)
+        return {"start": None, "through": target.isoformat(), "months": 0, "rows": 0}
+
+    # Base = cumulative balances at the end of the month before `start`
+    running = defaultdict(float)     # (etype, eid, pid) -> qty
+    if start > first:
+        for s in _read_month(_add_months(start, -1)):
+            running[(s["entity_type"], s.get("entity_id"), s["product_id"])] += \
+                float(s.get("closing_qty") or 0)
+
+    rows = _ledger_rows(start.isoformat(), _month_end(target).isoformat())
+    cancelled = cancelled_doc_ids(r.get("ops_document_id") for r in rows)
+    net = defaultdict(float)         # (month, etype, eid, pid) -> in - out
+    for r in _net_rows(rows, cancelled):
+        if not r.get("product_id") or not r.get("txn_date"):
+            continue
+        net[(_month_start(r["txn_date"]), r.get("entity_type"),
+             r.get("entity_id"), r["product_id"])] += \
+            float(r.get("qty_in") or 0) - float(r.get("qty_out") or 0)
+
+    # Readers must not trust months we are about to rewrite.
+    _save_state(built_from=first.isoformat(),
+                built_through=_add_months(start, -1).isoformat())
+    (admin_supabase.table(SNAPSHOT_TABLE)
+     .delete().gte("month", start.isoformat()).execute())
+    if start == first:
+        (admin_supabase.table(SNAPSHOT_TABLE)
+         .delete().lt("month", start.isoformat()).execute())
+
+    by_month = defaultdict(list)
+    for (m, et, eid, pid), qty in net.items():
+        by_month[m].append(((et, eid, pid), qty))
+
+    built_at = datetime.utcnow().isoformat()
+    written, months, m = 0, 0, start
+    batch = []
+    while m <= target:
+        for k, qty in by_month.get(m, []):
+            running[k] += qty
+        for (et, eid, pid), qty in running.items():
+            batch.append({
+                "entity_type": et,
+                "entity_key": _entity_key(eid),
+                "entity_id": eid,
+                "product_id": pid,
+                "month": m.isoformat(),
+                "closing_qty": qty,
+                "built_at": built_at,
+            })
+            if len(batch) >= _WRITE_BATCH:
+                admin_supabase.table(SNAPSHOT_TABLE).insert(batch).execute()
+                written += len(batch)
+                batch = []
+        months += 1
+        m = _add_months(m, 1)
+    if batch:
+        admin_supabase.table(SNAPSHOT_TABLE).insert(batch).execute()
+        written += len(batch)
+
+    _save_state(built_from=first.isoformat(),
+                built_through=target.isoformat(),
+                watermark=new_wm)
+    return {"start": start.isoformat(), "through": target.isoformat(),
+            "months": months, "rows": written}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# VERIFY
+# ─────────────────────────────────────────────────────────────────────────────
+
+def verify_stock_snapshots(as_of):
+    """
+    Compare opening stock before `as_of` computed two ways:
+      • snapshot path  : opening_rows() + ledger rows since the snapshot
+      • full-scan path : every ledger row before as_of
+    using the same exclusion rule. Returns a list of mismatch dicts
+    {entity_type, entity_id, product_id, snapshot, full_scan}; [] = match.
+    """
+    if isinstance(as_of, str):
+        as_of = date.fromisoformat(as_of[:10])
+    before = (as_of - timedelta(days=1)).isoformat()
+    etypes = sorted({r["entity_type"] for r in fetch_rows(lambda: (
+        admin_supabase.table("stock_ledger").select("id, entity_type")
+        .lt("txn_date", as_of.isoformat())
+    ), "Error reading stock ledger") if r.get("entity_type")})
+
+    bf_rows, rows_from = opening_rows(as_of, etypes)
+    if rows_from is None:
+        raise ValueError("No usable snapshot for this date — run the builder first.")
+
+    def _sum(rows):
+        cancelled = cancelled_doc_ids(r.get("ops_document_id") for r in rows)
+        out = defaultdict(float)
+        for r in _net_rows(rows, cancelled):
+            if r.get("product_id"):
+                out[(r.get("entity_type"), r.get("entity_id"), r["product_id"])] += \
+                    float(r.get("qty_in") or 0) - float(r.get("qty_out") or 0)
+        return out
+
+    snap = _sum(bf_rows + _ledger_rows(rows_from, before))
+    full = _sum(_ledger_rows(None, before))
+
+    mismatches = []
+    for k in set(snap) | set(full):
+        if abs(snap.get(k, 0.0) - full.get(k, 0.0)) > 1e-6:
+            mismatches.append({
+                "entity_type": k[0], "entity_id": k[1], "product_id": k[2],
+                "snapshot": snap.get(k, 0.0), "full_scan": full.get(k, 0.0),
+            })
+    return mismatches
@@ -6,6 +6,7 @@ Tables: ofs_orders, ofs_order_lines
 import streamlit as st
 from datetime import datetime
 from anchors.supabase_client import admin_supabase
+from anchors.doc_numbers import next_number
 
 
 # ─────────────────────────────────────────────────────────────
@@ -57,29 +58,15 @@ def ofs_get_all_products() -> list:
 
 def ofs_generate_order_no() -> str:
     """Generate next OFS order number e.g. OFS-001.
-    Uses existing pob_number_sequences table with doc_type = 'OFS'."""
+    Uses the pob_number_sequences counter with doc_type = 'OFS' through
+    the shared atomic allocator (anchors.doc_numbers).
+    Returns None if no number could be allocated."""
     try:
-        rows = _exec(
-            admin_supabase.table("pob_number_sequences")
-            .select("last_number")
-            .eq("doc_type", "OFS"),
-            "Error reading OFS sequence"
-        )
-        if not rows:
-            st.error("OFS sequence row missing. Run the SQL setup script first.")
-            import time
-            return f"OFS-{int(time.time())}"
-        current = rows[0]["last_number"]
-        next_no = current + 1
-        admin_supabase.table("pob_number_sequences") \
-            .update({"last_number": next_no}) \
-            .eq("doc_type", "OFS") \
-            .execute()
-        return f"OFS-{str(next_no).zfill(3)}"
+        next_no = next_number("OFS")
     except Exception as e:
-        import time
         st.error(f"Error generating order number: {e}")
-        return f"OFS-{int(time.time())}"
+        return None
+    return f"OFS-{str(next_no).zfill(3)}"
 
 
 # ─────────────────────────────────────────────────────────────
@@ -89,6 +76,8 @@ def ofs_generate_order_no() -> str:
 def ofs_create_order(user_id, stockist_id, order_date) -> str:
     """Create a new draft order. Returns order id."""
     order_no = ofs_generate_order_no()
+    if not order_no:
+        return None
     rows = _exec(
         admin_supabase.table("ofs_orders").insert({
             "order_no":   order_no,
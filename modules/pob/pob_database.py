@@ -9,6 +9,8 @@ Fully self-contained — no dependency on dcr_database or any other module.
 import streamlit as st
 from datetime import datetime
 from anchors.supabase_client import admin_supabase
+from anchors.master_cache import master_rows
+from anchors.doc_numbers import next_number
 
 
 # ─────────────────────────────────────────────────────────────
@@ -77,21 +79,9 @@ def pob_get_user_stockists(user_id: str) -> list:
     return result
 
 
-@st.cache_data(ttl=300)
 def pob_get_all_products() -> list:
-    """Cached 5 min to avoid hammering Supabase connection pool."""
-    import time
-    for attempt in range(3):
-        try:
-            resp = admin_supabase.table("products").select("id, name").order("name").execute()
-            return resp.data or []
-        except Exception as e:
-            if attempt < 2:
-                time.sleep(1)
-            else:
-                st.error(f"Error loading products: {e}")
-                return []
-    return []
+    """Shared process-wide master cache (anchors.master_cache)."""
+    return [{"id": p["id"], "name": p["name"]} for p in master_rows("products")]
 
 
 # ─────────────────────────────────────────────────────────────
@@ -102,32 +92,18 @@ _PREFIX = {"POB": "POB", "STATEMENT": "STM", "CREDIT_NOTE": "CRN"}
 
 def pob_generate_doc_no(doc_type: str) -> str:
     """
-    Reads pob_number_sequences, increments by 1, returns formatted number.
+    Next number from the shared allocator (anchors.doc_numbers — one
+    atomic increment, no read-then-write), formatted.
     e.g.  POB-0001, STM-0003, CRN-0001
+    Returns None if no number could be allocated.
     """
     try:
-        rows = _exec(
-            admin_supabase.table("pob_number_sequences")
-            .select("last_number")
-            .eq("doc_type", doc_type),
-            "Error reading sequence"
-        )
-        if not rows:
-            st.error(f"No sequence row found for doc_type: {doc_type}. Check pob_number_sequences table.")
-            import time
-            return f"{doc_type}-{int(time.time())}"
-        current = rows[0]["last_number"]
-        next_no = current + 1
-        admin_supabase.table("pob_number_sequences") \
-            .update({"last_number": next_no}) \
-            .eq("doc_type", doc_type) \
-            .execute()
-        prefix = _PREFIX.get(doc_type, doc_type)
-        return f"{prefix}-{str(next_no).zfill(4)}"
+        next_no = next_number(doc_type)
     except Exception as e:
         st.error(f"Error generating doc number: {e}")
-        import time
-        return f"{doc_type}-{int(time.time())}"
+        return None
+    prefix = _PREFIX.get(doc_type, doc_type)
+    return f"{prefix}-{str(next_no).zfill(4)}"
 
 
 # ─────────────────────────────────────────────────────────────
@@ -174,6 +150,8 @@ def pob_create_document(doc_type, doc_date, party_type, party_id,
                         party_name, user_id) -> str:
     """Create header row. Returns new document id or None."""
     doc_no = pob_generate_doc_no(doc_type)
+    if not doc_no:
+        return None
     rows = _exec(
         admin_supabase.table("pob_documents").insert({
             "pob_no":     doc_no,
@@ -8,6 +8,7 @@ import streamlit as st
 import urllib.parse
 from datetime import date
 
+from anchors.pdf_service import pdf_download_button
 from modules.dcr.dcr_helpers import get_current_user_id
 from modules.pob.pob_database import (
     pob_get_user_chemists,
@@ -535,13 +536,9 @@ def _step_done():
         wa_url = "https://wa.me/?text=" + urllib.parse.quote(msg)
         st.link_button("📱 WhatsApp", wa_url, use_container_width=True)
     with c2:
-        pdf_bytes = pob_generate_pdf(doc, lines)
-        if pdf_bytes:
-            st.download_button("📄 PDF", data=pdf_bytes,
-                               file_name=f"{doc['pob_no']}.pdf",
-                               mime="application/pdf",
-                               use_container_width=True)
-        else:
+        if not pdf_download_button("📄 PDF", lambda: pob_generate_pdf(doc, lines),
+                                   (doc, lines), file_name=f"{doc['pob_no']}.pdf",
+                                   use_container_width=True):
             st.caption("PDF: install reportlab")
     with c3:
         if st.button("➡️ Next Document", use_container_width=True,
@@ -699,12 +696,9 @@ def _view_doc(user_id, role):
         wa_url = "https://wa.me/?text=" + urllib.parse.quote(msg)
         st.link_button("📱 WhatsApp", wa_url, use_container_width=True)
     with e2:
-        pdf_bytes = pob_generate_pdf(doc, lines)
-        if pdf_bytes:
-            st.download_button("📄 PDF", data=pdf_bytes,
-                               file_name=f"{doc['pob_no']}.pdf",
-                               mime="application/pdf",
-                               use_container_width=True)
+        pdf_download_button("📄 PDF", lambda: pob_generate_pdf(doc, lines),
+                            (doc, lines), file_name=f"{doc['pob_no']}.pdf",
+                            use_container_width=True)
     with e3:
         if st.button("⬅️ Back to Archive", use_container_width=True,
                      key="pob_view_back"):
@@ -1,11 +1,24 @@
 """
 Notifications Module — Admin Only
 Reads from audit_logs table and displays a human-readable activity feed.
+
+The module filter runs in the query (action in (…)), so "Last 50" for DCR
+is the last 50 DCR events — not the DCR events among the last 500 rows.
+Older entries page in with a keyset cursor on (created_at, id). Refresh
+only asks for rows at or after the newest one already on screen and puts
+them on top. Usernames come from the cached user master.
+
+Indexes that keep both directions cheap:
+
+    create index audit_logs_feed_idx   on audit_logs (created_at desc, id desc);
+    create index audit_logs_action_idx on audit_logs (action, created_at desc);
 """
 
 import streamlit as st
 from datetime import datetime, timezone
 from anchors.supabase_client import admin_supabase
+from anchors.master_cache import master_index
+from anchors.notification_outbox import outbox_metrics
 
 
 # ── Human-readable labels for every action ────────────────────
@@ -66,6 +79,32 @@ ACTION_CONFIG = {
     "OS_DELETED":                 ("🗑️",  "Opening Stock Deleted",      "red"),
 }
 
+# ── Module filter → audit actions ─────────────────────────────
+MODULE_ACTIONS = {
+    "All Modules": None,
+    "📦 Statement": ["statement_submitted", "reset_statement", "admin_corrected_statement",
+                     "delete_statement", "create_stockist", "update_user",
+                     "create_territory", "update_territory", "reset_user_password",
+                     "statement_product_saved"],
+    "📥 OPS":       ["CANCEL_INVOICE", "DELETE_INVOICE", "DELETE_OPS", "EDIT_INVOICE",
+                     "DELETE_PAYMENT", "DELETE_FREIGHT", "DELETE_RETURN_REPLACE",
+                     "CREATE_FREIGHT", "ALLOCATE_PAYMENT"],
+    "📞 DCR":       ["DCR_SUBMITTED", "DCR_DELETED"],
+    "🗓️ Tour":      ["TOUR_CREATED", "TOUR_UPDATED", "TOUR_DELETED", "TOUR_APPROVED", "TOUR_REJECTED"],
+    "📋 POB":       ["POB_CREATED", "POB_SUBMITTED", "POB_APPROVED", "POB_REJECTED"],
+    "📦 OFS":         ["OFS_SUBMITTED", "OFS_DELETED"],
+    "💊 Doctor I/O": ["DOCTOR_INPUT_SAVED", "DOCTOR_INPUT_UPDATED", "DOCTOR_INPUT_DELETED",
+                      "DOCTOR_OUTPUT_SAVED", "DOCTOR_OUTPUT_DELETED",
+                      "DOCTOR_ADDED", "DOCTOR_UPDATED", "CHEMIST_ADDED"],
+    "📦 OPS Entries": ["OB_UPDATED", "OB_DELETED", "OS_UPDATED", "OS_DELETED"],
+}
+
+# page size — older pages load with "Load older"
+PAGE_OPTIONS = {"Last 50": 50, "Last 100": 100, "Last 200": 200, "Last 500": 500}
+
+_SELECT = "id, action, message, performed_by, target_type, target_id, metadata, created_at"
+_POLL_CAP = 200     # more new rows than this on Refresh → reload the first page
+
 COLOR_MAP = {
     "green":  "#1a6b5a",
     "blue":   "#1a4b8a",
@@ -102,17 +141,70 @@ def _time_ago(dt_str):
         return dt_str[:10] if dt_str else "Unknown"
 
 
-def _get_username(user_id):
-    """Fetch username from users table."""
-    if not user_id:
-        return "Unknown"
-    try:
-        result = admin_supabase.table("users").select("username").eq("id", str(user_id)).limit(1).execute()
-        if result.data:
-            return result.data[0]["username"]
-    except Exception:
-        pass
-    return "Unknown"
+# ── Feed queries ──────────────────────────────────────────────
+def _feed_query(actions):
+    q = admin_supabase.table("audit_logs").select(_SELECT)
+    return q.in_("action", actions) if actions else q
+
+
+def _fetch_page(actions, cursor, size):
+    """size rows older than cursor (created_at, id), newest first.
+    Returns (rows, has_more)."""
+    q = _feed_query(actions)
+    if cursor:
+        ts, log_id = cursor
+        q = q.or_(f'created_at.lt."{ts}",and(created_at.eq."{ts}",id.lt.{log_id})')
+    rows = q.order("created_at", desc=True).order("id", desc=True) \
+        .limit(size + 1).execute().data or []
+    return rows[:size], len(rows) > size
+
+
+def _fetch_newer(actions, newest):
+    """Rows at or after the newest one already shown (same-timestamp rows
+    come back too and are dropped by id). At most _POLL_CAP + 1 rows."""
+    return _feed_query(actions).gte("created_at", newest) \
+        .order("created_at", desc=True).order("id", desc=True) \
+        .limit(_POLL_CAP + 1).execute().data or []
+
+
+def _usernames(logs):
+    """performed_by -> username for every row on screen, from the user master."""
+    users = master_index("users")
+    out = {}
+    for log in logs:
+        uid = log.get("performed_by")
+        if uid not in out:
+            out[uid] = (users.get(str(uid)) or {}).get("username", "Unknown") if uid else "System"
+    return out
+
+
+# ── Feed state (kept across reruns, reset when the filter changes) ──
+def _feed_state(signature):
+    state = st.session_state.get("notif_feed")
+    if not state or state["sig"] != signature:
+        state = {"sig": signature, "logs": None, "has_more": False, "new_ids": set()}
+        st.session_state.notif_feed = state
+    return state
+
+
+def _load_first_page(state, actions, size):
+    state["logs"], state["has_more"] = _fetch_page(actions, None, size)
+    state["new_ids"] = set()
+
+
+def _poll_new(state, actions, size):
+    """Put rows newer than the top of the feed on top."""
+    if not state["logs"]:
+        _load_first_page(state, actions, size)
+        return
+    rows = _fetch_newer(actions, state["logs"][0]["created_at"])
+    if len(rows) > _POLL_CAP:
+        _load_first_page(state, actions, size)
+        return
+    shown = {log["id"] for log in state["logs"]}
+    fresh = [r for r in rows if r["id"] not in shown]
+    state["logs"] = fresh + state["logs"]
+    state["new_ids"] = {r["id"] for r in fresh}
 
 
 def run_notifications():
@@ -125,77 +217,63 @@ def run_notifications():
     col1, col2, col3 = st.columns([2, 2, 1])
 
     with col1:
-        module_options = {
-            "All Modules": None,
-            "📦 Statement": ["statement_submitted", "reset_statement", "admin_corrected_statement",
-                             "delete_statement", "create_stockist", "update_user",
-                             "create_territory", "update_territory", "reset_user_password",
-                             "statement_product_saved"],
-            "📥 OPS":       ["CANCEL_INVOICE", "DELETE_INVOICE", "DELETE_OPS", "EDIT_INVOICE",
-                             "DELETE_PAYMENT", "DELETE_FREIGHT", "DELETE_RETURN_REPLACE",
-                             "CREATE_FREIGHT", "ALLOCATE_PAYMENT"],
-            "📞 DCR":       ["DCR_SUBMITTED", "DCR_DELETED"],
-            "🗓️ Tour":      ["TOUR_CREATED", "TOUR_UPDATED", "TOUR_DELETED", "TOUR_APPROVED", "TOUR_REJECTED"],
-            "📋 POB":       ["POB_CREATED", "POB_SUBMITTED", "POB_APPROVED", "POB_REJECTED"],
-            # NEW ↓
-            "📦 OFS":         ["OFS_SUBMITTED", "OFS_DELETED"],
-            "💊 Doctor I/O": ["DOCTOR_INPUT_SAVED", "DOCTOR_INPUT_UPDATED", "DOCTOR_INPUT_DELETED",
-                              "DOCTOR_OUTPUT_SAVED", "DOCTOR_OUTPUT_DELETED",
-                              "DOCTOR_ADDED", "DOCTOR_UPDATED", "CHEMIST_ADDED"],
-            "📦 OPS Entries": ["OB_UPDATED", "OB_DELETED", "OS_UPDATED", "OS_DELETED"],
-        }
-        selected_module = st.selectbox("Filter by Module", list(module_options.keys()), key="notif_module_filter")
+        selected_module = st.selectbox("Filter by Module", list(MODULE_ACTIONS.keys()), key="notif_module_filter")
 
     with col2:
-        limit_options = {"Last 50": 50, "Last 100": 100, "Last 200": 200, "All": 500}
-        selected_limit = st.selectbox("Show", list(limit_options.keys()), key="notif_limit")
+        selected_limit = st.selectbox("Show", list(PAGE_OPTIONS.keys()), key="notif_limit")
 
     with col3:
         st.markdown("<br>", unsafe_allow_html=True)
-        if st.button("🔄 Refresh", use_container_width=True):
-            st.rerun()
+        refresh = st.button("🔄 Refresh", use_container_width=True)
+
+    with st.expander("📮 Push delivery"):
+        m = outbox_metrics()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Queued", "—" if m["queue_depth"] is None else m["queue_depth"] + m["local_queue"])
+        m2.metric("Sent", m["sent"])
+        m3.metric("Failed", m["failed"])
+        m4.metric("Retries", m["retried"])
+        st.caption(
+            f"Queue wait p50 / p95: {m['wait_p50_s'] or '—'} s / {m['wait_p95_s'] or '—'} s  ·  "
+            f"FCM send p50 / p95: {m['send_p50_s'] or '—'} s / {m['send_p95_s'] or '—'} s  ·  "
+            f"worker {'running' if m['worker_alive'] else 'stopped'}  ·  "
+            f"sent / failed / retries count recipients (this app instance, since start)"
+        )
 
     st.divider()
 
+    actions = MODULE_ACTIONS[selected_module]
+    page_size = PAGE_OPTIONS[selected_limit]
+    state = _feed_state((selected_module, page_size))
+
     # ── Fetch from audit_logs ─────────────────────────────────────
     try:
-        query = admin_supabase.table("audit_logs") \
-            .select("id, action, message, performed_by, target_type, target_id, metadata, created_at") \
-            .order("created_at", desc=True) \
-            .limit(limit_options[selected_limit])
-
-        result = query.execute()
-        logs = result.data or []
-
+        if state["logs"] is None:
+            _load_first_page(state, actions, page_size)
+        elif refresh:
+            _poll_new(state, actions, page_size)
+        else:
+            state["new_ids"] = set()
     except Exception as e:
         st.error(f"❌ Could not load notifications: {e}")
         return
 
+    logs = state["logs"]
     if not logs:
-        st.info("No activity recorded yet. Actions across the app will appear here.")
-        return
-
-    # ── Filter by module ──────────────────────────────────────────
-    action_filter = module_options[selected_module]
-    if action_filter:
-        logs = [log for log in logs if log.get("action") in action_filter]
-
-    if not logs:
-        st.info(f"No activity found for {selected_module}.")
+        if actions:
+            st.info(f"No activity found for {selected_module}.")
+        else:
+            st.info("No activity recorded yet. Actions across the app will appear here.")
         return
 
-    # ── Cache usernames to avoid repeated DB calls ────────────────
-    user_cache = {}
-
-    def get_username_cached(user_id):
-        if not user_id:
-            return "System"
-        if user_id not in user_cache:
-            user_cache[user_id] = _get_username(user_id)
-        return user_cache[user_id]
+    usernames = _usernames(logs)
 
     # ── Render feed ───────────────────────────────────────────────
-    st.markdown(f"**{len(logs)} notification{'s' if len(logs) != 1 else ''}**")
+    new_count = len(state["new_ids"])
+    st.markdown(
+        f"**{len(logs)} notification{'s' if len(logs) != 1 else ''}**"
+        + (f" &nbsp;·&nbsp; 🆕 {new_count} new since last refresh" if new_count else "")
+    )
     st.markdown("")
 
     for log in logs:
@@ -212,7 +290,9 @@ def run_notifications():
             emoji, label, color_key = "📝", action.replace("_", " ").title(), "gray"
 
         color = COLOR_MAP.get(color_key, "#666666")
-        username = get_username_cached(performed_by)
+        if log.get("id") in state["new_ids"]:
+            label = f"🆕 {label}"
+        username = usernames.get(performed_by, "Unknown")
 
         if metadata.get("performed_by_username"):
             username = metadata["performed_by_username"]
@@ -252,3 +332,17 @@ def run_notifications():
             </div>
         </div>
         """, unsafe_allow_html=True)
+
+    # ── Older entries ─────────────────────────────────────────────
+    if state["has_more"]:
+        if st.button(f"⬇️ Load {page_size} older", use_container_width=True, key="notif_older"):
+            last = logs[-1]
+            try:
+                older, state["has_more"] = _fetch_page(
+                    actions, (last["created_at"], last["id"]), page_size)
+            except Exception as e:
+                st.error(f"❌ Could not load notifications: {e}")
+                return
+            state["logs"] = logs + older
+            state["new_ids"] = set()
+            st.rerun()
@@ -0,0 +1,191 @@
+"""
+OPS Fact Tables — modules/statement/ops_facts.py
+
+One load per period for every OPS report (Reports 1-6). Each report used
+to query ops_documents with its own filters and re-read ops_lines /
+financial_ledger / products in .in_() batches of 100, so R2, R4 and R5
+re-read the same invoices, CNs and payments three times. They now all
+pivot off the same typed frames:
+
+    f = load_period_facts(yf, mf, yt, mt)
+    f["docs"]    one row per non-deleted document in the period
+    f["lines"]   ops_lines of invoice / CN / sample / lot documents
+    f["ledger"]  financial_ledger rows of CN and ADJUSTMENT documents
+
+docs carries `cancelled` (narration starts with "[CANCELLED]" or
+allocation_status is CANCELLED — the Cancel Payment marker) and `rev_del`
+(REV-DEL reversal narration), computed once here so every report applies
+the same rules. Lines and ledger are fetched concurrently after the
+documents; product names come from the master cache. Any failed fetch
+raises, so a partial fact set is never cached.
+
+The money rules — which documents are invoices / credit notes / payments
+and which column holds their amount — live here too (invoice_amounts,
+credit_note_amounts, payment_amounts), and so does the one quantity rule
+(credit_note_qty), so the reports and the AI assistant total things the
+same way.
+
+Facts are cached per (period, data watermark) for at most 10 minutes —
+new documents and every OPS update that stamps updated_at move the
+watermark (see report_cache.data_watermark); the TTL covers the rest.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from anchors.supabase_client import _pool, admin_supabase, fetch_all, fetch_in
+from anchors.master_cache import master_index
+from modules.statement.report_cache import data_watermark
+
+
+_DOC_COLS = ["id", "ops_date", "ops_type", "stock_as", "narration", "allocation_status",
+             "invoice_total", "outstanding_balance", "from_entity_type", "from_entity_id",
+             "to_entity_type", "to_entity_id"]
+_LINE_COLS = ["ops_document_id", "product_id", "sale_qty", "free_qty",
+              "gross_amount", "net_amount"]
+_LEDGER_COLS = ["ops_document_id", "debit", "credit", "gross_amount",
+                "discount_amount", "net_amount"]
+
+# documents whose lines / ledger rows any report reads
+_LINE_KINDS = ("normal", "credit_note", "sample", "lot")
+
+
+def _money(df, cols):
+    for c in cols:
+        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype(float)
+    return df
+
+
+def _frame(rows, cols):
+    return pd.DataFrame(rows, columns=cols) if rows else pd.DataFrame(columns=cols)
+
+
+@st.cache_data(ttl=600, max_entries=8, show_spinner=False)
+def _load_facts(from_iso, to_iso, watermark):
+    docs = _frame(fetch_all(lambda: (
+        admin_supabase.table("ops_documents")
+        .select(", ".join(_DOC_COLS))
+        .eq("is_deleted", False)
+        .gte("ops_date", from_iso)
+        .lt("ops_date", to_iso)
+    ), "Error loading documents"), _DOC_COLS)
+
+    narration = docs["narration"].fillna("").astype(str)
+    docs["cancelled"] = narration.str.startswith("[CANCELLED]") \
+        | (docs["allocation_status"] == "CANCELLED")
+    docs["rev_del"] = narration.str.startswith("REV-DEL")
+    docs["stock_as"] = docs["stock_as"].fillna("")
+    dates = docs["ops_date"].astype(str)
+    docs["year"] = pd.to_numeric(dates.str[:4], errors="coerce").fillna(0).astype(int)
+    docs["month"] = pd.to_numeric(dates.str[5:7], errors="coerce").fillna(0).astype(int)
+    docs = _money(docs, ["invoice_total", "outstanding_balance"])
+
+    live = docs[~docs["cancelled"]]
+    line_ids = live.loc[live["stock_as"].isin(_LINE_KINDS), "id"].tolist()
+    ledger_ids = live.loc[(live["stock_as"] == "credit_note")
+                          | (live["ops_type"] == "ADJUSTMENT"), "id"].tolist()
+
+    # _pool threads carry the script-run context; a failed fetch raises
+    # out of .result(), so a partial fact set is never cached
+    with _pool(2) as pool:
+        lines_f = pool.submit(fetch_in, lambda: admin_supabase.table("ops_lines")
+                              .select("id, " + ", ".join(_LINE_COLS)),
+                              "ops_document_id", line_ids, "Error loading document lines")
+        ledger_f = pool.submit(fetch_in, lambda: admin_supabase.table("financial_ledger")
+                               .select("id, " + ", ".join(_LEDGER_COLS)),
+                               "ops_document_id", ledger_ids, "Error loading ledger")
+        lines = _frame(lines_f.result(), ["id"] + _LINE_COLS)
+        ledger = _frame(ledger_f.result(), ["id"] + _LEDGER_COLS)
+
+    lines = _money(lines, ["sale_qty", "free_qty", "gross_amount", "net_amount"])
+    products = master_index("products")
+    lines["product"] = [
+        (products.get(pid) or {}).get("name") or "Unknown" for pid in lines["product_id"]
+    ]
+    ledger = _money(ledger, ["debit", "credit", "gross_amount", "discount_amount", "net_amount"])
+    return {"docs": docs, "lines": lines, "ledger": ledger}
+
+
+def load_period_facts(yf, mf, yt, mt):
+    """Fact frames for the months (yf, mf) .. (yt, mt) inclusive."""
+    from_date = date(yf, mf, 1)
+    to_date = date(yt + 1, 1, 1) if mt == 12 else date(yt, mt + 1, 1)
+    return _load_facts(from_date.isoformat(), to_date.isoformat(), data_watermark())
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# MONEY RULES
+# Each returns the live (non-cancelled) documents of one kind with their
+# amount columns added. Party: invoices -> to_entity, CN / payments -> from_entity.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _live(f):
+    return f["docs"][~f["docs"]["cancelled"]]
+
+
+def invoice_amounts(f):
+    """
+    Invoices with `gross` and `net`.
+    GROSS = first ops_lines.gross_amount (the document-level gross, stamped
+    identically on EVERY line — so read the FIRST line, never sum, which
+    would inflate by the product count). financial_ledger.debit is the NET
+    (it equals invoice_total), so it must NOT be used for gross.
+    NET = ops_documents.invoice_total (document-level).
+    """
+    live = _live(f)
+    inv = live[live["stock_as"] == "normal"]
+    gross = inv["id"].map(f["lines"].groupby("ops_document_id")["gross_amount"].first()).fillna(0.0)
+    return inv.assign(gross=gross.where(gross > 0, inv["invoice_total"]),
+                      net=inv["invoice_total"])
+
+
+def credit_note_amounts(f):
+    """
+    Credit notes with `amount`.
+    stock_as = "credit_note" catches BOTH stock-movement and financial-only
+    credit notes. The reliable amount is financial_ledger.credit; fall back
+    to ops_lines.net_amount (MAX — the same total is stamped on every line),
+    then invoice_total, if no ledger row.
+    """
+    live = _live(f)
+    cn = live[live["stock_as"] == "credit_note"]
+    credit = cn["id"].map(f["ledger"].groupby("ops_document_id")["credit"].sum()).fillna(0.0)
+    line_net = cn["id"].map(f["lines"].groupby("ops_document_id")["net_amount"].max()) \
+        .fillna(0.0).clip(lower=0.0)
+    amt = credit.where(credit > 0, line_net)
+    return cn.assign(amount=amt.where(amt > 0, cn["invoice_total"]))
+
+
+def payment_amounts(f):
+    """
+    Payments (ops_type ADJUSTMENT) with `gross`, `discount` and `net`.
+    IMPORTANT: a doc with stock_as = "credit_note" is ALWAYS a credit note,
+    even when its ops_type is ADJUSTMENT (financial-only credit notes).
+    Those must NOT count as payments. REV-DEL reversals are skipped too.
+    """
+    live = _live(f)
+    pay = live[(live["ops_type"] == "ADJUSTMENT")
+               & ~live["rev_del"]
+               & (live["stock_as"] != "credit_note")]
+    led = f["ledger"][f["ledger"]["ops_document_id"].isin(pay["id"])]
+    # Prefer explicit gross/discount/net; fall back to credit as net
+    net = led["net_amount"].where(
+        (led["gross_amount"] != 0) | (led["net_amount"] != 0), led["credit"])
+    rec = led.assign(net=net) \
+        .groupby("ops_document_id")[["gross_amount", "discount_amount", "net"]].sum() \
+        .reindex(pay["id"]).fillna(0.0)
+    g, d, n = (rec[c].to_numpy() for c in ("gross_amount", "discount_amount", "net"))
+    return pay.assign(gross=np.where(g > 0, g, n), discount=d, net=n)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# QUANTITY RULES
+# ─────────────────────────────────────────────────────────────────────────────
+
+def credit_note_qty(lines):
+    """Units a credit-note line returns: sale_qty + free_qty (free goods
+    come back too). Invoice lines keep sale and free apart."""
+    return lines["sale_qty"] + lines["free_qty"]
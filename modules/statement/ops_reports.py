@@ -6,6 +6,8 @@ Called from run_reports() in statement_main.py via tab2.
 All reports filter by: User(s) -> Stockist(s) -> Month From/To.
 Documents are matched to stockists by entity_id (invoices: to_entity_id,
 credit notes & payments: from_entity_id). Cancelled payments are excluded.
+All reports pivot off the shared per-period fact frames in
+modules/statement/ops_facts.py, so they apply the same cancelled-doc rules.
 
 Report 1 : Product (rows) x Month -> Invoice qty | Credit Note qty
 Report 2 : Payment | Credit Note (rows) x Month (cols)
@@ -36,9 +38,17 @@ def _mobile_table(df, compact_cols, detail_title_col, uid_prefix='tbl'):
     return components.html(css + body + js, height=max(250, len(rows)*34+120), scrolling=True)
 
 
+import json
 from datetime import date
 from io import BytesIO
 from anchors.supabase_client import admin_supabase, safe_exec
+from anchors.master_cache import master_rows, master_index
+from anchors.pdf_service import frame_rows, chunked_tables, pdf_download_button
+from modules.statement.report_cache import cached_frame
+from modules.statement.ops_facts import (
+    load_period_facts, invoice_amounts, credit_note_amounts, payment_amounts,
+    credit_note_qty,
+)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -74,6 +84,19 @@ def _period_range(yf, mf, yt, mt):
     return result
 
 
+def _generate_gate(key, label, params):
+    """
+    True when the report should render: its Generate button was clicked
+    for exactly these filters, on this or an earlier rerun. Results then
+    come from the report cache, so later widget interactions don't need
+    another click; changing a filter asks for Generate again.
+    """
+    sig = json.dumps(params, sort_keys=True, default=str)
+    if st.button(label, key=f"{key}_btn", type="primary"):
+        st.session_state[f"{key}_generated"] = sig
+    return st.session_state.get(f"{key}_generated") == sig
+
+
 def _safe_float(v):
     try:
         return float(v) if v is not None else 0.0
@@ -85,40 +108,25 @@ def _safe_float(v):
 # DATA LOADERS
 # ─────────────────────────────────────────────────────────────────────────────
 
-@st.cache_data(ttl=300)
 def _load_all_users():
-    rows = safe_exec(
-        admin_supabase.table("users")
-        .select("id, username")
-        .eq("is_active", True)
-        .order("username")
-    ) or []
-    return rows
+    return [{"id": u["id"], "username": u["username"]}
+            for u in master_rows("users") if u.get("is_active")]
 
 
-@st.cache_data(ttl=300)
 def _load_all_cnfs():
-    rows = safe_exec(
-        admin_supabase.table("cnfs")
-        .select("id, name")
-        .eq("is_active", True)
-        .order("name")
-    ) or []
-    return rows
+    return [{"id": c["id"], "name": c["name"]}
+            for c in master_rows("cnfs") if c.get("is_active")]
 
 
 def _load_stockists_for_users(user_ids):
     """Return unique stockists assigned to given user_ids."""
     if not user_ids:
         return []
-    rows = safe_exec(
-        admin_supabase.table("user_stockists")
-        .select("stockist_id, stockists(id, name)")
-        .in_("user_id", user_ids)
-    ) or []
+    users = set(user_ids)
+    names = master_index("stockists")
     seen = {}
-    for r in rows:
-        s = r.get("stockists")
+    for r in master_rows("user_stockists"):
+        s = names.get(r["stockist_id"]) if r["user_id"] in users else None
         if s:
             seen[s["id"]] = s["name"]
     return [{"id": k, "name": v} for k, v in sorted(seen.items(), key=lambda x: x[1])]
@@ -131,15 +139,13 @@ def _load_stockists_for_users(user_ids):
 def _build_pdf(report_title, subtitle, df):
     """
     Generate a formatted A4 / landscape PDF from a DataFrame.
-    Returns bytes ready for st.download_button.
+    Returns bytes — pass it to pdf_download_button via a lambda so it only
+    runs when the user clicks Download.
     """
     from reportlab.lib.pagesizes import A4, landscape
     from reportlab.lib import colors
     from reportlab.lib.units import cm
-    from reportlab.platypus import (
-        SimpleDocTemplate, Table, TableStyle,
-        Paragraph, Spacer,
-    )
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
     buf = BytesIO()
@@ -172,20 +178,8 @@ def _build_pdf(report_title, subtitle, df):
         Spacer(1, 0.2 * cm),
     ]
 
-    # Build table data — flatten MultiIndex columns if present (e.g. pivot_table)
-    df_out = df.reset_index()
-    if isinstance(df_out.columns, pd.MultiIndex):
-        df_out.columns = [
-            " ".join(str(c) for c in col).strip() if isinstance(col, tuple) else str(col)
-            for col in df_out.columns
-        ]
-    headers = list(df_out.columns)
-    rows_data = [headers]
-    for _, row in df_out.iterrows():
-        rows_data.append([
-            "" if pd.isna(v) else (str(int(v)) if isinstance(v, float) and v == int(v) else str(v))
-            for v in row
-        ])
+    rows_data = frame_rows(df)
+    headers = rows_data[0]
 
     # Column widths: first column wider
     usable_w = page_size[0] - 2 * cm
@@ -193,8 +187,7 @@ def _build_pdf(report_title, subtitle, df):
     rest_w   = (usable_w - first_w) / max(len(headers) - 1, 1)
     col_widths = [first_w] + [rest_w] * (len(headers) - 1)
 
-    tbl = Table(rows_data, colWidths=col_widths, repeatRows=1)
-    tbl.setStyle(TableStyle([
+    story.extend(chunked_tables(rows_data, [
         # Header row
         ("BACKGROUND",    (0, 0), (-1, 0), ivy_green),
         ("TEXTCOLOR",     (0, 0), (-1, 0), colors.white),
@@ -212,14 +205,12 @@ def _build_pdf(report_title, subtitle, df):
         ("BOTTOMPADDING", (0, 1), (-1, -1), 3),
         # Total row bold
         ("FONTNAME",      (0, -1), (-1, -1), "Helvetica-Bold"),
-        # Alternating row shading
-        *[("BACKGROUND", (0, i), (-1, i), row_shade)
-          for i in range(2, len(rows_data), 2)],
+        # Alternating row shading (rows 2, 4, 6 …)
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [None, row_shade]),
         # Grid
         ("GRID",          (0, 0), (-1, -1), 0.35, colors.HexColor("#c5ddd8")),
         ("LINEBELOW",     (0, 0), (-1, 0), 1.2, ivy_green),
-    ]))
-    story.append(tbl)
+    ], col_widths=col_widths))
     story.append(Spacer(1, 0.4 * cm))
     story.append(Paragraph(
         f"Generated on {date.today().strftime('%d %b %Y')} -- Ivy Pharmaceuticals",
@@ -335,17 +326,62 @@ def _user_and_stockist_selectors(key, role, current_user_id):
 
 
 
-def _is_cancelled_doc(d):
-    """A payment/doc is cancelled if its narration starts with [CANCELLED]
-    or its allocation_status is CANCELLED. Matches the Cancel Payment marker."""
-    narr = (d.get("narration") or "")
-    return narr.startswith("[CANCELLED]") or (d.get("allocation_status") == "CANCELLED")
-
-
 # ─────────────────────────────────────────────────────────────────────────────
 # REPORT 1 - Product x Month : Invoice qty | Credit Note qty  (per stockist)
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _build_report1(yf, mf, yt, mt, stockist_ids):
+    """Report 1 pivot: Product x (Period, Type) quantities, or a message."""
+    f = load_period_facts(yf, mf, yt, mt)
+    live = f["docs"][~f["docs"]["cancelled"]]
+    periods = _period_range(yf, mf, yt, mt)
+
+    # Invoices: stockist is the recipient (to_entity_id)
+    # Credit notes: stockist is the source (from_entity_id)
+    kinds = pd.concat([
+        live[(live["stock_as"] == "normal")
+             & live["to_entity_id"].isin(stockist_ids)].assign(kind="Invoice"),
+        live[(live["stock_as"] == "credit_note")
+             & live["from_entity_id"].isin(stockist_ids)].assign(kind="Credit Note"),
+    ])
+    if kinds.empty:
+        return "No Invoice / Credit Note documents found for this period."
+
+    lines = f["lines"].drop(columns="id").merge(
+        kinds[["id", "year", "month", "kind"]],
+        left_on="ops_document_id", right_on="id",
+    )
+    if lines.empty:
+        return "No product lines found for the matching documents."
+    lines["Period"] = [_mlabel(y, m) for y, m in zip(lines["year"], lines["month"])]
+
+    # Invoice -> three measures: Inv-Sale, Inv-Free, Inv-Total
+    # Credit Note -> single measure: CN (sale + free, i.e. total returned)
+    inv = lines[lines["kind"] == "Invoice"]
+    cn  = lines[lines["kind"] == "Credit Note"]
+    df_raw = pd.concat([
+        inv.assign(Type="Inv-Sale",  Qty=inv["sale_qty"]),
+        inv.assign(Type="Inv-Free",  Qty=inv["free_qty"]),
+        inv.assign(Type="Inv-Total", Qty=inv["sale_qty"] + inv["free_qty"]),
+        cn.assign(Type="CN",         Qty=credit_note_qty(cn)),
+    ]).rename(columns={"product": "Product"})[["Product", "Period", "Type", "Qty"]]
+
+    period_labels = [_mlabel(y, m) for y, m in periods]
+    # Order within each month: Inv-Sale, Inv-Free, Inv-Total, then CN
+    type_order    = ["Inv-Sale", "Inv-Free", "Inv-Total", "CN"]
+
+    pivot = df_raw.pivot_table(
+        index="Product", columns=["Period", "Type"],
+        values="Qty", aggfunc="sum", fill_value=0,
+    )
+    ordered_cols = [
+        (p, t) for p in period_labels for t in type_order
+        if (p, t) in pivot.columns
+    ]
+    pivot = pivot.reindex(columns=ordered_cols, fill_value=0).astype(int)
+    return pivot
+
+
 def _report1(role, user_id):
     st.markdown("#### Report 1 - Product x Month: Invoice & Credit Note Quantity")
     st.caption(
@@ -361,128 +397,19 @@ def _report1(role, user_id):
     if not stockist_ids:
         return
 
-    if not st.button("Generate Report 1", key="r1_btn", type="primary"):
+    params = {"period": [yf, mf, yt, mt], "stockists": sorted(stockist_ids)}
+    if not _generate_gate("r1", "Generate Report 1", params):
         return
 
-    with st.spinner("Fetching data..."):
-        from_date = date(yf, mf, 1)
-        to_date   = date(yt, 12, 31) if mt == 12 else date(yt, mt + 1, 1)
-        periods   = _period_range(yf, mf, yt, mt)
-        period_set = {(y, m) for y, m in periods}
-
-        # Invoices: stockist is the recipient (to_entity_id)
-        inv_docs = safe_exec(
-            admin_supabase.table("ops_documents")
-            .select("id, ops_date, stock_as, narration, allocation_status, to_entity_id")
-            .eq("stock_as", "normal")
-            .eq("is_deleted", False)
-            .in_("to_entity_id", stockist_ids)
-            .gte("ops_date", from_date.isoformat())
-            .lt("ops_date", to_date.isoformat())
-        ) or []
-
-        # Credit notes: stockist is the source (from_entity_id)
-        cn_docs = safe_exec(
-            admin_supabase.table("ops_documents")
-            .select("id, ops_date, stock_as, narration, allocation_status, from_entity_id")
-            .eq("stock_as", "credit_note")
-            .eq("is_deleted", False)
-            .in_("from_entity_id", stockist_ids)
-            .gte("ops_date", from_date.isoformat())
-            .lt("ops_date", to_date.isoformat())
-        ) or []
-
-        # Drop cancelled, build id -> (period, kind)
-        doc_info = {}
-        for d in inv_docs:
-            if _is_cancelled_doc(d):
-                continue
-            y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-            if (y, mo) in period_set:
-                doc_info[d["id"]] = ((y, mo), "Invoice")
-        for d in cn_docs:
-            if _is_cancelled_doc(d):
-                continue
-            y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-            if (y, mo) in period_set:
-                doc_info[d["id"]] = ((y, mo), "Credit Note")
-
-        if not doc_info:
-            st.info("No Invoice / Credit Note documents found for this period.")
-            return
-
-        doc_ids = list(doc_info.keys())
-
-        # Lines (quantity) — chunk the .in_() to avoid oversized requests
-        lines_raw = []
-        for i in range(0, len(doc_ids), 100):
-            batch = doc_ids[i:i + 100]
-            lines_raw += safe_exec(
-                admin_supabase.table("ops_lines")
-                .select("ops_document_id, sale_qty, free_qty, product_id")
-                .in_("ops_document_id", batch)
-            ) or []
-
-        if not lines_raw:
-            st.info("No product lines found for the matching documents.")
-            return
-
-        # Product names
-        prod_ids = list({ln["product_id"] for ln in lines_raw if ln.get("product_id")})
-        prod_map = {}
-        for i in range(0, len(prod_ids), 100):
-            batch = prod_ids[i:i + 100]
-            prows = safe_exec(
-                admin_supabase.table("products").select("id, name").in_("id", batch)
-            ) or []
-            for p in prows:
-                prod_map[p["id"]] = p["name"]
-
-        # Aggregate: (product, period, column_label) -> qty
-        # Invoice -> three measures: Inv-Sale, Inv-Free, Inv-Total
-        # Credit Note -> single measure: CN (sale + free, i.e. total returned)
-        agg = {}
-        for ln in lines_raw:
-            info = doc_info.get(ln["ops_document_id"])
-            if not info:
-                continue
-            (y, mo), kind = info
-            product = prod_map.get(ln.get("product_id"), "Unknown")
-            sale = _safe_float(ln.get("sale_qty"))
-            free = _safe_float(ln.get("free_qty"))
-            if kind == "Invoice":
-                for measure, val in (("Inv-Sale", sale),
-                                     ("Inv-Free", free),
-                                     ("Inv-Total", sale + free)):
-                    k = (product, y, mo, measure)
-                    agg[k] = agg.get(k, 0.0) + val
-            else:  # Credit Note
-                k = (product, y, mo, "CN")
-                agg[k] = agg.get(k, 0.0) + (sale + free)
-
-    if not agg:
-        st.info("No data to display after aggregation.")
+    try:
+        with st.spinner("Fetching data..."):
+            pivot = cached_frame("r1", params, lambda: _build_report1(yf, mf, yt, mt, stockist_ids))
+    except RuntimeError as e:
+        st.error(f"❌ Could not build the report: {e}")
+        return
+    if not isinstance(pivot, pd.DataFrame):
+        st.info(pivot)
         return
-
-    rows_list = [
-        {"Product": p, "Period": _mlabel(y, mo), "Type": t, "Qty": v}
-        for (p, y, mo, t), v in agg.items()
-    ]
-    df_raw = pd.DataFrame(rows_list)
-
-    period_labels = [_mlabel(y, m) for y, m in periods]
-    # Order within each month: Inv-Sale, Inv-Free, Inv-Total, then CN
-    type_order    = ["Inv-Sale", "Inv-Free", "Inv-Total", "CN"]
-
-    pivot = df_raw.pivot_table(
-        index="Product", columns=["Period", "Type"],
-        values="Qty", aggfunc="sum", fill_value=0,
-    )
-    ordered_cols = [
-        (p, t) for p in period_labels for t in type_order
-        if (p, t) in pivot.columns
-    ]
-    pivot = pivot.reindex(columns=ordered_cols, fill_value=0).astype(int)
 
     # Flatten for mobile table
     pivot_flat = pivot.copy()
@@ -498,11 +425,11 @@ def _report1(role, user_id):
 
     subtitle  = (f"Stockists: {stockist_label}  |  "
                  f"Period: {_mlabel(yf, mf)} - {_mlabel(yt, mt)}")
-    pdf_bytes = _build_pdf("Report 1 - Product x Month (Invoice / Credit Note Qty)", subtitle, pivot)
-    st.download_button(
-        "Download PDF", data=pdf_bytes,
-        file_name="r1_product_month_qty.pdf",
-        mime="application/pdf", key="r1_pdf",
+    title = "Report 1 - Product x Month (Invoice / Credit Note Qty)"
+    pdf_download_button(
+        "Download PDF", lambda: _build_pdf(title, subtitle, pivot),
+        (title, subtitle, pivot),
+        file_name="r1_product_month_qty.pdf", key="r1_pdf",
     )
 
 
@@ -511,6 +438,49 @@ def _report1(role, user_id):
 # Layout: rows = metrics, columns = months  (transposed)
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _build_financial_matrix(row_specs, yf, mf, yt, mt, stockist_ids):
+    """Metrics (rows) x months (cols) + TOTAL for _stockist_financial_matrix."""
+    f = load_period_facts(yf, mf, yt, mt)
+    periods  = _period_range(yf, mf, yt, mt)
+    row_keys = [rk for rk, _ in row_specs]
+    parts = []   # frames with year, month, key, amount
+
+    # ---- Invoices (to_entity_id = stockist) ----
+    if any(k in row_keys for k in ("INVOICE_GROSS", "INVOICE_NET")):
+        inv = invoice_amounts(f)
+        inv = inv[inv["to_entity_id"].isin(stockist_ids)]
+        parts.append(inv.assign(key="INVOICE_GROSS", amount=inv["gross"]))
+        parts.append(inv.assign(key="INVOICE_NET", amount=inv["net"]))
+
+    # ---- Credit notes (from_entity_id = stockist) ----
+    if "CREDIT_NOTE" in row_keys:
+        cn = credit_note_amounts(f)
+        cn = cn[cn["from_entity_id"].isin(stockist_ids)]
+        parts.append(cn.assign(key="CREDIT_NOTE"))
+
+    # ---- Payments (from_entity_id = stockist) ----
+    if any(k in row_keys for k in ("PAYMENT_GROSS", "PAYMENT_DISCOUNT", "PAYMENT_NET")):
+        pay = payment_amounts(f)
+        pay = pay[pay["from_entity_id"].isin(stockist_ids)]
+        parts.append(pay.assign(key="PAYMENT_GROSS", amount=pay["gross"]))
+        parts.append(pay.assign(key="PAYMENT_DISCOUNT", amount=pay["discount"]))
+        parts.append(pay.assign(key="PAYMENT_NET", amount=pay["net"]))
+
+    agg = {}
+    if parts:
+        agg = pd.concat(parts).groupby(["key", "year", "month"])["amount"].sum().to_dict()
+
+    # Build DataFrame: rows = metrics, columns = months
+    period_labels = [_mlabel(y, m) for y, m in periods]
+    data = {}
+    for rk, rl in row_specs:
+        data[rl] = [round(float(agg.get((rk, y, m), 0.0)), 2) for y, m in periods]
+    df = pd.DataFrame(data, index=period_labels).T  # metrics as rows, months as cols
+    df.columns = period_labels
+    df["TOTAL"] = df.sum(axis=1)
+    return df
+
+
 def _stockist_financial_matrix(key, role, user_id, row_specs, report_title):
     """
     row_specs: ordered list of (row_key, row_label).
@@ -528,176 +498,18 @@ def _stockist_financial_matrix(key, role, user_id, row_specs, report_title):
     if not stockist_ids:
         return
 
-    if not st.button(f"Generate {report_title.split('-')[0].strip()}", key=f"{key}_btn", type="primary"):
+    params = {"rows": [rk for rk, _ in row_specs], "period": [yf, mf, yt, mt],
+              "stockists": sorted(stockist_ids)}
+    if not _generate_gate(key, f"Generate {report_title.split('-')[0].strip()}", params):
         return
 
-    with st.spinner("Fetching data..."):
-        from_date = date(yf, mf, 1)
-        to_date   = date(yt, 12, 31) if mt == 12 else date(yt, mt + 1, 1)
-        periods   = _period_range(yf, mf, yt, mt)
-        period_set = {(y, m) for y, m in periods}
-        row_keys = [rk for rk, _ in row_specs]
-
-        need_invoice = any(k in row_keys for k in ("INVOICE_GROSS", "INVOICE_NET"))
-        need_cn      = "CREDIT_NOTE" in row_keys
-        need_payment = any(k in row_keys for k in ("PAYMENT_GROSS", "PAYMENT_DISCOUNT", "PAYMENT_NET"))
-
-        agg = {(y, m): {rk: 0.0 for rk, _ in row_specs} for y, m in periods}
-
-        # ---- Invoices (to_entity_id = stockist) ----
-        if need_invoice:
-            inv_docs = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("id, ops_date, stock_as, narration, allocation_status, invoice_total, to_entity_id")
-                .eq("stock_as", "normal").eq("is_deleted", False)
-                .in_("to_entity_id", stockist_ids)
-                .gte("ops_date", from_date.isoformat())
-                .lt("ops_date", to_date.isoformat())
-            ) or []
-            inv_docs = [d for d in inv_docs if not _is_cancelled_doc(d)]
-            inv_ids  = [d["id"] for d in inv_docs]
-
-            # GROSS = first ops_lines.gross_amount (the document-level gross,
-            # stamped identically on EVERY line — so read the FIRST line, never
-            # sum, which would inflate by the product count). financial_ledger
-            # .debit is the NET (it equals invoice_total), so it must NOT be used
-            # for gross. NET = ops_documents.invoice_total (document-level).
-            inv_gross = {}
-            for i in range(0, len(inv_ids), 100):
-                batch = inv_ids[i:i + 100]
-                for row in (safe_exec(
-                    admin_supabase.table("ops_lines")
-                    .select("ops_document_id, gross_amount")
-                    .in_("ops_document_id", batch)
-                ) or []):
-                    oid = row["ops_document_id"]
-                    if oid not in inv_gross:          # first line per invoice
-                        inv_gross[oid] = _safe_float(row.get("gross_amount"))
-            for d in inv_docs:
-                y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-                if (y, mo) not in period_set:
-                    continue
-                if "INVOICE_GROSS" in row_keys:
-                    g = inv_gross.get(d["id"], 0.0)
-                    if g <= 0:
-                        g = _safe_float(d.get("invoice_total"))
-                    agg[(y, mo)]["INVOICE_GROSS"] += g
-                if "INVOICE_NET" in row_keys:
-                    agg[(y, mo)]["INVOICE_NET"] += _safe_float(d.get("invoice_total"))
-
-        # ---- Credit notes (from_entity_id = stockist) ----
-        # stock_as = "credit_note" catches BOTH stock-movement and financial-only
-        # credit notes. The reliable amount is financial_ledger.credit (this is the
-        # same figure that was previously (wrongly) landing in the Payment row).
-        # Fall back to ops_lines.net_amount, then invoice_total, if no ledger row.
-        if need_cn:
-            cn_docs = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("id, ops_date, stock_as, narration, allocation_status, invoice_total, from_entity_id")
-                .eq("stock_as", "credit_note").eq("is_deleted", False)
-                .in_("from_entity_id", stockist_ids)
-                .gte("ops_date", from_date.isoformat())
-                .lt("ops_date", to_date.isoformat())
-            ) or []
-            cn_docs = [d for d in cn_docs if not _is_cancelled_doc(d)]
-            cn_ids  = [d["id"] for d in cn_docs]
-
-            # Primary source: financial_ledger.credit (one figure per CN)
-            cn_ledger = {}
-            for i in range(0, len(cn_ids), 100):
-                batch = cn_ids[i:i + 100]
-                for row in (safe_exec(
-                    admin_supabase.table("financial_ledger")
-                    .select("ops_document_id, credit")
-                    .in_("ops_document_id", batch)
-                ) or []):
-                    oid = row["ops_document_id"]
-                    cn_ledger[oid] = cn_ledger.get(oid, 0.0) + _safe_float(row.get("credit"))
-
-            # Fallback source: ops_lines.net_amount. The same document total is
-            # stamped on every line, so take MAX (the single true total), not SUM,
-            # to avoid inflating by product count.
-            cn_net = {}
-            for i in range(0, len(cn_ids), 100):
-                batch = cn_ids[i:i + 100]
-                for ln in (safe_exec(
-                    admin_supabase.table("ops_lines")
-                    .select("ops_document_id, net_amount")
-                    .in_("ops_document_id", batch)
-                ) or []):
-                    oid = ln["ops_document_id"]
-                    val = _safe_float(ln.get("net_amount"))
-                    cn_net[oid] = max(cn_net.get(oid, 0.0), val)
-
-            for d in cn_docs:
-                y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-                if (y, mo) not in period_set:
-                    continue
-                amt = cn_ledger.get(d["id"], 0.0)
-                if amt <= 0:
-                    amt = cn_net.get(d["id"], 0.0)
-                if amt <= 0:
-                    amt = _safe_float(d.get("invoice_total"))
-                agg[(y, mo)]["CREDIT_NOTE"] += amt
-
-        # ---- Payments (from_entity_id = stockist, ops_type ADJUSTMENT) ----
-        # IMPORTANT: a doc with stock_as = "credit_note" is ALWAYS a credit note,
-        # even when its ops_type is ADJUSTMENT (financial-only credit notes).
-        # Those must NOT count as payments — they belong only to the Credit Note row.
-        if need_payment:
-            pay_docs = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("id, ops_date, ops_type, stock_as, narration, allocation_status, from_entity_id")
-                .eq("ops_type", "ADJUSTMENT").eq("is_deleted", False)
-                .in_("from_entity_id", stockist_ids)
-                .gte("ops_date", from_date.isoformat())
-                .lt("ops_date", to_date.isoformat())
-            ) or []
-            # Exclude cancelled, REV-DEL reversals, AND any credit-note docs
-            pay_docs = [d for d in pay_docs
-                        if not _is_cancelled_doc(d)
-                        and not (d.get("narration") or "").startswith("REV-DEL")
-                        and (d.get("stock_as") or "") != "credit_note"]
-            pay_ids  = [d["id"] for d in pay_docs]
-            pay_amt  = {}  # ops_document_id -> {gross, discount, net}
-            for i in range(0, len(pay_ids), 100):
-                batch = pay_ids[i:i + 100]
-                for row in (safe_exec(
-                    admin_supabase.table("financial_ledger")
-                    .select("ops_document_id, gross_amount, discount_amount, net_amount, credit")
-                    .in_("ops_document_id", batch)
-                ) or []):
-                    oid = row["ops_document_id"]
-                    rec = pay_amt.setdefault(oid, {"gross": 0.0, "discount": 0.0, "net": 0.0})
-                    # Prefer explicit gross/discount/net; fall back to credit as net
-                    g = _safe_float(row.get("gross_amount"))
-                    dsc = _safe_float(row.get("discount_amount"))
-                    n = _safe_float(row.get("net_amount"))
-                    if g == 0 and n == 0:
-                        n = _safe_float(row.get("credit"))
-                    rec["gross"]    += g
-                    rec["discount"] += dsc
-                    rec["net"]      += n
-            for d in pay_docs:
-                y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-                if (y, mo) not in period_set:
-                    continue
-                rec = pay_amt.get(d["id"], {"gross": 0.0, "discount": 0.0, "net": 0.0})
-                if "PAYMENT_GROSS" in row_keys:
-                    agg[(y, mo)]["PAYMENT_GROSS"] += rec["gross"] if rec["gross"] > 0 else rec["net"]
-                if "PAYMENT_DISCOUNT" in row_keys:
-                    agg[(y, mo)]["PAYMENT_DISCOUNT"] += rec["discount"]
-                if "PAYMENT_NET" in row_keys:
-                    agg[(y, mo)]["PAYMENT_NET"] += rec["net"]
-
-    # Build DataFrame: rows = metrics, columns = months
-    period_labels = [_mlabel(y, m) for y, m in periods]
-    data = {}
-    for rk, rl in row_specs:
-        data[rl] = [round(agg[(y, m)][rk], 2) for y, m in periods]
-    df = pd.DataFrame(data, index=period_labels).T  # metrics as rows, months as cols
-    df.columns = period_labels
-    df["TOTAL"] = df.sum(axis=1)
+    try:
+        with st.spinner("Fetching data..."):
+            df = cached_frame(key, params, lambda: _build_financial_matrix(
+                row_specs, yf, mf, yt, mt, stockist_ids))
+    except RuntimeError as e:
+        st.error(f"❌ Could not build the report: {e}")
+        return
 
     df_display = df.reset_index().rename(columns={"index": "Metric"})
     first_col = df_display.columns[0]
@@ -710,11 +522,10 @@ def _stockist_financial_matrix(key, role, user_id, row_specs, report_title):
 
     subtitle  = (f"Stockists: {stockist_label}  |  "
                  f"Period: {_mlabel(yf, mf)} - {_mlabel(yt, mt)}")
-    pdf_bytes = _build_pdf(report_title, subtitle, df)
-    st.download_button(
-        "Download PDF", data=pdf_bytes,
-        file_name=f"{key}_matrix.pdf",
-        mime="application/pdf", key=f"{key}_pdf",
+    pdf_download_button(
+        "Download PDF", lambda: _build_pdf(report_title, subtitle, df),
+        (report_title, subtitle, df),
+        file_name=f"{key}_matrix.pdf", key=f"{key}_pdf",
     )
 
 
@@ -822,6 +633,59 @@ def _user_only_selector(key, role, current_user_id):
 #   Sample/Lot        -> directly to the selected users (Company/CNF -> User)
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _build_report6(yf, mf, yt, mt, sel_user_ids, stockist_ids):
+    """Report 6 flat frame: Product + "<month> <measure>" columns, or a message."""
+    f = load_period_facts(yf, mf, yt, mt)
+    live = f["docs"][~f["docs"]["cancelled"]]
+    periods = _period_range(yf, mf, yt, mt)
+
+    # Invoices (saleable + free) to, and credit notes from, the allotted
+    # stockists; samples & lots directly TO the selected users
+    sl = live[live["stock_as"].isin(["sample", "lot"]) & live["to_entity_id"].isin(sel_user_ids)]
+    kinds = pd.concat([
+        live[(live["stock_as"] == "normal")
+             & live["to_entity_id"].isin(stockist_ids)].assign(kind="INVOICE"),
+        live[(live["stock_as"] == "credit_note")
+             & live["from_entity_id"].isin(stockist_ids)].assign(kind="CN"),
+        sl.assign(kind=sl["stock_as"].str.upper()),          # SAMPLE / LOT
+    ])
+    if kinds.empty:
+        return "No stock movement found for this period."
+
+    ln = f["lines"].drop(columns="id").merge(
+        kinds[["id", "year", "month", "kind"]],
+        left_on="ops_document_id", right_on="id",
+    )
+    if ln.empty:
+        return "No product lines found for the matching documents."
+
+    sale, free, kind = ln["sale_qty"], ln["free_qty"], ln["kind"]
+    ln["Saleable"]    = sale.where(kind == "INVOICE", 0.0)
+    ln["Free"]        = free.where(kind == "INVOICE", 0.0)
+    ln["Sample"]      = sale.where(kind == "SAMPLE", 0.0)     # sample/lot has no free
+    ln["Lot"]         = sale.where(kind == "LOT", 0.0)
+    ln["Credit Note"] = credit_note_qty(ln).where(kind == "CN", 0.0)
+
+    measures = ["Saleable", "Free", "Sample", "Lot", "Credit Note"]
+    products = sorted(ln["product"].unique())
+    cell = ln.groupby(["product", "year", "month"])[measures].sum().reindex(
+        pd.MultiIndex.from_tuples([(p, y, m) for p in products for y, m in periods]),
+        fill_value=0.0,
+    )
+    cell["Total (excl CN)"] = cell["Saleable"] + cell["Free"] + cell["Sample"] + cell["Lot"]
+    cell["Net"] = cell["Total (excl CN)"] - cell["Credit Note"]
+
+    # Column order per month
+    sub_order = ["Saleable", "Free", "Sample", "Lot", "Credit Note",
+                 "Total (excl CN)", "Net"]
+    values = cell[sub_order].to_numpy().reshape(len(products), -1).astype(int)
+    df = pd.DataFrame(values, columns=[
+        f"{_mlabel(y, m)} {sub}" for y, m in periods for sub in sub_order
+    ])
+    df.insert(0, "Product", products)
+    return df
+
+
 def _report6(role, user_id):
     st.markdown("#### Report 6 - Stock Movement: Product x Month (by User)")
     st.caption(
@@ -842,162 +706,21 @@ def _report6(role, user_id):
     avail_stockists = _load_stockists_for_users(sel_user_ids)
     stockist_ids = [s["id"] for s in avail_stockists]
 
-    if not st.button("Generate Report 6", key="r6_btn", type="primary"):
+    params = {"period": [yf, mf, yt, mt], "users": sorted(sel_user_ids),
+              "stockists": sorted(stockist_ids)}
+    if not _generate_gate("r6", "Generate Report 6", params):
         return
 
-    with st.spinner("Fetching data..."):
-        from_date = date(yf, mf, 1)
-        to_date   = date(yt, 12, 31) if mt == 12 else date(yt, mt + 1, 1)
-        periods   = _period_range(yf, mf, yt, mt)
-        period_set = {(y, m) for y, m in periods}
-
-        # ---- Invoices (saleable + free) — to the allotted stockists ----
-        inv_docs = []
-        if stockist_ids:
-            inv_docs = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("id, ops_date, stock_as, narration, allocation_status, to_entity_id")
-                .eq("stock_as", "normal").eq("is_deleted", False)
-                .in_("to_entity_id", stockist_ids)
-                .gte("ops_date", from_date.isoformat())
-                .lt("ops_date", to_date.isoformat())
-            ) or []
-            inv_docs = [d for d in inv_docs if not _is_cancelled_doc(d)]
-
-        # ---- Credit notes — from the allotted stockists ----
-        cn_docs = []
-        if stockist_ids:
-            cn_docs = safe_exec(
-                admin_supabase.table("ops_documents")
-                .select("id, ops_date, stock_as, narration, allocation_status, from_entity_id")
-                .eq("stock_as", "credit_note").eq("is_deleted", False)
-                .in_("from_entity_id", stockist_ids)
-                .gte("ops_date", from_date.isoformat())
-                .lt("ops_date", to_date.isoformat())
-            ) or []
-            cn_docs = [d for d in cn_docs if not _is_cancelled_doc(d)]
-
-        # ---- Samples & Lots — directly TO the selected users ----
-        sl_docs = safe_exec(
-            admin_supabase.table("ops_documents")
-            .select("id, ops_date, stock_as, narration, allocation_status, to_entity_id")
-            .in_("stock_as", ["sample", "lot"]).eq("is_deleted", False)
-            .in_("to_entity_id", sel_user_ids)
-            .gte("ops_date", from_date.isoformat())
-            .lt("ops_date", to_date.isoformat())
-        ) or []
-        sl_docs = [d for d in sl_docs if not _is_cancelled_doc(d)]
-
-        # Map each doc id -> (period, kind)
-        doc_kind = {}
-        for d in inv_docs:
-            y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-            if (y, mo) in period_set:
-                doc_kind[d["id"]] = ((y, mo), "INVOICE")
-        for d in cn_docs:
-            y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-            if (y, mo) in period_set:
-                doc_kind[d["id"]] = ((y, mo), "CN")
-        for d in sl_docs:
-            y, mo = int(d["ops_date"][:4]), int(d["ops_date"][5:7])
-            if (y, mo) in period_set:
-                doc_kind[d["id"]] = ((y, mo), (d.get("stock_as") or "").upper())  # SAMPLE / LOT
-
-        if not doc_kind:
-            st.info("No stock movement found for this period.")
-            return
-
-        all_ids = list(doc_kind.keys())
-
-        # Lines — chunked
-        lines_raw = []
-        for i in range(0, len(all_ids), 100):
-            batch = all_ids[i:i + 100]
-            lines_raw += safe_exec(
-                admin_supabase.table("ops_lines")
-                .select("ops_document_id, sale_qty, free_qty, product_id")
-                .in_("ops_document_id", batch)
-            ) or []
-
-        if not lines_raw:
-            st.info("No product lines found for the matching documents.")
-            return
-
-        # Product names
-        prod_ids = list({ln["product_id"] for ln in lines_raw if ln.get("product_id")})
-        prod_map = {}
-        for i in range(0, len(prod_ids), 100):
-            batch = prod_ids[i:i + 100]
-            for p in (safe_exec(
-                admin_supabase.table("products").select("id, name").in_("id", batch)
-            ) or []):
-                prod_map[p["id"]] = p["name"]
-
-        # Aggregate: (product, period, measure) -> qty
-        agg = {}
-        def _add(product, ym, measure, val):
-            k = (product, ym, measure)
-            agg[k] = agg.get(k, 0.0) + val
-
-        for ln in lines_raw:
-            info = doc_kind.get(ln["ops_document_id"])
-            if not info:
-                continue
-            ym, kind = info
-            product = prod_map.get(ln.get("product_id"), "Unknown")
-            sale = _safe_float(ln.get("sale_qty"))
-            free = _safe_float(ln.get("free_qty"))
-            if kind == "INVOICE":
-                _add(product, ym, "Saleable", sale)
-                _add(product, ym, "Free", free)
-            elif kind == "SAMPLE":
-                _add(product, ym, "Sample", sale)        # sample/lot has no free
-            elif kind == "LOT":
-                _add(product, ym, "Lot", sale)
-            elif kind == "CN":
-                _add(product, ym, "CreditNote", sale + free)
-
-    if not agg:
-        st.info("No data to display after aggregation.")
+    try:
+        with st.spinner("Fetching data..."):
+            df = cached_frame("r6", params, lambda: _build_report6(
+                yf, mf, yt, mt, sel_user_ids, stockist_ids))
+    except RuntimeError as e:
+        st.error(f"❌ Could not build the report: {e}")
+        return
+    if not isinstance(df, pd.DataFrame):
+        st.info(df)
         return
-
-    # Build per-(product, period) measure dict, then compute totals
-    measures = ["Saleable", "Free", "Sample", "Lot", "CreditNote"]
-    cell = {}  # (product, period_label) -> {measure: qty}
-    products = set()
-    for (product, (y, mo), measure), val in agg.items():
-        plabel = _mlabel(y, mo)
-        products.add(product)
-        cell.setdefault((product, plabel), {m: 0.0 for m in measures})
-        cell[(product, plabel)][measure] += val
-
-    period_labels = [_mlabel(y, m) for y, m in periods]
-    # Column order per month
-    sub_order = ["Saleable", "Free", "Sample", "Lot", "Credit Note",
-                 "Total (excl CN)", "Net"]
-
-    # Build a flat row per product with all month*subcol values
-    rows = []
-    for product in sorted(products):
-        row = {"Product": product}
-        for plabel in period_labels:
-            c = cell.get((product, plabel), {m: 0.0 for m in measures})
-            total_excl = c["Saleable"] + c["Free"] + c["Sample"] + c["Lot"]
-            net = total_excl - c["CreditNote"]
-            vals = {
-                "Saleable":        c["Saleable"],
-                "Free":            c["Free"],
-                "Sample":          c["Sample"],
-                "Lot":             c["Lot"],
-                "Credit Note":     c["CreditNote"],
-                "Total (excl CN)": total_excl,
-                "Net":             net,
-            }
-            for sub in sub_order:
-                row[f"{plabel} {sub}"] = int(vals[sub])
-        rows.append(row)
-
-    df = pd.DataFrame(rows)
 
     _mobile_table(
         df,
@@ -1009,11 +732,12 @@ def _report6(role, user_id):
     subtitle = (f"Users: {user_label}  |  Stockists allotted: {len(stockist_ids)}  |  "
                 f"Period: {_mlabel(yf, mf)} - {_mlabel(yt, mt)}")
     # PDF uses the same flat frame (Product as index)
-    pdf_bytes = _build_pdf("Report 6 - Stock Movement (by User)", subtitle, df.set_index("Product"))
-    st.download_button(
-        "Download PDF", data=pdf_bytes,
-        file_name="r6_stock_movement.pdf",
-        mime="application/pdf", key="r6_pdf",
+    title = "Report 6 - Stock Movement (by User)"
+    pdf_frame = df.set_index("Product")
+    pdf_download_button(
+        "Download PDF", lambda: _build_pdf(title, subtitle, pdf_frame),
+        (title, subtitle, pdf_frame),
+        file_name="r6_stock_movement.pdf", key="r6_pdf",
     )
 
 
@@ -1022,7 +746,7 @@ def _report6(role, user_id):
 # ─────────────────────────────────────────────────────────────────────────────
 
 def run_ops_reports():
-    """Entry point. Renders sub-tabs inside the OPS Reports tab."""
+    """Entry point. Renders the selected OPS report."""
     user_id = st.session_state.auth_user.id
     role    = st.session_state.get("role", "user")
 
@@ -1030,21 +754,18 @@ def run_ops_reports():
     if role != "admin":
         st.caption("You can see data for your own stockists only.")
 
-    tabs = st.tabs([
-        "R1 - Product x Month",
-        "R2 - Payment & Credit Note",
-        "R4 - Gross Invoice & Credit Note",
-        "R5 - Full Financial Summary",
-        "R6 - Stock Movement",
-    ])
-
-    with tabs[0]:
-        _report1(role, user_id)
-    with tabs[1]:
-        _report2(role, user_id)
-    with tabs[2]:
-        _report4(role, user_id)
-    with tabs[3]:
-        _report5(role, user_id)
-    with tabs[4]:
-        _report6(role, user_id)
+    # Only the selected report runs (st.tabs would run all five bodies —
+    # selectors and their queries included — on every rerun).
+    reports = {
+        "R1 - Product x Month":            _report1,
+        "R2 - Payment & Credit Note":      _report2,
+        "R4 - Gross Invoice & Credit Note": _report4,
+        "R5 - Full Financial Summary":     _report5,
+        "R6 - Stock Movement":             _report6,
+    }
+    names = list(reports)
+    choice = st.segmented_control(
+        "OPS Report", names, default=names[0],
+        key="ops_reports_view", label_visibility="collapsed",
+    ) or names[0]
+    reports[choice](role, user_id)
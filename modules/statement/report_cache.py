@@ -0,0 +1,137 @@
+"""
+Report Result Cache — modules/statement/report_cache.py
+
+Aggregated OPS report frames (Reports 1-6) stored as Parquet on local disk,
+shared by every session on the instance. Month-end review means many
+managers generating the same 12-month reports; each Generate used to
+refetch ops_documents / ops_lines / financial_ledger and re-aggregate.
+
+    cached_frame("r1", params, build)   -> DataFrame (from disk or build())
+
+Key = sha1 of (report id, params, data watermark, age bucket). params
+holds the period and the sorted stockist / user ids. The watermark is the
+newest ops_documents.created_at / updated_at, so it only moves for writes
+that stamp updated_at — every ops_documents update in OPS does (soft
+deletes, invoice totals, payment / allocation status, cancel narration,
+money_integrity recomputes). A write that doesn't (another tool, a manual
+SQL fix, ledger-only changes) is covered by the age bucket: keys roll over
+every _MAX_AGE seconds, so no entry is served longer than that. Older
+entries simply stop matching and age out. The watermark is polled at most
+once per _WATERMARK_POLL seconds per process.
+
+Eviction is LRU by file mtime (touched on every hit) once the directory
+grows past _MAX_BYTES. REPORT_CACHE_DIR overrides the location.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from anchors.supabase_client import admin_supabase
+
+
+_CACHE_DIR = os.environ.get("REPORT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "ops_report_cache")
+_MAX_BYTES = 256 * 1024 * 1024
+_WATERMARK_POLL = 30    # seconds
+_MAX_AGE = 15 * 60      # seconds — backstop for writes that miss updated_at
+
+_lock = threading.Lock()
+_watermark = (None, 0.0)   # (value, polled_at)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# WATERMARK
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _latest(column):
+    try:
+        rows = admin_supabase.table("ops_documents") \
+            .select(column) \
+            .not_.is_(column, "null") \
+            .order(column, desc=True) \
+            .limit(1) \
+            .execute().data
+    except Exception:
+        return ""
+    return (rows[0].get(column) or "") if rows else ""
+
+
+def data_watermark():
+    """Newest ops_documents created_at / updated_at (rate-limited)."""
+    global _watermark
+    with _lock:
+        value, polled_at = _watermark
+        if value is None or time.time() - polled_at >= _WATERMARK_POLL:
+            value = f"{_latest('created_at')}|{_latest('updated_at')}"
+            _watermark = (value, time.time())
+        return value
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# STORE
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _path(report_id, params):
+    bucket = int(time.time() // _MAX_AGE)
+    raw = json.dumps([report_id, params, data_watermark(), bucket], sort_keys=True, default=str)
+    return os.path.join(_CACHE_DIR, f"{report_id}_{hashlib.sha1(raw.encode()).hexdigest()}.parquet")
+
+
+def _evict(keep):
+    """Drop least-recently-used entries (never `keep`) until the store fits
+    _MAX_BYTES."""
+    try:
+        entries = []
+        for name in os.listdir(_CACHE_DIR):
+            p = os.path.join(_CACHE_DIR, name)
+            info = os.stat(p)
+            entries.append((info.st_mtime, info.st_size, p))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+        if total <= _MAX_BYTES:
+            break
+        if p == keep:
+            continue
+        try:
+            os.remove(p)
+            total -= size
+        except OSError:
+            pass
+
+
+def cached_frame(report_id, params, build):
+    """
+    Return the report frame for (report_id, params) at the current
+    watermark, calling build() only on a miss. build() may return a
+    non-DataFrame (e.g. a "no data" message) — that is passed through and
+    not cached. A cache that cannot be read or written never stops the
+    report; it just rebuilds.
+    """
+    path = _path(report_id, params)
+    if os.path.exists(path):
+        try:
+            df = pd.read_parquet(path)
+            os.utime(path)
+            return df
+        except Exception:
+            pass
+
+    result = build()
+    if isinstance(result, pd.DataFrame):
+        try:
+            os.makedirs(_CACHE_DIR, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            result.to_parquet(tmp)
+            os.replace(tmp, path)
+            _evict(path)
+        except Exception:
+            pass
+    return result
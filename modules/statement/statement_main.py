@@ -22,53 +22,94 @@ def _mobile_table(df, compact_cols, detail_title_col, uid_prefix='tbl'):
     return components.html(css + body + js, height=max(250, len(rows)*34+120), scrolling=True)
 
 from datetime import datetime, date, timedelta
-from anchors.supabase_client import supabase, admin_supabase, safe_exec
+from anchors.supabase_client import supabase, admin_supabase, safe_exec, PAGE_SIZE
+from anchors.master_cache import master_rows, master_index, invalidate as invalidate_masters
 
 
 # ======================================================
 # CACHED DATA LOADERS
 # ======================================================
 
-@st.cache_data(ttl=3600)
+# Products / users / stockists come from the process-wide master cache
+# (anchors.master_cache); edits below call invalidate() for just that table.
+
 def load_products_cached():
-    return supabase.table("products") \
-        .select("*") \
-        .order("name") \
-        .execute().data
+    return master_rows("products")
 
 
-@st.cache_data(ttl=3600)
 def load_users_cached():
-    return supabase.table("users") \
-        .select("id, username, role, is_active") \
-        .order("username") \
-        .execute().data
+    return master_rows("users")
 
 
-@st.cache_data(ttl=3600)
 def load_stockists_cached():
-    return supabase.table("stockists") \
-        .select("id, name") \
-        .order("name") \
-        .execute().data
+    return master_rows("stockists")
 
 
-@st.cache_data(ttl=300)
+@st.cache_data(ttl=300, show_spinner=False)
 def load_monthly_summary_cached(stockist_ids):
+    """monthly_summary rows for the stockists, paged past the 1000-row cap.
+    Pass a sorted tuple so the same selection hits the same cache entry."""
     if not stockist_ids:
         return []
-    return admin_supabase.table("monthly_summary") \
-        .select("""
-            year,
-            month,
-            total_issue,
-            total_closing,
-            total_order,
-            products(name),
-            stockist_id
-        """) \
-        .in_("stockist_id", stockist_ids) \
-        .execute().data
+    rows, start = [], 0
+    while True:
+        page = safe_exec(
+            admin_supabase.table("monthly_summary")
+            .select("year, month, total_issue, total_closing, total_order, "
+                    "products(name), stockist_id, product_id")
+            .in_("stockist_id", list(stockist_ids))
+            .order("stockist_id").order("year").order("month").order("product_id")
+            .range(start, start + PAGE_SIZE - 1)
+        ) or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        start += PAGE_SIZE
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def final_statement_snapshot(stockist_id, year=None, month=None):
+    """
+    A stockist's final statement for (year, month) — or its latest final
+    statement when year / month are None — with its product rows, the
+    stock-control matrix (last month's closing from one request, not one
+    per product) and its territory label. None when there is none.
+    """
+    q = admin_supabase.table("statements").select("id, year, month") \
+        .eq("stockist_id", stockist_id).eq("status", "final")
+    if year is not None:
+        q = q.eq("year", year).eq("month", month)
+    stmt = safe_exec(q.order("year", desc=True).order("month", desc=True).limit(1))
+    if not stmt:
+        return None
+    stmt = stmt[0]
+
+    rows = safe_exec(
+        admin_supabase.table("statement_products")
+        .select("opening,purchase,issue,closing,difference,order_qty,issue_guidance,stock_guidance,product_id,products!statement_products_product_id_fkey(name)")
+        .eq("statement_id", stmt["id"])
+    ) or []
+    last = fetch_last_month_all(stockist_id, stmt["year"], stmt["month"])
+    matrix = [{
+        "Product": r["products"]["name"],
+        "Last Month Closing": last.get(r["product_id"], (0, 0))[0],
+        "Opening": r["opening"],
+        "Closing": r["closing"],
+        "Issue Guidance": r["issue_guidance"],
+        "Stock Guidance": r["stock_guidance"],
+        "Order": r["order_qty"],
+        "Difference": r["difference"]
+    } for r in rows]
+
+    territory_rows = safe_exec(
+        supabase.table("territory_stockists").select("territories(name)").eq("stockist_id", stockist_id)
+    ) or []
+    territory_label = ", ".join(sorted(
+        {t["territories"]["name"] for t in territory_rows if t.get("territories")}
+    )) or "—"
+
+    return {"id": stmt["id"], "year": stmt["year"], "month": stmt["month"],
+            "rows": rows, "matrix": matrix, "territory_label": territory_label}
 
 
 # ======================================================
@@ -149,6 +190,42 @@ def fetch_statement_product(statement_id, product_id):
     return rows[0] if rows else {}
 
 
+def fetch_statement_rows(statement_id):
+    """All saved statement_products of a statement as {product_id: row}."""
+    rows = safe_exec(
+        admin_supabase.table("statement_products")
+        .select("*")
+        .eq("statement_id", statement_id)
+    ) or []
+    return {r["product_id"]: r for r in rows}
+
+
+def fetch_last_month_all(stockist_id, year, month):
+    """
+    Whole-statement form of fetch_last_month_data(): {product_id: (closing,
+    issue)} from the previous month's final statement, in one request (the
+    products are embedded in the statements read).
+    """
+    py, pm = get_previous_period(year, month)
+    if py is None or pm is None:
+        return {}
+    stmt = safe_exec(
+        admin_supabase.table("statements")
+        .select("id, statement_products(product_id, closing, issue)")
+        .eq("stockist_id", stockist_id)
+        .eq("year", py)
+        .eq("month", pm)
+        .eq("status", "final")
+        .limit(1)
+    )
+    if not stmt:
+        return {}
+    return {
+        r["product_id"]: (float(r.get("closing") or 0), float(r.get("issue") or 0))
+        for r in stmt[0].get("statement_products") or []
+    }
+
+
 def detect_red_flags(rows):
     overstock, zero_issue, mismatch = [], [], []
     for r in rows:
@@ -453,6 +530,10 @@ def run_statement():
 # PRODUCT ENGINE (edit stage)
 # ======================================================
 
+_GRID_MODE = "📋 Whole statement"
+_STEP_MODE = "➡️ One product at a time"
+
+
 def _run_product_engine(sid, user_id, role):
     idx = st.session_state.get("product_index", 0)
     products = load_products_cached()
@@ -495,6 +576,13 @@ def _run_product_engine(sid, user_id, role):
                 st.success("✅ Statement reset successfully.")
                 st.rerun()
 
+    # Entry mode — whole statement in one grid, or one product per page
+    mode = st.radio("Entry mode", [_GRID_MODE, _STEP_MODE],
+                    horizontal=True, key="statement_entry_mode")
+    if mode == _GRID_MODE:
+        _run_grid_engine(sid, products, stmt_meta)
+        return
+
     # Move to preview if done
     if idx >= len(products):
         st.session_state.engine_stage = "preview"
@@ -591,6 +679,97 @@ def _run_product_engine(sid, user_id, role):
         st.rerun()
 
 
+def _run_grid_engine(sid, products, stmt_meta):
+    """
+    Whole-statement entry: every product in one st.data_editor, prefilled
+    from the saved rows and last month's final statement (two requests),
+    saved with one batched upsert. Closing left blank is saved as the
+    calculated closing, as the one-product form defaults it.
+    """
+    saved = fetch_statement_rows(sid)
+    last = fetch_last_month_all(
+        st.session_state.selected_stockist_id,
+        st.session_state.statement_year,
+        st.session_state.statement_month,
+    )
+
+    st.subheader(f"Statement — {len(products)} products")
+    if stmt_meta.get("last_saved_at"):
+        st.caption(f"💾 Last saved at {stmt_meta['last_saved_at']}")
+    else:
+        st.caption("💾 Not saved yet")
+
+    grid = pd.DataFrame([{
+        "Product": p["name"],
+        "Opening": int(saved.get(p["id"], {}).get("opening", last.get(p["id"], (0, 0))[0])),
+        "Last Month Issue": int(last.get(p["id"], (0, 0))[1]),
+        "Purchase": int(saved.get(p["id"], {}).get("purchase", 0)),
+        "Issue": int(saved.get(p["id"], {}).get("issue", 0)),
+        "Closing": saved[p["id"]].get("closing") if p["id"] in saved else None,
+        "Order": saved.get(p["id"], {}).get("order_qty"),
+        "Issue Guidance": saved.get(p["id"], {}).get("issue_guidance"),
+        "Stock Guidance": saved.get(p["id"], {}).get("stock_guidance"),
+    } for p in products])
+    grid["Closing"] = grid["Closing"].astype("Int64")
+
+    edited = st.data_editor(
+        grid,
+        key=f"stmt_grid_{sid}_{st.session_state.get('stmt_grid_rev', 0)}",
+        hide_index=True,
+        use_container_width=True,
+        num_rows="fixed",
+        disabled=["Product", "Last Month Issue", "Order", "Issue Guidance", "Stock Guidance"],
+        column_config={
+            "Opening":  st.column_config.NumberColumn(step=1, format="%d"),
+            "Purchase": st.column_config.NumberColumn(step=1, format="%d"),
+            "Issue":    st.column_config.NumberColumn(step=1, format="%d"),
+            "Closing":  st.column_config.NumberColumn(
+                step=1, format="%d", help="Leave blank to use Opening + Purchase − Issue"),
+        },
+    )
+
+    opening  = edited["Opening"].fillna(0).astype(int)
+    purchase = edited["Purchase"].fillna(0).astype(int)
+    issue    = edited["Issue"].fillna(0).astype(int)
+    calculated_closing = opening + purchase - issue
+    closing  = edited["Closing"].fillna(calculated_closing).astype(int)
+
+    diff = calculated_closing - closing
+    if (diff != 0).any():
+        st.warning("Difference detected: " + ", ".join(
+            f"{name} ({d:+d})" for name, d in zip(edited["Product"], diff) if d != 0))
+
+    c1, c2 = st.columns(2)
+    save = c1.button("💾 Save Statement", type="primary")
+    to_preview = c2.button("👁 Save & Preview")
+    if save or to_preview:
+        now = datetime.utcnow().isoformat()
+        safe_exec(
+            admin_supabase.table("statement_products").upsert([{
+                "statement_id": sid,
+                "product_id": p["id"],
+                "opening": int(opening.iloc[i]),
+                "last_month_issue": int(last.get(p["id"], (0, 0))[1]),
+                "purchase": int(purchase.iloc[i]),
+                "issue": int(issue.iloc[i]),
+                "closing": int(closing.iloc[i]),
+                "calculated_closing": int(calculated_closing.iloc[i]),
+                "updated_at": now,
+            } for i, p in enumerate(products)], on_conflict="statement_id,product_id")
+        )
+        st.session_state.product_index = len(products)
+        safe_exec(
+            admin_supabase.table("statements")
+            .update({"current_product_index": len(products), "last_saved_at": now})
+            .eq("id", sid)
+        )
+        # Fresh editor so the guidance columns show the server-side values
+        st.session_state.stmt_grid_rev = st.session_state.get("stmt_grid_rev", 0) + 1
+        if to_preview:
+            st.session_state.engine_stage = "preview"
+        st.rerun()
+
+
 # ======================================================
 # PREVIEW / VIEW
 # ======================================================
@@ -661,6 +840,7 @@ def _run_preview(sid, user_id, role):
                 for idx, p in enumerate(safe_exec(supabase.table("products").select("id").order("name")))
             }
             st.session_state.product_index = product_index_map[selected[1]]
+            st.session_state.statement_entry_mode = _STEP_MODE
             st.session_state.engine_stage = "edit"
             st.rerun()
 
@@ -701,6 +881,8 @@ def _run_preview(sid, user_id, role):
                 metadata={"stockist_name": stockist_name, "year": stmt_year, "month": stmt_month}
             )
             safe_exec(admin_supabase.rpc("populate_monthly_summary", {"p_statement_id": sid}))
+            load_monthly_summary_cached.clear()
+            final_statement_snapshot.clear()
             st.success("✅ Statement submitted successfully")
             if st.button("⬅ Back to Dashboard"):
                 for k in ["statement_id", "product_index", "statement_year",
@@ -724,6 +906,8 @@ def _run_preview(sid, user_id, role):
                 performed_by=user_id,
                 message="Admin corrected and finalized a submitted statement"
             )
+            load_monthly_summary_cached.clear()
+            final_statement_snapshot.clear()
             st.success("✅ Admin changes finalized successfully")
             if st.button("⬅ Back to Dashboard"):
                 for k in ["statement_id", "product_index", "statement_year",
@@ -736,362 +920,327 @@ def _run_preview(sid, user_id, role):
 # REPORTS — run_reports()
 # ======================================================
 
+_REPORT_VIEWS = ["📦 Stock Control Reports", "📊 OPS Reports"]
+
+
 def run_reports():
     user_id = st.session_state.auth_user.id
     role = st.session_state.get("role", "user")
 
     st.title("📊 Reports & Matrices")
 
-    # ── Top-level tab split ──────────────────────────────────────
-    tab1, tab2 = st.tabs(["📦 Stock Control Reports", "📊 OPS Reports"])
+    # ── Report selector ──────────────────────────────────────────
+    # Not st.tabs: Streamlit runs every tab body on every rerun, so the
+    # hidden report paid for its queries too. Only the selected one runs.
+    view = st.segmented_control(
+        "Report", _REPORT_VIEWS, default=_REPORT_VIEWS[0],
+        key="reports_view", label_visibility="collapsed",
+    ) or _REPORT_VIEWS[0]
 
-    with tab2:
+    if view == _REPORT_VIEWS[1]:
         from modules.statement.ops_reports import run_ops_reports
         run_ops_reports()
+        return
 
-    with tab1:
-        col1, col2, col3 = st.columns(3)
+    _run_stock_control_reports(user_id, role)
 
-        with col1:
-            if role == "admin":
-                users = supabase.table("users").select("id, username").order("username").execute().data
-                selected_users = st.multiselect("Users", users, default=users, format_func=lambda x: x["username"])
-                visible_user_ids = [u["id"] for u in selected_users]
-            else:
-                _prof = supabase.table("users").select("id, designation").eq("id", user_id).limit(1).execute().data
-                my_profile = _prof[0] if _prof else {}
-                if my_profile.get("designation") in ("manager", "senior_manager"):
-                    reps = supabase.table("users").select("id").eq("report_to", user_id).execute().data
-                    visible_user_ids = [user_id] + [r["id"] for r in reps]
-                else:
-                    visible_user_ids = [user_id]
-                st.text_input("User Scope", value="Auto (Hierarchy Based)", disabled=True)
 
-        with col2:
-            year_from = st.selectbox("Year From", list(range(2020, date.today().year + 1)))
-            month_from = st.selectbox("Month From", list(range(1, 13)))
+def _run_stock_control_reports(user_id, role):
+    col1, col2, col3 = st.columns(3)
 
-        with col3:
-            year_to = st.selectbox("Year To", list(range(2020, date.today().year + 1)))
-            month_to = st.selectbox("Month To", list(range(1, 13)))
+    with col1:
+        if role == "admin":
+            users = [{"id": u["id"], "username": u["username"]} for u in load_users_cached()]
+            selected_users = st.multiselect("Users", users, default=users, format_func=lambda x: x["username"])
+            visible_user_ids = [u["id"] for u in selected_users]
+        else:
+            _prof = supabase.table("users").select("id, designation").eq("id", user_id).limit(1).execute().data
+            my_profile = _prof[0] if _prof else {}
+            if my_profile.get("designation") in ("manager", "senior_manager"):
+                reps = supabase.table("users").select("id").eq("report_to", user_id).execute().data
+                visible_user_ids = [user_id] + [r["id"] for r in reps]
+            else:
+                visible_user_ids = [user_id]
+            st.text_input("User Scope", value="Auto (Hierarchy Based)", disabled=True)
+
+    with col2:
+        year_from = st.selectbox("Year From", list(range(2020, date.today().year + 1)))
+        month_from = st.selectbox("Month From", list(range(1, 13)))
+
+    with col3:
+        year_to = st.selectbox("Year To", list(range(2020, date.today().year + 1)))
+        month_to = st.selectbox("Month To", list(range(1, 13)))
+
+    visible = set(visible_user_ids)
+    stockist_index = master_index("stockists")
+    stockists = [
+        {"id": sid, "name": stockist_index[sid]["name"]}
+        for sid in dict.fromkeys(
+            r["stockist_id"] for r in master_rows("user_stockists") if r["user_id"] in visible
+        )
+        if sid in stockist_index
+    ]
 
-        raw_stockists = supabase.table("user_stockists") \
-            .select("stockist_id, stockists(name)") \
-            .in_("user_id", visible_user_ids) \
-            .execute().data
+    if not stockists:
+        st.warning("No stockists available for your reporting scope")
+        return
 
-        stockists = [{"id": r["stockist_id"], "name": r["stockists"]["name"]} for r in raw_stockists]
+    selected_stockists = st.multiselect("Stockists", stockists, default=stockists, format_func=lambda x: x["name"])
+    stockist_ids = [s["id"] for s in selected_stockists]
 
-        if not stockists:
-            st.warning("No stockists available for your reporting scope")
-            return
+    summary_rows = load_monthly_summary_cached(tuple(sorted(stockist_ids)))
 
-        selected_stockists = st.multiselect("Stockists", stockists, default=stockists, format_func=lambda x: x["name"])
-        stockist_ids = [s["id"] for s in selected_stockists]
+    if not summary_rows:
+        st.info("No data for selected filters")
+        return
 
-        summary_rows = safe_exec(
-            admin_supabase.table("monthly_summary")
-            .select("year, month, total_issue, total_closing, total_order, products(name), stockist_id")
-            .in_("stockist_id", stockist_ids)
-        )
+    df = pd.DataFrame([{
+        "Product": r["products"]["name"],
+        "Year-Month": f"{r['year']}-{r['month']:02d}",
+        "Issue": r["total_issue"],
+        "Closing": r["total_closing"],
+        "Order": r["total_order"]
+    } for r in summary_rows])
+
+    if "drilldown_product" not in st.session_state:
+        st.session_state.drilldown_product = None
+
+    if st.session_state.drilldown_product:
+        df = df[df["Product"] == st.session_state.drilldown_product]
+
+    # Alerts
+    st.subheader("🚨 Alerts Summary")
+    df_sorted = df.sort_values(["Product", "Year-Month"])
+    alert_found = False
+    for product in df_sorted["Product"].unique():
+        df_p = df_sorted[df_sorted["Product"] == product]
+        if len(df_p) < 2:
+            continue
+        latest, previous = df_p.iloc[-1], df_p.iloc[-2]
+        if latest["Issue"] < previous["Issue"]:
+            alert_found = True
+            if st.button(f"🔻 {product}: Issue degrowth", key=f"deg_{product}"):
+                st.session_state.drilldown_product = product
+                st.rerun()
+        if latest["Issue"] > 0 and latest["Closing"] >= 2 * latest["Issue"]:
+            alert_found = True
+            if st.button(f"⚠️ {product}: High closing stock", key=f"stk_{product}"):
+                st.session_state.drilldown_product = product
+                st.rerun()
+        if latest["Issue"] == 0 and latest["Closing"] == 0:
+            alert_found = True
+            if st.button(f"📣 {product}: Promotion needed", key=f"pro_{product}"):
+                st.session_state.drilldown_product = product
+                st.rerun()
+    if not alert_found:
+        st.success("✅ No alerts for selected period")
 
-        if not summary_rows:
-            st.info("No data for selected filters")
-            return
+    if st.session_state.drilldown_product:
+        st.info(f"🔍 Viewing detailed insights for **{st.session_state.drilldown_product}**")
+        if st.button("⬅️ Back to All Products"):
+            st.session_state.drilldown_product = None
+            st.rerun()
 
-        df = pd.DataFrame([{
-            "Product": r["products"]["name"],
-            "Year-Month": f"{r['year']}-{r['month']:02d}",
-            "Issue": r["total_issue"],
-            "Closing": r["total_closing"],
-            "Order": r["total_order"]
-        } for r in summary_rows])
+    # Matrices
+    st.subheader("📦 Stock Control Matrix")
+    stockist_for_matrix = st.selectbox("Select Stockist (Required)", selected_stockists, format_func=lambda x: x["name"])
+    m_year = st.selectbox("Year", sorted(set(df["Year-Month"].str[:4])))
+    m_month = st.selectbox("Month", list(range(1, 13)))
 
-        if "drilldown_product" not in st.session_state:
-            st.session_state.drilldown_product = None
+    if stockist_for_matrix:
+        snap = final_statement_snapshot(stockist_for_matrix["id"], int(m_year), int(m_month))
+        if not snap:
+            st.warning("No final statement for selected period")
+        else:
+            matrix = snap["matrix"]
+            if matrix:
+                _df_mx = pd.DataFrame(matrix).sort_values("Product")
+                _mobile_table(_df_mx, compact_cols=["Product","Closing","Order","Difference"], detail_title_col="Product", uid_prefix="mat_sum")
+            else:
+                st.info("No products in this statement to display.")
 
-        if st.session_state.drilldown_product:
-            df = df[df["Product"] == st.session_state.drilldown_product]
+    st.subheader("📦 Matrix 1 — Product-wise Sales (Issue)")
+    _pv=df.pivot_table(index="Product", columns="Year-Month", values="Issue", aggfunc="sum", fill_value=0).reset_index()
+    _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_issue")
 
-        # Alerts
-        st.subheader("🚨 Alerts Summary")
-        df_sorted = df.sort_values(["Product", "Year-Month"])
-        alert_found = False
-        for product in df_sorted["Product"].unique():
-            df_p = df_sorted[df_sorted["Product"] == product]
-            if len(df_p) < 2:
-                continue
-            latest, previous = df_p.iloc[-1], df_p.iloc[-2]
-            if latest["Issue"] < previous["Issue"]:
-                alert_found = True
-                if st.button(f"🔻 {product}: Issue degrowth", key=f"deg_{product}"):
-                    st.session_state.drilldown_product = product
-                    st.rerun()
-            if latest["Issue"] > 0 and latest["Closing"] >= 2 * latest["Issue"]:
-                alert_found = True
-                if st.button(f"⚠️ {product}: High closing stock", key=f"stk_{product}"):
-                    st.session_state.drilldown_product = product
-                    st.rerun()
-            if latest["Issue"] == 0 and latest["Closing"] == 0:
-                alert_found = True
-                if st.button(f"📣 {product}: Promotion needed", key=f"pro_{product}"):
-                    st.session_state.drilldown_product = product
-                    st.rerun()
-        if not alert_found:
-            st.success("✅ No alerts for selected period")
+    st.subheader("🧾 Matrix 2 — Product-wise Order")
+    _pv=df.pivot_table(index="Product", columns="Year-Month", values="Order", aggfunc="sum", fill_value=0).reset_index()
+    _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_order")
 
-        if st.session_state.drilldown_product:
-            st.info(f"🔍 Viewing detailed insights for **{st.session_state.drilldown_product}**")
-            if st.button("⬅️ Back to All Products"):
-                st.session_state.drilldown_product = None
-                st.rerun()
+    st.subheader("📊 Matrix 3 — Product-wise Closing")
+    _pv=df.pivot_table(index="Product", columns="Year-Month", values="Closing", aggfunc="sum", fill_value=0).reset_index()
+    _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_closing")
 
-        # Matrices
-        st.subheader("📦 Stock Control Matrix")
-        stockist_for_matrix = st.selectbox("Select Stockist (Required)", selected_stockists, format_func=lambda x: x["name"])
-        m_year = st.selectbox("Year", sorted(set(df["Year-Month"].str[:4])))
-        m_month = st.selectbox("Month", list(range(1, 13)))
-
-        if stockist_for_matrix:
-            stmt = safe_exec(
-                admin_supabase.table("statements").select("id")
-                .eq("stockist_id", stockist_for_matrix["id"])
-                .eq("year", int(m_year)).eq("month", int(m_month))
-                .eq("status", "final").limit(1)
-            )
-            if not stmt:
-                st.warning("No final statement for selected period")
+    st.subheader("📦📊 Matrix 4 — Issue & Closing")
+    _pv4=(df.melt(id_vars=["Product", "Year-Month"], value_vars=["Issue", "Closing"]).pivot_table(index="Product", columns=["Year-Month", "variable"], values="value", aggfunc="sum", fill_value=0))
+    _pv4.columns=[" ".join(str(c) for c in col).strip() for col in _pv4.columns]
+    _pv4=_pv4.reset_index()
+    _mobile_table(_pv4, compact_cols=[_pv4.columns[0]]+list(_pv4.columns[1:4]), detail_title_col=_pv4.columns[0], uid_prefix="pv_mix")
+
+    # Trend charts
+    st.subheader("📈 Trend Charts — Last 6 Months")
+    today = date.today()
+    last_6 = []
+    y, m = today.year, today.month
+    for _ in range(6):
+        last_6.append(f"{y}-{m:02d}")
+        m -= 1
+        if m == 0:
+            m = 12
+            y -= 1
+
+    df_trend = df[df["Year-Month"].isin(last_6)]
+    if df_trend.empty:
+        st.info("No trend data available for last 6 months")
+    else:
+        trend_products = sorted(df_trend["Product"].unique())
+        default_index = 0
+        if st.session_state.get("drilldown_product") in trend_products:
+            default_index = trend_products.index(st.session_state.drilldown_product)
+        trend_product = st.selectbox("Select Product for Trend", trend_products, index=default_index)
+        chart_df = (
+            df_trend[df_trend["Product"] == trend_product]
+            .sort_values("Year-Month")
+            .set_index("Year-Month")[["Issue", "Closing"]]
+        )
+        st.line_chart(chart_df)
+
+    # Forecast
+    st.subheader("🔮 Forecast — Next 3 Months")
+    products_master = [p for p in load_products_cached() if "peak_months" in p]
+    forecast_rows = []
+    for p in products_master:
+        df_p = df[df["Product"] == p["name"]]
+        if df_p.empty:
+            continue
+        last_issue = df_p.sort_values("Year-Month").iloc[-1]["Issue"]
+        fy, fm = today.year, today.month + 1
+        if fm == 13:
+            fm = 1
+            fy += 1
+        for _ in range(3):
+            if fm in (p.get("peak_months") or []):
+                factor = 2
+            elif fm in (p.get("high_months") or []):
+                factor = 1.5
+            elif fm in (p.get("lowest_months") or []):
+                factor = 0.8
             else:
-                stmt_id = stmt[0]["id"]
-                rows = safe_exec(
-                    admin_supabase.table("statement_products")
-                    .select("opening,purchase,issue,closing,difference,order_qty,issue_guidance,stock_guidance,product_id,products!statement_products_product_id_fkey(name)")
-                    .eq("statement_id", stmt_id)
-                )
-                matrix = []
-                for r in rows:
-                    last_closing = fetch_last_month_closing_only(stockist_for_matrix["id"], r["product_id"], int(m_year), int(m_month))
-                    matrix.append({
-                        "Product": r["products"]["name"],
-                        "Last Month Closing": last_closing,
-                        "Opening": r["opening"],
-                        "Closing": r["closing"],
-                        "Issue Guidance": r["issue_guidance"],
-                        "Stock Guidance": r["stock_guidance"],
-                        "Order": r["order_qty"],
-                        "Difference": r["difference"]
-                    })
-                if matrix:
-                    _df_mx = pd.DataFrame(matrix).sort_values("Product")
-                    _mobile_table(_df_mx, compact_cols=["Product","Closing","Order","Difference"], detail_title_col="Product", uid_prefix="mat_sum")
-                else:
-                    st.info("No products in this statement to display.")
-
-        st.subheader("📦 Matrix 1 — Product-wise Sales (Issue)")
-        _pv=df.pivot_table(index="Product", columns="Year-Month", values="Issue", aggfunc="sum", fill_value=0).reset_index()
-        _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_issue")
-
-        st.subheader("🧾 Matrix 2 — Product-wise Order")
-        _pv=df.pivot_table(index="Product", columns="Year-Month", values="Order", aggfunc="sum", fill_value=0).reset_index()
-        _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_order")
-
-        st.subheader("📊 Matrix 3 — Product-wise Closing")
-        _pv=df.pivot_table(index="Product", columns="Year-Month", values="Closing", aggfunc="sum", fill_value=0).reset_index()
-        _mobile_table(_pv, compact_cols=[_pv.columns[0]]+list(_pv.columns[1:4]), detail_title_col=_pv.columns[0], uid_prefix="pv_closing")
-
-        st.subheader("📦📊 Matrix 4 — Issue & Closing")
-        _pv4=(df.melt(id_vars=["Product", "Year-Month"], value_vars=["Issue", "Closing"]).pivot_table(index="Product", columns=["Year-Month", "variable"], values="value", aggfunc="sum", fill_value=0))
-        _pv4.columns=[" ".join(str(c) for c in col).strip() for col in _pv4.columns]
-        _pv4=_pv4.reset_index()
-        _mobile_table(_pv4, compact_cols=[_pv4.columns[0]]+list(_pv4.columns[1:4]), detail_title_col=_pv4.columns[0], uid_prefix="pv_mix")
-
-        # Trend charts
-        st.subheader("📈 Trend Charts — Last 6 Months")
-        today = date.today()
-        last_6 = []
-        y, m = today.year, today.month
-        for _ in range(6):
-            last_6.append(f"{y}-{m:02d}")
-            m -= 1
-            if m == 0:
-                m = 12
-                y -= 1
-
-        df_trend = df[df["Year-Month"].isin(last_6)]
-        if df_trend.empty:
-            st.info("No trend data available for last 6 months")
-        else:
-            trend_products = sorted(df_trend["Product"].unique())
-            default_index = 0
-            if st.session_state.get("drilldown_product") in trend_products:
-                default_index = trend_products.index(st.session_state.drilldown_product)
-            trend_product = st.selectbox("Select Product for Trend", trend_products, index=default_index)
-            chart_df = (
-                df_trend[df_trend["Product"] == trend_product]
-                .sort_values("Year-Month")
-                .set_index("Year-Month")[["Issue", "Closing"]]
-            )
-            st.line_chart(chart_df)
-
-        # Forecast
-        st.subheader("🔮 Forecast — Next 3 Months")
-        products_master = [p for p in load_products_cached() if "peak_months" in p]
-        forecast_rows = []
-        for p in products_master:
-            df_p = df[df["Product"] == p["name"]]
-            if df_p.empty:
-                continue
-            last_issue = df_p.sort_values("Year-Month").iloc[-1]["Issue"]
-            fy, fm = today.year, today.month + 1
+                factor = 1
+            forecast_rows.append({"Product": p["name"], "Forecast Month": f"{fy}-{fm:02d}", "Forecast Issue": round(last_issue * factor, 2)})
+            fm += 1
             if fm == 13:
                 fm = 1
                 fy += 1
-            for _ in range(3):
-                if fm in (p.get("peak_months") or []):
-                    factor = 2
-                elif fm in (p.get("high_months") or []):
-                    factor = 1.5
-                elif fm in (p.get("lowest_months") or []):
-                    factor = 0.8
-                else:
-                    factor = 1
-                forecast_rows.append({"Product": p["name"], "Forecast Month": f"{fy}-{fm:02d}", "Forecast Issue": round(last_issue * factor, 2)})
-                fm += 1
-                if fm == 13:
-                    fm = 1
-                    fy += 1
-
-        if forecast_rows:
-            _fc=pd.DataFrame(forecast_rows).pivot_table(index="Product", columns="Forecast Month", values="Forecast Issue", fill_value=0).reset_index()
-            _mobile_table(_fc, compact_cols=[_fc.columns[0]]+list(_fc.columns[1:4]), detail_title_col=_fc.columns[0], uid_prefix="fc_pivot")
-        else:
-            st.info("Forecast not available for selected filters")
-
-        # KPI
-        st.subheader("📊 KPI — Month-on-Month")
-        kpi_df = df.groupby("Year-Month", as_index=False).agg({"Issue": "sum"}).sort_values("Year-Month")
-        if len(kpi_df) >= 2:
-            cur, prev = kpi_df.iloc[-1], kpi_df.iloc[-2]
-            mom = cur["Issue"] - prev["Issue"]
-            pct = (mom / prev["Issue"] * 100) if prev["Issue"] else 0
-            c1, c2, c3 = st.columns(3)
-            c1.metric("Current Issue", round(cur["Issue"], 2))
-            c2.metric("MoM Change", round(mom, 2), round(mom, 2))
-            c3.metric("Growth %", f"{round(pct, 2)}%", f"{round(pct, 2)}%")
-        else:
-            st.info("Not enough data for KPI")
-
-        # Product KPI
-        st.subheader("📊 Product-level KPI Cards")
-        product_list = sorted(df["Product"].unique())
-        selected_product = st.selectbox("Select Product", product_list)
-        df_p = df[df["Product"] == selected_product].groupby("Year-Month", as_index=False).agg({"Issue": "sum"}).sort_values("Year-Month")
-        if len(df_p) >= 2:
-            latest, previous = df_p.iloc[-1], df_p.iloc[-2]
-            mom = latest["Issue"] - previous["Issue"]
-            pct = (mom / previous["Issue"] * 100) if previous["Issue"] else 0
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("Latest Issue", round(latest["Issue"], 2))
-            c2.metric("Previous Issue", round(previous["Issue"], 2))
-            c3.metric("MoM Change", round(mom, 2), round(mom, 2))
-            c4.metric("Growth %", f"{round(pct, 2)}%", f"{round(pct, 2)}%")
-        else:
-            st.info("Not enough data for product KPI")
 
-        # Authorized stockists panel
-        st.divider()
-        st.title("🏪 Authorized Stockists — Last Submitted Stock Control")
-        if role == "admin":
-            authorized_stockists = safe_exec(
-                supabase.table("stockists").select("id, name").eq("authorization_status", "AUTHORIZED").order("name")
-            )
-        else:
-            scoped = safe_exec(
-                supabase.table("user_stockists")
-                .select("stockist_id, stockists(id, name, authorization_status)")
-                .in_("user_id", visible_user_ids)
-            )
-            authorized_stockists = list({
-                r["stockists"]["id"]: {"id": r["stockists"]["id"], "name": r["stockists"]["name"]}
-                for r in scoped
-                if r["stockists"]["authorization_status"] == "AUTHORIZED"
-            }.values())
-
-        if not authorized_stockists:
-            st.info("No authorized stockists found.")
-            return
+    if forecast_rows:
+        _fc=pd.DataFrame(forecast_rows).pivot_table(index="Product", columns="Forecast Month", values="Forecast Issue", fill_value=0).reset_index()
+        _mobile_table(_fc, compact_cols=[_fc.columns[0]]+list(_fc.columns[1:4]), detail_title_col=_fc.columns[0], uid_prefix="fc_pivot")
+    else:
+        st.info("Forecast not available for selected filters")
+
+    # KPI
+    st.subheader("📊 KPI — Month-on-Month")
+    kpi_df = df.groupby("Year-Month", as_index=False).agg({"Issue": "sum"}).sort_values("Year-Month")
+    if len(kpi_df) >= 2:
+        cur, prev = kpi_df.iloc[-1], kpi_df.iloc[-2]
+        mom = cur["Issue"] - prev["Issue"]
+        pct = (mom / prev["Issue"] * 100) if prev["Issue"] else 0
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Current Issue", round(cur["Issue"], 2))
+        c2.metric("MoM Change", round(mom, 2), round(mom, 2))
+        c3.metric("Growth %", f"{round(pct, 2)}%", f"{round(pct, 2)}%")
+    else:
+        st.info("Not enough data for KPI")
+
+    # Product KPI
+    st.subheader("📊 Product-level KPI Cards")
+    product_list = sorted(df["Product"].unique())
+    selected_product = st.selectbox("Select Product", product_list)
+    df_p = df[df["Product"] == selected_product].groupby("Year-Month", as_index=False).agg({"Issue": "sum"}).sort_values("Year-Month")
+    if len(df_p) >= 2:
+        latest, previous = df_p.iloc[-1], df_p.iloc[-2]
+        mom = latest["Issue"] - previous["Issue"]
+        pct = (mom / previous["Issue"] * 100) if previous["Issue"] else 0
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Latest Issue", round(latest["Issue"], 2))
+        c2.metric("Previous Issue", round(previous["Issue"], 2))
+        c3.metric("MoM Change", round(mom, 2), round(mom, 2))
+        c4.metric("Growth %", f"{round(pct, 2)}%", f"{round(pct, 2)}%")
+    else:
+        st.info("Not enough data for product KPI")
 
-        for stockist in authorized_stockists:
-            stockist_id = stockist["id"]
-            last_stmt = safe_exec(
-                admin_supabase.table("statements").select("id, year, month")
-                .eq("stockist_id", stockist_id).eq("status", "final")
-                .order("year", desc=True).order("month", desc=True).limit(1)
-            )
-            if not last_stmt:
-                continue
+    # Authorized stockists panel
+    st.divider()
+    st.title("🏪 Authorized Stockists — Last Submitted Stock Control")
+    if role == "admin":
+        authorized_stockists = safe_exec(
+            supabase.table("stockists").select("id, name").eq("authorization_status", "AUTHORIZED").order("name")
+        )
+    else:
+        scoped = safe_exec(
+            supabase.table("user_stockists")
+            .select("stockist_id, stockists(id, name, authorization_status)")
+            .in_("user_id", visible_user_ids)
+        )
+        authorized_stockists = list({
+            r["stockists"]["id"]: {"id": r["stockists"]["id"], "name": r["stockists"]["name"]}
+            for r in scoped
+            if r["stockists"]["authorization_status"] == "AUTHORIZED"
+        }.values())
+
+    if not authorized_stockists:
+        st.info("No authorized stockists found.")
+        return
 
-            stmt_id, stmt_year, stmt_month = last_stmt[0]["id"], last_stmt[0]["year"], last_stmt[0]["month"]
-            territory_rows = safe_exec(
-                supabase.table("territory_stockists").select("territories(name)").eq("stockist_id", stockist_id)
-            )
-            territory_label = ", ".join(sorted({t["territories"]["name"] for t in territory_rows if t.get("territories")})) or "—"
+    for stockist in authorized_stockists:
+        stockist_id = stockist["id"]
+        snap = final_statement_snapshot(stockist_id)
+        if not snap:
+            continue
 
-            st.subheader(f"🏪 {stockist['name']}")
-            st.caption(f"📍 Territory: {territory_label}  |  🗓 Last Submitted: {stmt_month:02d}/{stmt_year}")
+        stmt_year, stmt_month = snap["year"], snap["month"]
+        territory_label = snap["territory_label"]
 
-            rows = safe_exec(
-                admin_supabase.table("statement_products")
-                .select("opening,issue,closing,difference,order_qty,issue_guidance,stock_guidance,product_id,products!statement_products_product_id_fkey(name)")
-                .eq("statement_id", stmt_id)
-            )
-            if not rows:
-                st.warning("No product data found for this statement.")
-                continue
+        st.subheader(f"🏪 {stockist['name']}")
+        st.caption(f"📍 Territory: {territory_label}  |  🗓 Last Submitted: {stmt_month:02d}/{stmt_year}")
 
-            flags = detect_red_flags(rows)
-            if any(flags.values()):
-                st.error("🔴 Red Flags Detected")
-                if flags["overstock"]:
-                    st.markdown(f"• **Overstock ({len(flags['overstock'])})**: {', '.join(flags['overstock'])}")
-                if flags["zero_issue"]:
-                    st.markdown(f"• **Zero Issue ({len(flags['zero_issue'])})**: {', '.join(flags['zero_issue'])}")
-                if flags["mismatch"]:
-                    st.markdown(f"• **Data Mismatch ({len(flags['mismatch'])})**: {', '.join(flags['mismatch'])}")
-            else:
-                st.success("🟢 No red flags detected")
-
-            overstock_count = len(flags["overstock"])
-            zero_issue_count = len(flags["zero_issue"])
-            st.info("🧠 AI Summary")
-            if overstock_count == 0 and zero_issue_count == 0:
-                summary = f"{stockist['name']}'s last submitted statement ({stmt_month:02d}/{stmt_year}) shows a stable stock position."
-            elif overstock_count > 0:
-                summary = f"{stockist['name']}'s latest statement indicates overstocking in {overstock_count} product(s)."
-            elif zero_issue_count > 0:
-                summary = f"Several products show zero issue despite available stock in {stockist['name']}'s latest statement."
-            else:
-                summary = f"Data inconsistencies present in the latest statement ({stmt_month:02d}/{stmt_year}). Review recommended."
-            st.markdown(summary)
-
-            matrix = []
-            for r in rows:
-                last_closing = fetch_last_month_closing_only(stockist_id, r["product_id"], stmt_year, stmt_month)
-                matrix.append({
-                    "Product": r["products"]["name"],
-                    "Last Month Closing": last_closing,
-                    "Opening": r["opening"],
-                    "Closing": r["closing"],
-                    "Issue Guidance": r["issue_guidance"],
-                    "Stock Guidance": r["stock_guidance"],
-                    "Order": r["order_qty"],
-                    "Difference": r["difference"]
-                })
-            if matrix:
-                _df_mx = pd.DataFrame(matrix).sort_values("Product")
-                _mobile_table(_df_mx, compact_cols=["Product","Closing","Order","Difference"], detail_title_col="Product", uid_prefix=f"mat_sum_{stockist_id}")
-            else:
-                st.info("No products in this statement to display.")
+        rows = snap["rows"]
+        if not rows:
+            st.warning("No product data found for this statement.")
+            continue
+
+        flags = detect_red_flags(rows)
+        if any(flags.values()):
+            st.error("🔴 Red Flags Detected")
+            if flags["overstock"]:
+                st.markdown(f"• **Overstock ({len(flags['overstock'])})**: {', '.join(flags['overstock'])}")
+            if flags["zero_issue"]:
+                st.markdown(f"• **Zero Issue ({len(flags['zero_issue'])})**: {', '.join(flags['zero_issue'])}")
+            if flags["mismatch"]:
+                st.markdown(f"• **Data Mismatch ({len(flags['mismatch'])})**: {', '.join(flags['mismatch'])}")
+        else:
+            st.success("🟢 No red flags detected")
+
+        overstock_count = len(flags["overstock"])
+        zero_issue_count = len(flags["zero_issue"])
+        st.info("🧠 AI Summary")
+        if overstock_count == 0 and zero_issue_count == 0:
+            summary = f"{stockist['name']}'s last submitted statement ({stmt_month:02d}/{stmt_year}) shows a stable stock position."
+        elif overstock_count > 0:
+            summary = f"{stockist['name']}'s latest statement indicates overstocking in {overstock_count} product(s)."
+        elif zero_issue_count > 0:
+            summary = f"Several products show zero issue despite available stock in {stockist['name']}'s latest statement."
+        else:
+            summary = f"Data inconsistencies present in the latest statement ({stmt_month:02d}/{stmt_year}). Review recommended."
+        st.markdown(summary)
+
+        matrix = snap["matrix"]
+        if matrix:
+            _df_mx = pd.DataFrame(matrix).sort_values("Product")
+            _mobile_table(_df_mx, compact_cols=["Product","Closing","Order","Difference"], detail_title_col="Product", uid_prefix=f"mat_sum_{stockist_id}")
+        else:
+            st.info("No products in this statement to display.")
 
 
 # ======================================================
@@ -1203,7 +1352,7 @@ def run_admin_panel():
         report_to = st.selectbox("Reports To", manager_options, format_func=lambda x: x["username"], index=default_index)
         phone = st.text_input("Phone Number", value=user.get("phone") or "")
         email = st.text_input("Email ID", value=user.get("email") or "")
-        all_stockists = supabase.table("stockists").select("id, name").order("name").execute().data
+        all_stockists = load_stockists_cached()
         assigned = supabase.table("user_stockists").select("stockist_id").eq("user_id", user["id"]).execute().data
         assigned_ids = [a["stockist_id"] for a in assigned]
         selected_stockists = st.multiselect("Assigned Stockists", all_stockists,
@@ -1218,6 +1367,7 @@ def run_admin_panel():
             supabase.table("user_stockists").delete().eq("user_id", user["id"]).execute()
             for s in selected_stockists:
                 supabase.table("user_stockists").insert({"user_id": user["id"], "stockist_id": s["id"]}).execute()
+            invalidate_masters("users", "user_stockists")
             log_audit(action="update_user", target_type="user", target_id=user["id"], performed_by=user_id,
                       message=f"User '{user['username']}' updated",
                       metadata={"is_active": is_active, "assigned_stockists": [s["name"] for s in selected_stockists]})
@@ -1232,6 +1382,7 @@ def run_admin_panel():
             email = f"{username}@internal.local"
             auth_user = admin_supabase.auth.admin.create_user({"email": email, "password": password, "email_confirm": True})
             supabase.table("users").insert({"id": auth_user.user.id, "username": username, "role": "user", "is_active": True}).execute()
+            invalidate_masters("users")
             st.success("User created successfully")
 
     # ── STOCKISTS ──────────────────────────────────────────────
@@ -1262,7 +1413,7 @@ def run_admin_panel():
             }).execute()
             log_audit(action="create_stockist", target_type="stockist", performed_by=user_id,
                       message=f"Stockist '{name.strip()}' created")
-            st.cache_data.clear()
+            invalidate_masters("stockists")
             st.success("Stockist added successfully")
             st.rerun()
 
@@ -1298,7 +1449,7 @@ def run_admin_panel():
                 "payment_terms": edit_payment_terms or None, "remarks": edit_remarks.strip() or None,
                 "authorization_status": edit_auth, "otp_required": edit_otp == "OTP NECESSARY"
             }).eq("id", stockist["id"]).execute()
-            st.cache_data.clear()
+            invalidate_masters("stockists")
             st.success("Stockist updated successfully")
             st.rerun()
 
@@ -1313,7 +1464,7 @@ def run_admin_panel():
                 st.error("❌ Stockist is assigned to users — unassign users first")
             else:
                 supabase.table("stockists").delete().eq("id", stockist["id"]).execute()
-                st.cache_data.clear()
+                invalidate_masters("stockists")
                 st.success("✅ Stockist deleted successfully")
                 st.rerun()
 
@@ -1331,7 +1482,8 @@ def run_admin_panel():
                 "name": name.strip(), "composition": composition.strip(),
                 "peak_months": peak, "high_months": high, "low_months": low, "lowest_months": lowest
             }).execute()
-            st.cache_data.clear()
+            invalidate_masters("products")
+            load_monthly_summary_cached.clear()
             st.success("Product added")
             st.rerun()
         st.divider()
@@ -1341,7 +1493,8 @@ def run_admin_panel():
         edit_composition = st.text_area("Composition", value=product.get("composition") or "medicine")
         if st.button("Update Product"):
             supabase.table("products").update({"name": edit_name.strip(), "composition": edit_composition.strip()}).eq("id", product["id"]).execute()
-            st.cache_data.clear()
+            invalidate_masters("products")
+            load_monthly_summary_cached.clear()
             st.success("Product updated")
             st.rerun()
         if st.button("Delete Product"):
@@ -1350,7 +1503,8 @@ def run_admin_panel():
                 st.error("Product used in statements")
             else:
                 supabase.table("products").delete().eq("id", product["id"]).execute()
-                st.cache_data.clear()
+                invalidate_masters("products")
+                load_monthly_summary_cached.clear()
                 st.success("Product deleted")
                 st.rerun()
 
@@ -1366,6 +1520,7 @@ def run_admin_panel():
                 st.error("Territory name is required")
                 return
             supabase.table("territories").insert({"name": t_name.strip(), "description": t_desc.strip() or None, "is_active": t_active, "created_by": user_id}).execute()
+            invalidate_masters("territories")
             log_audit(action="create_territory", target_type="territory", performed_by=user_id, message=f"Territory '{t_name.strip()}' created")
             st.success("Territory created")
             st.rerun()
@@ -1385,6 +1540,7 @@ def run_admin_panel():
                 "name": edit_name.strip(), "description": edit_desc.strip() or None,
                 "is_active": edit_active, "updated_at": datetime.utcnow().isoformat()
             }).eq("id", territory["id"]).execute()
+            invalidate_masters("territories")
             log_audit(action="update_territory", target_type="territory", target_id=territory["id"], performed_by=user_id, message=f"Territory '{edit_name.strip()}' updated")
             st.success("Territory updated")
             st.rerun()
@@ -1399,6 +1555,7 @@ def run_admin_panel():
             supabase.table("user_territories").delete().eq("territory_id", territory["id"]).execute()
             for u in selected_users:
                 supabase.table("user_territories").insert({"territory_id": territory["id"], "user_id": u["id"], "assigned_by": user_id}).execute()
+            invalidate_masters("user_territories")
             st.success("Users assigned")
 
         st.divider()